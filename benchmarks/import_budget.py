@@ -0,0 +1,89 @@
+"""冷启动导入耗时预算检查。
+
+在全新的子进程中导入 `web.app`，统计总耗时，并确认 LLM 提供商与 LangGraph 等
+重量级模块没有被提前导入。超出预算或出现提前导入时以非零退出码结束。
+
+用法：
+    python -m benchmarks.import_budget [--budget 1.5] [--runs 3] [--module web.app]
+"""
+
+from __future__ import annotations
+
+import argparse
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+BASE_DIR = Path(__file__).resolve().parents[1]
+
+# 这些模块应当在首次使用时才导入，导入 web.app 时不应出现
+LAZY_MODULES = (
+    "langchain_openai",
+    "langchain_anthropic",
+    "langchain_google_genai",
+    "langgraph",
+)
+
+
+def measure_import(module: str) -> tuple[float, set[str]]:
+    """在子进程中导入 module，返回 (耗时秒数, 已导入的受检模块集合)。"""
+    code = (
+        "import sys, time\n"
+        "t0 = time.perf_counter()\n"
+        f"import {module}\n"
+        "elapsed = time.perf_counter() - t0\n"
+        f"lazy = {LAZY_MODULES!r}\n"
+        "loaded = sorted(m for m in lazy if m in sys.modules)\n"
+        "print(elapsed)\n"
+        "print(','.join(loaded))\n"
+    )
+    proc = subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=str(BASE_DIR),
+        capture_output=True,
+        text=True,
+        timeout=120,
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f"导入 {module} 失败：\n{proc.stderr}")
+    lines = proc.stdout.strip().splitlines()
+    elapsed = float(lines[0])
+    loaded = {m for m in (lines[1].split(",") if len(lines) > 1 else []) if m}
+    return elapsed, loaded
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="web.app 冷启动导入耗时预算检查")
+    parser.add_argument("--module", default="web.app", help="要检查的模块（默认 web.app）")
+    parser.add_argument("--budget", type=float, default=1.5, help="导入耗时预算（秒，取多次运行的最小值比较）")
+    parser.add_argument("--runs", type=int, default=3, help="运行次数")
+    ns = parser.parse_args()
+
+    timings: list[float] = []
+    eager: set[str] = set()
+    started = time.perf_counter()
+    for _ in range(max(ns.runs, 1)):
+        elapsed, loaded = measure_import(ns.module)
+        timings.append(elapsed)
+        eager |= loaded
+    best = min(timings)
+    print(
+        f"import {ns.module}: best={best:.3f}s worst={max(timings):.3f}s "
+        f"budget={ns.budget:.3f}s runs={len(timings)} total={time.perf_counter() - started:.1f}s"
+    )
+
+    ok = True
+    if best > ns.budget:
+        print(f"FAIL: 导入耗时 {best:.3f}s 超出预算 {ns.budget:.3f}s")
+        ok = False
+    if eager:
+        print(f"FAIL: 以下模块应按需导入，但在导入 {ns.module} 时已被加载: {', '.join(sorted(eager))}")
+        ok = False
+    if ok:
+        print("OK")
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
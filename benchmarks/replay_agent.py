@@ -0,0 +1,80 @@
+"""用录制带重现完整的 Agent 运行：回归对比与性能测量。
+
+录制一次真实运行（执行 Nmap、调用 LLM），写入录制带：
+    python -m benchmarks.replay_agent --record data/run.jsonl.gz --target 10.0.0.5 [--goal ...] [--args "-sV -Pn"]
+
+回放（不联网、不启动进程）；--speed 0 尽快完成，1 按录制速度：
+    python -m benchmarks.replay_agent --replay data/run.jsonl.gz --target 10.0.0.5 [--speed 0] [--runs 5]
+
+每次运行输出耗时与结果指纹（侦察结果、分析、决策的哈希），多次回放指纹一致说明结果可复现；
+改动解析器或提示词后与改动前的指纹 / 耗时对比即可。回放中出现录制带里没有的调用时以非零退出码结束。
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import hashlib
+import sys
+import time
+
+from core.cassette import CassetteMissError, use_cassette
+
+
+def fingerprint(state: dict) -> str:
+    """结果指纹：侦察结果、分析与决策文本的哈希（前 12 位）。"""
+    parts = [str(state.get(k) or "") for k in ("recon_result", "analysis", "decision")]
+    return hashlib.sha1("\x00".join(parts).encode("utf-8")).hexdigest()[:12]
+
+
+async def run_once(goal: str, target: str, arguments: str) -> tuple[float, dict]:
+    from core.agent import create_kali_agent
+
+    agent = create_kali_agent()
+    started = time.perf_counter()
+    state = await agent.ainvoke({"goal": goal, "target": target, "nmap_arguments": arguments})
+    return time.perf_counter() - started, state
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="录制 / 回放一次完整的 Agent 运行")
+    mode = parser.add_mutually_exclusive_group(required=True)
+    mode.add_argument("--record", metavar="PATH", help="真实运行并写入录制带")
+    mode.add_argument("--replay", metavar="PATH", help="从录制带回放")
+    parser.add_argument("--target", required=True, help="扫描目标（与录制时一致）")
+    parser.add_argument("--goal", default="", help="任务目标（默认：对目标进行信息收集与分析）")
+    parser.add_argument("--args", default="-sV -Pn", help="Nmap 参数（与录制时一致）")
+    parser.add_argument("--speed", type=float, default=0.0, help="回放速度倍数，0 为尽快完成（默认 0）")
+    parser.add_argument("--runs", type=int, default=1, help="回放次数")
+    ns = parser.parse_args()
+
+    goal = ns.goal or f"对 {ns.target} 进行信息收集与分析"
+    path = ns.record or ns.replay
+    runs = 1 if ns.record else max(ns.runs, 1)
+    timings: list[float] = []
+    prints: set[str] = set()
+    for i in range(runs):
+        with use_cassette(path, "record" if ns.record else "replay", speed=ns.speed) as cassette:
+            try:
+                elapsed, state = asyncio.run(run_once(goal, ns.target, ns.args))
+            except CassetteMissError as exc:
+                print(f"FAIL: {exc}")
+                return 1
+            stats = cassette.snapshot()
+        timings.append(elapsed)
+        prints.add(fingerprint(state))
+        print(
+            f"run {i + 1}: {elapsed:.3f}s fingerprint={fingerprint(state)} "
+            f"recorded={stats['recorded']} exact={stats['exact']} fuzzy={stats['fuzzy']} repeated={stats['repeated']}"
+        )
+    if len(timings) > 1:
+        print(f"best={min(timings):.3f}s worst={max(timings):.3f}s runs={len(timings)}")
+    if len(prints) > 1:
+        print("FAIL: 多次回放的结果不一致")
+        return 1
+    print("OK")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
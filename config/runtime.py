@@ -9,6 +9,8 @@ from pathlib import Path
 _ROOT = Path(__file__).resolve().parents[1]
 _RUNTIME_FILE = _ROOT / "config" / "runtime_settings.json"
 
+SANDBOX_MODES = ("local", "docker", "distributed")
+
 
 def load_runtime_settings() -> dict:
     """读取 Web UI 保存的配置。若文件不存在或为空则返回空 dict。"""
@@ -42,10 +44,10 @@ def get_effective_llm_config() -> tuple[str | None, str | None]:
 
 
 def get_effective_sandbox_mode() -> str:
-    """返回当前生效的沙箱模式：local 或 docker。"""
+    """返回当前生效的沙箱模式：local、docker 或 distributed。"""
     from config.settings import settings
     runtime = load_runtime_settings()
     mode = (runtime.get("sandbox_mode") or "").strip().lower()
-    if mode in ("local", "docker"):
+    if mode in SANDBOX_MODES:
         return mode
     return (settings.sandbox_mode or "local").strip().lower() or "local"
@@ -29,6 +29,32 @@ class Settings(BaseSettings):
         default=None, description="DeepSeek API Key（可选，OpenAI 兼容接口）"
     )
 
+    llm_router: bool = Field(
+        default=True,
+        description="配置了多个提供商的 Key 时启用路由：出错或超时自动切换到下一个提供商",
+    )
+    llm_timeout: float = Field(
+        default=60.0,
+        description="单个提供商单次调用的超时（秒），超时后切换到下一个提供商",
+    )
+    llm_hedge: bool = Field(
+        default=False,
+        description="对冲请求：首个提供商超过其 p95 延迟仍未返回时，向下一个提供商并发再请求一次（会增加调用量）",
+    )
+    llm_cooldown_seconds: float = Field(
+        default=60.0,
+        description="提供商连续失败 3 次后的冷却时间（秒），冷却期间排在最后",
+    )
+
+    speculative_analysis: bool = Field(
+        default=False,
+        description="侦察期间对已发现的端口推测式地提前做 LLM 分析，扫描结束后对账（会增加 LLM 调用量，Nmap 自动加 -v）",
+    )
+    speculative_interval: float = Field(
+        default=15.0,
+        description="推测式分析两轮之间的最小间隔（秒），期间的新发现合并到下一轮",
+    )
+
     kali_image: str = Field(
         default="kalilinux/kali-rolling",
         description="Kali Linux Docker 镜像名",
@@ -41,13 +67,253 @@ class Settings(BaseSettings):
         default=True,
         description="容器退出后是否自动删除",
     )
+    recon_tcp_timeout: int = Field(
+        default=300,
+        description="侦察 TCP 服务扫描分支（用户指定的 Nmap 参数）的超时（秒）",
+    )
+    recon_udp: bool = Field(
+        default=True,
+        description="侦察时并行运行 UDP 常见端口扫描分支（需 root 或 nmap 具备原始套接字权限）",
+    )
+    recon_udp_arguments: str = Field(
+        default="-sU --top-ports 50 -Pn -T4",
+        description="UDP 分支的 Nmap 参数",
+    )
+    recon_udp_timeout: int = Field(
+        default=240,
+        description="UDP 分支超时（秒），超时时保留已得到的部分结果",
+    )
+    recon_scripts: bool = Field(
+        default=False,
+        description="侦察时并行运行 NSE 默认脚本扫描分支",
+    )
+    recon_script_arguments: str = Field(
+        default="-sC -Pn",
+        description="脚本扫描分支的 Nmap 参数",
+    )
+    recon_script_timeout: int = Field(
+        default=300,
+        description="脚本扫描分支超时（秒）",
+    )
+    scan_coalesce: bool = Field(
+        default=True,
+        description="合并同时进行的相同 Nmap 扫描：参数相同、目标相同或网段重叠时复用进行中的扫描，不重复探测同一主机",
+    )
+    scan_coalesce_max_hosts: int = Field(
+        default=4096,
+        description="按主机计算网段重叠的最大网段大小（地址数，默认到 /20），更大的网段只合并完全相同的请求",
+    )
+    scan_checkpoint: bool = Field(
+        default=True,
+        description="本机 Nmap 扫描写入检查点：超时或取消后再次发起相同的扫描时用 nmap --resume 从中断处继续，并与之前的结果合并",
+    )
+    scan_checkpoint_dir: str = Field(
+        default="data/scan_checkpoints",
+        description="扫描检查点目录（相对项目根目录）",
+    )
+    scan_checkpoint_ttl: float = Field(
+        default=86400.0,
+        description="检查点有效期（秒）：超过后不再续扫，重新扫描",
+    )
+    sqlmap_output_dir: str = Field(
+        default="data/sqlmap",
+        description="sqlmap 会话目录（--output-dir，相对项目根目录）：每个目标一个子目录，再次利用同一目标时复用其会话与缓存",
+    )
+    sqlmap_timeout: int = Field(
+        default=1800,
+        description="单次 sqlmap 运行超时（秒）；利用以后台任务执行，超时后再次执行从会话继续",
+    )
+    sqlmap_reuse: bool = Field(
+        default=True,
+        description="按 URL 与参数复用已有的 sqlmap 结果：已测试过的参数不再重复测试，全部测试过且只做探测时直接返回记录",
+    )
+    exploit_job_history: int = Field(
+        default=50,
+        description="保留的已结束利用任务数（供 /api/exploit_jobs 查询结果）",
+    )
     sandbox_default_timeout: int = Field(
         default=120,
         description="沙箱中命令默认超时时间（秒）",
     )
     sandbox_mode: str = Field(
         default="local",
-        description="沙箱模式：'local' 在本机执行（默认），'docker' 在容器中执行",
+        description="沙箱模式：'local' 在本机执行（默认），'docker' 在容器中执行，'distributed' 派发给已登记的 worker（core/worker.py）",
+    )
+    prewarm: bool = Field(
+        default=False,
+        description="启动时在后台预热：编译 Agent 图并建立 LLM 连接，缩短首次对话的等待",
+    )
+    engagement_db_path: str = Field(
+        default="data/youkai.db",
+        description="渗透记录库（SQLite）路径，相对路径以项目根目录为基准",
+    )
+    default_engagement: str = Field(
+        default="default",
+        description="未指定项目（engagement）时结果归档到的项目名",
+    )
+    state_backend: str = Field(
+        default="memory",
+        description="Web 层共享状态后端：memory（单进程）/ sqlite（多个 worker 进程共享，uvicorn --workers N 时使用）/ 自定义 \"模块:类名\"",
+    )
+    state_db_path: str = Field(
+        default="data/state.db",
+        description="sqlite 状态后端的文件路径，相对路径以项目根目录为基准；所有 worker 进程须指向同一文件",
+    )
+    state_job_ttl: float = Field(
+        default=30.0,
+        description="任务登记的有效期（秒）：运行任务的进程定期续期，进程退出后超过该时间未续期视为失效",
+    )
+    state_poll_interval: float = Field(
+        default=0.2,
+        description="从共享后端轮询其他进程上任务事件的间隔（秒）",
+    )
+    cassette_mode: str = Field(
+        default="off",
+        description="录制 / 回放：off 关闭；record 把 LLM 调用与工具执行写入录制带；replay 从录制带回放，不调用 LLM、不启动进程",
+    )
+    cassette_path: str = Field(
+        default="data/cassette.jsonl",
+        description="录制带文件（相对项目根目录；以 .gz 结尾时 gzip 压缩）",
+    )
+    cassette_speed: float = Field(
+        default=1.0,
+        description="回放速度倍数：1 按录制时的耗时回放，2 两倍速，0 不等待、尽快完成",
+    )
+    stream_frame_ms: float = Field(
+        default=50.0,
+        description="流式事件合帧窗口（毫秒）：窗口内的进度行合并为一次写入",
+    )
+    stream_frame_max_events: int = Field(
+        default=200,
+        description="单帧最多合并的事件数",
+    )
+    event_channel_capacity: int = Field(
+        default=2000,
+        description="单个流式任务事件通道可缓存的进度行上限",
+    )
+    event_channel_policy: str = Field(
+        default="coalesce",
+        description="事件通道满时的策略：block（等待消费者）/ drop_oldest（丢弃最早的进度行）/ coalesce（合并为省略计数）",
+    )
+    event_channel_block_timeout: float = Field(
+        default=10.0,
+        description="block 策略下生产者最长等待秒数，超时则丢弃该行",
+    )
+    profile_requests: bool = Field(
+        default=False,
+        description="对每个 /api/command_stream 任务做采样剖析（调试用，也可用请求头 X-Youkai-Profile: 1 单次开启）",
+    )
+    profile_interval_ms: float = Field(
+        default=5.0,
+        description="采样剖析的采样间隔（毫秒）",
+    )
+    scheduler_max_processes: int = Field(
+        default=8,
+        description="全局同时运行的外部进程（nmap / 工具 / sqlmap / 分片 worker）上限",
+    )
+    scheduler_per_target: int = Field(
+        default=4,
+        description="对同一目标同时运行的外部进程上限",
+    )
+    scheduler_target_rate: float = Field(
+        default=2.0,
+        description="对同一目标启动新进程的速率（次/秒，令牌桶补充速率），0 表示不限速",
+    )
+    scheduler_target_burst: float = Field(
+        default=4.0,
+        description="令牌桶容量：对同一目标可瞬间连续启动的进程数",
+    )
+    scheduler_queue_timeout: float = Field(
+        default=600.0,
+        description="外部命令排队等待上限（秒），超时返回错误",
+    )
+    process_limits: bool = Field(
+        default=True,
+        description="对本机启动的外部工具进程施加资源限制（nice / ionice / rlimit / cgroup），避免与 Web 服务争抢资源",
+    )
+    process_nice: int = Field(
+        default=10,
+        description="外部工具进程的 nice 值（0–19，越大优先级越低）",
+    )
+    process_ionice_class: str = Field(
+        default="best-effort",
+        description="外部工具进程的 I/O 调度类：best-effort / idle / none（不修改）",
+    )
+    process_ionice_level: int = Field(
+        default=7,
+        description="best-effort 类的 I/O 优先级（0–7，越大越低）",
+    )
+    process_max_memory_mb: int = Field(
+        default=4096,
+        description="单个外部工具进程的地址空间上限（RLIMIT_AS，MB），0 表示不限制",
+    )
+    process_max_open_files: int = Field(
+        default=4096,
+        description="单个外部工具进程的打开文件数上限（RLIMIT_NOFILE），0 表示不修改；不超过当前硬限制",
+    )
+    process_cgroup: str = Field(
+        default="",
+        description="可选：cgroup v2 目录（如 /sys/fs/cgroup/youkai.slice/tools，需预先创建并配置 cpu.max / memory.max 且可写），外部工具进程加入该 cgroup",
+    )
+    worker_token: str = Field(
+        default="",
+        description="协调端与分布式 worker 之间的共享口令（Authorization: Bearer）",
+    )
+    worker_heartbeat_interval: float = Field(
+        default=5.0,
+        description="worker 向协调端发送心跳的间隔（秒）",
+    )
+    worker_heartbeat_timeout: float = Field(
+        default=15.0,
+        description="超过该秒数未收到心跳的 worker 视为离线，不再派发任务",
+    )
+    worker_dispatch_attempts: int = Field(
+        default=3,
+        description="worker 失联时换其他 worker 重新派发的最多尝试次数",
+    )
+    enum_shards: int = Field(
+        default=4,
+        description="dirb / gobuster 字典分片数（并行进程数），1 表示不分片",
+    )
+    enum_shard_min_words: int = Field(
+        default=2000,
+        description="字典少于该行数时不分片，直接单进程运行",
+    )
+    enum_threads: int = Field(
+        default=10,
+        description="分片模式下每个 gobuster 进程的线程数（-t）",
+    )
+    enum_rate_limit: float = Field(
+        default=0.0,
+        description="分片模式下对目标的全局请求速率上限（次/秒），0 表示不限速",
+    )
+    enum_timeout: int = Field(
+        default=1800,
+        description="分片模式下整个枚举任务的时间预算（秒），超时返回已得到的结果",
+    )
+    hydra_workers: int = Field(
+        default=4,
+        description="Hydra 口令字典分区数（并行 Hydra 进程数），1 表示不分区",
+    )
+    hydra_tasks_per_worker: int = Field(
+        default=4,
+        description="每个 Hydra 进程的并发任务数（-t）",
+    )
+    hydra_max_connections: int = Field(
+        default=16,
+        description="对同一目标的 Hydra 并发连接总上限（所有进程、所有请求合计）",
+    )
+    hydra_partition_min_words: int = Field(
+        default=1000,
+        description="口令字典少于该行数时不分区，直接单进程运行",
+    )
+    hydra_timeout: int = Field(
+        default=1800,
+        description="分区模式下整个 Hydra 任务的时间预算（秒）",
+    )
+    exploitdb_path: str = Field(
+        default="/usr/share/exploitdb",
+        description="Exploit-DB 目录（含 files_exploits.csv），searchsploit 与服务漏洞匹配使用其内存索引",
     )
 
     class Config:
@@ -5,42 +5,44 @@ from __future__ import annotations
 状态流转：
 
 - START: 接收用户目标与扫描参数
-- RECON: 调用 Nmap 等侦察工具
+- RECON: 调用 Nmap 等侦察工具。TCP 服务扫描、UDP 常见端口扫描（settings.recon_udp）与 NSE 脚本扫描
+  （settings.recon_scripts）是从 START 分出的并行分支（RECON_TCP / RECON_UDP / RECON_NSE），各有超时，
+  超时保留部分结果；RECON 等全部分支结束后按主机合并，总耗时取决于最慢的分支
 - ANALYSIS: 使用 LLM 分析扫描结果
 - DECISION: 使用 LLM 结合红队思维做下一步决策，并**由 LLM 输出选下一步**（条件边）
 - HUMAN_CHECK: 在执行任何潜在攻击性操作前，生成计划并停在此节点等待人工确认
+
+RECON / ANALYSIS / DECISION 为协程节点（asyncio 子进程与 LLM 异步调用），图需用 ainvoke / astream 执行。
+settings.speculative_analysis 开启时（默认关闭），RECON_TCP 在 Nmap 扫描期间就对已发现的端口做推测式分析（core/speculative.py），
+ANALYSIS 在其与 TCP 分支最终结果一致、其余分支又没有新内容时直接采用，否则以其为初步分析做一次对账。
 """
 
+import asyncio
 import json
-from pathlib import Path
-from typing import Any, Dict, Literal, TypedDict
-
-from langchain_anthropic import ChatAnthropic
-from langchain_core.language_models.chat_models import BaseChatModel
-from langchain_core.messages import HumanMessage, SystemMessage
-from langchain_openai import ChatOpenAI
-from langgraph.graph import END, StateGraph
+import shlex
+import threading
+from typing import TYPE_CHECKING, Annotated, Any, Dict, Literal, Optional, TypedDict
 
 from config.runtime import get_effective_llm_config
 from config.settings import settings
-from tools.scanning import nmap_scan
+from core.cassette import ReplayLLM, is_replaying
+from core.prompts import (
+    ANALYSIS_INSTRUCTIONS,
+    DECISION_INSTRUCTIONS,
+    ainvoke_llm,
+    build_messages,
+    merge_usage,
+)
+from core.speculative import SpeculativeAnalyzer, recon_fingerprint, verbose_arguments
+from tools.scanning import anmap_branch, merge_nmap_outputs, parse_nmap_output
 
+if TYPE_CHECKING:
+    from langchain_core.language_models.chat_models import BaseChatModel
 
-BASE_DIR = Path(__file__).resolve().parents[1]
-SYSTEM_PROMPT_PATH = BASE_DIR / "prompts" / "system_prompt.txt"
 
-
-def _load_system_prompt() -> str:
-    try:
-        return SYSTEM_PROMPT_PATH.read_text(encoding="utf-8")
-    except FileNotFoundError:
-        return (
-            "你是经验丰富的红队专家，擅长使用 Kali Linux 进行信息收集与安全分析。"
-            "在任何可能造成破坏的操作前，必须先给出详细计划并请求人工确认。"
-        )
-
-
-SYSTEM_PROMPT = _load_system_prompt()
+def _merge_branches(left: Optional[dict], right: Optional[dict]) -> dict:
+    """并行侦察分支在同一步写入 recon_branches，按分支名合并。"""
+    return {**(left or {}), **(right or {})}
 
 
 class KaliAgentState(TypedDict, total=False):
@@ -50,60 +52,192 @@ class KaliAgentState(TypedDict, total=False):
     target: str
     nmap_arguments: str
     recon_result: str
+    recon_branches: Annotated[dict, _merge_branches]
     analysis: str
     decision: str
     human_check_message: str
+    exploit_candidates: list
+    llm_usage: dict
+    speculative: dict
+    analysis_source: str
 
 
-def create_llm() -> BaseChatModel:
-    """优先使用 Web UI 保存的配置，否则按环境变量：OpenAI > Anthropic > Gemini > DeepSeek。"""
-    provider, api_key = get_effective_llm_config()
-    if provider and api_key:
-        if provider == "openai":
-            return ChatOpenAI(model="gpt-4o", temperature=0.2, api_key=api_key)
-        if provider == "anthropic":
-            return ChatAnthropic(model="claude-3-5-sonnet-20241022", temperature=0.2, api_key=api_key)
-        if provider == "gemini":
-            from langchain_google_genai import ChatGoogleGenerativeAI
-            return ChatGoogleGenerativeAI(
-                model="gemini-1.5-flash",
-                temperature=0.2,
-                google_api_key=api_key,
-            )
-        if provider == "deepseek":
-            return ChatOpenAI(
-                model="deepseek-chat",
-                temperature=0.2,
-                openai_api_key=api_key,
-                openai_api_base="https://api.deepseek.com",
-            )
+# 各提供商的 LangChain 集成按需导入：只配置 DeepSeek 时不必加载 langchain_anthropic 等重量级模块。
+def _openai_llm(api_key: Optional[str]) -> "BaseChatModel":
+    from langchain_openai import ChatOpenAI
+    if api_key:
+        return ChatOpenAI(model="gpt-4o", temperature=0.2, api_key=api_key)
+    return ChatOpenAI(model="gpt-4o", temperature=0.2)
+
+
+def _anthropic_llm(api_key: Optional[str]) -> "BaseChatModel":
+    from langchain_anthropic import ChatAnthropic
+    if api_key:
+        return ChatAnthropic(model="claude-3-5-sonnet-20241022", temperature=0.2, api_key=api_key)
+    return ChatAnthropic(model="claude-3-5-sonnet-20241022", temperature=0.2)
+
+
+def _gemini_llm(api_key: Optional[str]) -> "BaseChatModel":
+    from langchain_google_genai import ChatGoogleGenerativeAI
+    return ChatGoogleGenerativeAI(
+        model="gemini-1.5-flash",
+        temperature=0.2,
+        google_api_key=api_key,
+    )
+
+
+def _deepseek_llm(api_key: Optional[str]) -> "BaseChatModel":
+    from langchain_openai import ChatOpenAI
+    return ChatOpenAI(
+        model="deepseek-chat",
+        temperature=0.2,
+        openai_api_key=api_key,
+        openai_api_base="https://api.deepseek.com",
+    )
+
+
+_PROVIDER_FACTORIES = {
+    "openai": _openai_llm,
+    "anthropic": _anthropic_llm,
+    "gemini": _gemini_llm,
+    "deepseek": _deepseek_llm,
+}
 
-    if settings.openai_api_key:
-        return ChatOpenAI(model="gpt-4o", temperature=0.2)
-    if settings.anthropic_api_key:
-        return ChatAnthropic(model="claude-3-5-sonnet-20241022", temperature=0.2)
-    if settings.google_gemini_api_key:
-        from langchain_google_genai import ChatGoogleGenerativeAI
-        return ChatGoogleGenerativeAI(
-            model="gemini-1.5-flash",
-            temperature=0.2,
-            google_api_key=settings.google_gemini_api_key,
-        )
-    if settings.deepseek_api_key:
-        return ChatOpenAI(
-            model="deepseek-chat",
-            temperature=0.2,
-            openai_api_key=settings.deepseek_api_key,
-            openai_api_base="https://api.deepseek.com",
-        )
 
-    raise RuntimeError(
-        "未检测到可用的 LLM API Key。请到 Web 界面「设置」中配置，或设置环境变量。"
+def configured_providers() -> list[tuple[str, Optional[str]]]:
+    """所有已配置的提供商 [(provider, api_key)]：Web UI 保存的在前，其后按环境变量 OpenAI > Anthropic > Gemini > DeepSeek。"""
+    providers: list[tuple[str, Optional[str]]] = []
+    provider, api_key = get_effective_llm_config()
+    if provider and api_key and provider in _PROVIDER_FACTORIES:
+        providers.append((provider, api_key))
+    # OpenAI / Anthropic 沿用各自 SDK 的默认环境变量读取方式
+    env = [
+        ("openai", settings.openai_api_key, None),
+        ("anthropic", settings.anthropic_api_key, None),
+        ("gemini", settings.google_gemini_api_key, settings.google_gemini_api_key),
+        ("deepseek", settings.deepseek_api_key, settings.deepseek_api_key),
+    ]
+    for name, configured, key in env:
+        if configured and all(name != p for p, _ in providers):
+            providers.append((name, key))
+    return providers
+
+
+def create_llm() -> "BaseChatModel":
+    """优先使用 Web UI 保存的配置，否则按环境变量：OpenAI > Anthropic > Gemini > DeepSeek。
+
+    配置了多个提供商且 settings.llm_router 开启时返回 LLMRouter（失败转移 / 对冲），接口与聊天模型一致。
+    """
+    providers = configured_providers()
+    if not providers and is_replaying():
+        # 回放录制带不需要真实的 LLM
+        return ReplayLLM()  # type: ignore[return-value]
+    if not providers:
+        raise RuntimeError(
+            "未检测到可用的 LLM API Key。请到 Web 界面「设置」中配置，或设置环境变量。"
+        )
+    if settings.llm_router and len(providers) > 1:
+        from core.llm_router import LLMRouter
+        return LLMRouter([(name, _PROVIDER_FACTORIES[name](key)) for name, key in providers])  # type: ignore[return-value]
+    name, key = providers[0]
+    return _PROVIDER_FACTORIES[name](key)
+
+
+_llm_cache: Optional[tuple[tuple, "BaseChatModel"]] = None
+_llm_lock = threading.Lock()
+
+
+def _llm_config_key() -> tuple:
+    return (
+        get_effective_llm_config(),
+        settings.openai_api_key,
+        settings.anthropic_api_key,
+        settings.google_gemini_api_key,
+        settings.deepseek_api_key,
+        settings.llm_router,
+        is_replaying(),
     )
 
 
-def build_kali_agent_graph(llm: BaseChatModel):
+def get_llm() -> "BaseChatModel":
+    """返回共享的 LLM 实例（复用底层 HTTP 连接池）；配置变化后自动重建。"""
+    global _llm_cache
+    key = _llm_config_key()
+    with _llm_lock:
+        if _llm_cache is None or _llm_cache[0] != key:
+            _llm_cache = (key, create_llm())
+        return _llm_cache[1]
+
+
+def match_exploits(recon_result: str, per_service: int = 5) -> list[dict[str, Any]]:
+    """用 Exploit-DB 内存索引批量匹配侦察结果中的服务版本，只保留有候选利用的服务。"""
+    from tools.exploitdb import get_exploit_index, services_from_hosts
+
+    index = get_exploit_index()
+    if not recon_result or not index.available:
+        return []
+    services = services_from_hosts(parse_nmap_output(recon_result))
+    return [m for m in index.match_services(services, limit=per_service) if m["exploits"]]
+
+
+def _format_exploit_candidates(candidates: list[dict[str, Any]]) -> str:
+    lines = []
+    for c in candidates:
+        lines.append(f"- {c['product']} {c['version']}".rstrip())
+        for e in c["exploits"]:
+            lines.append(f"  * EDB-{e['id']} [{e['match']}] {e['title']}")
+    return "\n".join(lines)
+
+
+# 合并顺序：TCP 在前（用户指定的扫描），其余分支补充
+_BRANCH_ORDER = ("TCP", "UDP", "NSE")
+
+
+def merge_recon_branches(branches: dict[str, dict[str, Any]]) -> str:
+    """把各侦察分支的结果合并成 recon_result：按主机合并端口，未完成的分支附注说明。
+
+    只有一个分支有端口结果时原样使用其输出；都没有时沿用 TCP 分支的原文（错误信息或无开放端口时的输出）。
+    """
+    ordered = [(name, branches[name]) for name in _BRANCH_ORDER if name in branches]
+    usable = [b["text"] for _, b in ordered if b["status"] in ("ok", "partial") and merge_nmap_outputs([b["text"]])]
+    if not usable:
+        return (branches.get("TCP") or {}).get("text", "")
+    merged = usable[0] if len(usable) == 1 else merge_nmap_outputs(usable)
+    notes: list[str] = []
+    for name, b in ordered:
+        if b["status"] == "partial":
+            saved = "；进度已保存，再次发起相同扫描将从中断处继续" if (b.get("checkpoint") or {}).get("saved") else ""
+            notes.append(f"# {name} 分支超时（{b['elapsed']:.0f}s），以上仅含其部分结果{saved}")
+        elif b["status"] in ("timeout", "error"):
+            reason = (b["text"].strip().splitlines() or [""])[0]
+            notes.append(f"# {name} 分支未完成：{reason}")
+    return "\n".join([merged, *notes])
+
+
+def _extends_tcp(branches: dict[str, dict[str, Any]]) -> bool:
+    """UDP / NSE 分支是否带来了 TCP 分支之外需要分析的内容：确认开放（state 为 open）的新端口或 NSE 脚本输出。
+
+    UDP 扫描几乎总会报告的 open|filtered 端口不算，否则推测结果（只覆盖 TCP 分支）几乎永远无法直接采用。
+    """
+    tcp = {(k[0], k[1], k[2]) for k in recon_fingerprint((branches.get("TCP") or {}).get("text", ""))}
+    for name, b in branches.items():
+        if name == "TCP" or b["status"] not in ("ok", "partial"):
+            continue
+        for h in parse_nmap_output(b["text"]):
+            if any(p["state"] == "open" and (h["address"], p["port"], p["protocol"]) not in tcp for p in h["ports"]):
+                return True
+        if any(line.startswith("|") for line in b["text"].splitlines()):
+            return True
+    return False
+
+
+def _skipped(arguments: str, reason: str) -> dict[str, Any]:
+    return {"arguments": arguments, "status": "skipped", "text": reason, "elapsed": 0.0}
+
+
+def build_kali_agent_graph(llm: "BaseChatModel"):
     """构建 Agent 的 LangGraph 状态机并返回编译后的图对象。"""
+    from langgraph.graph import END, StateGraph
 
     workflow = StateGraph(KaliAgentState)
 
@@ -117,61 +251,119 @@ def build_kali_agent_graph(llm: BaseChatModel):
             raise ValueError("Agent 启动需要提供 target（例：192.168.1.1 或 10.0.0.0/24）")
         return {"goal": goal, "target": target, "nmap_arguments": nmap_args}
 
-    def recon_node(state: KaliAgentState) -> KaliAgentState:
+    async def analyze(goal: str, recon_result: str, kind: str, preliminary: str = "") -> dict[str, Any]:
+        # 索引首次加载 / CSV 变更后重建需要读文件，放到线程里
+        candidates = await asyncio.to_thread(match_exploits, recon_result)
+        exploit_section = ""
+        if candidates:
+            exploit_section = (
+                "\n=== Exploit-DB 候选 ===\n"
+                f"{_format_exploit_candidates(candidates)}\n"
+                "=== 候选结束 ===\n"
+            )
+        preliminary_section = ""
+        if preliminary:
+            preliminary_section = (
+                "\n=== 初步分析（扫描进行中基于部分结果生成） ===\n"
+                f"{preliminary}\n"
+                "=== 初步分析结束 ===\n"
+            )
+        # 固定说明在系统消息（可缓存前缀），本次的目标与扫描输出在用户消息
+        messages = build_messages(
+            ANALYSIS_INSTRUCTIONS,
+            f"用户目标 (Goal): {goal}\n\n"
+            "=== Nmap 输出开始 ===\n"
+            f"{recon_result}\n"
+            "=== Nmap 输出结束 ===\n"
+            f"{exploit_section}"
+            f"{preliminary_section}",
+        )
+        resp, usage = await ainvoke_llm(llm, messages, kind)
+        analysis_text = resp.content if isinstance(resp.content, str) else str(resp.content)
+        return {"analysis": analysis_text, "exploit_candidates": candidates, "usage": usage}
+
+    async def recon_tcp_node(state: KaliAgentState) -> KaliAgentState:
         target = state["target"]
         nmap_arguments = state["nmap_arguments"]
-        recon_text = nmap_scan.invoke({"target": target, "arguments": nmap_arguments})
-        return {"recon_result": recon_text}
+        timeout = settings.recon_tcp_timeout
+        if not settings.speculative_analysis:
+            branch = await anmap_branch(target, nmap_arguments, timeout)
+            return {"recon_branches": {"TCP": branch}}
+        # 边扫描边分析：已发现的端口先交给 LLM，ANALYSIS 再与最终结果对账
+        goal = state["goal"]
+        analyzer = SpeculativeAnalyzer(lambda text: analyze(goal, text, "speculative"))
+        analyzer.start()
+        try:
+            branch = await anmap_branch(target, verbose_arguments(nmap_arguments), timeout, on_line=analyzer.feed)
+        except BaseException:
+            await analyzer.cancel()
+            raise
+        speculative = await analyzer.finish(branch["text"])
+        update: KaliAgentState = {"recon_branches": {"TCP": branch}}
+        if speculative is not None:
+            update["speculative"] = speculative
+            update["llm_usage"] = merge_usage(state.get("llm_usage"), analyzer.usage)
+        return update
+
+    async def recon_udp_node(state: KaliAgentState) -> KaliAgentState:
+        arguments = settings.recon_udp_arguments
+        if "-sU" in shlex.split(state["nmap_arguments"]):
+            return {"recon_branches": {"UDP": _skipped(arguments, "用户参数已包含 UDP 扫描")}}
+        branch = await anmap_branch(state["target"], arguments, settings.recon_udp_timeout, label="UDP")
+        return {"recon_branches": {"UDP": branch}}
+
+    async def recon_nse_node(state: KaliAgentState) -> KaliAgentState:
+        arguments = settings.recon_script_arguments
+        if any(t == "-sC" or t.startswith("--script") for t in shlex.split(state["nmap_arguments"])):
+            return {"recon_branches": {"NSE": _skipped(arguments, "用户参数已包含脚本扫描")}}
+        branch = await anmap_branch(state["target"], arguments, settings.recon_script_timeout, label="NSE")
+        return {"recon_branches": {"NSE": branch}}
+
+    def recon_node(state: KaliAgentState) -> KaliAgentState:
+        """各分支都结束后合并侦察结果。"""
+        return {"recon_result": merge_recon_branches(state.get("recon_branches") or {})}
 
-    def analysis_node(state: KaliAgentState) -> KaliAgentState:
+    async def analysis_node(state: KaliAgentState) -> KaliAgentState:
         recon_result = state["recon_result"]
         goal = state["goal"]
-        messages = [
-            SystemMessage(content=SYSTEM_PROMPT),
-            HumanMessage(
-                content=(
-                    "下面是一次针对渗透目标的 Nmap 扫描结果，请以红队专家的角度进行分析：\n\n"
-                    f"用户目标 (Goal): {goal}\n\n"
-                    "=== Nmap 输出开始 ===\n"
-                    f"{recon_result}\n"
-                    "=== Nmap 输出结束 ===\n\n"
-                    "请完成以下任务：\n"
-                    "1. 总结当前已知的开放端口与对应服务（如果有的话）。\n"
-                    "2. 指出可能存在的高价值攻击面或潜在风险。\n"
-                    "3. 结合红队流程，给出建议的下一步方向（例如 Web 枚举、SMB 枚举等）。\n"
-                )
-            ),
-        ]
-        resp = llm.invoke(messages)
-        analysis_text = resp.content if isinstance(resp.content, str) else str(resp.content)
-        return {"analysis": analysis_text}
-
-    def decision_node(state: KaliAgentState) -> KaliAgentState:
+        speculative = state.get("speculative")
+        branches = state.get("recon_branches") or {}
+        tcp_text = (branches.get("TCP") or {}).get("text", "")
+        if (
+            speculative
+            and speculative["fingerprint"] == recon_fingerprint(tcp_text)
+            and not _extends_tcp(branches)
+        ):
+            # 推测分析只看得到 TCP 分支：其最后一轮覆盖了 TCP 分支的最终结果，且其余分支没有新内容时直接采用
+            return {
+                "analysis": speculative["analysis"],
+                "exploit_candidates": speculative["exploit_candidates"],
+                "analysis_source": "speculative",
+            }
+        result = await analyze(
+            goal,
+            recon_result,
+            "analysis",
+            preliminary=speculative["analysis"] if speculative else "",
+        )
+        return {
+            "analysis": result["analysis"],
+            "exploit_candidates": result["exploit_candidates"],
+            "analysis_source": "reconciled" if speculative else "full",
+            "llm_usage": merge_usage(state.get("llm_usage"), result["usage"]),
+        }
+
+    async def decision_node(state: KaliAgentState) -> KaliAgentState:
         analysis = state["analysis"]
         goal = state["goal"]
-        messages = [
-            SystemMessage(content=SYSTEM_PROMPT),
-            HumanMessage(
-                content=(
-                    "基于以下分析结果，请给出下一步红队行动的决策，并**由你选择下一步**。\n\n"
-                    f"用户目标 (Goal): {goal}\n\n"
-                    "=== 分析结果 ===\n"
-                    f"{analysis}\n"
-                    "================\n\n"
-                    "请仅输出一个 JSON，对象格式如下（不要添加多余解释）：\n"
-                    "{\n"
-                    '  \"path\": \"web\" | \"smb\" | \"other\",\n'
-                    '  \"reason\": \"string\",\n'
-                    '  \"dangerous\": true/false,\n'
-                    '  \"next_step\": \"human_check\" | \"end\"\n'
-                    "}\n\n"
-                    "next_step 含义：\n"
-                    "- human_check：需要人工确认后再执行（有高危利用建议、或建议执行攻击时选此项）。\n"
-                    "- end：当前结论已足够，无需进一步攻击，直接结束并输出报告。\n"
-                )
-            ),
-        ]
-        resp = llm.invoke(messages)
+        messages = build_messages(
+            DECISION_INSTRUCTIONS,
+            f"用户目标 (Goal): {goal}\n\n"
+            "=== 分析结果 ===\n"
+            f"{analysis}\n"
+            "================\n",
+        )
+        resp, usage = await ainvoke_llm(llm, messages, "decision")
         raw = resp.content if isinstance(resp.content, str) else str(resp.content)
         try:
             data = json.loads(raw)
@@ -181,7 +373,10 @@ def build_kali_agent_graph(llm: BaseChatModel):
             data["next_step"] = "human_check" if data.get("dangerous", True) else "end"
         if data.get("next_step") not in ("human_check", "end"):
             data["next_step"] = "human_check" if data.get("dangerous", True) else "end"
-        return {"decision": json.dumps(data, ensure_ascii=False, indent=2)}
+        return {
+            "decision": json.dumps(data, ensure_ascii=False, indent=2),
+            "llm_usage": merge_usage(state.get("llm_usage"), usage),
+        }
 
     def route_after_decision(state: KaliAgentState) -> Literal["human_check", "end"]:
         """所有决策都过 LLM：根据 DECISION 节点中 LLM 输出的 next_step 选下一步。"""
@@ -216,13 +411,24 @@ def build_kali_agent_graph(llm: BaseChatModel):
         )
         return {"human_check_message": message}
 
+    branches = {"RECON_TCP": recon_tcp_node}
+    if settings.recon_udp:
+        branches["RECON_UDP"] = recon_udp_node
+    if settings.recon_scripts:
+        branches["RECON_NSE"] = recon_nse_node
+
     workflow.add_node("START", start_node)
+    for name, node in branches.items():
+        workflow.add_node(name, node)
     workflow.add_node("RECON", recon_node)
     workflow.add_node("ANALYSIS", analysis_node)
     workflow.add_node("DECISION", decision_node)
     workflow.add_node("HUMAN_CHECK", human_check_node)
     workflow.set_entry_point("START")
-    workflow.add_edge("START", "RECON")
+    for name in branches:
+        workflow.add_edge("START", name)
+    # 并行分支全部完成后才进入 RECON 合并
+    workflow.add_edge(list(branches), "RECON")
     workflow.add_edge("RECON", "ANALYSIS")
     workflow.add_edge("ANALYSIS", "DECISION")
     workflow.add_conditional_edges(
@@ -235,10 +441,18 @@ def build_kali_agent_graph(llm: BaseChatModel):
     return workflow.compile()
 
 
-def create_kali_agent():
-    """创建可直接 .invoke(...) 的 Agent 图。"""
-    llm = create_llm()
-    return build_kali_agent_graph(llm)
+def create_kali_agent(llm: Optional["BaseChatModel"] = None):
+    """创建 Agent 图（await .ainvoke(...) / async for ... in .astream(...)）。未传入 llm 时使用共享实例。"""
+    return build_kali_agent_graph(llm or get_llm())
 
 
-__all__ = ["KaliAgentState", "create_kali_agent", "create_llm", "build_kali_agent_graph"]
+__all__ = [
+    "KaliAgentState",
+    "build_kali_agent_graph",
+    "configured_providers",
+    "create_kali_agent",
+    "create_llm",
+    "get_llm",
+    "match_exploits",
+    "merge_recon_branches",
+]
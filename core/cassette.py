@@ -0,0 +1,464 @@
+"""录制 / 回放：把 LLM 调用与外部工具执行连同耗时记入录制带文件，之后不联网、不启动进程即可原样重现。
+
+- record：每次 LLM 调用（core/prompts.invoke_llm / ainvoke_llm）记录调用类型、消息、响应内容、token 用量与耗时；
+  每个外部进程（进程监督器 spawn，以及 Docker / 分布式沙箱执行的命令）记录参数、退出码、stdout / stderr、
+  每行输出的时间点与资源统计。每条记录写为一行 JSON，边运行边追加（路径以 .gz 结尾时 gzip 压缩）。
+- replay：不再调用 LLM、不启动任何进程，按请求内容找到录制的记录返回；stdout / stderr 按录制时的时间点
+  逐行送给回调。speed 为回放速度倍数：1 按录制速度，0 不等待、尽快完成。
+
+匹配：LLM 按（调用类型, 消息）、命令按完整参数计算键，同一键的多次调用按录制顺序依次取出，取完后重复最后一条；
+没有完全匹配时（提示中含时间、命令参数含临时文件路径等）按录制顺序取同类（同一调用类型 / 同一程序）
+尚未用过的记录；仍没有则抛 CassetteMissError。
+
+开启方式：settings.cassette_mode（off / record / replay）与 cassette_path、cassette_speed；
+回归测试与性能对比可在代码中 `with use_cassette(path, "replay", speed=0): ...`（进程内全局生效）。
+"""
+
+from __future__ import annotations
+
+import asyncio
+import concurrent.futures
+import errno
+import gzip
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from pathlib import Path
+from typing import IO, Any, Callable, Iterator, Optional
+
+from config.settings import settings
+
+logger = logging.getLogger(__name__)
+
+BASE_DIR = Path(__file__).resolve().parents[1]
+MODES = ("off", "record", "replay")
+_FORMAT_VERSION = 1
+
+
+class CassetteMissError(RuntimeError):
+    """回放时录制带中没有与请求对应的记录。"""
+
+
+def _key(*parts: Any) -> str:
+    raw = json.dumps(parts, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()[:16]
+
+
+def _message_parts(messages: Any) -> list:
+    if isinstance(messages, str):
+        return [["human", messages]]
+    return [[getattr(m, "type", type(m).__name__), getattr(m, "content", m)] for m in messages]
+
+
+def _split_lines(text: str) -> list[str]:
+    """按进程监督器的方式切行（见 core/supervisor.py）：以 \\n 分隔、去掉行尾 \\r，末尾不完整的行也算一行。"""
+    lines = text.split("\n")
+    if lines and lines[-1] == "":
+        lines.pop()
+    return [line.rstrip("\r") for line in lines]
+
+
+def _schedule(times: list[int], count: int, elapsed: float) -> list[float]:
+    """每行的送出时间（秒）；录制时没有逐行时间点（未走回调）则在耗时内均匀分布。"""
+    if len(times) == count:
+        return [t / 1000 for t in times]
+    return [elapsed * (i + 1) / (count + 1) for i in range(count)]
+
+
+def _open(path: Path, mode: str) -> IO[str]:
+    if path.suffix == ".gz":
+        return gzip.open(path, mode + "t", encoding="utf-8")  # type: ignore[return-value]
+    return open(path, mode, encoding="utf-8")
+
+
+class CommandRecorder:
+    """录制一次命令执行：包装逐行回调记下每行的时间点，结束时把结果写入录制带。"""
+
+    def __init__(
+        self,
+        cassette: "Cassette",
+        args: list[str],
+        on_stdout_line: Optional[Callable[[str], Any]] = None,
+        on_stderr_line: Optional[Callable[[str], Any]] = None,
+    ) -> None:
+        self.cassette = cassette
+        self.args = list(args)
+        self.started = time.monotonic()
+        self.out_times: list[int] = []
+        self.err_times: list[int] = []
+        self.stdout = self._clock(on_stdout_line, self.out_times)
+        self.stderr = self._clock(on_stderr_line, self.err_times)
+
+    def _clock(self, callback: Optional[Callable[[str], Any]], times: list[int]) -> Callable[[str], Any]:
+        def _line(line: str) -> Any:
+            times.append(int((time.monotonic() - self.started) * 1000))
+            if callback is not None:
+                return callback(line)
+            return None
+        return _line
+
+    def finish(
+        self,
+        exit_code: int,
+        stdout: str,
+        stderr: str,
+        timed_out: bool = False,
+        elapsed: Optional[float] = None,
+        usage: Optional[dict] = None,
+        limits: Optional[dict] = None,
+    ) -> None:
+        self.cassette._write({
+            "type": "command",
+            "key": _key(self.args),
+            "group": self.args[0] if self.args else "",
+            "args": self.args,
+            "exit_code": exit_code,
+            "stdout": stdout,
+            "stderr": stderr,
+            "timed_out": timed_out,
+            "elapsed": round(time.monotonic() - self.started if elapsed is None else elapsed, 3),
+            "out_times": self.out_times,
+            "err_times": self.err_times,
+            "usage": usage or {},
+            "limits": limits or {},
+        })
+
+    def finish_process(self, future: concurrent.futures.Future) -> None:
+        """进程监督器 future 的完成回调（结果为 ProcessResult）。"""
+        if future.cancelled() or future.exception() is not None:
+            return
+        res = future.result()
+        self.finish(res.exit_code, res.stdout, res.stderr, res.timed_out, res.elapsed, res.usage, res.limits)
+
+    def not_found(self) -> None:
+        """命令不存在（spawn 抛 FileNotFoundError），回放时同样抛出。"""
+        self.cassette._write({
+            "type": "command",
+            "key": _key(self.args),
+            "group": self.args[0] if self.args else "",
+            "args": self.args,
+            "error": "not_found",
+        })
+
+
+class ReplayProcess:
+    """回放的进程：接口与 ProcessHandle 一致（future / pid / done / kill / result），由后台线程按时间点送出输出行。"""
+
+    pid = 0
+
+    def __init__(
+        self,
+        entry: dict,
+        speed: float,
+        on_stdout_line: Optional[Callable[[str], None]],
+        on_stderr_line: Optional[Callable[[str], None]],
+        runs: Optional[list] = None,
+    ) -> None:
+        self.entry = entry
+        self.speed = speed
+        self.on_stdout_line = on_stdout_line
+        self.on_stderr_line = on_stderr_line
+        self.runs = runs
+        self.future: concurrent.futures.Future = concurrent.futures.Future()
+        self.future.set_running_or_notify_cancel()
+        self._killed = threading.Event()
+        threading.Thread(target=self._run, name="youkai-replay", daemon=True).start()
+
+    def done(self) -> bool:
+        return self.future.done()
+
+    def kill(self) -> None:
+        self._killed.set()
+
+    def result(self, timeout: Optional[float] = None) -> Any:
+        return self.future.result(timeout)
+
+    def _run(self) -> None:
+        from core.supervisor import ProcessResult
+
+        entry = self.entry
+        elapsed = float(entry.get("elapsed") or 0.0)
+        out = _split_lines(entry.get("stdout") or "")
+        err = _split_lines(entry.get("stderr") or "")
+        events = sorted(
+            [(t, 0, i, "stdout") for i, t in enumerate(_schedule(entry.get("out_times") or [], len(out), elapsed))]
+            + [(t, 1, i, "stderr") for i, t in enumerate(_schedule(entry.get("err_times") or [], len(err), elapsed))]
+        )
+        started = time.monotonic()
+        sent = {"stdout": 0, "stderr": 0}
+        for at, _, i, stream in events:
+            if self.speed > 0 and self._killed.wait(max(at / self.speed - (time.monotonic() - started), 0)):
+                break
+            if self._killed.is_set():
+                break
+            callback = self.on_stdout_line if stream == "stdout" else self.on_stderr_line
+            line = out[i] if stream == "stdout" else err[i]
+            sent[stream] = i + 1
+            if callback is not None:
+                try:
+                    callback(line)
+                except Exception:  # noqa: BLE001
+                    logger.debug("replay line callback failed", exc_info=True)
+        killed = self._killed.is_set()
+        if not killed and self.speed > 0:
+            killed = self._killed.wait(max(elapsed / self.speed - (time.monotonic() - started), 0))
+        if killed:
+            # 提前结束：只保留已送出的行
+            stdout = "".join(line + "\n" for line in out[:sent["stdout"]])
+            stderr = "".join(line + "\n" for line in err[:sent["stderr"]])
+            exit_code = -9
+        else:
+            stdout, stderr, exit_code = entry.get("stdout") or "", entry.get("stderr") or "", entry.get("exit_code", 0)
+        result = ProcessResult(
+            args=list(entry.get("args") or []),
+            pid=0,
+            exit_code=exit_code,
+            stdout=stdout,
+            stderr=stderr,
+            timed_out=bool(entry.get("timed_out")) and not killed,
+            killed=killed,
+            elapsed=time.monotonic() - started,
+            limits=dict(entry.get("limits") or {}),
+            usage=dict(entry.get("usage") or {}),
+        )
+        if self.runs is not None:
+            self.runs.append(result)
+        self.future.set_result(result)
+
+
+class Cassette:
+    """一盘录制带：record 模式新建并追加写入，replay 模式加载后按请求取出记录（线程安全）。"""
+
+    def __init__(self, path: str | Path, mode: str = "replay", speed: float = 1.0) -> None:
+        if mode not in ("record", "replay"):
+            raise ValueError(f"未知的录制带模式: {mode}，可选: record, replay")
+        raw = Path(path)
+        self.path = raw if raw.is_absolute() else BASE_DIR / raw
+        self.mode = mode
+        self.speed = max(float(speed), 0.0)
+        self._lock = threading.Lock()
+        self._file: Optional[IO[str]] = None
+        self._entries: list[dict] = []
+        self._by_key: dict[str, deque[int]] = {}
+        self._by_group: dict[str, deque[int]] = {}
+        self._last: dict[str, int] = {}
+        self._used: set[int] = set()
+        self.stats = {"recorded": 0, "exact": 0, "fuzzy": 0, "repeated": 0, "missed": 0}
+        if mode == "record":
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._file = _open(self.path, "w")
+            self._file.write(json.dumps({"type": "header", "version": _FORMAT_VERSION, "created": time.time()}) + "\n")
+            self._file.flush()
+        else:
+            self._load()
+
+    @property
+    def replaying(self) -> bool:
+        return self.mode == "replay"
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def snapshot(self) -> dict[str, Any]:
+        with self._lock:
+            return {"mode": self.mode, "path": str(self.path), "speed": self.speed, "entries": len(self._entries), **self.stats}
+
+    # ---------- 文件 ----------
+    def _write(self, entry: dict) -> None:
+        line = json.dumps(entry, ensure_ascii=False, separators=(",", ":"), default=str)
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.write(line + "\n")
+            self._file.flush()
+            self.stats["recorded"] += 1
+
+    def _load(self) -> None:
+        if not self.path.exists():
+            raise FileNotFoundError(f"录制带不存在: {self.path}")
+        with _open(self.path, "r") as fh:
+            for raw in fh:
+                raw = raw.strip()
+                if not raw:
+                    continue
+                try:
+                    entry = json.loads(raw)
+                except json.JSONDecodeError:
+                    # 录制时进程被中断，最后一行可能不完整
+                    logger.warning("Skipping truncated cassette line in %s", self.path)
+                    continue
+                if entry.get("type") == "header":
+                    if entry.get("version") != _FORMAT_VERSION:
+                        raise ValueError(f"不支持的录制带版本: {entry.get('version')}")
+                    continue
+                index = len(self._entries)
+                self._entries.append(entry)
+                self._by_key.setdefault(entry["key"], deque()).append(index)
+                self._by_group.setdefault(f"{entry['type']}:{entry.get('group', '')}", deque()).append(index)
+        logger.info("Loaded cassette %s (%d entries)", self.path, len(self._entries))
+
+    def _take(self, kind: str, group: str, key: str, describe: str) -> dict:
+        with self._lock:
+            exact = self._by_key.get(key)
+            while exact and exact[0] in self._used:
+                exact.popleft()
+            if exact:
+                index = exact.popleft()
+                self.stats["exact"] += 1
+            else:
+                pending = self._by_group.get(f"{kind}:{group}")
+                while pending and pending[0] in self._used:
+                    pending.popleft()
+                if pending:
+                    index = pending.popleft()
+                    self.stats["fuzzy"] += 1
+                    logger.info("Cassette: no exact match for %s, using next recorded %s call", describe, group)
+                elif key in self._last:
+                    index = self._last[key]
+                    self.stats["repeated"] += 1
+                else:
+                    self.stats["missed"] += 1
+                    raise CassetteMissError(f"录制带 {self.path.name} 中没有对应的记录: {describe}")
+            self._used.add(index)
+            self._last[key] = index
+            return self._entries[index]
+
+    def _delay(self, seconds: float) -> float:
+        return seconds / self.speed if self.speed > 0 else 0.0
+
+    # ---------- LLM ----------
+    def record_llm(self, kind: str, messages: Any, resp: Any, elapsed: float) -> None:
+        meta = getattr(resp, "response_metadata", None) or {}
+        self._write({
+            "type": "llm",
+            "key": _key(kind, _message_parts(messages)),
+            "group": kind,
+            "content": getattr(resp, "content", str(resp)),
+            "usage_metadata": dict(getattr(resp, "usage_metadata", None) or {}),
+            # 旧版集成的用量只在 response_metadata 中（见 core/prompts.usage_of）
+            "response_metadata": {k: meta[k] for k in ("token_usage", "usage", "model_name") if k in meta},
+            "elapsed": round(elapsed, 3),
+        })
+
+    def _llm_response(self, kind: str, messages: Any) -> tuple[Any, float]:
+        from langchain_core.messages import AIMessage
+
+        entry = self._take("llm", kind, _key(kind, _message_parts(messages)), f"LLM 调用（{kind}）")
+        resp = AIMessage(
+            content=entry.get("content") or "",
+            usage_metadata=entry.get("usage_metadata") or None,
+            response_metadata=entry.get("response_metadata") or {},
+        )
+        return resp, self._delay(float(entry.get("elapsed") or 0.0))
+
+    def replay_llm(self, kind: str, messages: Any) -> Any:
+        resp, delay = self._llm_response(kind, messages)
+        if delay:
+            time.sleep(delay)
+        return resp
+
+    async def areplay_llm(self, kind: str, messages: Any) -> Any:
+        resp, delay = self._llm_response(kind, messages)
+        if delay:
+            await asyncio.sleep(delay)
+        return resp
+
+    # ---------- 命令 ----------
+    def recorder(
+        self,
+        args: list[str],
+        on_stdout_line: Optional[Callable[[str], Any]] = None,
+        on_stderr_line: Optional[Callable[[str], Any]] = None,
+    ) -> CommandRecorder:
+        return CommandRecorder(self, args, on_stdout_line, on_stderr_line)
+
+    def spawn(
+        self,
+        args: list[str],
+        on_stdout_line: Optional[Callable[[str], None]] = None,
+        on_stderr_line: Optional[Callable[[str], None]] = None,
+        runs: Optional[list] = None,
+    ) -> ReplayProcess:
+        """回放一次进程执行（代替 ProcessSupervisor.spawn）；录制时命令不存在则同样抛 FileNotFoundError。"""
+        group = args[0] if args else ""
+        entry = self._take("command", group, _key(list(args)), " ".join(args))
+        if entry.get("error") == "not_found":
+            raise FileNotFoundError(errno.ENOENT, "No such file or directory", group)
+        return ReplayProcess(entry, self.speed, on_stdout_line, on_stderr_line, runs)
+
+
+_override: Optional[Cassette] = None
+_configured: Optional[tuple[tuple, Cassette]] = None
+_configured_lock = threading.Lock()
+
+
+def get_cassette() -> Optional[Cassette]:
+    """当前生效的录制带：use_cassette 设置的优先，否则按 settings.cassette_mode；未开启时为 None。"""
+    global _configured
+    if _override is not None:
+        return _override
+    mode = settings.cassette_mode
+    if mode == "off":
+        return None
+    key = (mode, settings.cassette_path, settings.cassette_speed)
+    with _configured_lock:
+        if _configured is None or _configured[0] != key:
+            if _configured is not None:
+                _configured[1].close()
+            _configured = (key, Cassette(settings.cassette_path, mode, settings.cassette_speed))
+        return _configured[1]
+
+
+def is_replaying() -> bool:
+    cassette = get_cassette()
+    return cassette is not None and cassette.replaying
+
+
+@contextmanager
+def use_cassette(path: str | Path, mode: str = "replay", speed: Optional[float] = None) -> Iterator[Cassette]:
+    """在 with 块内（进程内全局）使用指定录制带，结束后恢复原设置；speed 默认取 settings.cassette_speed。"""
+    global _override
+    cassette = Cassette(path, mode, settings.cassette_speed if speed is None else speed)
+    previous = _override
+    _override = cassette
+    try:
+        yield cassette
+    finally:
+        _override = previous
+        cassette.close()
+
+
+class ReplayLLM:
+    """回放且未配置任何 API Key 时 get_llm 返回的占位模型：调用由录制带提供（见 core/prompts.invoke_llm）。"""
+
+    def invoke(self, messages: Any, **_kwargs: Any) -> Any:
+        cassette = get_cassette()
+        if cassette is None or not cassette.replaying:
+            raise RuntimeError("未在回放录制带，且未配置 LLM API Key")
+        return cassette.replay_llm("direct", messages)
+
+    async def ainvoke(self, messages: Any, **_kwargs: Any) -> Any:
+        cassette = get_cassette()
+        if cassette is None or not cassette.replaying:
+            raise RuntimeError("未在回放录制带，且未配置 LLM API Key")
+        return await cassette.areplay_llm("direct", messages)
+
+
+__all__ = [
+    "MODES",
+    "Cassette",
+    "CassetteMissError",
+    "CommandRecorder",
+    "ReplayLLM",
+    "ReplayProcess",
+    "get_cassette",
+    "is_replaying",
+    "use_cassette",
+]
@@ -0,0 +1,361 @@
+"""分布式扫描协调端：登记 worker、心跳判活、按负载派发命令、失败后重新派发。
+
+worker 通过 POST /api/workers/heartbeat 登记并保持在线（见 core/worker.py）。
+Web 以多个进程运行时心跳只落到其中一个进程，登记表会定期合并共享状态后端（core/state.py）里的心跳。
+DistributedSandbox 与 LocalSandbox / KaliSandbox 接口一致，sandbox_mode 为 "distributed" 时使用。
+"""
+
+from __future__ import annotations
+
+import json
+import logging
+import shlex
+import socket
+import threading
+import time
+import urllib.error
+import urllib.request
+from dataclasses import dataclass
+from typing import Callable, List, Optional
+
+from config.settings import settings
+from core.cassette import get_cassette
+from core.state import get_state_backend
+from core.sandbox import (
+    CommandResult,
+    CommandTimeoutError,
+    LineCallback,
+    LocalSandbox,
+    _arun_in_thread,
+    _scheduled,
+    _validate_command_static,
+)
+from core.supervisor import ProcessResult, record_process, rusage_dict
+from core.worker import PING_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+
+class NoWorkerAvailableError(RuntimeError):
+    """没有在线的 worker 可以接收任务。"""
+
+
+@dataclass
+class WorkerInfo:
+    url: str
+    name: str
+    capacity: int = 1
+    running: int = 0  # worker 心跳上报的运行数
+    inflight: int = 0  # 本协调端已派发、尚未返回的任务数
+    last_seen: float = 0.0
+    failures: int = 0
+    completed: int = 0
+    failed_at: float = 0.0
+
+    def alive(self, now: float) -> bool:
+        return now - self.last_seen <= settings.worker_heartbeat_timeout
+
+    @property
+    def load(self) -> float:
+        return max(self.running, self.inflight) / max(self.capacity, 1)
+
+
+class WorkerRegistry:
+    """worker 登记表（线程安全）。"""
+
+    def __init__(self) -> None:
+        self._workers: dict[str, WorkerInfo] = {}
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._synced = 0.0
+
+    def heartbeat(self, url: str, name: str = "", capacity: int = 1, running: int = 0) -> WorkerInfo:
+        url = url.rstrip("/")
+        with self._lock:
+            info = self._workers.get(url)
+            if info is None:
+                info = WorkerInfo(url=url, name=name or url)
+                self._workers[url] = info
+                logger.info("Worker registered: %s (%s)", info.name, url)
+            info.name = name or info.name
+            info.capacity = max(int(capacity), 1)
+            info.running = max(int(running), 0)
+            info.last_seen = time.monotonic()
+            self._changed.notify_all()
+            return info
+
+    def mark_failed(self, url: str) -> None:
+        """派发失败：视为离线，直到下一次心跳。"""
+        with self._lock:
+            info = self._workers.get(url)
+            if info is not None:
+                info.failures += 1
+                info.last_seen = 0.0
+                info.failed_at = time.monotonic()
+                logger.warning("Worker marked offline: %s", url)
+
+    def _sync_shared_locked(self) -> None:
+        """合并其他 Web 进程收到的心跳（共享状态后端的 "workers" 命名空间），每秒至多一次。"""
+        backend = get_state_backend()
+        if not backend.shared or time.monotonic() - self._synced < 1.0:
+            return
+        self._synced = time.monotonic()
+        try:
+            entries = backend.items("workers")
+        except Exception as exc:  # noqa: BLE001
+            logger.warning("Failed to read shared worker heartbeats: %s", exc)
+            return
+        for url, entry in entries.items():
+            # 心跳时间为墙钟时间，换算到本进程的 monotonic 时钟
+            seen = time.monotonic() - max(time.time() - float(entry.get("seen") or 0), 0.0)
+            info = self._workers.get(url)
+            if info is None:
+                info = WorkerInfo(url=url, name=entry.get("name") or url)
+                self._workers[url] = info
+            if seen > max(info.last_seen, info.failed_at):
+                info.name = entry.get("name") or info.name
+                info.capacity = max(int(entry.get("capacity") or 1), 1)
+                info.running = max(int(entry.get("running") or 0), 0)
+                info.last_seen = seen
+
+    def pick(self, exclude: set[str], wait: float = 0.0) -> Optional[WorkerInfo]:
+        """选出负载最低的在线 worker 并计入 inflight；没有时最多等待 wait 秒。"""
+        deadline = time.monotonic() + wait
+        with self._lock:
+            while True:
+                self._sync_shared_locked()
+                now = time.monotonic()
+                candidates = [w for w in self._workers.values() if w.alive(now) and w.url not in exclude]
+                if candidates:
+                    best = min(candidates, key=lambda w: (w.load, w.inflight, w.failures))
+                    best.inflight += 1
+                    return best
+                if now >= deadline:
+                    return None
+                # 共享后端的心跳不会唤醒本进程，最多等 1 秒再合并一次
+                self._changed.wait(min(deadline - now, 1.0))
+
+    def done(self, info: WorkerInfo, ok: bool) -> None:
+        with self._lock:
+            info.inflight = max(info.inflight - 1, 0)
+            if ok:
+                info.completed += 1
+
+    def snapshot(self) -> list[dict]:
+        with self._lock:
+            self._sync_shared_locked()
+            now = time.monotonic()
+            return [
+                {
+                    "url": w.url,
+                    "name": w.name,
+                    "alive": w.alive(now),
+                    "capacity": w.capacity,
+                    "running": w.running,
+                    "inflight": w.inflight,
+                    "failures": w.failures,
+                    "completed": w.completed,
+                    "last_seen": round(now - w.last_seen, 1) if w.last_seen else None,
+                }
+                for w in self._workers.values()
+            ]
+
+
+class WorkerLostError(ConnectionError):
+    """worker 在执行过程中断开或失联。"""
+
+
+def _skip_delivered(
+    on_stdout_line: Optional[Callable[[str], None]],
+    delivered: list[int],
+    worker: str,
+) -> Optional[Callable[[str], None]]:
+    """逐行回调的包装：跳过与已推送前缀逐行相同的输出，之后的新行照常推送并记入 delivered。
+
+    重新执行的输出与之前不同时（如时间戳行）推送一条重新开始的标记，之后按新 worker 的输出完整推送。
+    """
+    if on_stdout_line is None:
+        return None
+    replay = list(delivered)
+    state = {"pos": 0, "diverged": not replay}
+
+    def _forward(line: str) -> None:
+        if not state["diverged"]:
+            if state["pos"] < len(replay) and hash(line) == replay[state["pos"]]:
+                state["pos"] += 1
+                return
+            state["diverged"] = True
+            if state["pos"] < len(replay):
+                on_stdout_line(f"[coordinator] {worker} 上重新执行的输出与之前不同，以下为其完整输出")
+                delivered.clear()
+                replay.clear()
+        delivered.append(hash(line))
+        on_stdout_line(line)
+
+    return _forward
+
+
+class DistributedSandbox:
+    """把命令派发给在线 worker 执行；worker 失联时换一个 worker 重新执行。"""
+
+    def __init__(
+        self,
+        registry: Optional[WorkerRegistry] = None,
+        allowed_binaries: Optional[List[str]] = None,
+        default_timeout: Optional[int] = None,
+    ) -> None:
+        self.registry = registry or get_worker_registry()
+        self.allowed_binaries = allowed_binaries or ["ls", "whoami", "nmap"]
+        self.default_timeout = default_timeout or settings.sandbox_default_timeout
+
+    def run(
+        self,
+        args: List[str],
+        timeout: Optional[int] = None,
+        on_stdout_line: Optional[Callable[[str], None]] = None,
+    ) -> CommandResult:
+        _validate_command_static(args, self.allowed_binaries)
+        cassette = get_cassette()
+        if cassette is not None and cassette.replaying:
+            # 回放录制带：由本机沙箱（进程监督器）回放，不需要 worker
+            return LocalSandbox(self.allowed_binaries, self.default_timeout).run(args, timeout, on_stdout_line)
+        with _scheduled(args):
+            return self._dispatch(args, timeout or self.default_timeout, on_stdout_line)
+
+    async def arun(
+        self,
+        args: List[str],
+        timeout: Optional[int] = None,
+        on_stdout_line: Optional[LineCallback] = None,
+    ) -> CommandResult:
+        """派发与读取 worker 的 NDJSON 流使用阻塞的 urllib，在线程中执行。"""
+        return await _arun_in_thread(self.run, args, timeout, on_stdout_line)
+
+    def _dispatch(
+        self,
+        args: List[str],
+        timeout: int,
+        on_stdout_line: Optional[Callable[[str], None]],
+    ) -> CommandResult:
+        cmd_str = " ".join(shlex.quote(a) for a in args)
+        cassette = get_cassette()
+        recorder = cassette.recorder(args, on_stdout_line) if cassette is not None else None
+        if recorder is not None:
+            on_stdout_line = recorder.stdout
+        # 已推送给调用方的行（哈希）：重新派发时新 worker 从头执行，与之前相同的前缀不再重复推送
+        delivered: list[int] = []
+        tried: set[str] = set()
+        attempts = max(settings.worker_dispatch_attempts, 1)
+        last_error = ""
+        for attempt in range(attempts):
+            worker = self.registry.pick(tried, wait=settings.worker_heartbeat_timeout)
+            if worker is None:
+                break
+            tried.add(worker.url)
+            logger.info("Dispatching to worker %s (attempt %d): %s", worker.name, attempt + 1, cmd_str)
+            ok = False
+            started = time.monotonic()
+            try:
+                result = self._run_on(worker, args, timeout, _skip_delivered(on_stdout_line, delivered, worker.name))
+                ok = True
+            except WorkerLostError as exc:
+                last_error = f"{worker.name}: {exc}"
+                self.registry.mark_failed(worker.url)
+                if on_stdout_line is not None:
+                    on_stdout_line(f"[coordinator] worker {worker.name} 失联，重新派发（命令从头执行，已收到的 {len(delivered)} 行不再重复）…")
+                continue
+            finally:
+                self.registry.done(worker, ok)
+            elapsed = time.monotonic() - started
+            if not result.usage:
+                # 旧版 worker 不回传资源统计
+                result.usage = rusage_dict(None, elapsed, len(result.stdout.encode()), len(result.stderr.encode()))
+            record_process(ProcessResult(
+                args=list(args),
+                pid=0,
+                exit_code=result.exit_code,
+                stdout="",
+                stderr="",
+                timed_out=result.timed_out,
+                elapsed=elapsed,
+                limits={**result.limits, "worker": worker.name},
+                usage=result.usage,
+            ))
+            if recorder is not None:
+                recorder.finish(
+                    result.exit_code, result.stdout, result.stderr, result.timed_out, elapsed, result.usage, result.limits
+                )
+            if result.timed_out:
+                raise CommandTimeoutError(
+                    f"命令在 worker {worker.name} 上执行超时（>{timeout}s）: {cmd_str}",
+                    stdout=result.stdout,
+                )
+            return result
+        raise NoWorkerAvailableError(
+            f"没有可用的扫描 worker（已尝试 {len(tried)} 个）{'：' + last_error if last_error else ''}"
+        )
+
+    def _run_on(
+        self,
+        worker: WorkerInfo,
+        args: List[str],
+        timeout: int,
+        on_stdout_line: Optional[Callable[[str], None]],
+    ) -> CommandResult:
+        req = urllib.request.Request(
+            worker.url + "/run",
+            data=json.dumps({"args": args, "timeout": timeout}).encode("utf-8"),
+            headers={"Content-Type": "application/json", "Authorization": f"Bearer {settings.worker_token}"},
+            method="POST",
+        )
+        # worker 运行期间每 PING_INTERVAL 秒至少发一行，读超时即视为失联
+        read_timeout = max(settings.worker_heartbeat_timeout, PING_INTERVAL * 2)
+        try:
+            with urllib.request.urlopen(req, timeout=read_timeout) as resp:
+                for raw in resp:
+                    event = json.loads(raw)
+                    kind = event.get("type")
+                    if kind == "line" and on_stdout_line is not None:
+                        try:
+                            on_stdout_line(event.get("line", ""))
+                        except Exception:  # noqa: BLE001
+                            pass
+                    elif kind == "result":
+                        return CommandResult(
+                            command=" ".join(shlex.quote(a) for a in args),
+                            exit_code=int(event.get("exit_code", -1)),
+                            stdout=event.get("stdout") or "",
+                            stderr=event.get("stderr") or "",
+                            timed_out=bool(event.get("timed_out")),
+                            limits=event.get("limits") or {},
+                            usage=event.get("usage") or {},
+                        )
+        except urllib.error.HTTPError as exc:
+            if exc.code == 401:
+                raise WorkerLostError("口令被拒绝（检查 KALI_AGENT_WORKER_TOKEN）") from exc
+            raise WorkerLostError(f"HTTP {exc.code}") from exc
+        except (urllib.error.URLError, socket.timeout, ConnectionError, ValueError) as exc:
+            raise WorkerLostError(str(exc)) from exc
+        raise WorkerLostError("连接在返回结果前中断")
+
+
+_registry: Optional[WorkerRegistry] = None
+_registry_lock = threading.Lock()
+
+
+def get_worker_registry() -> WorkerRegistry:
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = WorkerRegistry()
+    return _registry
+
+
+__all__ = [
+    "DistributedSandbox",
+    "NoWorkerAvailableError",
+    "WorkerInfo",
+    "WorkerLostError",
+    "WorkerRegistry",
+    "get_worker_registry",
+]
@@ -0,0 +1,554 @@
+"""跨任务的渗透记录库（SQLite）：主机 / 端口 / 服务 / 发现，按项目（engagement）归档。
+
+每次 Agent 运行与 Kali 工具运行的结果都会写入规范化的表，并建有索引，
+可在毫秒级回答「所有开放 445 的主机」「所有 Apache 2.4.x」之类的查询。
+每次运行启动的外部进程的资源消耗记入 process_stats，可按工具汇总成本（tool_costs）。
+sqlmap 的测试结果按 URL 与参数记入 sqlmap_results，再次利用同一目标时据此跳过已测试过的参数。
+"""
+
+from __future__ import annotations
+
+import json
+import logging
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Iterator, Optional
+
+from config.settings import settings
+from tools.scanning import parse_nmap_output
+
+logger = logging.getLogger(__name__)
+
+BASE_DIR = Path(__file__).resolve().parents[1]
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS engagements (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    created_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    engagement_id INTEGER NOT NULL REFERENCES engagements(id),
+    kind TEXT NOT NULL,
+    tool TEXT NOT NULL,
+    target TEXT NOT NULL DEFAULT '',
+    arguments TEXT NOT NULL DEFAULT '',
+    exit_code INTEGER,
+    created_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS hosts (
+    id INTEGER PRIMARY KEY,
+    engagement_id INTEGER NOT NULL REFERENCES engagements(id),
+    address TEXT NOT NULL,
+    hostname TEXT NOT NULL DEFAULT '',
+    first_seen REAL NOT NULL,
+    last_seen REAL NOT NULL,
+    UNIQUE (engagement_id, address)
+);
+CREATE TABLE IF NOT EXISTS ports (
+    id INTEGER PRIMARY KEY,
+    host_id INTEGER NOT NULL REFERENCES hosts(id),
+    port INTEGER NOT NULL,
+    protocol TEXT NOT NULL,
+    state TEXT NOT NULL,
+    last_run_id INTEGER REFERENCES runs(id),
+    last_seen REAL NOT NULL,
+    UNIQUE (host_id, port, protocol)
+);
+CREATE TABLE IF NOT EXISTS services (
+    id INTEGER PRIMARY KEY,
+    port_id INTEGER NOT NULL REFERENCES ports(id),
+    name TEXT NOT NULL DEFAULT '',
+    product TEXT NOT NULL DEFAULT '',
+    version TEXT NOT NULL DEFAULT '',
+    extrainfo TEXT NOT NULL DEFAULT '',
+    first_seen REAL NOT NULL,
+    last_seen REAL NOT NULL,
+    UNIQUE (port_id, name, product, version)
+);
+CREATE TABLE IF NOT EXISTS findings (
+    id INTEGER PRIMARY KEY,
+    engagement_id INTEGER NOT NULL REFERENCES engagements(id),
+    run_id INTEGER REFERENCES runs(id),
+    host_id INTEGER REFERENCES hosts(id),
+    source TEXT NOT NULL,
+    severity TEXT NOT NULL DEFAULT 'info',
+    title TEXT NOT NULL,
+    detail TEXT NOT NULL DEFAULT '',
+    created_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS process_stats (
+    id INTEGER PRIMARY KEY,
+    run_id INTEGER NOT NULL REFERENCES runs(id),
+    command TEXT NOT NULL,
+    exit_code INTEGER,
+    timed_out INTEGER NOT NULL DEFAULT 0,
+    wall_s REAL NOT NULL DEFAULT 0,
+    user_s REAL,
+    sys_s REAL,
+    max_rss_kb INTEGER,
+    read_bytes INTEGER,
+    write_bytes INTEGER,
+    stdout_bytes INTEGER NOT NULL DEFAULT 0,
+    stderr_bytes INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS sqlmap_results (
+    id INTEGER PRIMARY KEY,
+    engagement_id INTEGER NOT NULL REFERENCES engagements(id),
+    url TEXT NOT NULL,
+    place TEXT NOT NULL,
+    parameter TEXT NOT NULL,
+    injectable INTEGER NOT NULL DEFAULT 0,
+    dbms TEXT NOT NULL DEFAULT '',
+    techniques TEXT NOT NULL DEFAULT '[]',
+    level INTEGER NOT NULL DEFAULT 1,
+    risk INTEGER NOT NULL DEFAULT 1,
+    first_seen REAL NOT NULL,
+    last_seen REAL NOT NULL,
+    UNIQUE (engagement_id, url, place, parameter)
+);
+CREATE INDEX IF NOT EXISTS idx_hosts_address ON hosts(address);
+CREATE INDEX IF NOT EXISTS idx_ports_port_state ON ports(port, state);
+CREATE INDEX IF NOT EXISTS idx_ports_state ON ports(state, host_id);
+CREATE INDEX IF NOT EXISTS idx_services_name ON services(name);
+CREATE INDEX IF NOT EXISTS idx_services_product_version ON services(product COLLATE NOCASE, version);
+CREATE INDEX IF NOT EXISTS idx_findings_engagement ON findings(engagement_id, source);
+CREATE INDEX IF NOT EXISTS idx_findings_host ON findings(host_id);
+CREATE INDEX IF NOT EXISTS idx_runs_engagement ON runs(engagement_id, created_at);
+CREATE INDEX IF NOT EXISTS idx_process_stats_command ON process_stats(command, created_at);
+CREATE INDEX IF NOT EXISTS idx_process_stats_run ON process_stats(run_id);
+CREATE INDEX IF NOT EXISTS idx_sqlmap_results_url ON sqlmap_results(url, parameter);
+"""
+
+
+def _version_clause(version: str) -> tuple[str, list[Any]]:
+    """版本条件：'2.4.x' / '2.4.*' 按前缀匹配，'2.4' 匹配 2.4 与 2.4.*，其余精确匹配。"""
+    v = version.strip()
+    if v.endswith((".x", ".*")):
+        return "s.version LIKE ?", [v[:-1] + "%"]
+    if v.count(".") <= 1:
+        return "(s.version = ? OR s.version LIKE ?)", [v, v + ".%"]
+    return "s.version = ?", [v]
+
+
+class EngagementDB:
+    """线程安全的 SQLite 记录库；每个线程一个连接，WAL 模式。"""
+
+    def __init__(self, path: Optional[str | Path] = None) -> None:
+        raw = Path(path or settings.engagement_db_path)
+        self.path = raw if raw.is_absolute() else BASE_DIR / raw
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._local = threading.local()
+        self._conn().executescript(_SCHEMA)
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(str(self.path), timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA foreign_keys=ON")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _tx(self) -> Iterator[sqlite3.Connection]:
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    # ---------- 写入 ----------
+
+    def _engagement_id(self, conn: sqlite3.Connection, name: str) -> int:
+        name = (name or settings.default_engagement).strip() or "default"
+        conn.execute(
+            "INSERT OR IGNORE INTO engagements (name, created_at) VALUES (?, ?)",
+            (name, time.time()),
+        )
+        return conn.execute("SELECT id FROM engagements WHERE name = ?", (name,)).fetchone()[0]
+
+    def _host_id(self, conn: sqlite3.Connection, engagement_id: int, address: str, hostname: str, now: float) -> int:
+        conn.execute(
+            "INSERT INTO hosts (engagement_id, address, hostname, first_seen, last_seen) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT (engagement_id, address) DO UPDATE SET last_seen = excluded.last_seen, "
+            "hostname = CASE WHEN excluded.hostname != '' THEN excluded.hostname ELSE hosts.hostname END",
+            (engagement_id, address, hostname, now, now),
+        )
+        return conn.execute(
+            "SELECT id FROM hosts WHERE engagement_id = ? AND address = ?", (engagement_id, address)
+        ).fetchone()[0]
+
+    def _ingest_hosts(self, conn: sqlite3.Connection, engagement_id: int, run_id: int, hosts: list[dict], now: float) -> int:
+        count = 0
+        for host in hosts:
+            host_id = self._host_id(conn, engagement_id, host["address"], host.get("hostname", ""), now)
+            for p in host.get("ports", []):
+                conn.execute(
+                    "INSERT INTO ports (host_id, port, protocol, state, last_run_id, last_seen) VALUES (?, ?, ?, ?, ?, ?) "
+                    "ON CONFLICT (host_id, port, protocol) DO UPDATE SET state = excluded.state, "
+                    "last_run_id = excluded.last_run_id, last_seen = excluded.last_seen",
+                    (host_id, p["port"], p["protocol"], p["state"], run_id, now),
+                )
+                port_id = conn.execute(
+                    "SELECT id FROM ports WHERE host_id = ? AND port = ? AND protocol = ?",
+                    (host_id, p["port"], p["protocol"]),
+                ).fetchone()[0]
+                conn.execute(
+                    "INSERT INTO services (port_id, name, product, version, extrainfo, first_seen, last_seen) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (port_id, name, product, version) DO UPDATE SET "
+                    "extrainfo = excluded.extrainfo, last_seen = excluded.last_seen",
+                    (port_id, p.get("service", ""), p.get("product", ""), p.get("version", ""), p.get("extrainfo", ""), now, now),
+                )
+                count += 1
+        return count
+
+    def _new_run(self, conn: sqlite3.Connection, engagement_id: int, kind: str, tool: str, target: str, arguments: str, exit_code: Optional[int], now: float) -> int:
+        cur = conn.execute(
+            "INSERT INTO runs (engagement_id, kind, tool, target, arguments, exit_code, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (engagement_id, kind, tool, target or "", arguments or "", exit_code, now),
+        )
+        return int(cur.lastrowid)
+
+    def _record_processes(self, conn: sqlite3.Connection, run_id: int, processes: Optional[list[dict[str, Any]]], now: float) -> None:
+        """写入进程摘要（ProcessResult.summary()）中的资源消耗；Docker / worker 进程没有 CPU 与内存数据，存 NULL。"""
+        for p in processes or []:
+            usage = p.get("usage") or {}
+            conn.execute(
+                "INSERT INTO process_stats (run_id, command, exit_code, timed_out, wall_s, user_s, sys_s, max_rss_kb, "
+                "read_bytes, write_bytes, stdout_bytes, stderr_bytes, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    run_id, p.get("command") or "", p.get("exit_code"), int(bool(p.get("timed_out"))),
+                    usage.get("wall_s", p.get("elapsed", 0)), usage.get("user_s"), usage.get("sys_s"),
+                    usage.get("max_rss_kb"), usage.get("read_bytes"), usage.get("write_bytes"),
+                    usage.get("stdout_bytes", 0), usage.get("stderr_bytes", 0), now,
+                ),
+            )
+
+    def add_finding(
+        self,
+        engagement: str,
+        source: str,
+        title: str,
+        detail: str = "",
+        severity: str = "info",
+        host: str = "",
+        run_id: Optional[int] = None,
+    ) -> int:
+        now = time.time()
+        with self._tx() as conn:
+            eid = self._engagement_id(conn, engagement)
+            host_id = self._host_id(conn, eid, host, "", now) if host else None
+            cur = conn.execute(
+                "INSERT INTO findings (engagement_id, run_id, host_id, source, severity, title, detail, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (eid, run_id, host_id, source, severity, title, detail, now),
+            )
+            return int(cur.lastrowid)
+
+    def record_agent_run(self, state: dict[str, Any], engagement: str = "", processes: Optional[list[dict[str, Any]]] = None) -> int:
+        """写入一次 Agent 运行：Nmap 结果拆成主机/端口/服务，LLM 分析与决策记为发现，processes 为期间外部进程的摘要。返回 run_id。"""
+        now = time.time()
+        target = state.get("target", "")
+        with self._tx() as conn:
+            eid = self._engagement_id(conn, engagement)
+            run_id = self._new_run(conn, eid, "agent", "nmap", target, state.get("nmap_arguments", ""), None, now)
+            self._record_processes(conn, run_id, processes, now)
+            hosts = parse_nmap_output(state.get("recon_result") or "", default_host=target)
+            self._ingest_hosts(conn, eid, run_id, hosts, now)
+            # 单主机扫描时把分析/决策关联到该主机，网段扫描则只关联到项目
+            host_id = self._host_id(conn, eid, hosts[0]["address"], "", now) if len(hosts) == 1 else None
+            analysis = (state.get("analysis") or "").strip()
+            if analysis:
+                conn.execute(
+                    "INSERT INTO findings (engagement_id, run_id, host_id, source, severity, title, detail, created_at) "
+                    "VALUES (?, ?, ?, 'llm_analysis', 'info', ?, ?, ?)",
+                    (eid, run_id, host_id, f"LLM 分析: {target}", analysis, now),
+                )
+            decision = (state.get("decision") or "").strip()
+            if decision:
+                try:
+                    dangerous = bool(json.loads(decision).get("dangerous", True))
+                except (ValueError, TypeError, AttributeError):
+                    dangerous = True
+                conn.execute(
+                    "INSERT INTO findings (engagement_id, run_id, host_id, source, severity, title, detail, created_at) "
+                    "VALUES (?, ?, ?, 'llm_decision', ?, ?, ?, ?)",
+                    (eid, run_id, host_id, "high" if dangerous else "info", f"决策: {target}", decision, now),
+                )
+            return run_id
+
+    def record_tool_run(
+        self,
+        tool: str,
+        params: dict[str, Any],
+        exit_code: int,
+        stdout: str,
+        stderr: str = "",
+        engagement: str = "",
+        processes: Optional[list[dict[str, Any]]] = None,
+    ) -> int:
+        """写入一次 Kali 工具运行：nmap 输出按主机/端口/服务入库，其余工具输出记为发现。返回 run_id。"""
+        now = time.time()
+        target = str(params.get("target") or params.get("url") or params.get("domain") or params.get("host") or params.get("keyword") or "")
+        arguments = json.dumps(params, ensure_ascii=False, sort_keys=True)
+        with self._tx() as conn:
+            eid = self._engagement_id(conn, engagement)
+            run_id = self._new_run(conn, eid, "tool", tool, target, arguments, exit_code, now)
+            self._record_processes(conn, run_id, processes, now)
+            if tool == "nmap":
+                self._ingest_hosts(conn, eid, run_id, parse_nmap_output(stdout, default_host=target), now)
+            elif exit_code == 0 and stdout.strip():
+                conn.execute(
+                    "INSERT INTO findings (engagement_id, run_id, host_id, source, severity, title, detail, created_at) "
+                    "VALUES (?, ?, NULL, ?, 'info', ?, ?, ?)",
+                    (eid, run_id, tool, f"{tool}: {target}", stdout[:20000], now),
+                )
+            return run_id
+
+    def record_sqlmap_results(
+        self,
+        url: str,
+        results: list[dict[str, Any]],
+        engagement: str = "",
+        dbms: str = "",
+        level: int = 1,
+        risk: int = 1,
+    ) -> int:
+        """写入 sqlmap 对某个 URL 各参数的测试结果（见 tools/exploitation.parse_sqlmap_output），返回写入条数。
+
+        url 为去掉查询串的规范化地址；已确认可注入的参数不会被之后的「未发现」覆盖，
+        level / risk 记录已测试过的强度：只有新一次的 level 与 risk 都不低于已记录的值时才替换，
+        否则保留原记录（两次测试互不覆盖时按较早的一次判断，宁可重测也不误跳过）。
+        """
+        now = time.time()
+        with self._tx() as conn:
+            eid = self._engagement_id(conn, engagement)
+            for r in results:
+                conn.execute(
+                    "INSERT INTO sqlmap_results (engagement_id, url, place, parameter, injectable, dbms, techniques, "
+                    "level, risk, first_seen, last_seen) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                    "ON CONFLICT (engagement_id, url, place, parameter) DO UPDATE SET "
+                    "injectable = MAX(injectable, excluded.injectable), "
+                    "dbms = CASE WHEN excluded.dbms != '' THEN excluded.dbms ELSE dbms END, "
+                    "techniques = CASE WHEN excluded.injectable THEN excluded.techniques ELSE techniques END, "
+                    "level = CASE WHEN excluded.level >= level AND excluded.risk >= risk THEN excluded.level ELSE level END, "
+                    "risk = CASE WHEN excluded.level >= level AND excluded.risk >= risk THEN excluded.risk ELSE risk END, "
+                    "last_seen = excluded.last_seen",
+                    (
+                        eid, url, r.get("place") or "", r.get("parameter") or "", int(bool(r.get("injectable"))),
+                        dbms if r.get("injectable") else "",
+                        json.dumps(r.get("techniques") or [], ensure_ascii=False),
+                        int(level), int(risk), now, now,
+                    ),
+                )
+            return len(results)
+
+    # ---------- 查询 ----------
+
+    def _rows(self, sql: str, args: list[Any]) -> list[dict[str, Any]]:
+        return [dict(r) for r in self._conn().execute(sql, args).fetchall()]
+
+    def list_engagements(self) -> list[dict[str, Any]]:
+        return self._rows(
+            "SELECT e.id, e.name, e.created_at, "
+            "(SELECT COUNT(*) FROM hosts h WHERE h.engagement_id = e.id) AS hosts, "
+            "(SELECT COUNT(*) FROM runs r WHERE r.engagement_id = e.id) AS runs "
+            "FROM engagements e ORDER BY e.created_at",
+            [],
+        )
+
+    def query_services(
+        self,
+        port: Optional[int] = None,
+        protocol: str = "",
+        state: str = "open",
+        service: str = "",
+        product: str = "",
+        version: str = "",
+        address: str = "",
+        engagement: str = "",
+        limit: int = 1000,
+    ) -> list[dict[str, Any]]:
+        """按端口 / 服务 / 产品 / 版本查询，返回主机 + 端口 + 服务的扁平行。"""
+        where: list[str] = []
+        args: list[Any] = []
+        if port is not None:
+            where.append("p.port = ?")
+            args.append(int(port))
+        if protocol:
+            where.append("p.protocol = ?")
+            args.append(protocol)
+        if state:
+            where.append("p.state = ?")
+            args.append(state)
+        if service:
+            where.append("s.name = ?")
+            args.append(service)
+        if product:
+            where.append("s.product LIKE ? COLLATE NOCASE")
+            args.append(product.strip() + "%")
+        if version:
+            clause, vargs = _version_clause(version)
+            where.append(clause)
+            args.extend(vargs)
+        if address:
+            where.append("h.address = ?")
+            args.append(address)
+        if engagement:
+            where.append("e.name = ?")
+            args.append(engagement)
+        sql = (
+            "SELECT e.name AS engagement, h.address, h.hostname, p.port, p.protocol, p.state, "
+            "s.name AS service, s.product, s.version, s.extrainfo, s.last_seen "
+            "FROM ports p JOIN hosts h ON h.id = p.host_id JOIN engagements e ON e.id = h.engagement_id "
+            "LEFT JOIN services s ON s.port_id = p.id"
+        )
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY h.address, p.port LIMIT ?"
+        args.append(max(1, min(int(limit), 10000)))
+        return self._rows(sql, args)
+
+    def query_hosts(self, port: Optional[int] = None, state: str = "open", service: str = "", engagement: str = "", limit: int = 1000) -> list[dict[str, Any]]:
+        """按开放端口 / 服务筛选主机（去重），附带该主机的开放端口列表。"""
+        where = ["1 = 1"]
+        args: list[Any] = []
+        if engagement:
+            where.append("e.name = ?")
+            args.append(engagement)
+        if port is not None or service:
+            sub = ["p.host_id = h.id"]
+            if port is not None:
+                sub.append("p.port = ?")
+                args.append(int(port))
+            if state:
+                sub.append("p.state = ?")
+                args.append(state)
+            if service:
+                sub.append("EXISTS (SELECT 1 FROM services s WHERE s.port_id = p.id AND s.name = ?)")
+                args.append(service)
+            where.append("EXISTS (SELECT 1 FROM ports p WHERE " + " AND ".join(sub) + ")")
+        args.append(max(1, min(int(limit), 10000)))
+        rows = self._rows(
+            "SELECT e.name AS engagement, h.address, h.hostname, h.first_seen, h.last_seen, "
+            "(SELECT GROUP_CONCAT(p2.port || '/' || p2.protocol, ',') FROM ports p2 "
+            " WHERE p2.host_id = h.id AND p2.state = 'open') AS open_ports "
+            "FROM hosts h JOIN engagements e ON e.id = h.engagement_id WHERE " + " AND ".join(where) +
+            " ORDER BY h.address LIMIT ?",
+            args,
+        )
+        for r in rows:
+            r["open_ports"] = [p for p in (r["open_ports"] or "").split(",") if p]
+        return rows
+
+    def query_findings(self, source: str = "", address: str = "", engagement: str = "", limit: int = 200) -> list[dict[str, Any]]:
+        where = ["1 = 1"]
+        args: list[Any] = []
+        if source:
+            where.append("f.source = ?")
+            args.append(source)
+        if address:
+            where.append("h.address = ?")
+            args.append(address)
+        if engagement:
+            where.append("e.name = ?")
+            args.append(engagement)
+        args.append(max(1, min(int(limit), 10000)))
+        return self._rows(
+            "SELECT f.id, e.name AS engagement, h.address, f.source, f.severity, f.title, f.detail, f.created_at "
+            "FROM findings f JOIN engagements e ON e.id = f.engagement_id LEFT JOIN hosts h ON h.id = f.host_id "
+            "WHERE " + " AND ".join(where) + " ORDER BY f.created_at DESC LIMIT ?",
+            args,
+        )
+
+    def query_sqlmap_results(
+        self,
+        url: str = "",
+        parameter: str = "",
+        engagement: str = "",
+        injectable: Optional[bool] = None,
+        limit: int = 1000,
+    ) -> list[dict[str, Any]]:
+        """按 URL / 参数查询 sqlmap 测试结果（url 为规范化地址，见 tools/exploitation.normalize_url）。"""
+        where = ["1 = 1"]
+        args: list[Any] = []
+        if url:
+            where.append("r.url = ?")
+            args.append(url)
+        if parameter:
+            where.append("r.parameter = ?")
+            args.append(parameter)
+        if engagement:
+            where.append("e.name = ?")
+            args.append(engagement)
+        if injectable is not None:
+            where.append("r.injectable = ?")
+            args.append(int(injectable))
+        args.append(max(1, min(int(limit), 10000)))
+        rows = self._rows(
+            "SELECT e.name AS engagement, r.url, r.place, r.parameter, r.injectable, r.dbms, r.techniques, "
+            "r.level, r.risk, r.first_seen, r.last_seen "
+            "FROM sqlmap_results r JOIN engagements e ON e.id = r.engagement_id "
+            "WHERE " + " AND ".join(where) + " ORDER BY r.url, r.place, r.parameter LIMIT ?",
+            args,
+        )
+        for r in rows:
+            r["injectable"] = bool(r["injectable"])
+            r["techniques"] = json.loads(r["techniques"] or "[]")
+        return rows
+
+    def tool_costs(self, engagement: str = "", command: str = "", since: float = 0.0) -> list[dict[str, Any]]:
+        """按外部命令汇总资源消耗：次数、超时数、平均/最大用时、CPU 秒、峰值内存、磁盘 I/O 与输出大小。"""
+        where = ["1 = 1"]
+        args: list[Any] = []
+        if engagement:
+            where.append("e.name = ?")
+            args.append(engagement)
+        if command:
+            where.append("ps.command = ?")
+            args.append(command)
+        if since:
+            where.append("ps.created_at >= ?")
+            args.append(float(since))
+        rows = self._rows(
+            "SELECT ps.command, COUNT(*) AS runs, SUM(ps.timed_out) AS timeouts, "
+            "AVG(ps.wall_s) AS avg_wall_s, MAX(ps.wall_s) AS max_wall_s, SUM(ps.wall_s) AS total_wall_s, "
+            "AVG(ps.user_s + ps.sys_s) AS avg_cpu_s, SUM(ps.user_s + ps.sys_s) AS total_cpu_s, "
+            "MAX(ps.max_rss_kb) AS max_rss_kb, AVG(ps.read_bytes) AS avg_read_bytes, AVG(ps.write_bytes) AS avg_write_bytes, "
+            "AVG(ps.stdout_bytes + ps.stderr_bytes) AS avg_output_bytes "
+            "FROM process_stats ps JOIN runs r ON r.id = ps.run_id JOIN engagements e ON e.id = r.engagement_id "
+            "WHERE " + " AND ".join(where) + " GROUP BY ps.command ORDER BY total_wall_s DESC",
+            args,
+        )
+        for r in rows:
+            for k, v in r.items():
+                if isinstance(v, float):
+                    r[k] = round(v, 3)
+        return rows
+
+
+_db: Optional[EngagementDB] = None
+_db_lock = threading.Lock()
+
+
+def get_engagement_db() -> EngagementDB:
+    """返回进程内共享的记录库实例。"""
+    global _db
+    with _db_lock:
+        if _db is None:
+            _db = EngagementDB()
+        return _db
+
+
+__all__ = ["EngagementDB", "get_engagement_db"]
@@ -0,0 +1,275 @@
+"""Agent / 工具 → 流式响应的有界事件通道。
+
+工作线程调用 `put`、事件循环上的协程（异步 Agent 节点、Nmap 子进程回调）调用 `await aput` 推送事件，
+流式响应用 `await get()` / `get_nowait()` 读取（接口与 asyncio.Queue 一致，可直接交给 read_frame）。
+通道绑定在 contextvars 上下文中：asyncio 任务与 asyncio.to_thread 启动的线程都会继承。
+
+容量有限，满时按策略处理进度行（("progress_line", channel, line)）：
+- block：生产者等待消费者腾出空间（最多 block_timeout 秒，超时丢弃该行）
+- drop_oldest：丢弃队列中最早的一条进度行
+- coalesce：不再入队，只为该通道累计「已省略 N 行」，消费者读到 ("progress_dropped", channel, n)
+
+step / done 等控制事件从不丢弃，因此单个任务的内存占用恒定，与工具输出量和客户端速度无关。
+BroadcastChannel 把同一任务的事件分发给多个 EventChannel（相同任务合并时使用）。分发不等待任何订阅者：
+满了的订阅者即使是 block 策略也只为自己累计「已省略 N 行」，一个慢客户端不会拖慢生产者与其他订阅者。
+"""
+
+from __future__ import annotations
+
+import asyncio
+import contextvars
+import threading
+from collections import deque
+from typing import Optional
+
+POLICIES = ("block", "drop_oldest", "coalesce")
+
+
+def _is_progress(event: tuple) -> bool:
+    return bool(event) and event[0] == "progress_line"
+
+
+class EventChannel:
+    """有界、线程安全的事件通道（多生产者线程，单个 asyncio 消费者）。"""
+
+    def __init__(
+        self,
+        capacity: int = 2000,
+        policy: str = "coalesce",
+        block_timeout: float = 10.0,
+        loop: Optional[asyncio.AbstractEventLoop] = None,
+    ) -> None:
+        if policy not in POLICIES:
+            raise ValueError(f"未知的溢出策略: {policy}，可选: {', '.join(POLICIES)}")
+        self.capacity = max(int(capacity), 1)
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.dropped = 0
+        self._loop = loop or asyncio.get_event_loop()
+        self._items: deque = deque()
+        self._progress_count = 0
+        # coalesce 策略下每个通道至多一个「省略计数」标记留在队列里
+        self._markers: dict[str, list] = {}
+        self._lock = threading.Lock()
+        self._not_full = threading.Condition(self._lock)
+        self._waiter: Optional[asyncio.Future] = None
+        # 事件循环上的生产者（aput）在 block 策略下等待空间
+        self._space_waiters: list[asyncio.Future] = []
+        self._closed = False
+
+    def put(self, event: tuple) -> bool:
+        """线程安全地推送事件；返回 False 表示事件被丢弃或计入省略数。
+
+        block 策略下会阻塞调用线程，事件循环上的协程应改用 aput。
+        """
+        with self._lock:
+            return self._put_locked(event)
+
+    async def aput(self, event: tuple) -> bool:
+        """事件循环侧推送：block 策略下以协程方式等待空间（最多 block_timeout 秒），不阻塞事件循环。"""
+        deadline = self._loop.time() + self.block_timeout
+        while True:
+            with self._lock:
+                full = _is_progress(event) and self._progress_count >= self.capacity
+                if self._closed or not full or self.policy != "block":
+                    return self._put_locked(event)
+                remaining = deadline - self._loop.time()
+                if remaining <= 0:
+                    self.dropped += 1
+                    return False
+                waiter = self._loop.create_future()
+                self._space_waiters.append(waiter)
+            await asyncio.wait({waiter}, timeout=remaining)
+            with self._lock:
+                if waiter in self._space_waiters:
+                    self._space_waiters.remove(waiter)
+
+    def offer(self, event: tuple) -> bool:
+        """不等待地推送（BroadcastChannel 分发时使用）：满时 block 策略也不等待，改为计入「已省略 N 行」，
+        慢的订阅者只丢自己的进度行，不拖慢生产者与其他订阅者。"""
+        with self._lock:
+            if self.policy == "block" and not self._closed and _is_progress(event) and self._progress_count >= self.capacity:
+                return self._coalesce(event)
+            return self._put_locked(event)
+
+    # 以下方法均在持有 self._lock 时调用
+    def _put_locked(self, event: tuple) -> bool:
+        if self._closed:
+            return False
+        if _is_progress(event) and self._progress_count >= self.capacity:
+            if not self._make_room(event):
+                return False
+        self._items.append(event)
+        if _is_progress(event):
+            self._progress_count += 1
+        self._wake_consumer()
+        return True
+
+    def _make_room(self, event: tuple) -> bool:
+        if self.policy == "block":
+            self._not_full.wait_for(
+                lambda: self._closed or self._progress_count < self.capacity,
+                timeout=self.block_timeout,
+            )
+            if self._closed or self._progress_count >= self.capacity:
+                self.dropped += 1
+                return False
+            return True
+        if self.policy == "drop_oldest":
+            for i, item in enumerate(self._items):
+                if _is_progress(item):
+                    del self._items[i]
+                    self._progress_count -= 1
+                    self.dropped += 1
+                    return True
+            return True
+        return self._coalesce(event)
+
+    def _coalesce(self, event: tuple) -> bool:
+        channel = event[1]
+        marker = self._markers.get(channel)
+        if marker is None:
+            marker = ["progress_dropped", channel, 0]
+            self._markers[channel] = marker
+            self._items.append(marker)
+            self._wake_consumer()
+        marker[2] += 1
+        self.dropped += 1
+        return False
+
+    def _wake_consumer(self) -> None:
+        waiter = self._waiter
+        if waiter is not None:
+            self._waiter = None
+            self._loop.call_soon_threadsafe(_resolve, waiter)
+
+    def _pop(self) -> tuple:
+        item = self._items.popleft()
+        if isinstance(item, list):
+            # 省略计数标记：取出时定格数值，之后的溢出重新计数
+            self._markers.pop(item[1], None)
+            return tuple(item)
+        if _is_progress(item):
+            self._progress_count -= 1
+            self._not_full.notify()
+            if self._space_waiters:
+                self._loop.call_soon_threadsafe(_resolve, self._space_waiters.pop(0))
+        return item
+
+    def get_nowait(self) -> tuple:
+        """事件循环侧非阻塞读取；为空时抛 asyncio.QueueEmpty。"""
+        with self._lock:
+            if not self._items:
+                raise asyncio.QueueEmpty
+            return self._pop()
+
+    async def get(self) -> tuple:
+        """事件循环侧等待下一条事件。"""
+        while True:
+            with self._lock:
+                if self._items:
+                    return self._pop()
+                waiter = self._loop.create_future()
+                self._waiter = waiter
+            try:
+                await waiter
+            finally:
+                with self._lock:
+                    if self._waiter is waiter:
+                        self._waiter = None
+
+    def qsize(self) -> int:
+        with self._lock:
+            return len(self._items)
+
+    def close(self) -> None:
+        """消费者离开（如客户端断开）后关闭：之后的 put 直接丢弃，阻塞中的生产者立即返回。"""
+        with self._lock:
+            self._closed = True
+            self._items.clear()
+            self._markers.clear()
+            self._progress_count = 0
+            self._not_full.notify_all()
+            for waiter in self._space_waiters:
+                self._loop.call_soon_threadsafe(_resolve, waiter)
+            self._space_waiters.clear()
+
+
+class BroadcastChannel:
+    """把一个任务的事件分发给多个订阅通道（相同任务合并后，多个流式请求共享同一次 Agent 运行）。
+
+    put / aput 与 EventChannel 一致，可直接 bind_channel 给任务；进度行以外的事件（step、queue 等）
+    另存一份历史，后加入的订阅者先收到历史再接收后续事件。没有订阅者时事件直接丢弃。
+    """
+
+    def __init__(self) -> None:
+        self._subscribers: list[EventChannel] = []
+        self._history: list[tuple] = []
+        self._lock = threading.Lock()
+
+    def subscribe(self, channel: EventChannel) -> None:
+        with self._lock:
+            # 历史中没有进度行，put 不会阻塞
+            for event in self._history:
+                channel.put(event)
+            self._subscribers.append(channel)
+
+    def unsubscribe(self, channel: EventChannel) -> None:
+        with self._lock:
+            if channel in self._subscribers:
+                self._subscribers.remove(channel)
+
+    @property
+    def subscribers(self) -> int:
+        with self._lock:
+            return len(self._subscribers)
+
+    def _fanout(self, event: tuple) -> list[EventChannel]:
+        with self._lock:
+            if not _is_progress(event):
+                self._history.append(event)
+            return list(self._subscribers)
+
+    def offer(self, event: tuple) -> bool:
+        """分发给所有订阅者且不等待（见 EventChannel.offer）：满了的订阅者只为自己计入省略数。"""
+        delivered = False
+        for channel in self._fanout(event):
+            delivered = channel.offer(event) or delivered
+        return delivered
+
+    def put(self, event: tuple) -> bool:
+        return self.offer(event)
+
+    async def aput(self, event: tuple) -> bool:
+        return self.offer(event)
+
+
+def _resolve(fut: asyncio.Future) -> None:
+    if not fut.done():
+        fut.set_result(None)
+
+
+_channel_var: contextvars.ContextVar[Optional[EventChannel | BroadcastChannel]] = contextvars.ContextVar(
+    "youkai_event_channel", default=None
+)
+
+
+def bind_channel(channel: Optional[EventChannel | BroadcastChannel]) -> None:
+    """把事件通道绑定到当前上下文（协程任务或线程），供工具（如 nmap_scan）推送实时输出。"""
+    _channel_var.set(channel)
+
+
+def current_channel() -> Optional[EventChannel | BroadcastChannel]:
+    """当前上下文若在流式请求中，返回其事件通道，否则为 None。"""
+    return _channel_var.get()
+
+
+def emit(event: tuple) -> bool:
+    """向当前上下文绑定的通道推送事件（不阻塞，控制事件从不丢弃）；未绑定时忽略并返回 False。"""
+    channel = current_channel()
+    if channel is None:
+        return False
+    return channel.put(event)
+
+
+__all__ = ["POLICIES", "BroadcastChannel", "EventChannel", "bind_channel", "current_channel", "emit"]
@@ -0,0 +1,241 @@
+"""多提供商 LLM 路由：按各提供商的延迟与错误率选择、出错或超时自动切换，可选对冲请求。
+
+- 每个提供商记录最近 N 次调用的延迟（p95）与成败；连续失败后冷却一段时间，期间排到最后。
+- 失败转移：当前提供商报错或超过 settings.llm_timeout 秒未返回，改用下一个。
+- 对冲（settings.llm_hedge）：首个请求超过其 p95 仍未返回时，向下一个提供商再发一份，取先返回的结果；
+  异步调用（ainvoke）会取消落后的请求，同步调用（invoke）丢弃其结果。
+
+Anthropic 的提示缓存标记按实际选中的提供商添加（见 core/prompts.py）。
+对外接口与 LangChain 聊天模型一致：invoke(messages) / ainvoke(messages)，返回 AIMessage。
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import TYPE_CHECKING, Any, Optional
+
+from config.settings import settings
+from core.prompts import apply_cache_control
+
+if TYPE_CHECKING:
+    from langchain_core.language_models.chat_models import BaseChatModel
+
+logger = logging.getLogger(__name__)
+
+# 统计窗口：最近多少次调用
+_WINDOW = 50
+# 样本少于该数时不对冲（p95 不可靠）
+_MIN_SAMPLES = 5
+# 连续失败多少次进入冷却
+_FAILURE_THRESHOLD = 3
+
+
+class ProviderStats:
+    """单个提供商的延迟与错误统计（线程安全）。"""
+
+    def __init__(self) -> None:
+        self.latencies: deque[float] = deque(maxlen=_WINDOW)
+        self.outcomes: deque[bool] = deque(maxlen=_WINDOW)
+        self.consecutive_failures = 0
+        self.cooldown_until = 0.0
+        self.hedged = 0
+        self._lock = threading.Lock()
+
+    def record(self, ok: bool, latency: float) -> None:
+        with self._lock:
+            self.outcomes.append(ok)
+            if ok:
+                self.latencies.append(latency)
+                self.consecutive_failures = 0
+                return
+            self.consecutive_failures += 1
+            if self.consecutive_failures >= _FAILURE_THRESHOLD:
+                self.cooldown_until = time.monotonic() + settings.llm_cooldown_seconds
+
+    def p95(self) -> Optional[float]:
+        with self._lock:
+            if len(self.latencies) < _MIN_SAMPLES:
+                return None
+            ordered = sorted(self.latencies)
+            return ordered[min(int(len(ordered) * 0.95), len(ordered) - 1)]
+
+    @property
+    def error_rate(self) -> float:
+        with self._lock:
+            return (self.outcomes.count(False) / len(self.outcomes)) if self.outcomes else 0.0
+
+    @property
+    def cooling(self) -> bool:
+        return time.monotonic() < self.cooldown_until
+
+    def snapshot(self) -> dict[str, Any]:
+        p95 = self.p95()
+        with self._lock:
+            lat = list(self.latencies)
+        return {
+            "calls": len(self.outcomes),
+            "error_rate": round(self.error_rate, 3),
+            "p50": round(sorted(lat)[len(lat) // 2], 3) if lat else None,
+            "p95": round(p95, 3) if p95 is not None else None,
+            "cooling": self.cooling,
+            "hedged": self.hedged,
+        }
+
+
+class AllProvidersFailedError(RuntimeError):
+    """所有提供商都失败或超时。"""
+
+
+_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="llm-router")
+
+
+class LLMRouter:
+    """在多个已配置的提供商之间失败转移 / 对冲的 LLM。"""
+
+    def __init__(self, providers: list[tuple[str, "BaseChatModel"]]) -> None:
+        if not providers:
+            raise ValueError("LLMRouter 至少需要一个提供商")
+        self.providers = providers
+        self.stats: dict[str, ProviderStats] = {name: ProviderStats() for name, _ in providers}
+
+    def ordered(self) -> list[tuple[str, "BaseChatModel"]]:
+        """冷却中的提供商排最后；其余按配置顺序，错误率明显偏高的后移。"""
+        def rank(item: tuple[int, tuple[str, Any]]) -> tuple:
+            idx, (name, _) = item
+            st = self.stats[name]
+            return (st.cooling, round(st.error_rate, 1), idx)
+
+        return [p for _, p in sorted(enumerate(self.providers), key=rank)]
+
+    def _hedge_delay(self, name: str) -> Optional[float]:
+        if not settings.llm_hedge:
+            return None
+        return self.stats[name].p95()
+
+    # ---------- 同步 ----------
+    def _call(self, name: str, llm: "BaseChatModel", messages: Any, kwargs: dict) -> Any:
+        started = time.monotonic()
+        try:
+            resp = llm.invoke(apply_cache_control(messages, name), **kwargs)
+        except Exception:
+            self.stats[name].record(False, time.monotonic() - started)
+            raise
+        self.stats[name].record(True, time.monotonic() - started)
+        return resp
+
+    def invoke(self, messages: Any, **kwargs: Any) -> Any:
+        candidates = self.ordered()
+        errors: list[str] = []
+        i = 0
+        while i < len(candidates):
+            name, llm = candidates[i]
+            i += 1
+            pending: dict[Future, str] = {_executor.submit(self._call, name, llm, messages, kwargs): name}
+            started = time.monotonic()
+            hedge_at = self._hedge_delay(name)
+            while pending:
+                now = time.monotonic()
+                limit = started + settings.llm_timeout - now
+                if hedge_at is not None and i < len(candidates):
+                    limit = min(limit, started + hedge_at - now)
+                done, _ = wait(pending, timeout=max(limit, 0), return_when=FIRST_COMPLETED)
+                for fut in done:
+                    owner = pending.pop(fut)
+                    try:
+                        resp = fut.result()
+                    except Exception as exc:  # noqa: BLE001
+                        errors.append(f"{owner}: {exc}")
+                        logger.warning("LLM provider %s failed: %s", owner, exc)
+                        continue
+                    for other in pending:
+                        other.cancel()  # 未开始的直接取消；已在执行的结果被丢弃
+                    return resp
+                if not done and hedge_at is not None and i < len(candidates):
+                    # 超过 p95 仍未返回：向下一个提供商发对冲请求
+                    hedge_name, hedge_llm = candidates[i]
+                    i += 1
+                    self.stats[name].hedged += 1
+                    logger.info("LLM hedge: %s slower than p95 %.2fs, also asking %s", name, hedge_at, hedge_name)
+                    pending[_executor.submit(self._call, hedge_name, hedge_llm, messages, kwargs)] = hedge_name
+                    hedge_at = None
+                    continue
+                if not done and time.monotonic() - started >= settings.llm_timeout:
+                    # 超时的线程仍会跑完，届时由 _call 记录其真实延迟
+                    for fut, owner in pending.items():
+                        fut.cancel()
+                        errors.append(f"{owner}: 超时（>{settings.llm_timeout:.0f}s）")
+                    pending.clear()
+            # 当前提供商（及其对冲）均失败，继续下一个
+        raise AllProvidersFailedError("所有 LLM 提供商均失败：" + "；".join(errors))
+
+    # ---------- 异步 ----------
+    async def _acall(self, name: str, llm: "BaseChatModel", messages: Any, kwargs: dict) -> Any:
+        started = time.monotonic()
+        try:
+            resp = await llm.ainvoke(apply_cache_control(messages, name), **kwargs)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.stats[name].record(False, time.monotonic() - started)
+            raise
+        self.stats[name].record(True, time.monotonic() - started)
+        return resp
+
+    async def ainvoke(self, messages: Any, **kwargs: Any) -> Any:
+        candidates = self.ordered()
+        errors: list[str] = []
+        i = 0
+        while i < len(candidates):
+            name, llm = candidates[i]
+            i += 1
+            pending: dict[asyncio.Task, str] = {asyncio.ensure_future(self._acall(name, llm, messages, kwargs)): name}
+            loop = asyncio.get_running_loop()
+            started = loop.time()
+            hedge_at = self._hedge_delay(name)
+            try:
+                while pending:
+                    limit = started + settings.llm_timeout - loop.time()
+                    if hedge_at is not None and i < len(candidates):
+                        limit = min(limit, started + hedge_at - loop.time())
+                    done, _ = await asyncio.wait(pending, timeout=max(limit, 0), return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        owner = pending.pop(task)
+                        if task.exception() is not None:
+                            errors.append(f"{owner}: {task.exception()}")
+                            logger.warning("LLM provider %s failed: %s", owner, task.exception())
+                            continue
+                        return task.result()
+                    if not done and hedge_at is not None and i < len(candidates):
+                        hedge_name, hedge_llm = candidates[i]
+                        i += 1
+                        self.stats[name].hedged += 1
+                        logger.info("LLM hedge: %s slower than p95 %.2fs, also asking %s", name, hedge_at, hedge_name)
+                        pending[asyncio.ensure_future(self._acall(hedge_name, hedge_llm, messages, kwargs))] = hedge_name
+                        hedge_at = None
+                        continue
+                    if not done and loop.time() - started >= settings.llm_timeout:
+                        for owner in pending.values():
+                            self.stats[owner].record(False, settings.llm_timeout)
+                            errors.append(f"{owner}: 超时（>{settings.llm_timeout:.0f}s）")
+                        break
+            finally:
+                # 取消落后 / 超时的请求
+                for task in pending:
+                    task.cancel()
+        raise AllProvidersFailedError("所有 LLM 提供商均失败：" + "；".join(errors))
+
+    def snapshot(self) -> dict[str, Any]:
+        return {
+            "hedge": settings.llm_hedge,
+            "timeout": settings.llm_timeout,
+            "order": [name for name, _ in self.ordered()],
+            "providers": {name: self.stats[name].snapshot() for name, _ in self.providers},
+        }
+
+
+__all__ = ["AllProvidersFailedError", "LLMRouter", "ProviderStats"]
@@ -0,0 +1,161 @@
+"""按请求开启的采样式性能剖析（调试用）。
+
+只在显式开启时创建采样线程：定期读取 `sys._current_frames()` 中被关注线程的调用栈，
+聚合为 flame graph 兼容的 folded stacks 文本（每行 `frame;frame;frame count`），
+可直接交给 flamegraph.pl / speedscope / inferno 渲染。关闭时不产生任何额外开销。
+
+事件循环线程由所有请求共享：track_tasks 登记当前任务，并通过事件循环的 task factory 登记其后
+在同一上下文中派生的任务（上下文变量标记），采样时只统计这些任务正在运行的时刻，
+其他并发请求的任务与事件循环空闲等待（select）不计入本次剖析。
+"""
+
+from __future__ import annotations
+
+import asyncio
+import sys
+import threading
+import time
+import weakref
+from collections import Counter
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Any, Optional
+
+BASE_DIR = Path(__file__).resolve().parents[1]
+PROFILE_DIR = BASE_DIR / "profiles"
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    module = frame.f_globals.get("__name__") or Path(code.co_filename).stem
+    return f"{module}:{code.co_name}"
+
+
+# 当前上下文所属的剖析；上下文中派生的 asyncio 任务登记到该剖析（见 _install_task_factory）
+_task_profiler: ContextVar[Optional["SamplingProfiler"]] = ContextVar("youkai_task_profiler", default=None)
+
+
+def _install_task_factory(loop: asyncio.AbstractEventLoop) -> None:
+    """在事件循环上装一次 task factory（保留原有的 factory）：新任务创建时，若创建者上下文属于某次剖析则登记到该剖析。"""
+    previous = loop.get_task_factory()
+    if getattr(previous, "youkai_profiler", False):
+        return
+
+    def factory(loop: asyncio.AbstractEventLoop, coro: Any, **kwargs: Any) -> asyncio.Future:
+        task = previous(loop, coro, **kwargs) if previous is not None else asyncio.Task(coro, loop=loop, **kwargs)
+        profiler = _task_profiler.get()
+        if profiler is not None:
+            profiler.add_task(task)
+        return task
+
+    factory.youkai_profiler = True  # type: ignore[attr-defined]
+    loop.set_task_factory(factory)
+
+
+class SamplingProfiler:
+    """对一组线程做定时栈采样，结果为 folded stacks。"""
+
+    def __init__(self, interval: float = 0.005, max_depth: int = 128) -> None:
+        self.interval = interval
+        self.max_depth = max_depth
+        self.samples = 0
+        self._stacks: Counter[str] = Counter()
+        self._threads: dict[int, str] = {}
+        # 事件循环线程：只在登记的任务运行时采样（track_tasks）
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread: Optional[int] = None
+        self._tasks: weakref.WeakSet = weakref.WeakSet()
+        self.skipped = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._sampler: Optional[threading.Thread] = None
+        self._started_at = 0.0
+        self.duration = 0.0
+
+    def add_thread(self, thread_id: Optional[int] = None, name: str = "") -> None:
+        """登记需要采样的线程（默认当前线程）。可在采样过程中随时追加。"""
+        tid = thread_id if thread_id is not None else threading.get_ident()
+        with self._lock:
+            self._threads[tid] = name or f"thread-{tid}"
+
+    def track_tasks(self, name: str = "event-loop") -> None:
+        """在事件循环上的任务中调用：采样该线程，但只统计当前任务及其此后派生的任务运行的时刻。"""
+        loop = asyncio.get_running_loop()
+        _install_task_factory(loop)
+        _task_profiler.set(self)
+        task = asyncio.current_task()
+        with self._lock:
+            self._loop = loop
+            self._loop_thread = threading.get_ident()
+            self._threads[self._loop_thread] = name
+            if task is not None:
+                self._tasks.add(task)
+
+    def add_task(self, task: asyncio.Future) -> None:
+        with self._lock:
+            self._tasks.add(task)
+
+    def start(self) -> None:
+        if self._sampler is not None:
+            return
+        self._started_at = time.monotonic()
+        self._sampler = threading.Thread(target=self._run, name="youkai-profiler", daemon=True)
+        self._sampler.start()
+
+    def stop(self) -> None:
+        if self._sampler is None:
+            return
+        self._stop.set()
+        self._sampler.join(timeout=1.0)
+        self._sampler = None
+        self.duration = time.monotonic() - self._started_at
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            self._sample_once()
+
+    def _sample_once(self) -> None:
+        with self._lock:
+            threads = dict(self._threads)
+            loop, loop_thread = self._loop, self._loop_thread
+            running = asyncio.current_task(loop) if loop is not None else None
+            ours = running is not None and running in self._tasks
+        frames = sys._current_frames()  # noqa: SLF001
+        for tid, name in threads.items():
+            if tid == loop_thread and not ours:
+                # 事件循环正在运行其他请求的任务或空闲等待
+                self.skipped += 1
+                continue
+            frame = frames.get(tid)
+            if frame is None:
+                continue
+            stack: list[str] = []
+            while frame is not None and len(stack) < self.max_depth:
+                stack.append(_frame_label(frame))
+                frame = frame.f_back
+            stack.append(name)
+            stack.reverse()
+            self._stacks[";".join(stack)] += 1
+        self.samples += 1
+
+    def folded(self) -> str:
+        """返回 folded stacks 文本，按样本数从多到少排序。"""
+        return "".join(f"{stack} {count}\n" for stack, count in self._stacks.most_common())
+
+    def save(self, job_id: str) -> Path:
+        """将结果写入 profiles/<job_id>.folded 并返回路径。"""
+        PROFILE_DIR.mkdir(parents=True, exist_ok=True)
+        path = PROFILE_DIR / f"{job_id}.folded"
+        path.write_text(self.folded(), encoding="utf-8")
+        return path
+
+
+def profile_path(job_id: str) -> Optional[Path]:
+    """按任务 ID 查找已保存的剖析结果；ID 不合法或文件不存在时返回 None。"""
+    if not job_id or not job_id.isalnum():
+        return None
+    path = PROFILE_DIR / f"{job_id}.folded"
+    return path if path.exists() else None
+
+
+__all__ = ["PROFILE_DIR", "SamplingProfiler", "profile_path"]
@@ -0,0 +1,210 @@
+"""LLM 提示词：稳定前缀（系统提示 + 固定任务说明）与可变后缀（目标、扫描结果等）分离，便于提供商缓存前缀。
+
+- 每类调用的 SystemMessage 内容逐字节固定，OpenAI / DeepSeek 的自动前缀缓存即可命中；
+- Anthropic 需显式标记，apply_cache_control 给系统消息加 cache_control: ephemeral；
+- usage_of 从响应中提取输入 / 输出 / 缓存命中 token 数，record_usage 累计到进程级统计；
+- 开启录制 / 回放（core/cassette.py）时，invoke_llm / ainvoke_llm 把调用写入录制带或从录制带取出响应。
+"""
+
+from __future__ import annotations
+
+import threading
+import time
+from pathlib import Path
+from typing import TYPE_CHECKING, Any
+
+from langchain_core.messages import BaseMessage, HumanMessage, SystemMessage
+
+from core.cassette import get_cassette
+
+if TYPE_CHECKING:
+    from langchain_core.language_models.chat_models import BaseChatModel
+
+BASE_DIR = Path(__file__).resolve().parents[1]
+SYSTEM_PROMPT_PATH = BASE_DIR / "prompts" / "system_prompt.txt"
+
+
+def _load_system_prompt() -> str:
+    try:
+        return SYSTEM_PROMPT_PATH.read_text(encoding="utf-8")
+    except FileNotFoundError:
+        return (
+            "你是经验丰富的红队专家，擅长使用 Kali Linux 进行信息收集与安全分析。"
+            "在任何可能造成破坏的操作前，必须先给出详细计划并请求人工确认。"
+        )
+
+
+SYSTEM_PROMPT = _load_system_prompt()
+
+ANALYSIS_INSTRUCTIONS = (
+    "你将收到一次针对渗透目标的 Nmap 扫描结果（以及可能的 Exploit-DB 候选），请以红队专家的角度进行分析。\n"
+    "Exploit-DB 候选按服务版本自动匹配：exact 为版本精确命中，range/prefix 为版本范围命中。\n\n"
+    "请完成以下任务：\n"
+    "1. 总结当前已知的开放端口与对应服务（如果有的话）。\n"
+    "2. 指出可能存在的高价值攻击面或潜在风险。\n"
+    "3. 结合红队流程，给出建议的下一步方向（例如 Web 枚举、SMB 枚举等）。\n"
+    "若附有「初步分析」（扫描进行中基于部分结果生成），请以完整的 Nmap 输出为准核对、修正并补充，输出最终分析。\n"
+)
+
+DECISION_INSTRUCTIONS = (
+    "你将收到用户目标与分析结果，请给出下一步红队行动的决策，并**由你选择下一步**。\n\n"
+    "请仅输出一个 JSON，对象格式如下（不要添加多余解释）：\n"
+    "{\n"
+    '  "path": "web" | "smb" | "other",\n'
+    '  "reason": "string",\n'
+    '  "dangerous": true/false,\n'
+    '  "next_step": "human_check" | "end"\n'
+    "}\n\n"
+    "next_step 含义：\n"
+    "- human_check：需要人工确认后再执行（有高危利用建议、或建议执行攻击时选此项）。\n"
+    "- end：当前结论已足够，无需进一步攻击，直接结束并输出报告。\n"
+)
+
+CLASSIFY_INSTRUCTIONS = (
+    "请判断用户意图。若用户是在下达新的扫描/渗透任务（例如要扫描某个目标、对某 IP 做侦察），回复 scan。"
+    "若用户是在追问、询问、吐槽或闲聊（例如问结果在哪、目标文件呢、怎么回事、为什么），回复 followup。"
+    "仅回复一个英文词：scan 或 followup。"
+)
+
+FOLLOWUP_INSTRUCTIONS = (
+    "你是 Youkai 红队助手。用户之前可能运行过扫描，下面会给出上次扫描的上下文与用户的新消息。"
+    "请用一两句话简短回复（中文），例如：报告在「Youkai 报告」窗口、执行结果在「终端 — 执行」、或请先下达扫描任务。"
+)
+
+
+def build_messages(instructions: str, variable: str, with_system_prompt: bool = True) -> list[BaseMessage]:
+    """SystemMessage 放固定前缀（系统提示 + 任务说明），HumanMessage 只放本次的可变内容。"""
+    prefix = f"{SYSTEM_PROMPT}\n\n{instructions}" if with_system_prompt else instructions
+    return [SystemMessage(content=prefix), HumanMessage(content=variable)]
+
+
+def provider_of(llm: Any) -> str:
+    """根据 LangChain 模型类推断提供商（openai / anthropic / gemini / deepseek）。"""
+    cls = type(llm).__name__.lower()
+    if "anthropic" in cls:
+        return "anthropic"
+    if "google" in cls or "gemini" in cls:
+        return "gemini"
+    base = str(getattr(llm, "openai_api_base", "") or "")
+    return "deepseek" if "deepseek" in base else "openai"
+
+
+def apply_cache_control(messages: list[BaseMessage], provider: str) -> list[BaseMessage]:
+    """Anthropic：把系统消息改为带 cache_control 的内容块；其他提供商自动缓存前缀，原样返回。"""
+    if provider != "anthropic":
+        return messages
+    out: list[BaseMessage] = []
+    for msg in messages:
+        if isinstance(msg, SystemMessage) and isinstance(msg.content, str):
+            msg = SystemMessage(content=[{"type": "text", "text": msg.content, "cache_control": {"type": "ephemeral"}}])
+        out.append(msg)
+    return out
+
+
+def usage_of(resp: Any) -> dict[str, int]:
+    """提取 token 用量：input / output / cache_read（缓存命中）/ cache_creation（写入缓存）。"""
+    um = getattr(resp, "usage_metadata", None) or {}
+    details = um.get("input_token_details") or {}
+    usage = {
+        "input_tokens": int(um.get("input_tokens") or 0),
+        "output_tokens": int(um.get("output_tokens") or 0),
+        "cache_read": int(details.get("cache_read") or 0),
+        "cache_creation": int(details.get("cache_creation") or 0),
+    }
+    # 旧版集成只在 response_metadata 里给出：OpenAI cached_tokens / DeepSeek prompt_cache_hit_tokens / Anthropic cache_read_input_tokens
+    meta = getattr(resp, "response_metadata", None) or {}
+    tu = meta.get("token_usage") or meta.get("usage") or {}
+    if not usage["input_tokens"]:
+        usage["input_tokens"] = int(tu.get("prompt_tokens") or tu.get("input_tokens") or 0)
+        usage["output_tokens"] = int(tu.get("completion_tokens") or tu.get("output_tokens") or 0)
+    if not usage["cache_read"]:
+        usage["cache_read"] = int(
+            tu.get("prompt_cache_hit_tokens")
+            or (tu.get("prompt_tokens_details") or {}).get("cached_tokens")
+            or tu.get("cache_read_input_tokens")
+            or 0
+        )
+    return usage
+
+
+def merge_usage(total: dict[str, int] | None, usage: dict[str, int]) -> dict[str, int]:
+    """把一次调用的用量（或另一份累计值，含 calls）并入累计值。"""
+    merged = dict(total or {})
+    for k, v in usage.items():
+        if k != "calls":
+            merged[k] = merged.get(k, 0) + v
+    merged["calls"] = merged.get("calls", 0) + usage.get("calls", 1)
+    return merged
+
+
+_totals: dict[str, dict[str, int]] = {}
+_totals_lock = threading.Lock()
+
+
+def record_usage(kind: str, usage: dict[str, int]) -> None:
+    with _totals_lock:
+        _totals[kind] = merge_usage(_totals.get(kind), usage)
+
+
+def usage_totals() -> dict[str, dict[str, int]]:
+    """进程启动以来各类调用（analysis / decision / classify / followup）的累计用量。"""
+    with _totals_lock:
+        return {k: dict(v) for k, v in _totals.items()}
+
+
+def invoke_llm(llm: "BaseChatModel", messages: list[BaseMessage], kind: str) -> tuple[Any, dict[str, int]]:
+    """调用 LLM（按提供商开启前缀缓存）并记录用量，返回 (响应, 用量)。回放录制带时由录制带提供响应。"""
+    from core.llm_router import LLMRouter
+
+    cassette = get_cassette()
+    if cassette is not None and cassette.replaying:
+        resp = cassette.replay_llm(kind, messages)
+    else:
+        started = time.monotonic()
+        sent = messages
+        if not isinstance(llm, LLMRouter):
+            # 路由器在选定提供商后自行处理
+            sent = apply_cache_control(messages, provider_of(llm))
+        resp = llm.invoke(sent)
+        if cassette is not None:
+            cassette.record_llm(kind, messages, resp, time.monotonic() - started)
+    usage = usage_of(resp)
+    record_usage(kind, usage)
+    return resp, usage
+
+
+async def ainvoke_llm(llm: "BaseChatModel", messages: list[BaseMessage], kind: str) -> tuple[Any, dict[str, int]]:
+    """invoke_llm 的协程版本（异步 Agent 节点与 Web 处理函数使用）。"""
+    from core.llm_router import LLMRouter
+
+    cassette = get_cassette()
+    if cassette is not None and cassette.replaying:
+        resp = await cassette.areplay_llm(kind, messages)
+    else:
+        started = time.monotonic()
+        sent = messages
+        if not isinstance(llm, LLMRouter):
+            sent = apply_cache_control(messages, provider_of(llm))
+        resp = await llm.ainvoke(sent)
+        if cassette is not None:
+            cassette.record_llm(kind, messages, resp, time.monotonic() - started)
+    usage = usage_of(resp)
+    record_usage(kind, usage)
+    return resp, usage
+
+
+__all__ = [
+    "ANALYSIS_INSTRUCTIONS",
+    "CLASSIFY_INSTRUCTIONS",
+    "DECISION_INSTRUCTIONS",
+    "FOLLOWUP_INSTRUCTIONS",
+    "SYSTEM_PROMPT",
+    "ainvoke_llm",
+    "apply_cache_control",
+    "build_messages",
+    "invoke_llm",
+    "merge_usage",
+    "provider_of",
+    "usage_of",
+    "usage_totals",
+]
@@ -1,20 +1,32 @@
 from __future__ import annotations
 
+import asyncio
+import inspect
 import logging
 import shlex
-import subprocess
 import threading
-from dataclasses import dataclass
-from typing import Callable, List, Optional, Union
+import time
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Any, Awaitable, Callable, List, Optional, Union
 
 from config.runtime import get_effective_sandbox_mode
 from config.settings import settings
+from core.cassette import get_cassette
+from core.scheduler import get_scheduler
+from core.supervisor import ProcessResult, get_supervisor, record_process, rusage_dict
+
+if TYPE_CHECKING:
+    from core.coordinator import DistributedSandbox
 
 logger = logging.getLogger(__name__)
 
 
 class CommandTimeoutError(TimeoutError):
-    """命令在沙箱中执行超时。"""
+    """命令在沙箱中执行超时。stdout 为超时前已产生的输出（可用于部分结果）。"""
+
+    def __init__(self, message: str, stdout: str = "") -> None:
+        super().__init__(message)
+        self.stdout = stdout
 
 
 @dataclass
@@ -24,6 +36,10 @@ class CommandResult:
     stdout: str
     stderr: str
     timed_out: bool = False
+    # 实际生效的资源限制（见 core/supervisor.py；Docker 沙箱为容器级限制）
+    limits: dict = field(default_factory=dict)
+    # 资源消耗（墙钟 / CPU / 峰值内存 / 块 I/O / 输出字节数），键见 core/supervisor.rusage_dict
+    usage: dict = field(default_factory=dict)
 
 
 def _validate_command_static(args: List[str], allowed_binaries: List[str]) -> None:
@@ -36,6 +52,42 @@ def _validate_command_static(args: List[str], allowed_binaries: List[str]) -> No
         )
 
 
+def _scheduled(args: List[str]):
+    """沙箱命令同样经全局调度器排队；目标取最后一个参数（nmap 的目标写在末尾）。"""
+    target = args[-1] if len(args) > 1 and not args[-1].startswith("-") else ""
+    return get_scheduler().slot(args[0], target, timeout=settings.scheduler_queue_timeout)
+
+
+def _ascheduled(args: List[str]):
+    target = args[-1] if len(args) > 1 and not args[-1].startswith("-") else ""
+    return get_scheduler().aslot(args[0], target, timeout=settings.scheduler_queue_timeout)
+
+
+# arun 的逐行回调：普通函数或协程函数（如 EventChannel.aput 的包装）均可
+LineCallback = Callable[[str], Union[None, Awaitable[Any]]]
+
+
+async def _arun_in_thread(
+    run: Callable[..., CommandResult],
+    args: List[str],
+    timeout: Optional[int],
+    on_stdout_line: Optional[LineCallback],
+) -> CommandResult:
+    """没有原生异步实现的沙箱（Docker SDK、分布式 HTTP）在线程中执行；协程回调转回事件循环执行。
+
+    任务取消时只停止等待，容器或 worker 上的命令不会被结束，仍在各自的超时内退出。
+    """
+    callback = on_stdout_line
+    if on_stdout_line is not None and inspect.iscoroutinefunction(on_stdout_line):
+        loop = asyncio.get_running_loop()
+
+        def _threadsafe(line: str) -> None:
+            asyncio.run_coroutine_threadsafe(on_stdout_line(line), loop).result()
+
+        callback = _threadsafe
+    return await asyncio.to_thread(run, args, timeout, callback)
+
+
 class LocalSandbox:
     """在本机（如 Kali 虚拟机）直接执行命令的沙箱。"""
 
@@ -59,69 +111,42 @@ class LocalSandbox:
         self._validate_command(args)
         cmd_str = " ".join(shlex.quote(a) for a in args)
         logger.info("Executing in local sandbox: %s", cmd_str)
-        result: dict = {}
-        error: dict = {}
-
-        def _worker() -> None:
-            try:
-                proc = subprocess.Popen(
-                    args,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                    text=True,
-                )
-                result["proc"] = proc
-                if on_stdout_line and proc.stdout:
-                    lines: list[str] = []
-                    for line in iter(proc.stdout.readline, ""):
-                        lines.append(line)
-                        try:
-                            on_stdout_line(line.rstrip("\n"))
-                        except Exception:  # noqa: BLE001
-                            pass
-                    proc.wait()
-                    err = (proc.stderr.read() or "") if proc.stderr else ""
-                    result["value"] = CommandResult(
-                        command=cmd_str,
-                        exit_code=proc.returncode or 0,
-                        stdout="".join(lines) or "",
-                        stderr=err or "",
-                        timed_out=False,
-                    )
-                else:
-                    out, err = proc.communicate()
-                    result["value"] = CommandResult(
-                        command=cmd_str,
-                        exit_code=proc.returncode or 0,
-                        stdout=out or "",
-                        stderr=err or "",
-                        timed_out=False,
-                    )
-            except Exception as exc:  # noqa: BLE001
-                error["exception"] = exc
+        effective_timeout = timeout or self.default_timeout
+        with _scheduled(args):
+            result = get_supervisor().run(args, effective_timeout, on_stdout_line)
+        return self._result(cmd_str, result, effective_timeout)
 
-        thread = threading.Thread(target=_worker, daemon=True)
-        thread.start()
+    async def arun(
+        self,
+        args: List[str],
+        timeout: Optional[int] = None,
+        on_stdout_line: Optional[LineCallback] = None,
+    ) -> CommandResult:
+        """run 的协程版本：由进程监督器执行，等待期间不占用线程；任务取消时结束进程组。"""
+        self._validate_command(args)
+        cmd_str = " ".join(shlex.quote(a) for a in args)
+        logger.info("Executing in local sandbox (async): %s", cmd_str)
         effective_timeout = timeout or self.default_timeout
-        thread.join(effective_timeout)
+        async with _ascheduled(args):
+            result = await get_supervisor().arun(args, effective_timeout, on_stdout_line)
+        return self._result(cmd_str, result, effective_timeout)
 
-        if thread.is_alive():
-            logger.warning(
-                "Command timed out in local sandbox after %s seconds: %s",
-                effective_timeout,
-                cmd_str,
-            )
-            if "proc" in result:
-                try:
-                    result["proc"].kill()
-                except Exception:  # noqa: BLE001
-                    pass
+    @staticmethod
+    def _result(cmd_str: str, result: ProcessResult, effective_timeout: int) -> CommandResult:
+        if result.timed_out:
             raise CommandTimeoutError(
-                f"命令在本机执行超时（>{effective_timeout}s）: {cmd_str}"
+                f"命令在本机执行超时（>{effective_timeout}s）: {cmd_str}",
+                stdout=result.stdout,
             )
-        if "exception" in error:
-            raise error["exception"]  # type: ignore[misc]
-        return result["value"]  # type: ignore[return-value]
+        return CommandResult(
+            command=cmd_str,
+            exit_code=result.exit_code or 0,
+            stdout=result.stdout,
+            stderr=result.stderr,
+            timed_out=False,
+            limits=result.limits,
+            usage=result.usage,
+        )
 
 
 class KaliSandbox:
@@ -161,11 +186,24 @@ class KaliSandbox:
                 detach=True,
                 auto_remove=settings.docker_auto_remove,
                 network_mode=settings.docker_network_mode,
+                **self._container_limits(),
             )
         except DockerException as exc:
             logger.exception("Failed to start Kali container: %s", exc)
             raise
 
+    def _container_limits(self) -> dict:
+        """容器级资源限制：内存上限、较低的 CPU 权重与打开文件数（对应 settings.process_*）。"""
+        if not settings.process_limits:
+            return {}
+        kwargs: dict = {"cpu_shares": 256}  # 默认 1024，容器内工具让位于宿主上的 Web 服务
+        if settings.process_max_memory_mb > 0:
+            kwargs["mem_limit"] = f"{settings.process_max_memory_mb}m"
+        if settings.process_max_open_files > 0:
+            n = settings.process_max_open_files
+            kwargs["ulimits"] = [self._docker.types.Ulimit(name="nofile", soft=n, hard=n)]
+        return kwargs
+
     def stop(self) -> None:
         if self._container is None:
             return
@@ -190,8 +228,29 @@ class KaliSandbox:
         self._validate_command(args)
         if self._container is None:
             raise RuntimeError("Kali 容器尚未启动")
+        with _scheduled(args):
+            return self._execute(args, timeout, on_stdout_line)
+
+    async def arun(
+        self,
+        args: List[str],
+        timeout: Optional[int] = None,
+        on_stdout_line: Optional[LineCallback] = None,
+    ) -> CommandResult:
+        """Docker SDK 只有同步接口，在线程中执行。"""
+        return await _arun_in_thread(self.run, args, timeout, on_stdout_line)
+
+    def _execute(
+        self,
+        args: List[str],
+        timeout: Optional[int],
+        on_stdout_line: Optional[Callable[[str], None]],
+    ) -> CommandResult:
         cmd_str = " ".join(shlex.quote(a) for a in args)
         logger.info("Executing in Kali sandbox: %s", cmd_str)
+        cassette = get_cassette()
+        recorder = cassette.recorder(args) if cassette is not None else None
+        started = time.monotonic()
         result: dict = {}
         error: dict = {}
 
@@ -205,6 +264,12 @@ class KaliSandbox:
                     stdout=(stdout_bytes or b"").decode(errors="ignore"),
                     stderr=(stderr_bytes or b"").decode(errors="ignore"),
                     timed_out=False,
+                    limits={
+                        k: v for k, v in (
+                            ("container_memory_mb", settings.process_max_memory_mb),
+                            ("max_open_files", settings.process_max_open_files),
+                        ) if settings.process_limits and v > 0
+                    },
                 )
             except Exception as exc:  # noqa: BLE001
                 error["exception"] = exc
@@ -220,19 +285,43 @@ class KaliSandbox:
                 cmd_str,
             )
             self.stop()
+            if recorder is not None:
+                recorder.finish(-1, "", "", timed_out=True)
             raise CommandTimeoutError(
                 f"命令在沙箱中执行超时（>{effective_timeout}s）: {cmd_str}"
             )
         if "exception" in error:
             raise error["exception"]  # type: ignore[misc]
-        return result["value"]  # type: ignore[return-value]
+        value: CommandResult = result["value"]
+        elapsed = time.monotonic() - started
+        # 容器内进程的 rusage 拿不到，只记录墙钟时间与输出大小
+        value.usage = rusage_dict(None, elapsed, len(value.stdout.encode()), len(value.stderr.encode()))
+        record_process(ProcessResult(
+            args=list(args),
+            pid=0,
+            exit_code=value.exit_code,
+            stdout="",
+            stderr="",
+            elapsed=elapsed,
+            limits=value.limits,
+            usage=value.usage,
+        ))
+        if recorder is not None:
+            recorder.finish(value.exit_code, value.stdout, value.stderr, False, elapsed, value.usage, value.limits)
+        return value
 
 
-def get_sandbox() -> Union[KaliSandbox, LocalSandbox]:
-    """根据配置返回沙箱（优先 Web UI 保存的配置）。"""
+def get_sandbox() -> Union[KaliSandbox, LocalSandbox, "DistributedSandbox"]:
+    """根据配置返回沙箱（优先 Web UI 保存的配置）。回放录制带时不执行命令，不需要 Docker 与 worker。"""
+    cassette = get_cassette()
+    if cassette is not None and cassette.replaying:
+        return LocalSandbox()
     mode = get_effective_sandbox_mode()
     if mode == "docker":
         return KaliSandbox()
+    if mode == "distributed":
+        from core.coordinator import DistributedSandbox
+        return DistributedSandbox()
     return LocalSandbox()
 
 
@@ -0,0 +1,365 @@
+"""全局外部进程调度器：所有外部命令（nmap、Kali 工具、sqlmap、分片 worker）启动前在此排队。
+
+- 全局进程数上限：settings.scheduler_max_processes
+- 每个目标的并发上限：settings.scheduler_per_target
+- 每个目标的令牌桶：按 settings.scheduler_target_rate（次/秒）补充、容量 scheduler_target_burst，限制进程启动速率
+- 优先级：interactive（/api/tool、确认执行）> agent（Agent 侦察）> batch（分片 / 分区等批量任务）；
+  同优先级先到先得，目标受限的任务不阻塞其他目标的任务。
+
+排队中的任务向当前上下文绑定的事件通道推送 ("queue", info)，info 含排队位置与已等待时间。
+线程调用 acquire / slot；事件循环上的协程调用 aacquire / aslot，排队时让出事件循环而不占用线程。
+"""
+
+from __future__ import annotations
+
+import asyncio
+import contextvars
+import itertools
+import logging
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Iterator, Optional
+from urllib.parse import urlsplit
+
+from config.settings import settings
+from core.cassette import is_replaying
+from core.events import emit
+
+logger = logging.getLogger(__name__)
+
+PRIORITIES = {"interactive": 0, "agent": 1, "batch": 2}
+
+
+class QueueTimeoutError(TimeoutError):
+    """排队等待超过上限仍未获得执行槽位。"""
+
+
+def target_key(value: str) -> str:
+    """把 URL / host:port / IP / 网段统一成调度用的目标键（URL 取主机名）。"""
+    value = (value or "").strip().lower()
+    if "://" in value:
+        return urlsplit(value).hostname or value
+    return value
+
+
+@dataclass
+class Ticket:
+    label: str
+    target: str
+    priority: str
+    seq: int
+    enqueued_at: float = field(default_factory=time.monotonic)
+    started_at: float = 0.0
+
+    @property
+    def rank(self) -> tuple[int, int]:
+        return PRIORITIES.get(self.priority, 1), self.seq
+
+    @property
+    def waited(self) -> float:
+        return (self.started_at or time.monotonic()) - self.enqueued_at
+
+
+class _TokenBucket:
+    def __init__(self, rate: float, burst: float) -> None:
+        self.rate = rate
+        self.burst = max(burst, 1.0)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """距离下一枚令牌可用的秒数，0 表示现在可取。"""
+        if self.rate <= 0:
+            return 0.0
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now: float) -> None:
+        if self.rate <= 0:
+            return
+        self._refill(now)
+        self.tokens -= 1
+
+
+class ProcessScheduler:
+    """按优先级、全局上限、目标并发与令牌桶调度外部进程。"""
+
+    def __init__(
+        self,
+        max_processes: int,
+        per_target: int,
+        target_rate: float = 0.0,
+        target_burst: float = 1.0,
+    ) -> None:
+        self.max_processes = max(int(max_processes), 1)
+        self.per_target = max(int(per_target), 1)
+        self.target_rate = target_rate
+        self.target_burst = target_burst
+        self._cond = threading.Condition()
+        self._seq = itertools.count()
+        self._waiting: list[Ticket] = []
+        self._running: dict[int, Ticket] = {}
+        self._per_target: dict[str, int] = {}
+        self._buckets: dict[str, _TokenBucket] = {}
+        # 协程等待者：(事件循环, future)，与 Condition 一起在状态变化时唤醒
+        self._async_waiters: list[tuple[asyncio.AbstractEventLoop, asyncio.Future]] = []
+
+    # 以下 _ 方法均在持有 self._cond 时调用
+    def _notify(self) -> None:
+        self._cond.notify_all()
+        waiters, self._async_waiters = self._async_waiters, []
+        for loop, fut in waiters:
+            try:
+                loop.call_soon_threadsafe(_resolve, fut)
+            except RuntimeError:
+                pass  # 事件循环已关闭
+
+    def _start(self, ticket: Ticket) -> None:
+        ticket.started_at = time.monotonic()
+        if ticket.target:
+            self._per_target[ticket.target] = self._per_target.get(ticket.target, 0) + 1
+            if not is_replaying():
+                # 回放录制带不向目标发包，不消耗启动速率
+                self._bucket(ticket.target).take(ticket.started_at)
+        self._running[id(ticket)] = ticket
+        # 队列中其他任务的位置变化了
+        self._notify()
+
+    def _bucket(self, target: str) -> _TokenBucket:
+        bucket = self._buckets.get(target)
+        if bucket is None:
+            bucket = _TokenBucket(self.target_rate, self.target_burst)
+            self._buckets[target] = bucket
+        return bucket
+
+    def _blocked_for(self, ticket: Ticket, now: float) -> Optional[float]:
+        """ticket 现在能否启动：可以返回 None，否则返回建议等待秒数（0 表示等通知）。"""
+        if len(self._running) >= self.max_processes:
+            return 0.0
+        if ticket.target and self._per_target.get(ticket.target, 0) >= self.per_target:
+            return 0.0
+        if ticket.target:
+            delay = self._bucket(ticket.target).delay(now)
+            if delay > 0:
+                return delay
+        # 优先级更高（或同级更早）且同样可以启动的任务先走
+        for other in self._waiting:
+            if other is ticket or other.rank >= ticket.rank:
+                continue
+            if other.target and self._per_target.get(other.target, 0) >= self.per_target:
+                continue
+            if other.target and self._bucket(other.target).delay(now) > 0:
+                continue
+            return 0.0
+        return None
+
+    def _position(self, ticket: Ticket) -> int:
+        return 1 + sum(1 for other in self._waiting if other.rank < ticket.rank)
+
+    def acquire(
+        self,
+        label: str,
+        target: str = "",
+        priority: str = "agent",
+        timeout: Optional[float] = None,
+    ) -> Ticket:
+        """排队直到获得执行槽位；超过 timeout 秒抛 QueueTimeoutError。"""
+        ticket = Ticket(label=label, target=target_key(target), priority=priority, seq=next(self._seq))
+        deadline = None if timeout is None else ticket.enqueued_at + timeout
+        last_position = 0
+        with self._cond:
+            self._waiting.append(ticket)
+            try:
+                while True:
+                    now = time.monotonic()
+                    wait = self._blocked_for(ticket, now)
+                    if wait is None:
+                        break
+                    position = self._position(ticket)
+                    if position != last_position:
+                        last_position = position
+                        emit(("queue", self._info(ticket, "queued", position)))
+                    if deadline is not None and now >= deadline:
+                        raise QueueTimeoutError(
+                            f"排队超时（{ticket.waited:.1f}s）：{label}，当前运行 {len(self._running)} 个进程"
+                        )
+                    # 等通知；令牌桶限速时按补充时间醒来；每秒醒一次以刷新排队位置
+                    limit = wait if wait > 0 else 1.0
+                    if deadline is not None:
+                        limit = min(limit, max(deadline - now, 0.01))
+                    self._cond.wait(limit)
+            finally:
+                self._waiting.remove(ticket)
+            self._start(ticket)
+        if last_position:
+            emit(("queue", self._info(ticket, "started", 0)))
+            logger.info("Scheduler: %s started after %.1fs in queue", label, ticket.waited)
+        return ticket
+
+    async def aacquire(
+        self,
+        label: str,
+        target: str = "",
+        priority: str = "agent",
+        timeout: Optional[float] = None,
+    ) -> Ticket:
+        """acquire 的协程版本：排队期间 await，不阻塞事件循环。"""
+        loop = asyncio.get_running_loop()
+        ticket = Ticket(label=label, target=target_key(target), priority=priority, seq=next(self._seq))
+        deadline = None if timeout is None else ticket.enqueued_at + timeout
+        last_position = 0
+        started = False
+        with self._cond:
+            self._waiting.append(ticket)
+        try:
+            while True:
+                with self._cond:
+                    now = time.monotonic()
+                    wait = self._blocked_for(ticket, now)
+                    if wait is None:
+                        self._waiting.remove(ticket)
+                        started = True
+                        self._start(ticket)
+                        break
+                    position = self._position(ticket)
+                    if position != last_position:
+                        last_position = position
+                        emit(("queue", self._info(ticket, "queued", position)))
+                    if deadline is not None and now >= deadline:
+                        raise QueueTimeoutError(
+                            f"排队超时（{ticket.waited:.1f}s）：{label}，当前运行 {len(self._running)} 个进程"
+                        )
+                    limit = wait if wait > 0 else 1.0
+                    if deadline is not None:
+                        limit = min(limit, max(deadline - now, 0.01))
+                    waiter = loop.create_future()
+                    self._async_waiters.append((loop, waiter))
+                await asyncio.wait({waiter}, timeout=limit)
+        finally:
+            if not started:
+                # 超时或协程被取消：退出队列，让后面的任务重新评估
+                with self._cond:
+                    self._waiting.remove(ticket)
+                    self._notify()
+        if last_position:
+            emit(("queue", self._info(ticket, "started", 0)))
+            logger.info("Scheduler: %s started after %.1fs in queue", label, ticket.waited)
+        return ticket
+
+    def release(self, ticket: Ticket) -> None:
+        with self._cond:
+            if self._running.pop(id(ticket), None) is None:
+                return
+            if ticket.target:
+                left = self._per_target.get(ticket.target, 0) - 1
+                if left > 0:
+                    self._per_target[ticket.target] = left
+                else:
+                    self._per_target.pop(ticket.target, None)
+            self._notify()
+
+    @contextmanager
+    def slot(
+        self,
+        label: str,
+        target: str = "",
+        priority: Optional[str] = None,
+        timeout: Optional[float] = None,
+    ) -> Iterator[Ticket]:
+        ticket = self.acquire(label, target, priority or current_priority(), timeout)
+        try:
+            yield ticket
+        finally:
+            self.release(ticket)
+
+    @asynccontextmanager
+    async def aslot(
+        self,
+        label: str,
+        target: str = "",
+        priority: Optional[str] = None,
+        timeout: Optional[float] = None,
+    ) -> AsyncIterator[Ticket]:
+        ticket = await self.aacquire(label, target, priority or current_priority(), timeout)
+        try:
+            yield ticket
+        finally:
+            self.release(ticket)
+
+    def _info(self, ticket: Ticket, state: str, position: int) -> dict:
+        return {
+            "state": state,
+            "label": ticket.label,
+            "target": ticket.target,
+            "priority": ticket.priority,
+            "position": position,
+            "waiting": len(self._waiting),
+            "running": len(self._running),
+            "waited": round(ticket.waited, 2),
+        }
+
+    def snapshot(self) -> dict:
+        """当前运行与排队情况（供 /api/scheduler 查看）。"""
+        with self._cond:
+            return {
+                "max_processes": self.max_processes,
+                "per_target": self.per_target,
+                "running": [self._info(t, "running", 0) for t in self._running.values()],
+                "waiting": [
+                    self._info(t, "queued", self._position(t))
+                    for t in sorted(self._waiting, key=lambda t: t.rank)
+                ],
+            }
+
+
+def _resolve(fut: asyncio.Future) -> None:
+    if not fut.done():
+        fut.set_result(None)
+
+
+_priority_var: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("youkai_process_priority", default=None)
+
+
+def set_priority(priority: Optional[str]) -> None:
+    """设置当前上下文（线程或协程任务）发起的外部进程的优先级（interactive / agent / batch）。"""
+    _priority_var.set(priority)
+
+
+def current_priority() -> str:
+    return _priority_var.get() or "agent"
+
+
+_scheduler: Optional[ProcessScheduler] = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler() -> ProcessScheduler:
+    """返回进程内共享的调度器（按 settings 创建）。"""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = ProcessScheduler(
+                max_processes=settings.scheduler_max_processes,
+                per_target=settings.scheduler_per_target,
+                target_rate=settings.scheduler_target_rate,
+                target_burst=settings.scheduler_target_burst,
+            )
+    return _scheduler
+
+
+__all__ = [
+    "PRIORITIES",
+    "ProcessScheduler",
+    "QueueTimeoutError",
+    "Ticket",
+    "current_priority",
+    "get_scheduler",
+    "set_priority",
+    "target_key",
+]
@@ -0,0 +1,157 @@
+"""侦察期间的推测式增量分析：Nmap 仍在扫描时，先对已发现的主机与端口做初步 LLM 分析，随新发现逐步刷新。
+
+- RECON 把 Nmap 的每一行交给 SpeculativeAnalyzer.feed；出现新的开放端口（-v 的 "Discovered open port" 行或主机端口表）时触发一轮分析；
+- 同一时间最多一轮在跑，两轮开始之间至少间隔 settings.speculative_interval 秒，期间的新发现合并到下一轮；
+- 扫描结束后 finish() 与最终结果比对：正在跑的一轮恰好覆盖最终结果就等它完成，否则取消；
+  ANALYSIS 节点在指纹一致时直接采用推测结果，不一致时把最近一轮作为初步分析交给 LLM 对账。
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import re
+import shlex
+from contextlib import suppress
+from typing import Any, Awaitable, Callable, Optional
+
+from config.settings import settings
+from core.events import emit
+from core.prompts import merge_usage
+from tools.scanning import _filter_nmap_output, parse_nmap_output
+
+logger = logging.getLogger(__name__)
+
+_DISCOVERED_RE = re.compile(r"^Discovered open port (\d+)/(tcp|udp|sctp) on (\S+)$")
+
+# analyze(recon_text) -> {"analysis", "exploit_candidates", "usage"}
+Analyze = Callable[[str], Awaitable[dict[str, Any]]]
+
+
+def recon_fingerprint(recon_text: str) -> tuple:
+    """侦察结果的指纹：开放端口 (主机, 端口, 协议, 服务, 产品, 版本) 的有序元组，推测结果与最终结果据此比对。"""
+    return tuple(sorted(
+        (h["address"], p["port"], p["protocol"], p["service"], p["product"], p["version"])
+        for h in parse_nmap_output(recon_text)
+        for p in h["ports"]
+        if p["state"].startswith("open")
+    ))
+
+
+def verbose_arguments(arguments: str) -> str:
+    """推测模式需要 Nmap 边扫边报告开放端口（-v 的 Discovered open port 行）；已带 -v / -d 时原样返回。"""
+    tokens = shlex.split(arguments or "")
+    if any(t.startswith(("-v", "-d")) for t in tokens):
+        return arguments
+    return f"{arguments} -v".strip()
+
+
+class SpeculativeAnalyzer:
+    """收集 Nmap 实时输出，在扫描进行中分轮执行 analyze。须在事件循环上使用。"""
+
+    def __init__(self, analyze: Analyze, interval: Optional[float] = None) -> None:
+        self.analyze = analyze
+        self.interval = settings.speculative_interval if interval is None else interval
+        self.rounds = 0
+        self.latest: Optional[dict[str, Any]] = None
+        self.usage: dict[str, int] = {}
+        self._lines: list[str] = []
+        self._discovered: dict[str, set[tuple[int, str]]] = {}
+        self._changed = asyncio.Event()
+        self._closed = False
+        self._inflight: Optional[tuple] = None
+        self._worker: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        self._worker = asyncio.create_task(self._run())
+
+    def feed(self, line: str) -> None:
+        """Nmap stdout 的一行（on_line 回调）。"""
+        self._lines.append(line + "\n")
+        stripped = line.strip()
+        m = _DISCOVERED_RE.match(stripped)
+        if m:
+            self._discovered.setdefault(m.group(3), set()).add((int(m.group(1)), m.group(2)))
+            self._changed.set()
+        elif ("/tcp" in stripped or "/udp" in stripped) and "open" in stripped:
+            self._changed.set()
+
+    def partial_recon(self) -> str:
+        """当前已知结果：已完成主机的端口表（与最终结果同样过滤），加上仅在 Discovered 行出现过的端口。"""
+        raw = "".join(self._lines)
+        filtered = _filter_nmap_output(raw) if "/tcp" in raw or "/udp" in raw else ""
+        known = {
+            (h["address"], p["port"], p["protocol"])
+            for h in parse_nmap_output(filtered)
+            for p in h["ports"]
+        }
+        extra: list[str] = []
+        for address, ports in self._discovered.items():
+            pending = sorted(p for p in ports if (address, *p) not in known)
+            if pending:
+                extra.append(f"Nmap scan report for {address}")
+                extra.extend(f"{port}/{proto} open unknown" for port, proto in pending)
+        return "\n".join(x for x in (filtered if known else "", "\n".join(extra)) if x)
+
+    async def _run(self) -> None:
+        last: Optional[tuple] = None
+        while True:
+            await self._changed.wait()
+            self._changed.clear()
+            if self._closed:
+                return
+            text = self.partial_recon()
+            key = recon_fingerprint(text)
+            if not key or key == last:
+                continue
+            last = key
+            self._inflight = key
+            try:
+                result = await self.analyze(text)
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:  # noqa: BLE001
+                logger.warning("Speculative analysis failed: %s", exc)
+                continue
+            finally:
+                self._inflight = None
+            self.rounds += 1
+            self.usage = merge_usage(self.usage, result.get("usage") or {})
+            self.latest = {**result, "fingerprint": key, "round": self.rounds}
+            emit(("analysis_preview", {
+                "round": self.rounds,
+                "hosts": len({k[0] for k in key}),
+                "ports": len(key),
+                "text": result.get("analysis", ""),
+            }))
+            if self._closed:
+                return
+            # 节流：间隔内的新发现留到下一轮
+            await asyncio.sleep(self.interval)
+
+    async def finish(self, recon_result: str) -> Optional[dict[str, Any]]:
+        """扫描结束：返回最近一轮推测结果（含 fingerprint，可能与最终结果不一致），没有则返回 None。"""
+        self._closed = True
+        self._changed.set()
+        final = recon_fingerprint(recon_result)
+        worker = self._worker
+        if worker is not None and not worker.done():
+            if final and self._inflight == final:
+                # 在跑的这一轮用的正是最终结果，等它完成比重新分析更快
+                with suppress(asyncio.CancelledError):
+                    await worker
+            else:
+                worker.cancel()
+                with suppress(asyncio.CancelledError):
+                    await worker
+        return self.latest
+
+    async def cancel(self) -> None:
+        self._closed = True
+        if self._worker is not None and not self._worker.done():
+            self._worker.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._worker
+
+
+__all__ = ["SpeculativeAnalyzer", "recon_fingerprint", "verbose_arguments"]
@@ -0,0 +1,352 @@
+"""Web 层的共享状态后端：会话上下文、数据窗口、任务登记、任务事件与结果。
+
+默认的 MemoryBackend 只在本进程内有效（单 worker）。`uvicorn --workers N` 部署时改用
+SQLiteBackend（KALI_AGENT_STATE_BACKEND=sqlite）：所有 worker 进程读写同一个 SQLite 文件，
+任意进程都能服务任意会话——追问能拿到别的进程上完成的扫描上下文，相同任务只在一个进程里跑，
+其他进程上的请求从后端轮询它的事件与结果。也可以填 "模块:类名" 接入外部存储（如 Redis），
+实现 StateBackend 的方法即可。
+
+值均为可 JSON 序列化的对象；事件为列表形式的元组（("step", ...) 存取后变为 ["step", ...]）。
+"""
+
+from __future__ import annotations
+
+import importlib
+import json
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Callable, Iterator, Optional
+
+from config.settings import settings
+
+BASE_DIR = Path(__file__).resolve().parents[1]
+
+# 已结束任务的事件与结果保留时间（秒），供稍晚接入的请求读取
+_JOB_RETENTION = 3600.0
+# 会话数据（上下文、数据窗口）的保留时间（秒）
+_KV_RETENTION = 7 * 86400.0
+
+
+class StateBackend(ABC):
+    """共享状态后端接口，子类须实现全部方法（缺少时实例化即报错）。shared 为 True 表示状态跨进程可见（多 worker 部署需要）。"""
+
+    shared = False
+
+    # ---------- 键值：会话上下文、数据窗口、worker 心跳 ----------
+
+    @abstractmethod
+    def get(self, namespace: str, key: str) -> Any:
+        ...
+
+    @abstractmethod
+    def set(self, namespace: str, key: str, value: Any) -> None:
+        ...
+
+    @abstractmethod
+    def update(self, namespace: str, key: str, fn: Callable[[Any], Any]) -> Any:
+        """原子地读-改-写：fn 收到当前值（不存在为 None），返回新值。"""
+        ...
+
+    @abstractmethod
+    def items(self, namespace: str) -> dict[str, Any]:
+        ...
+
+    # ---------- 任务登记 ----------
+
+    @abstractmethod
+    def claim_job(self, key: str, job_id: str, ttl: float) -> str:
+        """登记任务：key 上已有未过期的任务时返回它的 job_id，否则登记 job_id 并返回它。"""
+        ...
+
+    @abstractmethod
+    def refresh_job(self, key: str, job_id: str, ttl: float) -> None:
+        """任务仍在运行：延长登记的有效期（运行任务的进程退出后登记自然过期）。"""
+        ...
+
+    @abstractmethod
+    def job_active(self, job_id: str) -> bool:
+        ...
+
+    @abstractmethod
+    def finish_job(self, key: str, job_id: str, result: dict[str, Any]) -> None:
+        """保存任务结果并撤销登记。"""
+        ...
+
+    @abstractmethod
+    def job_result(self, job_id: str) -> Optional[dict[str, Any]]:
+        ...
+
+    # ---------- 任务事件 ----------
+
+    @abstractmethod
+    def publish(self, job_id: str, events: list[Any]) -> None:
+        """追加任务事件（按序号递增）。"""
+        ...
+
+    @abstractmethod
+    def read_events(self, job_id: str, after: int, limit: int = 500) -> list[tuple[int, Any]]:
+        """读取序号大于 after 的事件，返回 [(序号, 事件)]。"""
+        ...
+
+
+class MemoryBackend(StateBackend):
+    """进程内状态（单 worker）。每个命名空间按最近使用保留 max_keys 个键。"""
+
+    shared = False
+
+    def __init__(self, max_keys: int = 1024) -> None:
+        self.max_keys = max(int(max_keys), 1)
+        self._kv: dict[str, OrderedDict[str, Any]] = {}
+        self._jobs: dict[str, tuple[str, float]] = {}
+        self._results: OrderedDict[str, dict[str, Any]] = OrderedDict()
+        self._events: dict[str, list[Any]] = {}
+        self._lock = threading.Lock()
+
+    def _space(self, namespace: str) -> OrderedDict[str, Any]:
+        return self._kv.setdefault(namespace, OrderedDict())
+
+    def _store(self, namespace: str, key: str, value: Any) -> None:
+        space = self._space(namespace)
+        space[key] = value
+        space.move_to_end(key)
+        while len(space) > self.max_keys:
+            space.popitem(last=False)
+
+    def get(self, namespace: str, key: str) -> Any:
+        with self._lock:
+            return self._space(namespace).get(key)
+
+    def set(self, namespace: str, key: str, value: Any) -> None:
+        with self._lock:
+            self._store(namespace, key, value)
+
+    def update(self, namespace: str, key: str, fn: Callable[[Any], Any]) -> Any:
+        with self._lock:
+            value = fn(self._space(namespace).get(key))
+            self._store(namespace, key, value)
+            return value
+
+    def items(self, namespace: str) -> dict[str, Any]:
+        with self._lock:
+            return dict(self._space(namespace))
+
+    def claim_job(self, key: str, job_id: str, ttl: float) -> str:
+        now = time.time()
+        with self._lock:
+            current = self._jobs.get(key)
+            if current is not None and current[1] > now:
+                return current[0]
+            self._jobs[key] = (job_id, now + ttl)
+            return job_id
+
+    def refresh_job(self, key: str, job_id: str, ttl: float) -> None:
+        with self._lock:
+            if self._jobs.get(key, ("",))[0] == job_id:
+                self._jobs[key] = (job_id, time.time() + ttl)
+
+    def job_active(self, job_id: str) -> bool:
+        now = time.time()
+        with self._lock:
+            return any(j == job_id and exp > now for j, exp in self._jobs.values())
+
+    def finish_job(self, key: str, job_id: str, result: dict[str, Any]) -> None:
+        with self._lock:
+            if self._jobs.get(key, ("",))[0] == job_id:
+                del self._jobs[key]
+            self._results[job_id] = result
+            while len(self._results) > self.max_keys:
+                old, _ = self._results.popitem(last=False)
+                self._events.pop(old, None)
+
+    def job_result(self, job_id: str) -> Optional[dict[str, Any]]:
+        with self._lock:
+            return self._results.get(job_id)
+
+    def publish(self, job_id: str, events: list[Any]) -> None:
+        with self._lock:
+            self._events.setdefault(job_id, []).extend(events)
+
+    def read_events(self, job_id: str, after: int, limit: int = 500) -> list[tuple[int, Any]]:
+        with self._lock:
+            events = self._events.get(job_id, [])
+            return [(i + 1, e) for i, e in enumerate(events[after:after + limit], start=after)]
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS kv (
+    namespace TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (namespace, key)
+);
+CREATE TABLE IF NOT EXISTS jobs (
+    key TEXT PRIMARY KEY,
+    job_id TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS job_results (
+    job_id TEXT PRIMARY KEY,
+    result TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS job_events (
+    job_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    event TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    PRIMARY KEY (job_id, seq)
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_job_id ON jobs(job_id);
+CREATE INDEX IF NOT EXISTS idx_kv_updated ON kv(updated_at);
+CREATE INDEX IF NOT EXISTS idx_job_events_created ON job_events(created_at);
+"""
+
+
+def _dumps(value: Any) -> str:
+    return json.dumps(value, ensure_ascii=False, default=str)
+
+
+class SQLiteBackend(StateBackend):
+    """多进程共享的 SQLite 状态文件；每个线程一个连接，WAL 模式（同 core/engagement_db.py）。"""
+
+    shared = True
+
+    def __init__(self, path: Optional[str | Path] = None) -> None:
+        raw = Path(path or settings.state_db_path)
+        self.path = raw if raw.is_absolute() else BASE_DIR / raw
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._local = threading.local()
+        self._conn().executescript(_SCHEMA)
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(str(self.path), timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _tx(self) -> Iterator[sqlite3.Connection]:
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def get(self, namespace: str, key: str) -> Any:
+        row = self._conn().execute("SELECT value FROM kv WHERE namespace = ? AND key = ?", (namespace, key)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, namespace: str, key: str, value: Any) -> None:
+        self._conn().execute(
+            "INSERT OR REPLACE INTO kv (namespace, key, value, updated_at) VALUES (?, ?, ?, ?)",
+            (namespace, key, _dumps(value), time.time()),
+        )
+
+    def update(self, namespace: str, key: str, fn: Callable[[Any], Any]) -> Any:
+        with self._tx() as conn:
+            row = conn.execute("SELECT value FROM kv WHERE namespace = ? AND key = ?", (namespace, key)).fetchone()
+            value = fn(json.loads(row[0]) if row else None)
+            conn.execute(
+                "INSERT OR REPLACE INTO kv (namespace, key, value, updated_at) VALUES (?, ?, ?, ?)",
+                (namespace, key, _dumps(value), time.time()),
+            )
+            return value
+
+    def items(self, namespace: str) -> dict[str, Any]:
+        rows = self._conn().execute("SELECT key, value FROM kv WHERE namespace = ?", (namespace,)).fetchall()
+        return {k: json.loads(v) for k, v in rows}
+
+    def claim_job(self, key: str, job_id: str, ttl: float) -> str:
+        now = time.time()
+        with self._tx() as conn:
+            row = conn.execute("SELECT job_id, expires_at FROM jobs WHERE key = ?", (key,)).fetchone()
+            if row is not None and row[1] > now:
+                return row[0]
+            conn.execute("INSERT OR REPLACE INTO jobs (key, job_id, expires_at) VALUES (?, ?, ?)", (key, job_id, now + ttl))
+            return job_id
+
+    def refresh_job(self, key: str, job_id: str, ttl: float) -> None:
+        self._conn().execute(
+            "UPDATE jobs SET expires_at = ? WHERE key = ? AND job_id = ?", (time.time() + ttl, key, job_id)
+        )
+
+    def job_active(self, job_id: str) -> bool:
+        row = self._conn().execute(
+            "SELECT 1 FROM jobs WHERE job_id = ? AND expires_at > ?", (job_id, time.time())
+        ).fetchone()
+        return row is not None
+
+    def finish_job(self, key: str, job_id: str, result: dict[str, Any]) -> None:
+        now = time.time()
+        with self._tx() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO job_results (job_id, result, created_at) VALUES (?, ?, ?)",
+                (job_id, _dumps(result), now),
+            )
+            conn.execute("DELETE FROM jobs WHERE key = ? AND job_id = ?", (key, job_id))
+            # 顺带清理过期数据
+            conn.execute("DELETE FROM job_results WHERE created_at < ?", (now - _JOB_RETENTION,))
+            conn.execute("DELETE FROM job_events WHERE created_at < ?", (now - _JOB_RETENTION,))
+            conn.execute("DELETE FROM kv WHERE updated_at < ?", (now - _KV_RETENTION,))
+
+    def job_result(self, job_id: str) -> Optional[dict[str, Any]]:
+        row = self._conn().execute("SELECT result FROM job_results WHERE job_id = ?", (job_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def publish(self, job_id: str, events: list[Any]) -> None:
+        if not events:
+            return
+        now = time.time()
+        with self._tx() as conn:
+            seq = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM job_events WHERE job_id = ?", (job_id,)).fetchone()[0]
+            conn.executemany(
+                "INSERT INTO job_events (job_id, seq, event, created_at) VALUES (?, ?, ?, ?)",
+                [(job_id, seq + i, _dumps(e), now) for i, e in enumerate(events, start=1)],
+            )
+
+    def read_events(self, job_id: str, after: int, limit: int = 500) -> list[tuple[int, Any]]:
+        rows = self._conn().execute(
+            "SELECT seq, event FROM job_events WHERE job_id = ? AND seq > ? ORDER BY seq LIMIT ?",
+            (job_id, int(after), int(limit)),
+        ).fetchall()
+        return [(seq, json.loads(event)) for seq, event in rows]
+
+
+def _load_backend(spec: str) -> StateBackend:
+    name = (spec or "memory").strip()
+    if name == "memory":
+        return MemoryBackend()
+    if name == "sqlite":
+        return SQLiteBackend()
+    module_name, _, class_name = name.partition(":")
+    if not class_name:
+        raise ValueError(f"未知的状态后端: {name}，可选: memory / sqlite / 模块:类名")
+    return getattr(importlib.import_module(module_name), class_name)()
+
+
+_backend: Optional[StateBackend] = None
+_backend_lock = threading.Lock()
+
+
+def get_state_backend() -> StateBackend:
+    """按 KALI_AGENT_STATE_BACKEND 返回进程内共享的状态后端实例。"""
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            _backend = _load_backend(settings.state_backend)
+        return _backend
+
+
+__all__ = ["MemoryBackend", "SQLiteBackend", "StateBackend", "get_state_backend"]
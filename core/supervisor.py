@@ -0,0 +1,692 @@
+"""外部进程监督器：一个线程用 selectors 多路复用所有子进程的 stdout / stderr，替代“每条命令一个读线程”。
+
+- 每个子进程在独立的进程组中启动（start_new_session），超时或被取消时向整个进程组发 SIGKILL，
+  nmap / hydra 等派生的子进程一并结束；
+- stdout 与 stderr 以非阻塞方式同时读取，工具大量写 stderr 也不会把管道写满而卡死；
+- 逐行回调：spawn 的回调在监督线程上执行（必须快速返回）；run 把行转交给调用线程执行回调，
+  arun 转交给事件循环执行（回调可为协程函数），回调阻塞不会拖慢其他进程。
+支持 pidfd 的内核上进程退出也由 selector 监听，否则在管道关闭后以 50ms 间隔轮询。
+
+资源限制（settings.process_*）：子进程启动后由父进程立即设置 nice、I/O 优先级、RLIMIT_AS / RLIMIT_NOFILE，
+并可加入预先配置好的 cgroup v2 目录，工具此后派生的子进程都继承（不用 preexec_fn，见 prepare_limits）；生效的限制随 ProcessResult.limits 返回，
+track_processes 收集一次请求内启动的全部进程。
+
+录制 / 回放（core/cassette.py）：录制时 spawn 记下每个进程的输出与逐行时间点；回放时 spawn 不启动进程，
+返回按录制时间点送出输出的 ReplayProcess（接口与 ProcessHandle 一致）。
+
+资源统计：子进程由监督线程用 wait4 回收，取得其 rusage（含它回收过的子孙进程），
+与墙钟时间、输出字节数一起随 ProcessResult.usage 返回，供按工具统计成本。
+"""
+
+from __future__ import annotations
+
+import asyncio
+import concurrent.futures
+import inspect
+import logging
+import os
+import platform
+import queue
+import selectors
+import signal
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Any, Callable, Iterator, Optional
+
+from config.settings import settings
+from core.cassette import get_cassette
+
+logger = logging.getLogger(__name__)
+
+# 进程组被杀后仍有管道未关闭（如孙进程另起会话）时，最多再等待的秒数
+_KILL_GRACE = 2.0
+_POLL_INTERVAL = 0.05
+_READ_SIZE = 65536
+_DONE = object()
+
+
+@dataclass(frozen=True)
+class ResourceLimits:
+    """外部工具进程的资源限制；0 / "none" / "" 表示该项不修改。"""
+
+    nice: int = 0
+    ionice_class: str = "none"
+    ionice_level: int = 7
+    max_memory_mb: int = 0
+    max_open_files: int = 0
+    cgroup: str = ""
+
+    @classmethod
+    def from_settings(cls) -> Optional["ResourceLimits"]:
+        if not settings.process_limits:
+            return None
+        return cls(
+            nice=settings.process_nice,
+            ionice_class=settings.process_ionice_class,
+            ionice_level=settings.process_ionice_level,
+            max_memory_mb=settings.process_max_memory_mb,
+            max_open_files=settings.process_max_open_files,
+            cgroup=settings.process_cgroup,
+        )
+
+
+@dataclass
+class ProcessResult:
+    args: list[str]
+    pid: int
+    exit_code: int
+    stdout: str
+    stderr: str
+    timed_out: bool = False
+    killed: bool = False
+    elapsed: float = 0.0
+    limits: dict[str, Any] = field(default_factory=dict)
+    # wall_s / user_s / sys_s / max_rss_kb / read_bytes / write_bytes / stdout_bytes / stderr_bytes
+    usage: dict[str, Any] = field(default_factory=dict)
+
+    def summary(self) -> dict[str, Any]:
+        """不含输出的摘要，随接口结果返回。"""
+        return {
+            "command": self.args[0] if self.args else "",
+            "pid": self.pid,
+            "exit_code": self.exit_code,
+            "elapsed": round(self.elapsed, 3),
+            "timed_out": self.timed_out,
+            "limits": self.limits,
+            "usage": self.usage,
+        }
+
+
+def rusage_dict(ru: Any, elapsed: float, stdout_bytes: int, stderr_bytes: int) -> dict[str, Any]:
+    """wait4 的 rusage 转成统计字典；读写字节数由块 I/O 次数（512 字节为单位）折算。"""
+    usage: dict[str, Any] = {"wall_s": round(elapsed, 3)}
+    if ru is not None:
+        usage.update(
+            user_s=round(ru.ru_utime, 3),
+            sys_s=round(ru.ru_stime, 3),
+            max_rss_kb=int(ru.ru_maxrss),
+            read_bytes=int(ru.ru_inblock) * 512,
+            write_bytes=int(ru.ru_oublock) * 512,
+        )
+    usage.update(stdout_bytes=stdout_bytes, stderr_bytes=stderr_bytes)
+    return usage
+
+
+def total_usage(processes: list[dict[str, Any]]) -> dict[str, Any]:
+    """汇总多条进程摘要（summary()）的资源消耗：时间与字节数求和，峰值内存取最大值。"""
+    total: dict[str, Any] = {"commands": len(processes)}
+    for p in processes:
+        for k, v in (p.get("usage") or {}).items():
+            if k == "max_rss_kb":
+                total[k] = max(total.get(k, 0), v)
+            else:
+                total[k] = round(total.get(k, 0) + v, 3)
+    return total
+
+
+# 当前请求启动的进程（track_processes 设置）；spawn 时捕获，进程结束时追加
+_runs_var: ContextVar[Optional[list[ProcessResult]]] = ContextVar("youkai_process_runs", default=None)
+
+
+@contextmanager
+def track_processes() -> Iterator[list[ProcessResult]]:
+    """收集此上下文（及其派生的任务 / to_thread 线程）中经监督器启动的进程结果。"""
+    runs: list[ProcessResult] = []
+    token = _runs_var.set(runs)
+    try:
+        yield runs
+    finally:
+        _runs_var.reset(token)
+
+
+def record_process(result: ProcessResult) -> None:
+    """把不经本机监督器执行的命令（Docker / 分布式 worker）记入当前 track_processes。"""
+    runs = _runs_var.get()
+    if runs is not None:
+        runs.append(result)
+
+
+# ioprio_set 系统调用号
+_IOPRIO_SET = {"x86_64": 251, "aarch64": 30, "i386": 289, "i686": 289, "armv7l": 314}
+_IOPRIO_CLASSES = {"best-effort": 2, "idle": 3}
+_IOPRIO_WHO_PROCESS = 1
+
+
+_libc: Any = None
+
+
+def _load_libc() -> Any:
+    global _libc
+    if _libc is None:
+        import ctypes
+
+        _libc = ctypes.CDLL(None, use_errno=True)
+    return _libc
+
+
+def prepare_limits(limits: ResourceLimits) -> tuple[Callable[[int], None], dict[str, Any]]:
+    """返回 (对已启动的子进程施加限制的函数，参数为 pid, 将生效的限制)。
+
+    限制由父进程按 pid 施加（prlimit、setpriority、ioprio_set、写入 cgroup.procs），不用 preexec_fn：
+    在多线程的服务进程里 fork 之后执行 Python 代码可能死锁，且 preexec_fn 会让 subprocess 放弃 vfork / posix_spawn。
+    能否生效在这里预先判断（rlimit 按继承的硬限制收紧、cgroup 检查可写、ioprio 检查架构）。
+    """
+    import resource
+
+    applied: dict[str, Any] = {}
+    errors: list[str] = []
+    rlimits: list[tuple[int, tuple[int, int]]] = []
+    cgroup_procs = ""
+    if limits.cgroup:
+        path = os.path.join(limits.cgroup, "cgroup.procs")
+        if os.access(path, os.W_OK):
+            cgroup_procs = path
+            applied["cgroup"] = limits.cgroup
+        else:
+            errors.append(f"cgroup: {path} 不存在或不可写")
+    for key, res, want in (
+        ("max_memory_mb", resource.RLIMIT_AS, limits.max_memory_mb * 1024 * 1024),
+        ("max_open_files", resource.RLIMIT_NOFILE, limits.max_open_files),
+    ):
+        if want <= 0:
+            continue
+        hard = resource.getrlimit(res)[1]
+        soft = want if hard == resource.RLIM_INFINITY else min(want, hard)
+        rlimits.append((res, (soft, hard)))
+        applied[key] = soft // (1024 * 1024) if res == resource.RLIMIT_AS else soft
+    nice = min(max(limits.nice, 0), 19)
+    if nice:
+        applied["nice"] = nice
+        # 与 os.nice 相同，在服务进程自身的 nice 值上增加
+        nice = min(os.getpriority(os.PRIO_PROCESS, 0) + nice, 19)
+    ioprio = 0
+    syscall_no = _IOPRIO_SET.get(platform.machine())
+    libc: Any = None
+    io_class = _IOPRIO_CLASSES.get(limits.ionice_class)
+    if io_class is not None:
+        if syscall_no is None:
+            errors.append(f"ionice: 不支持的架构 {platform.machine()}")
+        else:
+            libc = _load_libc()
+            level = min(max(limits.ionice_level, 0), 7) if io_class == 2 else 0
+            ioprio = (io_class << 13) | level
+            applied["ionice"] = f"best-effort:{level}" if io_class == 2 else "idle"
+    if errors:
+        applied["errors"] = errors
+
+    def _apply(pid: int) -> None:
+        # Popen 返回后立即执行；失败（如进程已退出）不影响工具运行
+        if cgroup_procs:
+            try:
+                with open(cgroup_procs, "w") as fh:
+                    fh.write(str(pid))
+            except OSError:
+                pass
+        for res, value in rlimits:
+            try:
+                resource.prlimit(pid, res, value)
+            except (OSError, ValueError):
+                pass
+        if nice:
+            try:
+                os.setpriority(os.PRIO_PROCESS, pid, nice)
+            except OSError:
+                pass
+        if ioprio:
+            libc.syscall(syscall_no, _IOPRIO_WHO_PROCESS, pid, ioprio)
+
+    return _apply, applied
+
+
+@dataclass(eq=False)
+class _Child:
+    args: list[str]
+    proc: subprocess.Popen
+    future: concurrent.futures.Future
+    deadline: Optional[float]
+    on_stdout_line: Optional[Callable[[str], None]]
+    on_stderr_line: Optional[Callable[[str], None]]
+    limits: dict[str, Any] = field(default_factory=dict)
+    runs: Optional[list[ProcessResult]] = None
+    started: float = field(default_factory=time.monotonic)
+    out_chunks: list[bytes] = field(default_factory=list)
+    err_chunks: list[bytes] = field(default_factory=list)
+    partial: dict[str, bytes] = field(default_factory=lambda: {"stdout": b"", "stderr": b""})
+    open_pipes: int = 0
+    pidfd: Optional[int] = None
+    exited: bool = False
+    timed_out: bool = False
+    killed: bool = False
+    kill_deadline: Optional[float] = None
+    reaped: bool = False
+    rusage: Any = None
+
+
+class ProcessHandle:
+    """spawn 返回的句柄：future 在进程结束且输出读完后给出 ProcessResult。"""
+
+    def __init__(self, supervisor: "ProcessSupervisor", child: _Child) -> None:
+        self._supervisor = supervisor
+        self._child = child
+        self.future: concurrent.futures.Future = child.future
+
+    @property
+    def pid(self) -> int:
+        return self._child.proc.pid
+
+    def done(self) -> bool:
+        return self.future.done()
+
+    def kill(self) -> None:
+        """结束整个进程组（线程安全）。"""
+        self._supervisor._kill(self._child)
+
+    def result(self, timeout: Optional[float] = None) -> ProcessResult:
+        return self.future.result(timeout)
+
+
+def _kill_group(proc: subprocess.Popen) -> None:
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        try:
+            proc.kill()
+        except ProcessLookupError:
+            pass
+
+
+class ProcessSupervisor:
+    def __init__(self) -> None:
+        self._sel = selectors.DefaultSelector()
+        self._wake_r, self._wake_w = os.pipe()
+        os.set_blocking(self._wake_r, False)
+        os.set_blocking(self._wake_w, False)
+        self._sel.register(self._wake_r, selectors.EVENT_READ, ("wake", None))
+        self._pending: list[_Child] = []
+        self._children: set[_Child] = set()
+        # 监督出错后已结束进程组、尚待回收的子进程
+        self._orphans: list[_Child] = []
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    # ---------- 对外接口 ----------
+    def spawn(
+        self,
+        args: list[str],
+        timeout: Optional[float] = None,
+        on_stdout_line: Optional[Callable[[str], None]] = None,
+        on_stderr_line: Optional[Callable[[str], None]] = None,
+        limits: Optional[ResourceLimits] = None,
+    ) -> ProcessHandle:
+        """启动子进程（独立进程组）并交给监督线程。命令不存在时抛 FileNotFoundError。
+
+        limits 为 None 时使用配置中的资源限制（settings.process_limits 关闭则不限制）。
+        回调在监督线程上执行，必须快速返回。回放录制带时不启动进程，返回 ReplayProcess。
+        """
+        cassette = get_cassette()
+        if cassette is not None and cassette.replaying:
+            return cassette.spawn(args, on_stdout_line, on_stderr_line, _runs_var.get())  # type: ignore[return-value]
+        recorder = None
+        if cassette is not None:
+            recorder = cassette.recorder(args, on_stdout_line, on_stderr_line)
+            on_stdout_line, on_stderr_line = recorder.stdout, recorder.stderr
+        limits = limits or ResourceLimits.from_settings()
+        apply_limits, applied = prepare_limits(limits) if limits else (None, {})
+        try:
+            proc = subprocess.Popen(
+                args,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                start_new_session=True,
+            )
+        except FileNotFoundError:
+            if recorder is not None:
+                recorder.not_found()
+            raise
+        if apply_limits is not None:
+            apply_limits(proc.pid)
+        child = _Child(
+            args=list(args),
+            proc=proc,
+            future=concurrent.futures.Future(),
+            deadline=(time.monotonic() + timeout) if timeout else None,
+            on_stdout_line=on_stdout_line,
+            on_stderr_line=on_stderr_line,
+            limits=applied,
+            runs=_runs_var.get(),
+        )
+        # RUNNING 状态的 future 不会被 wrap_future 的取消连带取消，结束进程统一走 kill()
+        child.future.set_running_or_notify_cancel()
+        if recorder is not None:
+            child.future.add_done_callback(recorder.finish_process)
+        with self._lock:
+            self._pending.append(child)
+            self._ensure_thread()
+        self._wake()
+        return ProcessHandle(self, child)
+
+    def run(
+        self,
+        args: list[str],
+        timeout: Optional[float] = None,
+        on_stdout_line: Optional[Callable[[str], None]] = None,
+    ) -> ProcessResult:
+        """同步执行；on_stdout_line 在调用线程上执行（可以阻塞，不影响其他进程）。"""
+        if on_stdout_line is None:
+            return self.spawn(args, timeout).result()
+        lines: queue.SimpleQueue = queue.SimpleQueue()
+        handle = self.spawn(args, timeout, on_stdout_line=lines.put)
+        handle.future.add_done_callback(lambda _f: lines.put(_DONE))
+        while (line := lines.get()) is not _DONE:
+            try:
+                on_stdout_line(line)
+            except Exception:  # noqa: BLE001
+                logger.debug("stdout callback failed", exc_info=True)
+        return handle.result()
+
+    async def arun(
+        self,
+        args: list[str],
+        timeout: Optional[float] = None,
+        on_stdout_line: Optional[Callable[[str], Any]] = None,
+    ) -> ProcessResult:
+        """协程版本：等待期间不占线程；on_stdout_line 在事件循环上执行，可为协程函数。任务取消时结束进程组。"""
+        loop = asyncio.get_running_loop()
+        lines: Optional[asyncio.Queue] = None
+        deliver: Optional[Callable[[Any], None]] = None
+        if on_stdout_line is not None:
+            lines = asyncio.Queue()
+
+            def _to_loop(item: Any) -> None:
+                try:
+                    loop.call_soon_threadsafe(lines.put_nowait, item)
+                except RuntimeError:
+                    pass  # 事件循环已关闭
+
+            deliver = _to_loop
+        handle = self.spawn(args, timeout, on_stdout_line=deliver)
+        try:
+            if lines is not None:
+                handle.future.add_done_callback(lambda _f: deliver(_DONE))
+                while (line := await lines.get()) is not _DONE:
+                    try:
+                        ret = on_stdout_line(line)
+                        if inspect.isawaitable(ret):
+                            await ret
+                    except Exception:  # noqa: BLE001
+                        logger.debug("stdout callback failed", exc_info=True)
+            return await asyncio.wrap_future(handle.future)
+        except asyncio.CancelledError:
+            handle.kill()
+            raise
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "running": len(self._children) + len(self._pending),
+                "processes": [
+                    {"pid": c.proc.pid, "command": c.args[0], "elapsed": round(time.monotonic() - c.started, 1)}
+                    for c in list(self._children) + self._pending
+                ],
+            }
+
+    # ---------- 监督线程 ----------
+    def _ensure_thread(self) -> None:
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._loop, name="youkai-supervisor", daemon=True)
+            self._thread.start()
+
+    def _wake(self) -> None:
+        try:
+            os.write(self._wake_w, b"\0")
+        except BlockingIOError:
+            pass  # 已有未处理的唤醒
+
+    def _kill(self, child: _Child) -> None:
+        if child.future.done():
+            return
+        child.killed = True
+        _kill_group(child.proc)
+        self._wake()
+
+    def _register(self, child: _Child) -> None:
+        for name, pipe in (("stdout", child.proc.stdout), ("stderr", child.proc.stderr)):
+            assert pipe is not None
+            os.set_blocking(pipe.fileno(), False)
+            self._sel.register(pipe.fileno(), selectors.EVENT_READ, (name, child))
+            child.open_pipes += 1
+        try:
+            child.pidfd = os.pidfd_open(child.proc.pid)
+            self._sel.register(child.pidfd, selectors.EVENT_READ, ("exit", child))
+        except (AttributeError, OSError):
+            child.pidfd = None
+        self._children.add(child)
+
+    def _loop(self) -> None:
+        # 单个子进程出错只结束该进程（_fail），监督线程继续服务其他进程
+        while True:
+            try:
+                ready = self._sel.select(self._next_timeout())
+            except Exception:  # noqa: BLE001
+                logger.exception("Supervisor select failed")
+                time.sleep(_POLL_INTERVAL)
+                continue
+            for key, _ in ready:
+                kind, child = key.data
+                if kind == "wake":
+                    try:
+                        while os.read(self._wake_r, 4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                    continue
+                if child not in self._children:
+                    continue  # 本轮中已被 _fail 移除
+                try:
+                    if kind == "exit":
+                        self._close_pidfd(child)
+                        child.exited = True
+                    else:
+                        self._read(key.fd, kind, child)
+                except Exception as exc:  # noqa: BLE001
+                    self._fail(child, exc)
+            with self._lock:
+                pending, self._pending = self._pending, []
+                for child in pending:
+                    try:
+                        self._register(child)
+                    except Exception as exc:  # noqa: BLE001
+                        self._fail(child, exc)
+            now = time.monotonic()
+            for child in list(self._children):
+                try:
+                    self._check(child, now)
+                except Exception as exc:  # noqa: BLE001
+                    self._fail(child, exc)
+            if self._orphans:
+                self._orphans = [c for c in self._orphans if not self._reap_orphan(c)]
+
+    def _fail(self, child: _Child, exc: BaseException) -> None:
+        """监督某个子进程时出错：结束其进程组、注销其描述符，future 以该异常结束。"""
+        logger.error("Supervising %s (pid %d) failed, killing its process group", child.args[0], child.proc.pid, exc_info=exc)
+        _kill_group(child.proc)
+        for key in list(self._sel.get_map().values()):
+            kind, owner = key.data
+            if owner is child:
+                try:
+                    self._sel.unregister(key.fd)
+                except (KeyError, ValueError, OSError):
+                    pass
+        for pipe in (child.proc.stdout, child.proc.stderr):
+            try:
+                if pipe is not None:
+                    pipe.close()
+            except OSError:
+                pass
+        if child.pidfd is not None:
+            try:
+                os.close(child.pidfd)
+            except OSError:
+                pass
+            child.pidfd = None
+        child.open_pipes = 0
+        self._children.discard(child)
+        if not child.reaped:
+            self._orphans.append(child)
+        if not child.future.done():
+            child.future.set_exception(exc)
+
+    @staticmethod
+    def _reap_orphan(child: _Child) -> bool:
+        try:
+            return os.waitpid(child.proc.pid, os.WNOHANG)[0] != 0
+        except ChildProcessError:
+            return True
+
+    def _next_timeout(self) -> Optional[float]:
+        now = time.monotonic()
+        timeout: Optional[float] = None
+        for child in self._children:
+            for t in (None if child.timed_out else child.deadline, child.kill_deadline):
+                if t is not None:
+                    timeout = max(t - now, 0.0) if timeout is None else min(timeout, max(t - now, 0.0))
+            if child.open_pipes == 0 and child.pidfd is None:
+                timeout = _POLL_INTERVAL if timeout is None else min(timeout, _POLL_INTERVAL)
+        if self._orphans:
+            timeout = _POLL_INTERVAL if timeout is None else min(timeout, _POLL_INTERVAL)
+        return timeout
+
+    def _read(self, fd: int, stream: str, child: _Child) -> None:
+        try:
+            data = os.read(fd, _READ_SIZE)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b""
+        callback = child.on_stdout_line if stream == "stdout" else child.on_stderr_line
+        if not data:
+            self._close_pipe(fd, stream, child)
+            rest = child.partial[stream]
+            if rest and callback is not None:
+                self._deliver(callback, rest)
+            child.partial[stream] = b""
+            return
+        (child.out_chunks if stream == "stdout" else child.err_chunks).append(data)
+        if callback is None:
+            return
+        buf = child.partial[stream] + data
+        *lines, child.partial[stream] = buf.split(b"\n")
+        for raw in lines:
+            self._deliver(callback, raw)
+
+    @staticmethod
+    def _deliver(callback: Callable[[str], None], raw: bytes) -> None:
+        try:
+            callback(raw.decode(errors="replace").rstrip("\r"))
+        except Exception:  # noqa: BLE001
+            logger.debug("line callback failed", exc_info=True)
+
+    def _close_pipe(self, fd: int, stream: str, child: _Child) -> None:
+        self._sel.unregister(fd)
+        pipe = child.proc.stdout if stream == "stdout" else child.proc.stderr
+        if pipe is not None:
+            pipe.close()
+        child.open_pipes -= 1
+
+    def _close_pidfd(self, child: _Child) -> None:
+        if child.pidfd is not None:
+            self._sel.unregister(child.pidfd)
+            os.close(child.pidfd)
+            child.pidfd = None
+
+    @staticmethod
+    def _reap(child: _Child) -> bool:
+        """非阻塞回收子进程并记录 rusage；代替 Popen.poll()（poll 回收后就拿不到 rusage）。"""
+        if child.reaped:
+            return True
+        try:
+            pid, status, ru = os.wait4(child.proc.pid, os.WNOHANG)
+        except ChildProcessError:
+            # 已被别处回收，没有 rusage
+            if child.proc.returncode is None:
+                child.proc.returncode = -1
+            child.reaped = True
+            return True
+        if pid == 0:
+            return False
+        child.proc.returncode = os.waitstatus_to_exitcode(status)
+        child.rusage = ru
+        child.reaped = True
+        return True
+
+    def _check(self, child: _Child, now: float) -> None:
+        if child.deadline is not None and now >= child.deadline and not child.timed_out and not self._reap(child):
+            logger.warning("Process %s (pid %d) timed out, killing its process group", child.args[0], child.proc.pid)
+            child.timed_out = True
+            _kill_group(child.proc)
+        if (child.timed_out or child.killed) and child.kill_deadline is None:
+            child.kill_deadline = now + _KILL_GRACE
+        if child.open_pipes and child.kill_deadline is not None and now >= child.kill_deadline:
+            # 进程组已杀，但仍有进程（另起会话的孙进程）占着管道：不再等待
+            for key in list(self._sel.get_map().values()):
+                kind, owner = key.data
+                if owner is child and kind in ("stdout", "stderr"):
+                    self._close_pipe(key.fd, kind, child)
+        if child.open_pipes:
+            return
+        if child.pidfd is not None and not child.exited:
+            return
+        if not self._reap(child):
+            return
+        self._close_pidfd(child)
+        self._children.discard(child)
+        elapsed = time.monotonic() - child.started
+        stdout = b"".join(child.out_chunks)
+        stderr = b"".join(child.err_chunks)
+        result = ProcessResult(
+            args=child.args,
+            pid=child.proc.pid,
+            exit_code=child.proc.returncode,
+            stdout=stdout.decode(errors="replace"),
+            stderr=stderr.decode(errors="replace"),
+            timed_out=child.timed_out,
+            killed=child.killed,
+            elapsed=elapsed,
+            limits=child.limits,
+            usage=rusage_dict(child.rusage, elapsed, len(stdout), len(stderr)),
+        )
+        if child.runs is not None:
+            child.runs.append(result)
+        child.future.set_result(result)
+
+
+_supervisor: Optional[ProcessSupervisor] = None
+_supervisor_lock = threading.Lock()
+
+
+def get_supervisor() -> ProcessSupervisor:
+    """进程内共享的监督器（监督线程在第一次 spawn 时启动）。"""
+    global _supervisor
+    with _supervisor_lock:
+        if _supervisor is None:
+            _supervisor = ProcessSupervisor()
+    return _supervisor
+
+
+__all__ = [
+    "ProcessHandle",
+    "ProcessResult",
+    "ProcessSupervisor",
+    "ResourceLimits",
+    "get_supervisor",
+    "prepare_limits",
+    "record_process",
+    "rusage_dict",
+    "total_usage",
+    "track_processes",
+]
@@ -0,0 +1,240 @@
+"""分布式扫描 worker：在另一台（或同一台）主机上执行协调端派发的 nmap / 工具命令。
+
+启动（同一台机器上可起多个，端口不同即可）：
+
+    python -m core.worker --port 9101 --token <共享口令> --coordinator http://127.0.0.1:8000
+
+默认只监听 127.0.0.1。worker 会执行协调端派发的扫描命令，口令以明文 HTTP 发送：跨主机使用时须用 --host
+显式指定监听地址（如 --host 10.0.0.5，同时填 --advertise-url），并只在可信网络内使用，或放在 TLS 反向代理之后。
+
+协议（HTTP + JSON，所有请求带 Authorization: Bearer <token>）：
+- POST /run  {"args": [...], "timeout": 300} → NDJSON 流：
+  {"type": "line", "line": "..."}（实时 stdout）、{"type": "ping"}（保活）、
+  最后一行 {"type": "result", "exit_code", "stdout", "stderr", "timed_out"}
+- GET /health → {"ok": true, "name", "capacity", "running"}
+worker 每隔 worker_heartbeat_interval 秒向协调端 POST /api/workers/heartbeat 报告自身状态。
+"""
+
+from __future__ import annotations
+
+import argparse
+import hmac
+import json
+import logging
+import queue
+import socket
+import threading
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+from config.settings import settings
+from core.sandbox import CommandTimeoutError, LocalSandbox
+
+logger = logging.getLogger(__name__)
+
+# worker 允许执行的命令（与 tools/kali_tools.py、tools/exploitation.py 对应）
+WORKER_BINARIES = [
+    "nmap", "nikto", "dirb", "gobuster", "hydra", "whatweb",
+    "searchsploit", "whois", "ping", "curl", "sqlmap",
+]
+# 命令运行期间发送保活行的间隔（秒），协调端据此判断 worker 是否失联
+PING_INTERVAL = 5.0
+
+
+def check_token(header: Optional[str], token: str) -> bool:
+    """校验 Authorization: Bearer <token>（常量时间比较）。"""
+    if not token:
+        return False
+    prefix = "Bearer "
+    if not header or not header.startswith(prefix):
+        return False
+    return hmac.compare_digest(header[len(prefix):].strip(), token)
+
+
+class WorkerServer:
+    """worker 进程：HTTP 服务 + 向协调端发送心跳。"""
+
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        token: str,
+        coordinator: str = "",
+        name: str = "",
+        advertise_url: str = "",
+    ) -> None:
+        if not token:
+            raise ValueError("worker 需要共享口令：--token 或 KALI_AGENT_WORKER_TOKEN")
+        self.token = token
+        self.coordinator = coordinator.rstrip("/")
+        self.name = name or f"{socket.gethostname()}:{port}"
+        self.url = advertise_url or f"http://{'127.0.0.1' if host in ('', '0.0.0.0') else host}:{port}"
+        self.capacity = max(settings.scheduler_max_processes, 1)
+        self.sandbox = LocalSandbox(allowed_binaries=WORKER_BINARIES)
+        self._running = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self.httpd = ThreadingHTTPServer((host, port), self._handler_class())
+        self.httpd.daemon_threads = True
+
+    @property
+    def running(self) -> int:
+        with self._lock:
+            return self._running
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # HTTP/1.0：响应结束即关闭连接，NDJSON 可边执行边写出
+            protocol_version = "HTTP/1.0"
+
+            def log_message(self, fmt: str, *args) -> None:  # noqa: D401
+                logger.debug("%s - %s", self.address_string(), fmt % args)
+
+            def _json(self, status: int, body: dict) -> None:
+                data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _authorized(self) -> bool:
+                if check_token(self.headers.get("Authorization"), server.token):
+                    return True
+                self._json(401, {"ok": False, "error": "unauthorized"})
+                return False
+
+            def do_GET(self) -> None:  # noqa: N802
+                if not self._authorized():
+                    return
+                if self.path != "/health":
+                    self._json(404, {"ok": False, "error": "not found"})
+                    return
+                self._json(200, server.status())
+
+            def do_POST(self) -> None:  # noqa: N802
+                if not self._authorized():
+                    return
+                if self.path != "/run":
+                    self._json(404, {"ok": False, "error": "not found"})
+                    return
+                try:
+                    length = int(self.headers.get("Content-Length") or 0)
+                    body = json.loads(self.rfile.read(length) or b"{}")
+                    args = [str(a) for a in body.get("args") or []]
+                    timeout = int(body.get("timeout") or settings.sandbox_default_timeout)
+                except (ValueError, TypeError):
+                    self._json(400, {"ok": False, "error": "无效请求"})
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "application/x-ndjson")
+                self.end_headers()
+                for event in server.execute(args, timeout):
+                    try:
+                        self.wfile.write((json.dumps(event, ensure_ascii=False) + "\n").encode("utf-8"))
+                        self.wfile.flush()
+                    except OSError:
+                        # 协调端已断开；命令仍会在超时内结束
+                        return
+
+        return Handler
+
+    def status(self) -> dict:
+        return {"ok": True, "name": self.name, "url": self.url, "capacity": self.capacity, "running": self.running}
+
+    def execute(self, args: list[str], timeout: int):
+        """执行命令并产出 NDJSON 事件（line / ping / result）。"""
+        events: queue.Queue = queue.Queue()
+
+        def _run() -> None:
+            with self._lock:
+                self._running += 1
+            try:
+                res = self.sandbox.run(args, timeout=timeout, on_stdout_line=lambda line: events.put({"type": "line", "line": line}))
+                events.put({
+                    "type": "result",
+                    "exit_code": res.exit_code,
+                    "stdout": res.stdout,
+                    "stderr": res.stderr,
+                    "timed_out": res.timed_out,
+                    "limits": res.limits,
+                    "usage": res.usage,
+                })
+            except CommandTimeoutError as exc:
+                events.put({"type": "result", "exit_code": -1, "stdout": exc.stdout, "stderr": str(exc), "timed_out": True})
+            except Exception as exc:  # noqa: BLE001
+                events.put({"type": "result", "exit_code": -1, "stdout": "", "stderr": str(exc), "timed_out": False})
+            finally:
+                with self._lock:
+                    self._running -= 1
+
+        threading.Thread(target=_run, daemon=True).start()
+        while True:
+            try:
+                event = events.get(timeout=PING_INTERVAL)
+            except queue.Empty:
+                yield {"type": "ping"}
+                continue
+            yield event
+            if event["type"] == "result":
+                return
+
+    def _heartbeat_loop(self) -> None:
+        interval = max(settings.worker_heartbeat_interval, 0.5)
+        while not self._stop.is_set():
+            try:
+                req = urllib.request.Request(
+                    self.coordinator + "/api/workers/heartbeat",
+                    data=json.dumps(self.status()).encode("utf-8"),
+                    headers={"Content-Type": "application/json", "Authorization": f"Bearer {self.token}"},
+                    method="POST",
+                )
+                with urllib.request.urlopen(req, timeout=interval):
+                    pass
+            except OSError as exc:
+                logger.warning("Heartbeat to %s failed: %s", self.coordinator, exc)
+            self._stop.wait(interval)
+
+    def serve_forever(self) -> None:
+        if self.coordinator:
+            threading.Thread(target=self._heartbeat_loop, daemon=True).start()
+        logger.info("Youkai worker %s listening on %s", self.name, self.url)
+        try:
+            self.httpd.serve_forever()
+        finally:
+            self._stop.set()
+
+    def shutdown(self) -> None:
+        self._stop.set()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def main(argv: Optional[list[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Youkai 分布式扫描 worker")
+    parser.add_argument(
+        "--host",
+        default="127.0.0.1",
+        help="监听地址（默认只监听本机）；跨主机使用需显式指定，且只应在可信网络内或经 TLS 反向代理访问",
+    )
+    parser.add_argument("--port", type=int, default=9101)
+    parser.add_argument("--token", default=settings.worker_token, help="与协调端共享的口令")
+    parser.add_argument("--coordinator", default="", help="协调端地址，如 http://127.0.0.1:8000")
+    parser.add_argument("--name", default="", help="worker 名称（默认 主机名:端口）")
+    parser.add_argument("--advertise-url", default="", help="协调端访问本 worker 的地址（跨主机时填写）")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    if args.host not in ("127.0.0.1", "localhost", "::1"):
+        logger.warning("Worker listening on %s: commands and the bearer token travel over plain HTTP, "
+                       "use it only on a trusted network or behind a TLS proxy", args.host)
+    WorkerServer(args.host, args.port, args.token, args.coordinator, args.name, args.advertise_url).serve_forever()
+
+
+__all__ = ["PING_INTERVAL", "WORKER_BINARIES", "WorkerServer", "check_token"]
+
+
+if __name__ == "__main__":
+    main()
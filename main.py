@@ -11,6 +11,8 @@ from __future__ import annotations
 5. 将最终的 human_check_message 打印到终端，供人工审阅
 """
 
+import asyncio
+
 from core.agent import create_kali_agent
 
 
@@ -23,12 +25,14 @@ def main() -> None:
     agent = create_kali_agent()
 
     print("\n[Agent] 正在执行 START -> RECON -> ANALYSIS -> DECISION -> HUMAN_CHECK 流程...\n")
-    final_state = agent.invoke(
-        {
-            "goal": goal,
-            "target": target,
-            "nmap_arguments": nmap_args,
-        }
+    final_state = asyncio.run(
+        agent.ainvoke(
+            {
+                "goal": goal,
+                "target": target,
+                "nmap_arguments": nmap_args,
+            }
+        )
     )
 
     message = final_state.get("human_check_message")
@@ -0,0 +1,8 @@
+"""pytest 配置：把项目根目录加入导入路径（项目没有打包配置，模块按 core.* / tools.* 导入）。"""
+
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
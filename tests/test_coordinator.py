@@ -0,0 +1,42 @@
+"""core/coordinator.py：重新派发时不重复推送已收到的输出行。"""
+
+from __future__ import annotations
+
+from core.coordinator import _skip_delivered
+
+
+def test_redispatch_skips_the_already_delivered_prefix():
+    received: list[str] = []
+    delivered: list[int] = []
+    first = _skip_delivered(received.append, delivered, "w1")
+    for line in ("Starting Nmap", "Discovered open port 22/tcp on 10.0.0.1"):
+        first(line)
+    # worker 失联，新 worker 从头执行
+    second = _skip_delivered(received.append, delivered, "w2")
+    for line in ("Starting Nmap", "Discovered open port 22/tcp on 10.0.0.1", "Discovered open port 80/tcp on 10.0.0.1"):
+        second(line)
+    assert received == ["Starting Nmap", "Discovered open port 22/tcp on 10.0.0.1", "Discovered open port 80/tcp on 10.0.0.1"]
+
+
+def test_redispatch_with_different_output_emits_a_restart_marker():
+    received: list[str] = []
+    delivered: list[int] = []
+    first = _skip_delivered(received.append, delivered, "w1")
+    first("Starting Nmap at 10:00")
+    second = _skip_delivered(received.append, delivered, "w2")
+    second("Starting Nmap at 10:01")
+    second("done")
+    assert received == [
+        "Starting Nmap at 10:00",
+        "[coordinator] w2 上重新执行的输出与之前不同，以下为其完整输出",
+        "Starting Nmap at 10:01",
+        "done",
+    ]
+    # 之后再重新派发时以新输出为准
+    third = _skip_delivered(received.append, delivered, "w3")
+    third("Starting Nmap at 10:01")
+    assert received[-1] == "done"
+
+
+def test_no_callback():
+    assert _skip_delivered(None, [], "w1") is None
@@ -0,0 +1,95 @@
+"""core/events.py：有界事件通道的溢出策略与 BroadcastChannel 分发。"""
+
+from __future__ import annotations
+
+import asyncio
+import time
+
+import pytest
+
+from core.events import BroadcastChannel, EventChannel
+
+
+def _line(i: int) -> tuple:
+    return ("progress_line", "recon", f"line {i}")
+
+
+def _drain(channel: EventChannel) -> list[tuple]:
+    events = []
+    while True:
+        try:
+            events.append(channel.get_nowait())
+        except asyncio.QueueEmpty:
+            return events
+
+
+def _run(coro):
+    return asyncio.run(coro)
+
+
+def test_coalesce_counts_dropped_lines_and_keeps_control_events():
+    async def main():
+        channel = EventChannel(capacity=2, policy="coalesce")
+        for i in range(5):
+            channel.put(_line(i))
+        channel.put(("step", "RECON", "x"))
+        return _drain(channel), channel.dropped
+
+    events, dropped = _run(main())
+    assert events == [_line(0), _line(1), ("progress_dropped", "recon", 3), ("step", "RECON", "x")]
+    assert dropped == 3
+
+
+def test_drop_oldest_keeps_latest_lines():
+    async def main():
+        channel = EventChannel(capacity=2, policy="drop_oldest")
+        for i in range(4):
+            channel.put(_line(i))
+        return _drain(channel)
+
+    assert _run(main()) == [_line(2), _line(3)]
+
+
+def test_block_aput_waits_for_space_then_times_out():
+    async def main():
+        channel = EventChannel(capacity=1, policy="block", block_timeout=0.1)
+        await channel.aput(_line(0))
+        started = time.monotonic()
+        assert await channel.aput(_line(1)) is False
+        waited = time.monotonic() - started
+        # 消费者腾出空间后等待中的生产者继续
+        pending = asyncio.create_task(channel.aput(_line(2)))
+        await asyncio.sleep(0.01)
+        assert channel.get_nowait() == _line(0)
+        assert await pending is True
+        return waited, _drain(channel)
+
+    waited, rest = _run(main())
+    assert waited >= 0.09
+    assert rest == [_line(2)]
+
+
+def test_unknown_policy_is_rejected():
+    with pytest.raises(ValueError):
+        EventChannel(policy="unbounded")
+
+
+def test_broadcast_slow_block_subscriber_only_drops_its_own_lines():
+    async def main():
+        slow = EventChannel(capacity=1, policy="block", block_timeout=5.0)
+        fast = EventChannel(capacity=100, policy="block", block_timeout=5.0)
+        broadcast = BroadcastChannel()
+        broadcast.put(("step", "START", "x"))
+        broadcast.subscribe(slow)
+        broadcast.subscribe(fast)
+        started = time.monotonic()
+        for i in range(3):
+            await broadcast.aput(_line(i))
+        elapsed = time.monotonic() - started
+        return elapsed, _drain(slow), _drain(fast)
+
+    elapsed, slow, fast = _run(main())
+    # 生产者不等待慢订阅者的 block_timeout
+    assert elapsed < 1.0
+    assert slow == [("step", "START", "x"), _line(0), ("progress_dropped", "recon", 2)]
+    assert fast == [("step", "START", "x"), _line(0), _line(1), _line(2)]
@@ -0,0 +1,85 @@
+"""tools/exploitdb.py：Exploit-DB 内存索引的查询与重新加载。"""
+
+from __future__ import annotations
+
+import os
+import threading
+
+import pytest
+
+from tools.exploitdb import ExploitIndex
+
+HEADER = "id,file,description,date_published,author,type,platform\n"
+
+
+def _write_csv(path, titles: list[str]) -> None:
+    rows = "".join(f"{i},exploits/linux/{i}.txt,{t},2020-01-01,x,remote,linux\n" for i, t in enumerate(titles, 1))
+    path.write_text(HEADER + rows, encoding="utf-8")
+
+
+def test_search_prefix_matches_and_newest_first(tmp_path):
+    csv_path = tmp_path / "files_exploits.csv"
+    _write_csv(csv_path, ["Apache 2.4.49 - Path Traversal", "OpenSSH 7.2 - User Enumeration", "Apache 2.4.50 - RCE"])
+    index = ExploitIndex(csv_path)
+    assert [r["id"] for r in index.search("apache 2.4")] == ["3", "1"]
+    assert index.search("nginx") == []
+
+
+def test_readers_see_a_consistent_index_while_it_reloads(tmp_path):
+    csv_path = tmp_path / "files_exploits.csv"
+    big = [f"Apache 2.4.{i} - Bug {i}" for i in range(400)]
+    _write_csv(csv_path, big)
+    index = ExploitIndex(csv_path)
+    index.refresh(force=True)
+    errors: list[BaseException] = []
+    stop = threading.Event()
+
+    def reader() -> None:
+        try:
+            while not stop.is_set():
+                index.search("apache")
+                index.match_services([("Apache httpd", "2.4.10")])
+        except BaseException as exc:  # noqa: BLE001
+            errors.append(exc)
+
+    threads = [threading.Thread(target=reader) for _ in range(4)]
+    for t in threads:
+        t.start()
+    # 交替写入大、小两个文件：旧实现在 rows 已换成小表、倒排表仍是旧表时会越界
+    for n in range(20):
+        _write_csv(csv_path, big if n % 2 else big[:3])
+        os.utime(csv_path, (n + 1, n + 1))
+        index.refresh(force=True)
+    stop.set()
+    for t in threads:
+        t.join()
+    assert errors == []
+
+
+@pytest.mark.parametrize(
+    ("title", "version", "expected"),
+    [
+        ("OpenSSH 7.2p2 - Username Enumeration", "7.2p2", "exact"),
+        ("Apache 2.4.49 - Path Traversal", "2.4.49", "exact"),
+        ("vsftpd 2.3 - Backdoor Command Execution", "2.3.4", "prefix"),
+        ("Samba < 3.6.2 - Remote Code Execution", "3.5.1", "range"),
+        ("Samba <= 3.6.2 - Remote Code Execution", "3.6.3", ""),
+        # 标题中出现与服务完全相同的版本号时按 exact 计
+        ("Samba <= 3.6.2 - Remote Code Execution", "3.6.2", "exact"),
+        # 多分支上界只与同一 major.minor 分支比较
+        ("OpenSSL < 1.0.2/1.1.1 - DoS", "1.1.0", "range"),
+        ("OpenSSL < 1.0.2/1.1.1 - DoS", "1.0.9", ""),
+        ("Apache 2.2 - Denial of Service", "2.4.52", ""),
+        ("Apache httpd - Anything", "", "product"),
+    ],
+)
+def test_version_match(title, version, expected):
+    assert ExploitIndex("/nonexistent.csv")._version_match(title, version) == expected
+
+
+def test_match_service_ranks_exact_before_range(tmp_path):
+    csv_path = tmp_path / "files_exploits.csv"
+    _write_csv(csv_path, ["Apache 2.4.49 - Path Traversal", "Apache < 2.4.51 - SSRF", "Apache 2.2 - DoS"])
+    index = ExploitIndex(csv_path)
+    ((result,),) = [index.match_services([("Apache httpd", "2.4.49")])]
+    assert [(e["id"], e["match"]) for e in result["exploits"]] == [("1", "exact"), ("2", "range")]
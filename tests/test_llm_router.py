@@ -0,0 +1,113 @@
+"""core/llm_router.py：提供商统计、失败转移与对冲。"""
+
+from __future__ import annotations
+
+import asyncio
+import time
+
+import pytest
+
+from config.settings import settings
+from core import llm_router
+from core.llm_router import AllProvidersFailedError, LLMRouter, ProviderStats
+
+
+class FakeLLM:
+    def __init__(self, reply: str = "", delay: float = 0.0, error: bool = False) -> None:
+        self.reply = reply
+        self.delay = delay
+        self.error = error
+        self.calls = 0
+
+    def invoke(self, messages, **kwargs):
+        self.calls += 1
+        time.sleep(self.delay)
+        if self.error:
+            raise RuntimeError("boom")
+        return self.reply
+
+    async def ainvoke(self, messages, **kwargs):
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        if self.error:
+            raise RuntimeError("boom")
+        return self.reply
+
+
+@pytest.fixture(autouse=True)
+def router_settings(monkeypatch):
+    monkeypatch.setattr(settings, "llm_timeout", 2.0)
+    monkeypatch.setattr(settings, "llm_hedge", False)
+    monkeypatch.setattr(settings, "llm_cooldown_seconds", 60.0)
+
+
+def _warm(stats: ProviderStats, latency: float, n: int = 10) -> None:
+    for _ in range(n):
+        stats.record(True, latency)
+
+
+def test_p95_needs_enough_samples():
+    stats = ProviderStats()
+    _warm(stats, 0.1, llm_router._MIN_SAMPLES - 1)
+    assert stats.p95() is None
+    for latency in (0.2, 0.3, 5.0):
+        stats.record(True, latency)
+    assert stats.p95() == 5.0
+    snap = stats.snapshot()
+    assert snap["calls"] == llm_router._MIN_SAMPLES + 2 and snap["p50"] == 0.1
+
+
+def test_consecutive_failures_start_cooldown_and_success_resets():
+    stats = ProviderStats()
+    for _ in range(llm_router._FAILURE_THRESHOLD - 1):
+        stats.record(False, 1.0)
+    assert not stats.cooling
+    stats.record(True, 0.1)
+    assert stats.consecutive_failures == 0
+    for _ in range(llm_router._FAILURE_THRESHOLD):
+        stats.record(False, 1.0)
+    assert stats.cooling
+    failures = 2 * llm_router._FAILURE_THRESHOLD - 1
+    assert stats.error_rate == pytest.approx(failures / (failures + 1))
+
+
+def test_cooling_provider_is_ordered_last():
+    a, b = FakeLLM("a"), FakeLLM("b")
+    router = LLMRouter([("a", a), ("b", b)])
+    for _ in range(llm_router._FAILURE_THRESHOLD):
+        router.stats["a"].record(False, 1.0)
+    assert [name for name, _ in router.ordered()] == ["b", "a"]
+
+
+def test_invoke_fails_over_to_next_provider():
+    bad, good = FakeLLM(error=True), FakeLLM("ok")
+    router = LLMRouter([("bad", bad), ("good", good)])
+    assert router.invoke([]) == "ok"
+    assert router.stats["bad"].consecutive_failures == 1
+
+
+def test_ainvoke_times_out_then_fails_over(monkeypatch):
+    monkeypatch.setattr(settings, "llm_timeout", 0.1)
+    slow, good = FakeLLM("late", delay=1.0), FakeLLM("ok")
+    router = LLMRouter([("slow", slow), ("good", good)])
+    assert asyncio.run(router.ainvoke([])) == "ok"
+    assert router.stats["slow"].outcomes[-1] is False
+
+
+def test_all_providers_failing_raises():
+    router = LLMRouter([("a", FakeLLM(error=True)), ("b", FakeLLM(error=True))])
+    with pytest.raises(AllProvidersFailedError):
+        router.invoke([])
+
+
+def test_hedge_asks_next_provider_after_p95(monkeypatch):
+    monkeypatch.setattr(settings, "llm_hedge", True)
+    slow, fast = FakeLLM("slow", delay=1.0), FakeLLM("fast")
+    router = LLMRouter([("slow", slow), ("fast", fast)])
+    _warm(router.stats["slow"], 0.05)
+    started = time.monotonic()
+    assert asyncio.run(router.ainvoke([])) == "fast"
+    assert time.monotonic() - started < 0.5
+    assert router.stats["slow"].hedged == 1
+    assert router.invoke([]) == "fast"
+    assert router.stats["slow"].hedged == 2
@@ -0,0 +1,54 @@
+"""web/panels.py：数据窗口长文本的片段替换与按版本的增量。"""
+
+from __future__ import annotations
+
+from core.state import MemoryBackend
+from web.panels import _PATCH_MIN_CHARS, PanelStore, _text_patch
+
+
+def _apply(old: str, patch: dict) -> str:
+    # 与前端一致的还原方式
+    return old[: patch["p"]] + patch["t"] + old[len(old) - patch["s"]:]
+
+
+def test_patch_replaces_only_the_changed_middle():
+    old = "A" * 200 + "22/tcp open ssh\n" + "B" * 200
+    new = "A" * 200 + "22/tcp open ssh\n80/tcp open http\n" + "B" * 200
+    patch = _text_patch(old, new)
+    assert patch == {"p": 216, "s": 200, "t": "80/tcp open http\n"}
+    assert _apply(old, patch) == new
+
+
+def test_patch_handles_appends_and_overlapping_repeats():
+    old = "x" * 300
+    new = "x" * 310
+    patch = _text_patch(old, new)
+    # 前后缀重叠时不能把同一段计两次
+    assert patch["p"] + patch["s"] <= len(old)
+    assert _apply(old, patch) == new
+
+
+def test_short_or_mostly_changed_text_is_sent_whole():
+    assert _text_patch("a" * 10, "b" * 10) is None
+    assert _text_patch("a" * 400, "b" * 400) is None
+    assert _text_patch("", "c" * _PATCH_MIN_CHARS) is None
+
+
+def test_non_bmp_text_falls_back_to_full_value():
+    # 前端按 UTF-16 下标切片，emoji 会让下标错位
+    old = "报告 🚀 " + "x" * 300
+    assert _text_patch(old, old + "y") is None
+    assert _text_patch("x" * 300, "x" * 300 + "🚀") is None
+
+
+def test_store_returns_deltas_against_the_client_version():
+    store = PanelStore(MemoryBackend())
+    first = store.update("s1", {"ports": "22", "report": "r" * 300})
+    assert first["full"] and first["version"] == 1
+    delta = store.update("s1", {"ports": "22,80", "report": "r" * 300 + "!"}, base_version=1)
+    assert delta["base"] == 1 and delta["version"] == 2
+    assert delta["set"] == {"ports": "22,80"}
+    assert _apply("r" * 300, delta["patch"]["report"]) == "r" * 300 + "!"
+    # 版本不一致（如新标签页）返回完整快照
+    stale = store.update("s1", {"ports": "22,80"}, base_version=1)
+    assert stale["full"] and stale["set"] == {"ports": "22,80"}
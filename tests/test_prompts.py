@@ -0,0 +1,145 @@
+"""core/prompts.py：稳定前缀、按提供商的 cache_control 与用量提取，用桩模型驱动 invoke_llm / ainvoke_llm。"""
+
+from __future__ import annotations
+
+import asyncio
+from typing import Any
+
+import pytest
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, BaseMessage, SystemMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+
+from core import prompts
+from core.prompts import (
+    ANALYSIS_INSTRUCTIONS,
+    DECISION_INSTRUCTIONS,
+    ainvoke_llm,
+    build_messages,
+    invoke_llm,
+    usage_of,
+)
+
+USAGE = {
+    "input_tokens": 1200,
+    "output_tokens": 80,
+    "total_tokens": 1280,
+    "input_token_details": {"cache_read": 1024, "cache_creation": 0},
+}
+
+
+class StubChat(BaseChatModel):
+    """记录收到的消息，返回带 usage_metadata 的 AIMessage；类名不含 anthropic，按 OpenAI 处理。"""
+
+    calls: list = []
+
+    @property
+    def _llm_type(self) -> str:
+        return "stub"
+
+    def _generate(self, messages: list[BaseMessage], stop: Any = None, run_manager: Any = None, **kwargs: Any) -> ChatResult:
+        self.calls.append(messages)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content="ok", usage_metadata=USAGE))])
+
+
+class StubAnthropicChat(StubChat):
+    """类名含 anthropic，provider_of 判定为 Anthropic。"""
+
+
+@pytest.fixture(autouse=True)
+def _no_cassette(monkeypatch):
+    # 不受环境中录制 / 回放配置影响
+    monkeypatch.setattr(prompts, "get_cassette", lambda: None)
+
+
+def _system_text(message: BaseMessage) -> str:
+    content = message.content
+    return content if isinstance(content, str) else content[0]["text"]
+
+
+def test_system_prefix_is_byte_stable_across_calls():
+    llm = StubChat(calls=[])
+    invoke_llm(llm, build_messages(ANALYSIS_INSTRUCTIONS, "target A\n22/tcp open ssh"), "analysis")
+    invoke_llm(llm, build_messages(ANALYSIS_INSTRUCTIONS, "target B\n80/tcp open http"), "analysis")
+    first, second = llm.calls
+    assert isinstance(first[0], SystemMessage)
+    assert _system_text(first[0]).encode("utf-8") == _system_text(second[0]).encode("utf-8")
+    # 可变内容只出现在 HumanMessage 中
+    assert "target A" not in _system_text(first[0])
+    assert first[1].content != second[1].content
+    # 不同调用类型的前缀各自固定
+    decision = build_messages(DECISION_INSTRUCTIONS, "x")[0]
+    assert _system_text(decision) == _system_text(build_messages(DECISION_INSTRUCTIONS, "y")[0])
+
+
+def test_anthropic_system_message_gets_cache_control():
+    llm = StubAnthropicChat(calls=[])
+    messages = build_messages(ANALYSIS_INSTRUCTIONS, "scan")
+    invoke_llm(llm, messages, "analysis")
+    sent = llm.calls[0][0]
+    assert sent.content == [
+        {"type": "text", "text": messages[0].content, "cache_control": {"type": "ephemeral"}},
+    ]
+    # 调用方的消息不被修改
+    assert isinstance(messages[0].content, str)
+
+
+def test_other_providers_are_sent_unchanged():
+    llm = StubChat(calls=[])
+    messages = build_messages(ANALYSIS_INSTRUCTIONS, "scan")
+    invoke_llm(llm, messages, "analysis")
+    assert [m.content for m in llm.calls[0]] == [m.content for m in messages]
+
+
+def test_ainvoke_llm_matches_invoke_llm():
+    llm = StubAnthropicChat(calls=[])
+    messages = build_messages(DECISION_INSTRUCTIONS, "analysis text")
+    resp, usage = asyncio.run(ainvoke_llm(llm, messages, "decision"))
+    assert resp.content == "ok"
+    assert llm.calls[0][0].content[0]["cache_control"] == {"type": "ephemeral"}
+    assert usage == {"input_tokens": 1200, "output_tokens": 80, "cache_read": 1024, "cache_creation": 0}
+
+
+def test_invoke_llm_records_usage_totals():
+    before = prompts.usage_totals().get("classify", {})
+    invoke_llm(StubChat(calls=[]), build_messages("x", "y", with_system_prompt=False), "classify")
+    after = prompts.usage_totals()["classify"]
+    assert after["calls"] == before.get("calls", 0) + 1
+    assert after["cache_read"] == before.get("cache_read", 0) + 1024
+
+
+@pytest.mark.parametrize(
+    "metadata, expected",
+    [
+        # OpenAI：prompt_tokens_details.cached_tokens
+        (
+            {"token_usage": {"prompt_tokens": 900, "completion_tokens": 50, "prompt_tokens_details": {"cached_tokens": 768}}},
+            {"input_tokens": 900, "output_tokens": 50, "cache_read": 768, "cache_creation": 0},
+        ),
+        # DeepSeek：prompt_cache_hit_tokens
+        (
+            {"token_usage": {"prompt_tokens": 700, "completion_tokens": 20, "prompt_cache_hit_tokens": 512}},
+            {"input_tokens": 700, "output_tokens": 20, "cache_read": 512, "cache_creation": 0},
+        ),
+        # Anthropic：usage.cache_read_input_tokens
+        (
+            {"usage": {"input_tokens": 300, "output_tokens": 10, "cache_read_input_tokens": 256}},
+            {"input_tokens": 300, "output_tokens": 10, "cache_read": 256, "cache_creation": 0},
+        ),
+    ],
+)
+def test_usage_of_reads_legacy_response_metadata(metadata, expected):
+    assert usage_of(AIMessage(content="ok", response_metadata=metadata)) == expected
+
+
+def test_usage_of_prefers_usage_metadata():
+    resp = AIMessage(
+        content="ok",
+        usage_metadata=USAGE,
+        response_metadata={"token_usage": {"prompt_tokens": 1, "completion_tokens": 1, "prompt_cache_hit_tokens": 1}},
+    )
+    assert usage_of(resp) == {"input_tokens": 1200, "output_tokens": 80, "cache_read": 1024, "cache_creation": 0}
+
+
+def test_usage_of_without_usage_is_zero():
+    assert usage_of(AIMessage(content="ok")) == {"input_tokens": 0, "output_tokens": 0, "cache_read": 0, "cache_creation": 0}
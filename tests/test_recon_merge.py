@@ -0,0 +1,123 @@
+"""并行侦察分支的合并：NSE 脚本输出、服务信息 / OS 行随端口与主机一起保留（tools/scanning.py、core/agent.py）。"""
+
+from __future__ import annotations
+
+from core.agent import _extends_tcp, merge_recon_branches
+from core.speculative import recon_fingerprint
+from tools.scanning import _filter_nmap_output, merge_nmap_outputs
+
+TCP_RAW = """\
+Starting Nmap 7.94 ( https://nmap.org ) at 2026-10-19 10:00 UTC
+Nmap scan report for web.lab (10.0.0.5)
+Host is up (0.00050s latency).
+Not shown: 998 closed tcp ports (reset)
+PORT   STATE SERVICE VERSION
+22/tcp open  ssh     OpenSSH 8.9p1 Ubuntu 3ubuntu0.1 (Ubuntu Linux; protocol 2.0)
+80/tcp open  http    Apache httpd 2.4.52 ((Ubuntu))
+Service Info: OS: Linux; CPE: cpe:/o:linux:linux_kernel
+
+Nmap done: 1 IP address (1 host up) scanned in 7.12 seconds
+"""
+
+NSE_RAW = """\
+Nmap scan report for web.lab (10.0.0.5)
+Host is up (0.00048s latency).
+Not shown: 998 closed tcp ports (reset)
+PORT   STATE SERVICE
+22/tcp open  ssh
+| ssh-hostkey:
+|   256 aa:bb:cc:dd (ECDSA)
+|_  256 ee:ff:00:11 (ED25519)
+80/tcp open  http
+|_http-title: Apache2 Ubuntu Default Page: It works
+
+Host script results:
+|_clock-skew: -1s
+
+Nmap done: 1 IP address (1 host up) scanned in 12.40 seconds
+"""
+
+UDP_RAW = """\
+Nmap scan report for web.lab (10.0.0.5)
+Host is up (0.00051s latency).
+Not shown: 48 closed udp ports (port-unreach)
+PORT    STATE         SERVICE
+68/udp  open|filtered dhcpc
+161/udp open          snmp
+| snmp-info:
+|   enterprise: net-snmp
+|_  engineIDFormat: unknown
+
+Nmap done: 1 IP address (1 host up) scanned in 60.02 seconds
+"""
+
+TCP_AGGRESSIVE_RAW = """\
+Nmap scan report for web.lab (10.0.0.5)
+PORT   STATE SERVICE VERSION
+22/tcp open  ssh     OpenSSH 8.9p1 Ubuntu 3ubuntu0.1 (Ubuntu Linux; protocol 2.0)
+| ssh-hostkey:
+|_  256 aa:bb:cc:dd (ECDSA)
+Device type: general purpose
+Running: Linux 5.X
+OS details: Linux 5.0 - 5.14
+Service Info: OS: Linux; CPE: cpe:/o:linux:linux_kernel
+"""
+
+
+def _branch(raw: str, status: str = "ok") -> dict:
+    return {"status": status, "text": _filter_nmap_output(raw), "elapsed": 1.0}
+
+
+def test_filter_keeps_scripts_of_open_ports_and_host_trailers():
+    text = _filter_nmap_output(NSE_RAW)
+    assert "|_http-title: Apache2 Ubuntu Default Page: It works" in text
+    assert "|_clock-skew: -1s" in text
+    assert "Host is up" not in text
+    assert "Service Info: OS: Linux; CPE: cpe:/o:linux:linux_kernel" in _filter_nmap_output(TCP_RAW)
+
+
+def test_merge_tcp_and_nse_carries_script_output():
+    merged = merge_recon_branches({"TCP": _branch(TCP_RAW), "NSE": _branch(NSE_RAW)})
+    lines = merged.splitlines()
+    assert lines[0] == "Nmap scan report for web.lab (10.0.0.5)"
+    # 端口行来自 TCP 分支（带版本），脚本块紧跟在对应端口下
+    ssh = lines.index("22/tcp open ssh OpenSSH 8.9p1 Ubuntu 3ubuntu0.1 (Ubuntu Linux; protocol 2.0)")
+    assert lines[ssh + 1:ssh + 4] == ["| ssh-hostkey:", "|   256 aa:bb:cc:dd (ECDSA)", "|_  256 ee:ff:00:11 (ED25519)"]
+    http = lines.index("80/tcp open http Apache httpd 2.4.52 ((Ubuntu))")
+    assert lines[http + 1] == "|_http-title: Apache2 Ubuntu Default Page: It works"
+    assert "Service Info: OS: Linux; CPE: cpe:/o:linux:linux_kernel" in lines
+    assert lines[-2:] == ["Host script results:", "|_clock-skew: -1s"]
+
+
+def test_merge_tcp_and_udp_keeps_aggressive_scan_output():
+    merged = merge_recon_branches({"TCP": _branch(TCP_AGGRESSIVE_RAW), "UDP": _branch(UDP_RAW)})
+    lines = merged.splitlines()
+    assert "|_  256 aa:bb:cc:dd (ECDSA)" in lines
+    assert "OS details: Linux 5.0 - 5.14" in lines
+    assert "Running: Linux 5.X" in lines
+    snmp = lines.index("161/udp open snmp")
+    assert lines[snmp + 1:snmp + 4] == ["| snmp-info:", "|   enterprise: net-snmp", "|_  engineIDFormat: unknown"]
+    # TCP 端口排在 UDP 之前
+    assert lines.index("22/tcp open ssh OpenSSH 8.9p1 Ubuntu 3ubuntu0.1 (Ubuntu Linux; protocol 2.0)") < lines.index("68/udp open|filtered dhcpc")
+
+
+def test_duplicate_scripts_and_trailers_are_kept_once():
+    merged = merge_nmap_outputs([_filter_nmap_output(TCP_AGGRESSIVE_RAW), _filter_nmap_output(NSE_RAW), _filter_nmap_output(TCP_RAW)])
+    assert merged.count("| ssh-hostkey:") == 1
+    assert merged.count("Service Info:") == 1
+
+
+def test_unfinished_branch_is_noted_and_fingerprint_unchanged_by_scripts():
+    udp = {"status": "timeout", "text": "Nmap 扫描在 240 秒内未完成", "elapsed": 240.0}
+    merged = merge_recon_branches({"TCP": _branch(TCP_RAW), "NSE": _branch(NSE_RAW), "UDP": udp})
+    assert merged.splitlines()[-1] == "# UDP 分支未完成：Nmap 扫描在 240 秒内未完成"
+    assert recon_fingerprint(merged) == recon_fingerprint(_filter_nmap_output(TCP_RAW))
+
+
+def test_udp_open_filtered_does_not_block_speculative_adoption():
+    udp_noise = "Nmap scan report for web.lab (10.0.0.5)\nPORT STATE SERVICE\n68/udp open|filtered dhcpc"
+    assert not _extends_tcp({"TCP": _branch(TCP_RAW), "UDP": {"status": "ok", "text": udp_noise}})
+    # 确认开放的 UDP 端口或 NSE 脚本输出需要重新分析
+    assert _extends_tcp({"TCP": _branch(TCP_RAW), "UDP": _branch(UDP_RAW)})
+    assert _extends_tcp({"TCP": _branch(TCP_RAW), "NSE": _branch(NSE_RAW)})
+    assert not _extends_tcp({"TCP": _branch(TCP_RAW), "UDP": {"status": "timeout", "text": "超时"}})
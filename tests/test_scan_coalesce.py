@@ -0,0 +1,100 @@
+"""相同扫描合并（tools/scanning.py）：共享扫描不属于第一个请求，发起者取消后其余接入者照常拿到结果。"""
+
+from __future__ import annotations
+
+import asyncio
+
+import pytest
+
+from config.settings import settings
+from core.events import EventChannel, bind_channel, current_channel, emit
+from core.sandbox import CommandResult
+from core.supervisor import ProcessResult, record_process, track_processes
+from tools import scanning
+
+OUTPUT = "Nmap scan report for 10.0.0.1\nPORT STATE SERVICE VERSION\n22/tcp open ssh OpenSSH 8.9"
+
+
+class FakeSandbox:
+    def __init__(self) -> None:
+        self.calls = 0
+        self.channel = None
+        self.release = asyncio.Event()
+
+    async def arun(self, args, timeout=None, on_stdout_line=None):
+        self.calls += 1
+        self.channel = current_channel()
+        emit(("queue", {"state": "started"}))
+        await on_stdout_line("Discovered open port 22/tcp on 10.0.0.1")
+        await self.release.wait()
+        record_process(ProcessResult(args=list(args), pid=4242, exit_code=0, stdout="", stderr=""))
+        return CommandResult(command=" ".join(args), exit_code=0, stdout=OUTPUT, stderr="")
+
+
+@pytest.fixture
+def sandbox(monkeypatch):
+    monkeypatch.setattr(settings, "scan_coalesce", True)
+    monkeypatch.setattr(settings, "scan_checkpoint", False)
+    fake = FakeSandbox()
+    monkeypatch.setattr(scanning, "get_sandbox", lambda: fake)
+    return fake
+
+
+def _drain(channel: EventChannel) -> list[tuple]:
+    events = []
+    while True:
+        try:
+            events.append(channel.get_nowait())
+        except asyncio.QueueEmpty:
+            return events
+
+
+def test_followers_keep_the_scan_when_the_first_requester_is_cancelled(sandbox):
+    async def main():
+        channels = [EventChannel(), EventChannel()]
+
+        async def job(channel):
+            bind_channel(channel)
+            with track_processes() as runs:
+                branch = await scanning.anmap_branch("10.0.0.1", "-sV -Pn")
+            return branch, runs
+
+        owner = asyncio.create_task(job(channels[0]))
+        await asyncio.sleep(0.05)
+        follower = asyncio.create_task(job(channels[1]))
+        await asyncio.sleep(0.05)
+        assert sandbox.calls == 1
+        # 扫描在独立上下文中运行，不使用第一个请求的事件通道
+        assert sandbox.channel not in channels
+        owner.cancel()
+        await asyncio.sleep(0.05)
+        sandbox.release.set()
+        branch, runs = await follower
+        assert branch["status"] == "ok" and branch["shared"] == 1
+        assert [r.pid for r in runs] == [4242]
+        assert owner.cancelled()
+        # 排队事件与输出行都转发给了接入者
+        events = _drain(channels[1])
+        assert ("queue", {"state": "started"}) in events
+        assert ("progress_line", "recon", "Discovered open port 22/tcp on 10.0.0.1") in events
+
+    asyncio.run(main())
+
+
+def test_scan_is_cancelled_when_the_last_requester_leaves(sandbox):
+    async def main():
+        bind_channel(EventChannel())
+        first = asyncio.create_task(scanning.anmap_branch("10.0.0.1", "-sV -Pn"))
+        await asyncio.sleep(0.05)
+        second = asyncio.create_task(scanning.anmap_branch("10.0.0.1", "-sV -Pn"))
+        await asyncio.sleep(0.05)
+        (entry,) = scanning._inflight
+        first.cancel()
+        await asyncio.sleep(0.05)
+        assert not entry.task.done()
+        second.cancel()
+        await asyncio.sleep(0.05)
+        assert entry.task.cancelled()
+        assert not scanning._inflight
+
+    asyncio.run(main())
@@ -0,0 +1,74 @@
+"""core/scheduler.py：每目标令牌桶与进程调度的优先级、目标并发上限。"""
+
+from __future__ import annotations
+
+import threading
+import time
+
+import pytest
+
+from core.scheduler import ProcessScheduler, QueueTimeoutError, _TokenBucket, target_key
+
+
+def test_token_bucket_allows_burst_then_paces_at_rate():
+    bucket = _TokenBucket(rate=2.0, burst=3)
+    now = bucket.updated
+    for _ in range(3):
+        assert bucket.delay(now) == 0.0
+        bucket.take(now)
+    # 令牌用完：按 2 次/秒补充，下一枚在 0.5 秒后
+    assert bucket.delay(now) == pytest.approx(0.5)
+    assert bucket.delay(now + 0.5) == 0.0
+    # 长时间空闲后最多攒到 burst 枚
+    bucket.take(now + 0.5)
+    bucket.delay(now + 100)
+    assert bucket.tokens == 3
+
+
+def test_token_bucket_disabled_when_rate_is_zero():
+    bucket = _TokenBucket(rate=0.0, burst=0)
+    assert bucket.burst == 1.0
+    for _ in range(10):
+        bucket.take(bucket.updated)
+    assert bucket.delay(bucket.updated) == 0.0
+
+
+def test_target_key_normalizes_urls():
+    assert target_key("HTTP://Web.Lab:8080/login") == "web.lab"
+    assert target_key(" 10.0.0.0/24 ") == "10.0.0.0/24"
+
+
+def test_rate_limited_target_does_not_block_other_targets():
+    sched = ProcessScheduler(max_processes=4, per_target=4, target_rate=1.0, target_burst=1)
+    first = sched.acquire("a", "10.0.0.1")
+    sched.release(first)
+    # 10.0.0.1 的令牌已用完，需等约 1 秒；其他目标立即启动
+    with pytest.raises(QueueTimeoutError):
+        sched.acquire("a", "10.0.0.1", timeout=0.2)
+    started = time.monotonic()
+    other = sched.acquire("b", "10.0.0.2", timeout=0.2)
+    assert time.monotonic() - started < 0.1
+    sched.release(other)
+
+
+def test_higher_priority_starts_first_when_a_slot_frees():
+    sched = ProcessScheduler(max_processes=1, per_target=1)
+    running = sched.acquire("hold")
+    order: list[str] = []
+
+    def waiter(label: str, priority: str) -> None:
+        ticket = sched.acquire(label, priority=priority, timeout=5)
+        order.append(label)
+        sched.release(ticket)
+
+    threads = [threading.Thread(target=waiter, args=("batch", "batch"))]
+    threads[0].start()
+    time.sleep(0.05)
+    threads.append(threading.Thread(target=waiter, args=("interactive", "interactive")))
+    threads[1].start()
+    time.sleep(0.05)
+    assert [w["label"] for w in sched.snapshot()["waiting"]] == ["interactive", "batch"]
+    sched.release(running)
+    for t in threads:
+        t.join()
+    assert order == ["interactive", "batch"]
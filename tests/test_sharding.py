@@ -0,0 +1,63 @@
+"""tools/sharding.py：字典流式分片去重与按目标的连接预算。"""
+
+from __future__ import annotations
+
+import threading
+
+from tools.sharding import TargetBudget, count_lines, write_shards
+
+
+def _read(paths):
+    return [p.read_bytes().splitlines() for p in paths]
+
+
+def test_write_shards_dedups_across_shards_and_keeps_order(tmp_path):
+    words = [f"w{i}".encode() for i in range(200)]
+    wordlist = tmp_path / "list.txt"
+    wordlist.write_bytes(b"\n".join(words + [b"", b"# comment", b"  w5  "] + words[::-1]) + b"\n")
+    shard_dir = tmp_path / "shards"
+    shard_dir.mkdir()
+    paths, total = write_shards(wordlist, 4, shard_dir)
+    shards = _read(paths)
+    assert total == 200
+    assert sorted(w for shard in shards for w in shard) == sorted(words)
+    # 每个分片内保持首次出现的顺序
+    for shard in shards:
+        assert shard == sorted(shard, key=words.index)
+    assert not list(shard_dir.glob("raw_*"))
+
+
+def test_write_shards_password_mode_keeps_spaces_and_comments(tmp_path):
+    wordlist = tmp_path / "pass.txt"
+    wordlist.write_bytes(b"#secret\r\n pass \npass\n\n#secret\n")
+    paths, total = write_shards(wordlist, 2, tmp_path, skip_comments=False, strip=False)
+    assert total == 3
+    assert sorted(w for shard in _read(paths) for w in shard) == [b" pass ", b"#secret", b"pass"]
+
+
+def test_write_shards_empty_wordlist(tmp_path):
+    wordlist = tmp_path / "empty.txt"
+    wordlist.write_bytes(b"\n# only comments\n")
+    assert write_shards(wordlist, 3, tmp_path) == ([], 0)
+
+
+def test_count_lines_without_trailing_newline(tmp_path):
+    wordlist = tmp_path / "list.txt"
+    wordlist.write_bytes(b"a\nb\nc")
+    assert count_lines(wordlist) == 3
+    wordlist.write_bytes(b"")
+    assert count_lines(wordlist) == 0
+
+
+def test_target_budget_caps_connections_per_target():
+    budget = TargetBudget()
+    assert budget.acquire("t", 12, 16) == 12
+    assert budget.acquire("t", 12, 16) == 4
+    assert budget.acquire("other", 12, 16) == 12
+    assert budget.acquire("t", 1, 16, timeout=0.05) == 0
+    granted: list[int] = []
+    waiter = threading.Thread(target=lambda: granted.append(budget.acquire("t", 8, 16, timeout=5)))
+    waiter.start()
+    budget.release("t", 12)
+    waiter.join()
+    assert granted == [8]
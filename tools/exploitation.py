@@ -1,15 +1,26 @@
-"""利用类工具：sqlmap、自定义高危命令，需人工确认后执行。"""
+"""利用类工具：sqlmap（会话复用、按 URL 与参数索引结果）、自定义高危命令，需人工确认后执行。"""
 
 from __future__ import annotations
 
+import logging
+import re
 import shlex
-import subprocess
-from typing import Optional
+from pathlib import Path
+from typing import Any, Callable, Optional
+from urllib.parse import parse_qsl, urlsplit, urlunsplit
 
 from langchain_core.tools import tool
 
+from config.settings import settings
+from core.events import current_channel
+from core.scheduler import QueueTimeoutError, get_scheduler
+from core.supervisor import get_supervisor
 from tools.base import ToolMetadata
 
+logger = logging.getLogger(__name__)
+
+BASE_DIR = Path(__file__).resolve().parents[1]
+
 
 HIGH_RISK_METADATA = ToolMetadata(
     name="exploitation",
@@ -29,35 +40,250 @@ def placeholder_exploit(description: str) -> str:
     )
 
 
-def run_sqlmap(url: str, extra_args: str = "--batch --level=1 --risk=1", timeout: int = 300) -> tuple[int, str, str]:
-    """在本机执行 sqlmap（需已安装 sqlmap）。返回 (returncode, stdout, stderr)。"""
+# ---------- sqlmap 会话与结果索引 ----------
+
+_SQLMAP_DEFAULT_ARGS = "--batch --level=1 --risk=1"
+
+# 「Parameter: id (GET)」块：sqlmap 确认（或从会话恢复）的注入点，其后缩进行为 Type / Title / Payload
+_INJECTION_RE = re.compile(r"^Parameter: (?P<parameter>.+?) \((?P<place>.+)\)$")
+_FIELD_RE = re.compile(r"^\s+(?P<key>Type|Title|Payload): (?P<value>.*)$")
+# 「GET parameter 'id' does not seem to be injectable」/「… is not injectable」
+_NOT_INJECTABLE_RE = re.compile(
+    r"(?P<place>[\w()\- ]+?) parameter '(?P<parameter>[^']+)' (?:does not seem to be|is not) injectable"
+)
+_DBMS_RE = re.compile(r"^back-end DBMS: (?P<dbms>.+)$")
+_LOG_PREFIX_RE = re.compile(r"^\[\d{2}:\d{2}:\d{2}\] \[\w+\] ")
+
+# 这些参数表示在已确认的注入点上继续利用（枚举、读取数据等），不能用记录代替执行
+_ENUMERATION_ARGS = (
+    "-a", "--all", "-b", "--banner", "--current-user", "--current-db", "--hostname", "--is-dba",
+    "--users", "--passwords", "--privileges", "--roles", "--dbs", "--tables", "--columns", "--schema",
+    "--count", "--dump", "--dump-all", "--search", "--comments", "--statements", "-D", "-T", "-C",
+    "--sql-query", "--sql-shell", "--sql-file", "--os-cmd", "--os-shell", "--os-pwn", "--file-read",
+    "--file-write", "--reg-read", "--reg-add", "--reg-del", "--flush-session", "--fresh-queries",
+)
+
+
+def sqlmap_output_dir() -> Path:
+    """sqlmap 会话根目录（--output-dir）；sqlmap 在其下按主机名建子目录保存 session.sqlite 与日志。"""
+    raw = Path(settings.sqlmap_output_dir)
+    return raw if raw.is_absolute() else BASE_DIR / raw
+
+
+def normalize_url(url: str) -> str:
+    """结果索引用的 URL：小写协议与主机，去掉查询串与片段（参数单独记录）。"""
+    parts = urlsplit(url.strip())
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path or "/", "", ""))
+
+
+def url_parameters(url: str) -> list[str]:
+    """URL 查询串中的参数名（按出现顺序去重），即 sqlmap 默认测试的 GET 参数。"""
+    names: list[str] = []
+    for name, _ in parse_qsl(urlsplit(url.strip()).query, keep_blank_values=True):
+        if name and name not in names:
+            names.append(name)
+    return names
+
+
+def _option(args: list[str], name: str) -> Optional[str]:
+    """取 sqlmap 参数值，支持 --level=3 与 --level 3 两种写法；未给出时返回 None。"""
+    for i, a in enumerate(args):
+        if a.startswith(name + "="):
+            return a.split("=", 1)[1]
+        if a == name and i + 1 < len(args):
+            return args[i + 1]
+    return None
+
+
+def _int_option(args: list[str], name: str, default: int) -> int:
+    try:
+        return int(_option(args, name) or default)
+    except ValueError:
+        return default
+
+
+def _continues_exploitation(args: list[str]) -> bool:
+    return any(a.split("=", 1)[0] in _ENUMERATION_ARGS for a in args)
+
+
+def parse_sqlmap_output(text: str) -> dict[str, Any]:
+    """从 sqlmap 输出中提取各参数的测试结果。
+
+    返回 {"results": [{"parameter", "place", "injectable", "techniques": [{"type", "title", "payload"}]}], "dbms": str}；
+    同一参数既被确认可注入又出现「未发现」时以可注入为准。
+    """
+    found: dict[tuple[str, str], dict[str, Any]] = {}
+    dbms = ""
+    current: Optional[dict[str, Any]] = None
+    technique: Optional[dict[str, str]] = None
+    for raw in text.splitlines():
+        line = _LOG_PREFIX_RE.sub("", raw.rstrip())
+        m = _INJECTION_RE.match(line)
+        if m:
+            key = (m.group("place").strip(), m.group("parameter").strip())
+            current = found.setdefault(key, {"parameter": key[1], "place": key[0], "injectable": True, "techniques": []})
+            current["injectable"] = True
+            technique = None
+            continue
+        m = _FIELD_RE.match(line)
+        if m and current is not None:
+            name, value = m.group("key").lower(), m.group("value").strip()
+            if name == "type":
+                # 从会话恢复时同一注入点会再打印一遍，按类型去重
+                technique = next((t for t in current["techniques"] if t.get("type") == value), None)
+                if technique is None:
+                    technique = {"type": value}
+                    current["techniques"].append(technique)
+            elif technique is not None:
+                technique[name] = value
+            continue
+        if not line.strip():
+            # 注入点块内各类型之间以空行分隔，块以「---」结束
+            continue
+        current = technique = None
+        m = _NOT_INJECTABLE_RE.search(line)
+        if m:
+            key = (m.group("place").strip(), m.group("parameter").strip())
+            found.setdefault(key, {"parameter": key[1], "place": key[0], "injectable": False, "techniques": []})
+            continue
+        m = _DBMS_RE.match(line)
+        if m:
+            dbms = m.group("dbms").strip()
+    return {"results": list(found.values()), "dbms": dbms}
+
+
+def _engagement_name(engagement: str) -> str:
+    return (engagement or settings.default_engagement).strip() or "default"
+
+
+def _known_results(url: str, engagement: str) -> dict[tuple[str, str], dict[str, Any]]:
+    from core.engagement_db import get_engagement_db
+
+    rows = get_engagement_db().query_sqlmap_results(url=normalize_url(url), engagement=_engagement_name(engagement))
+    return {(r["place"], r["parameter"]): r for r in rows}
+
+
+def _covered(row: Optional[dict[str, Any]], level: int, risk: int) -> bool:
+    """已确认可注入，或已在不低于本次的 level / risk 下测试过且未发现注入。"""
+    if row is None:
+        return False
+    return row["injectable"] or (row["level"] >= level and row["risk"] >= risk)
+
+
+def _format_known(url: str, rows: list[dict[str, Any]]) -> str:
+    lines = [f"[记录] {normalize_url(url)} 的参数均已测试过，未重新执行 sqlmap（payload 中 force=true 可强制重新测试）："]
+    for r in rows:
+        if r["injectable"]:
+            kinds = "、".join(t.get("type", "") for t in r["techniques"]) or "未知类型"
+            dbms = f"，数据库 {r['dbms']}" if r["dbms"] else ""
+            lines.append(f"{r['place']} 参数 {r['parameter']}：可注入（{kinds}{dbms}）")
+        else:
+            lines.append(f"{r['place']} 参数 {r['parameter']}：未发现注入（level={r['level']} risk={r['risk']}）")
+    return "\n".join(lines)
+
+
+def _record_results(url: str, output: str, engagement: str, level: int, risk: int) -> None:
+    parsed = parse_sqlmap_output(output)
+    if not parsed["results"]:
+        return
+    try:
+        from core.engagement_db import get_engagement_db
+
+        get_engagement_db().record_sqlmap_results(
+            normalize_url(url), parsed["results"], engagement=engagement, dbms=parsed["dbms"], level=level, risk=risk,
+        )
+    except Exception as exc:  # noqa: BLE001
+        logger.warning("Failed to record sqlmap results for %s: %s", url, exc)
+
+
+def run_sqlmap(
+    url: str,
+    extra_args: str = _SQLMAP_DEFAULT_ARGS,
+    timeout: Optional[int] = None,
+    engagement: str = "",
+    force: bool = False,
+) -> tuple[int, str, str]:
+    """在本机执行 sqlmap（需已安装 sqlmap）。返回 (returncode, stdout, stderr)。
+
+    会话保存在 sqlmap_output_dir 下（--output-dir），再次利用同一目标时 sqlmap 从会话恢复已确认的注入点与已取得的数据；
+    各参数的结果按 URL 与参数写入记录库。开启 sqlmap_reuse 时已测试过且未发现注入的参数加入 --skip，
+    全部参数都已测试过且本次只做探测（没有 --dbs、--dump 等继续利用的参数）时直接返回记录，不再执行。
+    输出逐行推送到当前上下文的事件通道（「终端 — 执行」）。
+    """
     if not url or not url.strip():
         return -1, "", "URL 不能为空"
-    args = ["sqlmap", "-u", url.strip()]
-    args.extend(shlex.split(extra_args or "--batch --level=1 --risk=1"))
+    url = url.strip()
+    timeout = timeout or settings.sqlmap_timeout
+    args = ["sqlmap", "-u", url]
+    extra = shlex.split(extra_args or _SQLMAP_DEFAULT_ARGS)
+    args.extend(extra)
+    level, risk = _int_option(extra, "--level", 1), _int_option(extra, "--risk", 1)
+    channel = current_channel()
+    if settings.sqlmap_reuse and not force:
+        try:
+            known = _known_results(url, engagement)
+        except Exception as exc:  # noqa: BLE001
+            logger.warning("Failed to look up sqlmap results for %s: %s", url, exc)
+            known = {}
+        # 只对 URL 中的 GET 参数判断；用户自己指定 -p / --skip 时不改动
+        params = url_parameters(url)
+        if known and params and _option(extra, "-p") is None and _option(extra, "--skip") is None:
+            rows = [known.get(("GET", p)) for p in params]
+            if all(_covered(r, level, risk) for r in rows) and not _continues_exploitation(extra):
+                text = _format_known(url, [r for r in rows if r is not None])
+                if channel is not None:
+                    for line in text.splitlines():
+                        channel.put(("progress_line", "exec", line))
+                return 0, text, ""
+            skip = [p for p, r in zip(params, rows) if r is not None and not r["injectable"] and _covered(r, level, risk)]
+            if skip:
+                args.append("--skip=" + ",".join(skip))
+    if _option(extra, "--output-dir") is None:
+        output_dir = sqlmap_output_dir()
+        output_dir.mkdir(parents=True, exist_ok=True)
+        args.append(f"--output-dir={output_dir}")
+    on_stdout_line: Optional[Callable[[str], None]] = None
+    if channel is not None:
+
+        def _on_line(line: str) -> None:
+            if line.strip():
+                channel.put(("progress_line", "exec", line))
+
+        on_stdout_line = _on_line
     try:
-        proc = subprocess.run(
-            args,
-            capture_output=True,
-            text=True,
-            timeout=timeout,
-        )
-        return proc.returncode, proc.stdout or "", proc.stderr or ""
+        with get_scheduler().slot("sqlmap", urlsplit(url).hostname or url, timeout=settings.scheduler_queue_timeout):
+            res = get_supervisor().run(args, timeout, on_stdout_line)
+    except QueueTimeoutError as e:
+        return -1, "", str(e)
     except FileNotFoundError:
         return -1, "", "未找到 sqlmap，请确保已安装（apt install sqlmap 或 pip install sqlmap）"
-    except subprocess.TimeoutExpired:
-        return -1, "", f"sqlmap 执行超时（{timeout}s）"
     except Exception as e:  # noqa: BLE001
         return -1, "", str(e)
+    # 超时前确认的结果同样记录；会话已保存，再次执行从中断处继续
+    _record_results(url, res.stdout, engagement, level, risk)
+    if res.timed_out:
+        return -1, res.stdout, f"sqlmap 执行超时（{timeout}s），会话已保存，再次执行将从中断处继续"
+    return res.exit_code, res.stdout, res.stderr
 
 
 def run_dangerous_command(allowed_action: str, payload: dict) -> tuple[int, str, str]:
     """仅允许白名单内的利用动作。allowed_action: sqlmap。"""
     if allowed_action == "sqlmap":
         url = payload.get("url") or ""
-        extra = payload.get("extra_args") or "--batch --level=1 --risk=1"
-        return run_sqlmap(url, extra)
+        extra = payload.get("extra_args") or _SQLMAP_DEFAULT_ARGS
+        return run_sqlmap(
+            url, extra, engagement=str(payload.get("engagement") or ""), force=bool(payload.get("force")),
+        )
     return -1, "", f"不允许的执行类型: {allowed_action}"
 
 
-__all__ = ["HIGH_RISK_METADATA", "placeholder_exploit", "run_sqlmap", "run_dangerous_command"]
+__all__ = [
+    "HIGH_RISK_METADATA",
+    "normalize_url",
+    "parse_sqlmap_output",
+    "placeholder_exploit",
+    "run_dangerous_command",
+    "run_sqlmap",
+    "sqlmap_output_dir",
+    "url_parameters",
+]
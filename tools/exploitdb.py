@@ -0,0 +1,264 @@
+"""Exploit-DB 内存索引：一次加载 files_exploits.csv，替代逐关键词启动 searchsploit 进程。
+
+- 标题分词后建倒排索引，关键词按前缀匹配（"2.4" 命中 "2.4.49"），多个词取交集，语义接近 searchsploit。
+- CSV 文件变化（mtime / 大小）后下次查询自动重新加载。
+- match_services 批量匹配 (product, version)：一次调用返回侦察结果中每个服务的候选利用。
+"""
+
+from __future__ import annotations
+
+import bisect
+import csv
+import logging
+import re
+import threading
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Iterable, Optional
+
+from config.settings import settings
+
+logger = logging.getLogger(__name__)
+
+_TOKEN_RE = re.compile(r"[a-z0-9][a-z0-9._-]*")
+_VERSION_RE = re.compile(r"^\d+(?:\.\d+)*[a-z0-9-]*$")
+# "< 4.4.14/4.5.10/4.6.4" 这类按分支列出的上界也一并捕获
+_RANGE_RE = re.compile(r"(<=?|before|prior to)\s*v?(\d+(?:\.\d+)+(?:/\d+(?:\.\d+)+)*)", re.IGNORECASE)
+# 服务产品名里不具区分度的词，匹配时忽略
+_GENERIC_WORDS = {"httpd", "http", "server", "daemon", "service", "smbd", "ftpd", "sshd", "the", "and"}
+# refresh 检查文件变化的最小间隔（秒）
+_STAT_INTERVAL = 5.0
+
+
+def _tokens(text: str) -> list[str]:
+    return [t.strip("._-") for t in _TOKEN_RE.findall((text or "").lower()) if t.strip("._-")]
+
+
+def _version_tuple(v: str) -> tuple[int, ...]:
+    parts: list[int] = []
+    for p in re.split(r"[.\-]", v):
+        m = re.match(r"\d+", p)
+        if not m:
+            break
+        parts.append(int(m.group(0)))
+    return tuple(parts)
+
+
+@dataclass(frozen=True)
+class _Snapshot:
+    """一次加载的索引内容。重新加载时整体替换，读者取一次引用后始终看到同一版本的 rows 与倒排表。"""
+
+    rows: tuple[tuple[str, str, str, str, str], ...] = ()  # (id, title, type, platform, path)
+    postings: dict[str, list[int]] = field(default_factory=dict)
+    sorted_tokens: tuple[str, ...] = ()
+
+    def prefix_postings(self, prefix: str) -> set[int]:
+        out: set[int] = set()
+        i = bisect.bisect_left(self.sorted_tokens, prefix)
+        while i < len(self.sorted_tokens) and self.sorted_tokens[i].startswith(prefix):
+            out.update(self.postings[self.sorted_tokens[i]])
+            i += 1
+        return out
+
+    def candidates(self, terms: Iterable[str]) -> set[int]:
+        result: Optional[set[int]] = None
+        for term in sorted(set(terms), key=len, reverse=True):
+            ids = self.prefix_postings(term)
+            result = ids if result is None else result & ids
+            if not result:
+                return set()
+        return result or set()
+
+    def row(self, idx: int, match: str = "") -> dict[str, Any]:
+        eid, title, etype, platform, path = self.rows[idx]
+        row = {"id": eid, "title": title, "type": etype, "platform": platform, "path": path}
+        if match:
+            row["match"] = match
+        return row
+
+
+class ExploitIndex:
+    """files_exploits.csv 的倒排索引。"""
+
+    def __init__(self, csv_path: Optional[str | Path] = None) -> None:
+        self.csv_path = Path(csv_path or Path(settings.exploitdb_path) / "files_exploits.csv")
+        self._lock = threading.Lock()
+        self._signature: Optional[tuple[float, int]] = None
+        self._checked_at = 0.0
+        # 读者不加锁：只读取一次 self._snapshot，refresh 以一次赋值换入新快照
+        self._snapshot = _Snapshot()
+        self.loaded_at = 0.0
+        self.load_seconds = 0.0
+
+    @property
+    def rows(self) -> tuple[tuple[str, str, str, str, str], ...]:
+        return self._snapshot.rows
+
+    @property
+    def available(self) -> bool:
+        self.refresh()
+        return bool(self._snapshot.rows)
+
+    def refresh(self, force: bool = False) -> None:
+        """文件不存在时清空索引；文件有变化时重新加载。"""
+        now = time.monotonic()
+        if not force and now - self._checked_at < _STAT_INTERVAL and self._signature is not None:
+            return
+        with self._lock:
+            self._checked_at = now
+            try:
+                st = self.csv_path.stat()
+            except OSError:
+                if self._snapshot.rows:
+                    logger.warning("Exploit-DB CSV disappeared: %s", self.csv_path)
+                self._snapshot = _Snapshot()
+                self._signature = (0.0, 0)
+                return
+            signature = (st.st_mtime, st.st_size)
+            if signature == self._signature and not force:
+                return
+            self._snapshot = self._load()
+            self._signature = signature
+
+    def _load(self) -> _Snapshot:
+        started = time.perf_counter()
+        rows: list[tuple[str, str, str, str, str]] = []
+        postings: dict[str, list[int]] = {}
+        with self.csv_path.open(encoding="utf-8", errors="ignore", newline="") as fh:
+            for rec in csv.DictReader(fh):
+                title = rec.get("description") or ""
+                if not title:
+                    continue
+                idx = len(rows)
+                rows.append((
+                    rec.get("id") or "",
+                    title,
+                    rec.get("type") or "",
+                    rec.get("platform") or "",
+                    rec.get("file") or "",
+                ))
+                for tok in set(_tokens(title)):
+                    postings.setdefault(tok, []).append(idx)
+        self.loaded_at = time.time()
+        self.load_seconds = time.perf_counter() - started
+        logger.info("Loaded %d exploits from %s in %.2fs", len(rows), self.csv_path, self.load_seconds)
+        return _Snapshot(rows=tuple(rows), postings=postings, sorted_tokens=tuple(sorted(postings)))
+
+    def search(self, keyword: str, limit: int = 200) -> list[dict[str, Any]]:
+        """关键词搜索（各词前缀匹配后取交集），结果按 EDB-ID 倒序（新的在前）。"""
+        self.refresh()
+        snap = self._snapshot
+        terms = _tokens(keyword)
+        if not terms or not snap.rows:
+            return []
+        ids = sorted(snap.candidates(terms), reverse=True)[:limit]
+        return [snap.row(i) for i in ids]
+
+    def _product_terms(self, product: str) -> list[str]:
+        return [t for t in _tokens(product) if t not in _GENERIC_WORDS and not _VERSION_RE.match(t)]
+
+    def _version_match(self, title: str, version: str) -> str:
+        """判断标题与服务版本的关系：exact / prefix / range，不相关返回空串。"""
+        if not version:
+            return "product"
+        vt = _version_tuple(version)
+        low = title.lower()
+        for tok in _tokens(low):
+            if not tok[:1].isdigit():
+                continue
+            if tok == version.lower():
+                return "exact"
+            tt = _version_tuple(tok)
+            if tt and vt[: len(tt)] == tt and len(tt) >= 2:
+                return "prefix"
+        for op, bounds in _RANGE_RE.findall(title):
+            branches = [_version_tuple(b) for b in bounds.split("/")]
+            if len(branches) > 1:
+                # 多分支上界只与同一 major.minor 分支比较
+                branches = [bt for bt in branches if bt[:2] == vt[:2]]
+            for bt in branches:
+                if vt and bt and (vt < bt or (op == "<=" and vt == bt)):
+                    return "range"
+        return ""
+
+    def match_service(
+        self, product: str, version: str = "", limit: int = 20, snapshot: Optional[_Snapshot] = None
+    ) -> list[dict[str, Any]]:
+        snap = snapshot or self._snapshot
+        terms = self._product_terms(product)
+        if not terms:
+            return []
+        # 产品名的第一个有效词最具区分度（openssh / apache / samba / vsftpd ...）
+        ids = snap.candidates(terms[:1])
+        rank = {"exact": 0, "range": 1, "prefix": 2, "product": 3}
+        hits: list[tuple[int, int, dict[str, Any]]] = []
+        for idx in ids:
+            match = self._version_match(snap.rows[idx][1], version)
+            if match:
+                hits.append((rank[match], -idx, snap.row(idx, match)))
+        hits.sort(key=lambda h: (h[0], h[1]))
+        return [h[2] for h in hits[:limit]]
+
+    def match_services(self, services: Iterable[tuple[str, str]], limit: int = 20) -> list[dict[str, Any]]:
+        """批量匹配 [(product, version), ...]，相同组合只查一次。"""
+        self.refresh()
+        # 整批使用同一个快照，批量匹配期间的重新加载不影响本次结果
+        snap = self._snapshot
+        out: list[dict[str, Any]] = []
+        seen: set[tuple[str, str]] = set()
+        for product, version in services:
+            key = ((product or "").strip(), (version or "").strip())
+            if not key[0] or key in seen:
+                continue
+            seen.add(key)
+            out.append({
+                "product": key[0],
+                "version": key[1],
+                "exploits": self.match_service(key[0], key[1], limit, snap) if snap.rows else [],
+            })
+        return out
+
+
+def services_from_hosts(hosts: list[dict]) -> list[tuple[str, str]]:
+    """从 parse_nmap_output 的结果中提取开放端口的 (product, version)。"""
+    pairs: list[tuple[str, str]] = []
+    for host in hosts:
+        for p in host.get("ports", []):
+            if p.get("state") == "open" and p.get("product"):
+                pairs.append((p["product"], p.get("version", "")))
+    return pairs
+
+
+def format_searchsploit(rows: list[dict[str, Any]]) -> str:
+    """按 searchsploit 的表格样式输出。"""
+    if not rows:
+        return "Exploits: No Results\n"
+    width = min(max(len(r["title"]) for r in rows), 90)
+    sep = "-" * (width + 2) + " " + "-" * 40
+    lines = [sep, f" {'Exploit Title'.ljust(width)} |  Path", sep]
+    for r in rows:
+        lines.append(f" {r['title'][:width].ljust(width)} | {r['path']}")
+    lines.append(sep)
+    return "\n".join(lines) + "\n"
+
+
+_index: Optional[ExploitIndex] = None
+_index_lock = threading.Lock()
+
+
+def get_exploit_index() -> ExploitIndex:
+    """返回进程内共享的 Exploit-DB 索引（首次使用时加载）。"""
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = ExploitIndex()
+    return _index
+
+
+__all__ = [
+    "ExploitIndex",
+    "format_searchsploit",
+    "get_exploit_index",
+    "services_from_hosts",
+]
@@ -2,26 +2,49 @@
 
 from __future__ import annotations
 
+import re
 import shlex
-import subprocess
-from typing import Any
+from pathlib import Path
+from typing import Any, Optional
 
+from config.runtime import get_effective_sandbox_mode
+from config.settings import settings
+from core.sandbox import CommandTimeoutError
+from core.scheduler import QueueTimeoutError, get_scheduler
+from core.supervisor import get_supervisor
+from tools.sharding import TargetBudget, count_lines, per_worker_delay, run_sharded
+
+
+def _run_distributed(cmd: list[str], timeout: int) -> tuple[int, str, str]:
+    """分布式模式：派发给在线 worker 执行（排队由 DistributedSandbox 完成）。"""
+    from core.coordinator import DistributedSandbox, NoWorkerAvailableError
 
-def _run(cmd: list[str], timeout: int = 300) -> tuple[int, str, str]:
     try:
-        proc = subprocess.run(
-            cmd,
-            capture_output=True,
-            text=True,
-            timeout=timeout,
-        )
-        return proc.returncode, proc.stdout or "", proc.stderr or ""
+        res = DistributedSandbox(allowed_binaries=[cmd[0]]).run(cmd, timeout=timeout)
+        return res.exit_code, res.stdout, res.stderr
+    except CommandTimeoutError:
+        return -1, "", f"执行超时（{timeout}s）"
+    except (NoWorkerAvailableError, QueueTimeoutError) as e:
+        return -1, "", str(e)
+
+
+def _run(cmd: list[str], timeout: int = 300, target: str = "") -> tuple[int, str, str]:
+    """经全局调度器排队后由进程监督器执行；target 用于按目标限制并发与启动速率。"""
+    if get_effective_sandbox_mode() == "distributed":
+        return _run_distributed(cmd, timeout)
+    try:
+        with get_scheduler().slot(cmd[0], target, timeout=settings.scheduler_queue_timeout):
+            res = get_supervisor().run(cmd, timeout)
+    except QueueTimeoutError as e:
+        return -1, "", str(e)
     except FileNotFoundError:
         return -1, "", f"未找到命令: {cmd[0]}，请确保已安装（Kali: apt install {cmd[0]}）"
-    except subprocess.TimeoutExpired:
-        return -1, "", f"执行超时（{timeout}s）"
     except Exception as e:  # noqa: BLE001
         return -1, "", str(e)
+    if res.timed_out:
+        # 进程组已被结束，保留超时前的输出
+        return -1, res.stdout, f"执行超时（{timeout}s）"
+    return res.exit_code, res.stdout, res.stderr
 
 
 def run_nmap(target: str, args: str = "-sV -Pn", timeout: int = 300) -> tuple[int, str, str]:
@@ -29,59 +52,211 @@ def run_nmap(target: str, args: str = "-sV -Pn", timeout: int = 300) -> tuple[in
     if not target:
         return -1, "", "目标不能为空"
     cmd = ["nmap"] + shlex.split(args or "-sV -Pn") + [target]
-    return _run(cmd, timeout)
+    return _run(cmd, timeout, target)
 
 
 def run_nikto(url: str, timeout: int = 120) -> tuple[int, str, str]:
     """Nikto Web 服务器扫描。"""
     if not url:
         return -1, "", "URL 不能为空"
-    return _run(["nikto", "-h", url], timeout)
+    return _run(["nikto", "-h", url], timeout, url)
+
+
+def _should_shard(wordlist: str, shards: int) -> bool:
+    """是否分片：分片数 > 1 且字典行数达到 settings.enum_shard_min_words；无法读取时走单进程。"""
+    if shards <= 1:
+        return False
+    try:
+        return count_lines(wordlist) >= settings.enum_shard_min_words
+    except OSError:
+        return False
+
+
+def _gobuster_delay(shards: int, rate_limit: Optional[float]) -> list[str]:
+    rate = settings.enum_rate_limit if rate_limit is None else rate_limit
+    delay = per_worker_delay(rate, shards, settings.enum_threads)
+    args = ["-t", str(settings.enum_threads)]
+    if delay > 0:
+        args += ["--delay", f"{int(delay * 1000)}ms"]
+    return args
+
+
+def _parse_gobuster_dir(line: str) -> Optional[str]:
+    # /admin                (Status: 301) [Size: 178] [--> http://target/admin/]
+    if "(Status:" not in line:
+        return None
+    return line.split()[0]
+
 
+def _parse_gobuster_dns(line: str) -> Optional[str]:
+    # Found: www.example.com [93.184.216.34]
+    if not line.startswith("Found:"):
+        return None
+    parts = line.split()
+    return parts[1].lower() if len(parts) > 1 else None
 
-def run_dirb(url: str, wordlist: str = "/usr/share/wordlists/dirb/common.txt", timeout: int = 300) -> tuple[int, str, str]:
-    """Dirb 目录/文件枚举。"""
+
+def _parse_dirb(line: str) -> Optional[str]:
+    # + http://target/admin (CODE:200|SIZE:123)  /  ==> DIRECTORY: http://target/images/
+    if line.startswith("+ "):
+        return line.split()[1]
+    if line.startswith("==> DIRECTORY:"):
+        return line.split()[-1]
+    return None
+
+
+def run_dirb(
+    url: str,
+    wordlist: str = "/usr/share/wordlists/dirb/common.txt",
+    timeout: Optional[int] = None,
+    shards: Optional[int] = None,
+    rate_limit: Optional[float] = None,
+) -> tuple[int, str, str]:
+    """Dirb 目录/文件枚举。字典较大时按分片并行运行（见 settings.enum_*）。"""
     if not url:
         return -1, "", "URL 不能为空"
-    cmd = ["dirb", url, wordlist, "-w"]
-    return _run(cmd, timeout)
+    n = settings.enum_shards if shards is None else shards
+    if not _should_shard(wordlist, n):
+        return _run(["dirb", url, wordlist, "-w"], timeout or 300, url)
+    rate = settings.enum_rate_limit if rate_limit is None else rate_limit
+    delay_ms = int(per_worker_delay(rate, n) * 1000)
+
+    def build(path: Path) -> list[str]:
+        cmd = ["dirb", url, str(path), "-w", "-S"]
+        return cmd + ["-z", str(delay_ms)] if delay_ms > 0 else cmd
+
+    result = run_sharded(build, wordlist, n, _parse_dirb, timeout or settings.enum_timeout, target=url)
+    return result.to_tuple("dirb")
 
 
-def run_gobuster_dir(url: str, wordlist: str = "/usr/share/wordlists/dirb/common.txt", timeout: int = 300) -> tuple[int, str, str]:
-    """Gobuster 目录枚举。"""
+def run_gobuster_dir(
+    url: str,
+    wordlist: str = "/usr/share/wordlists/dirb/common.txt",
+    timeout: Optional[int] = None,
+    shards: Optional[int] = None,
+    rate_limit: Optional[float] = None,
+) -> tuple[int, str, str]:
+    """Gobuster 目录枚举。字典较大时按分片并行运行（见 settings.enum_*）。"""
     if not url:
         return -1, "", "URL 不能为空"
-    cmd = ["gobuster", "dir", "-u", url, "-w", wordlist, "-q"]
-    return _run(cmd, timeout)
+    n = settings.enum_shards if shards is None else shards
+    if not _should_shard(wordlist, n):
+        return _run(["gobuster", "dir", "-u", url, "-w", wordlist, "-q"], timeout or 300, url)
+    extra = _gobuster_delay(n, rate_limit)
+    result = run_sharded(
+        lambda path: ["gobuster", "dir", "-u", url, "-w", str(path), "-q", "--no-error", *extra],
+        wordlist, n, _parse_gobuster_dir, timeout or settings.enum_timeout, target=url,
+    )
+    return result.to_tuple("gobuster dir")
 
 
-def run_gobuster_dns(domain: str, wordlist: str = "/usr/share/wordlists/dirb/common.txt", timeout: int = 120) -> tuple[int, str, str]:
-    """Gobuster 子域名枚举。"""
+def run_gobuster_dns(
+    domain: str,
+    wordlist: str = "/usr/share/wordlists/dirb/common.txt",
+    timeout: Optional[int] = None,
+    shards: Optional[int] = None,
+    rate_limit: Optional[float] = None,
+) -> tuple[int, str, str]:
+    """Gobuster 子域名枚举。字典较大时按分片并行运行（见 settings.enum_*）。"""
     if not domain:
         return -1, "", "域名不能为空"
-    cmd = ["gobuster", "dns", "-d", domain, "-w", wordlist, "-q"]
-    return _run(cmd, timeout)
+    n = settings.enum_shards if shards is None else shards
+    if not _should_shard(wordlist, n):
+        return _run(["gobuster", "dns", "-d", domain, "-w", wordlist, "-q"], timeout or 120, domain)
+    extra = _gobuster_delay(n, rate_limit)
+    result = run_sharded(
+        lambda path: ["gobuster", "dns", "-d", domain, "-w", str(path), "-q", *extra],
+        wordlist, n, _parse_gobuster_dns, timeout or settings.enum_timeout, target=domain,
+    )
+    return result.to_tuple("gobuster dns")
+
+
+_hydra_budget = TargetBudget()
+# [22][ssh] host: 10.0.0.5   login: root   password: toor
+_HYDRA_FOUND_RE = re.compile(r"^\[\d+\]\[[^\]]+\]\s+host:\s")
+
+
+def _parse_hydra(line: str) -> Optional[str]:
+    return line if _HYDRA_FOUND_RE.match(line) else None
 
 
-def run_hydra(target: str, service: str, user: str, passlist: str, timeout: int = 120) -> tuple[int, str, str]:
-    """Hydra 暴力破解（如 ssh, ftp, http-form）。"""
+def run_hydra(
+    target: str,
+    service: str,
+    user: str,
+    passlist: str,
+    timeout: Optional[int] = None,
+    workers: Optional[int] = None,
+    tasks: Optional[int] = None,
+) -> tuple[int, str, str]:
+    """Hydra 暴力破解（如 ssh, ftp, http-form）。
+
+    口令字典较大时分区并行：字典切成 workers 份，每份一个 Hydra 进程（-t tasks）；
+    同一目标的并发连接合计不超过 settings.hydra_max_connections；任一分区找到口令即结束全部分区。
+    """
     if not target or not service:
         return -1, "", "目标与服务不能为空"
-    cmd = ["hydra", "-l", user, "-P", passlist, target, service, "-t", "4", "-V"]
-    return _run(cmd, timeout)
+    workers = settings.hydra_workers if workers is None else workers
+    limit = max(settings.hydra_max_connections, 1)
+    tasks = min(max(settings.hydra_tasks_per_worker if tasks is None else tasks, 1), limit)
+    partition = False
+    if workers > 1:
+        try:
+            partition = count_lines(passlist) >= settings.hydra_partition_min_words
+        except OSError:
+            partition = False
+    if not partition:
+        # 不分区时同样计入目标的连接上限，并发的小字典运行合计也不超过 limit
+        budget = timeout or 120
+        granted = _hydra_budget.acquire(target, tasks, limit, timeout=budget)
+        if not granted:
+            return -1, "", f"等待目标 {target} 的空闲连接超时（上限 {limit}）"
+        try:
+            return _run(
+                ["hydra", "-l", user, "-P", passlist, target, service, "-t", str(min(tasks, granted)), "-V"],
+                budget, target,
+            )
+        finally:
+            _hydra_budget.release(target, granted)
+
+    budget = timeout or settings.hydra_timeout
+    granted = _hydra_budget.acquire(target, workers * tasks, limit, minimum=min(tasks, limit), timeout=budget)
+    if not granted:
+        return -1, "", f"等待目标 {target} 的空闲连接超时（上限 {limit}）"
+    try:
+        # 按实际分到的连接数调整分区数，保证每个进程的 -t 不超过 tasks
+        n = max(min(workers, granted // tasks), 1)
+        per_worker = max(min(tasks, granted // n), 1)
+        result = run_sharded(
+            lambda path: ["hydra", "-l", user, "-P", str(path), "-t", str(per_worker), "-f", "-I", target, service],
+            passlist, n, _parse_hydra, budget,
+            stop_when=lambda line: True,
+            progress_channel="exec",
+            target=target,
+            skip_comments=False,
+            strip=False,
+        )
+    finally:
+        _hydra_budget.release(target, granted)
+    return result.to_tuple(f"hydra {service}://{target}，每进程 -t {per_worker}")
 
 
 def run_whatweb(url: str, timeout: int = 60) -> tuple[int, str, str]:
     """Whatweb Web 技术指纹识别。"""
     if not url:
         return -1, "", "URL 不能为空"
-    return _run(["whatweb", url, "--color=never"], timeout)
+    return _run(["whatweb", url, "--color=never"], timeout, url)
 
 
 def run_searchsploit(keyword: str, timeout: int = 30) -> tuple[int, str, str]:
-    """Searchsploit 漏洞库搜索。"""
+    """Searchsploit 漏洞库搜索：优先查内存索引，未找到 files_exploits.csv 时回退到 searchsploit 命令。"""
     if not keyword:
         return -1, "", "关键词不能为空"
+    from tools.exploitdb import format_searchsploit, get_exploit_index
+
+    index = get_exploit_index()
+    if index.available:
+        return 0, format_searchsploit(index.search(keyword)), ""
     return _run(["searchsploit", "--color", keyword], timeout)
 
 
@@ -89,14 +264,14 @@ def run_whois(domain: str, timeout: int = 15) -> tuple[int, str, str]:
     """Whois 域名信息。"""
     if not domain:
         return -1, "", "域名不能为空"
-    return _run(["whois", domain], timeout)
+    return _run(["whois", domain], timeout, domain)
 
 
 def run_ping(host: str, count: int = 4, timeout: int = 15) -> tuple[int, str, str]:
     """Ping 主机。"""
     if not host:
         return -1, "", "主机不能为空"
-    return _run(["ping", "-c", str(count), host], timeout)
+    return _run(["ping", "-c", str(count), host], timeout, host)
 
 
 def run_curl(url: str, method: str = "GET", timeout: int = 30) -> tuple[int, str, str]:
@@ -104,7 +279,17 @@ def run_curl(url: str, method: str = "GET", timeout: int = 30) -> tuple[int, str
     if not url:
         return -1, "", "URL 不能为空"
     cmd = ["curl", "-s", "-i", "-X", method.upper(), "-m", "20", url]
-    return _run(cmd, timeout)
+    return _run(cmd, timeout, url)
+
+
+def _opt_number(value: Any, cast: type) -> Any:
+    """前端参数可能是空串或字符串数字；无效时返回 None（使用 settings 默认值）。"""
+    if value is None or value == "":
+        return None
+    try:
+        return cast(value)
+    except (TypeError, ValueError):
+        return None
 
 
 def run_tool(name: str, params: dict[str, Any]) -> tuple[int, str, str]:
@@ -114,18 +299,24 @@ def run_tool(name: str, params: dict[str, Any]) -> tuple[int, str, str]:
         return run_nmap(params.get("target", ""), params.get("args", "-sV -Pn"))
     if name == "nikto":
         return run_nikto(params.get("url", ""))
+    # 字典类枚举：shards / rate_limit 留空时使用 settings.enum_shards / enum_rate_limit
+    wordlist = params.get("wordlist") or "/usr/share/wordlists/dirb/common.txt"
+    shards = _opt_number(params.get("shards"), int)
+    rate_limit = _opt_number(params.get("rate_limit"), float)
     if name == "dirb":
-        return run_dirb(params.get("url", ""), params.get("wordlist", "/usr/share/wordlists/dirb/common.txt"))
+        return run_dirb(params.get("url", ""), wordlist, shards=shards, rate_limit=rate_limit)
     if name == "gobuster_dir":
-        return run_gobuster_dir(params.get("url", ""), params.get("wordlist", "/usr/share/wordlists/dirb/common.txt"))
+        return run_gobuster_dir(params.get("url", ""), wordlist, shards=shards, rate_limit=rate_limit)
     if name == "gobuster_dns":
-        return run_gobuster_dns(params.get("domain", ""), params.get("wordlist", "/usr/share/wordlists/dirb/common.txt"))
+        return run_gobuster_dns(params.get("domain", ""), wordlist, shards=shards, rate_limit=rate_limit)
     if name == "hydra":
         return run_hydra(
             params.get("target", ""),
             params.get("service", "ssh"),
             params.get("user", "root"),
-            params.get("passlist", "/usr/share/wordlists/rockyou.txt"),
+            params.get("passlist") or "/usr/share/wordlists/rockyou.txt",
+            workers=_opt_number(params.get("workers"), int),
+            tasks=_opt_number(params.get("tasks"), int),
         )
     if name == "whatweb":
         return run_whatweb(params.get("url", ""))
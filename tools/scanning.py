@@ -1,12 +1,32 @@
 from __future__ import annotations
 
+import asyncio
+import contextvars
+import hashlib
+import ipaddress
+import json
+import logging
+import os
+import re
 import shlex
+import shutil
 import threading
-from typing import Optional
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Optional
 
 from langchain_core.tools import tool
 
-from core.sandbox import CommandTimeoutError, get_sandbox
+from config.runtime import get_effective_sandbox_mode
+from config.settings import settings
+from core.events import BroadcastChannel, EventChannel, bind_channel, current_channel
+from core.sandbox import CommandResult, CommandTimeoutError, get_sandbox
+from core.supervisor import ProcessResult, record_process, track_processes
+
+logger = logging.getLogger(__name__)
+
+BASE_DIR = Path(__file__).resolve().parents[1]
 
 
 def _build_nmap_command(target: str, arguments: Optional[str]) -> list[str]:
@@ -19,62 +39,740 @@ def _build_nmap_command(target: str, arguments: Optional[str]) -> list[str]:
     return args
 
 
+# 主机段末尾随端口表一起保留的行：服务信息与 OS 检测结果；Host script results 之后是主机级脚本输出
+_HOST_TRAILERS = (
+    "Service Info:",
+    "Device type:",
+    "Running:",
+    "Running (JUST GUESSING):",
+    "OS CPE:",
+    "OS details:",
+    "Aggregated OS guesses:",
+    "Host script results:",
+)
+
+
 def _filter_nmap_output(raw: str) -> str:
     lines = raw.splitlines()
     important: list[str] = []
     in_ports_section = False
+    # 紧随其后的 NSE 脚本输出（| 开头的行）属于保留的开放端口或主机脚本结果
+    keep_script = False
     for line in lines:
         stripped = line.strip()
+        if stripped.startswith("Nmap scan report for "):
+            # 保留主机行，多主机（网段）扫描时端口才能对应到主机
+            important.append(stripped)
+            in_ports_section = keep_script = False
+            continue
+        if stripped.startswith("|"):
+            if keep_script:
+                important.append(stripped)
+            continue
+        keep_script = False
         if stripped.lower().startswith("port") and "state" in stripped.lower():
             in_ports_section = True
             important.append(stripped)
             continue
+        if stripped.startswith(_HOST_TRAILERS):
+            important.append(stripped)
+            in_ports_section = False
+            keep_script = stripped == "Host script results:"
+            continue
         if in_ports_section:
             if "/tcp" in stripped or "/udp" in stripped:
                 if "open" in stripped:
                     important.append(stripped)
+                    keep_script = True
             if not stripped:
                 in_ports_section = False
-    if not important:
+    if not any("/tcp" in ln or "/udp" in ln for ln in important):
         return "\n".join(lines[:80])
     return "\n".join(important)
 
 
-def _get_progress_queue():
-    """当前线程若在流式请求中，会带有 progress_queue，用于推送 Nmap 实时输出。"""
-    return getattr(threading.current_thread(), "progress_queue", None)
+_HOST_RE = re.compile(r"^Nmap scan report for (?:(\S+) \(([^)]+)\)|(\S+))$")
+_PORT_RE = re.compile(r"^(\d+)/(tcp|udp|sctp)\s+(\S+)\s+(\S+)(?:\s+(.*))?$")
+
+
+def _split_version(text: str) -> tuple[str, str, str]:
+    """把 Nmap VERSION 列拆成 (product, version, extrainfo)，如 'Apache httpd 2.4.52 ((Ubuntu))'。"""
+    tokens = (text or "").split()
+    for i, tok in enumerate(tokens):
+        if tok[:1].isdigit():
+            return " ".join(tokens[:i]), tok, " ".join(tokens[i + 1:])
+    return " ".join(tokens), "", ""
+
+
+def parse_nmap_output(text: str, default_host: str = "") -> list[dict]:
+    """解析 Nmap 普通输出（原始或经 _filter_nmap_output 过滤），按主机返回端口与服务信息。
+
+    返回 [{"address", "hostname", "ports": [{"port", "protocol", "state", "service", "product", "version", "extrainfo"}]}]。
+    没有主机行时端口归到 default_host。
+    """
+    hosts: list[dict] = []
+    current: Optional[dict] = None
+    for line in (text or "").splitlines():
+        stripped = line.strip()
+        m = _HOST_RE.match(stripped)
+        if m:
+            hostname, address = (m.group(1), m.group(2)) if m.group(2) else ("", m.group(3))
+            current = {"address": address, "hostname": hostname, "ports": []}
+            hosts.append(current)
+            continue
+        m = _PORT_RE.match(stripped)
+        if not m:
+            continue
+        if current is None:
+            current = {"address": default_host, "hostname": "", "ports": []}
+            hosts.append(current)
+        product, version, extrainfo = _split_version(m.group(5) or "")
+        current["ports"].append({
+            "port": int(m.group(1)),
+            "protocol": m.group(2),
+            "state": m.group(3),
+            "service": m.group(4),
+            "product": product,
+            "version": version,
+            "extrainfo": extrainfo,
+        })
+    return [h for h in hosts if h["address"]]
+
+
+# NSE 脚本块的首行：| 或 |_ 后紧跟脚本名（续行在前缀后还有空白）
+_SCRIPT_RE = re.compile(r"^\|[_ ]([^\s:]+):")
+
+
+def _script_blocks(lines: list[str]) -> dict[str, list[str]]:
+    """把 | 开头的脚本输出按脚本名分块，保持顺序。"""
+    blocks: dict[str, list[str]] = {}
+    current: Optional[list[str]] = None
+    for line in lines:
+        m = _SCRIPT_RE.match(line)
+        if m:
+            current = blocks.setdefault(m.group(1), [])
+            if current:
+                # 同一脚本重复出现时只保留第一块
+                current = None
+                continue
+        if current is not None:
+            current.append(line)
+    return blocks
+
+
+def _parse_host_sections(text: str) -> list[dict]:
+    """按主机解析 Nmap 普通输出，保留每个端口的脚本输出与主机段末尾的服务信息 / OS / 主机脚本行。
+
+    返回 [{"address", "hostname", "ports": {(端口, 协议): {"port": ..., "scripts": [行]}}, "trailer": [行], "scripts": [行]}]。
+    """
+    hosts: list[dict] = []
+    current: Optional[dict] = None
+    scripts: Optional[list[str]] = None
+    for line in (text or "").splitlines():
+        stripped = line.strip()
+        m = _HOST_RE.match(stripped)
+        if m:
+            hostname, address = (m.group(1), m.group(2)) if m.group(2) else ("", m.group(3))
+            current = {"address": address, "hostname": hostname, "ports": {}, "trailer": [], "scripts": []}
+            hosts.append(current)
+            scripts = None
+            continue
+        if stripped.startswith("|"):
+            if scripts is not None:
+                scripts.append(stripped)
+            continue
+        scripts = None
+        m = _PORT_RE.match(stripped)
+        if m:
+            if current is None:
+                current = {"address": "", "hostname": "", "ports": {}, "trailer": [], "scripts": []}
+                hosts.append(current)
+            product, version, extrainfo = _split_version(m.group(5) or "")
+            port = {
+                "port": int(m.group(1)),
+                "protocol": m.group(2),
+                "state": m.group(3),
+                "service": m.group(4),
+                "product": product,
+                "version": version,
+                "extrainfo": extrainfo,
+                "scripts": [],
+            }
+            current["ports"][(port["port"], port["protocol"])] = port
+            scripts = port["scripts"]
+            continue
+        if current is not None and stripped.startswith(_HOST_TRAILERS):
+            if stripped == "Host script results:":
+                scripts = current["scripts"]
+            else:
+                current["trailer"].append(stripped)
+    return [h for h in hosts if h["address"]]
+
+
+def merge_nmap_outputs(texts: list[str], only: Optional[frozenset[str]] = None) -> str:
+    """合并多次 Nmap 扫描（如 TCP / UDP / NSE 分支）的结果：按主机合并，端口按 (端口, 协议) 去重。
+
+    端口行取第一次出现的（TCP 分支在前，带版本信息），各分支对同一端口的 NSE 脚本输出按脚本名合并到端口行下；
+    服务信息 / OS 检测行按标签（冒号前）去重，主机脚本结果同样按脚本名合并。
+    only 非空时只保留地址在其中的主机。都没有解析出端口时返回空串。
+    """
+    merged: dict[str, dict] = {}
+    for text in texts:
+        for h in _parse_host_sections(text):
+            if only is not None and h["address"] not in only:
+                continue
+            host = merged.setdefault(h["address"], {"hostname": h["hostname"], "ports": {}, "trailer": {}, "scripts": {}})
+            host["hostname"] = host["hostname"] or h["hostname"]
+            for key, p in h["ports"].items():
+                port = host["ports"].setdefault(key, {**p, "scripts": {}})
+                for name, block in _script_blocks(p["scripts"]).items():
+                    port["scripts"].setdefault(name, block)
+            for line in h["trailer"]:
+                host["trailer"].setdefault(line.split(":", 1)[0], line)
+            for name, block in _script_blocks(h["scripts"]).items():
+                host["scripts"].setdefault(name, block)
+    lines: list[str] = []
+    for address, host in merged.items():
+        if not host["ports"]:
+            continue
+        lines.append(f"Nmap scan report for {host['hostname']} ({address})" if host["hostname"] else f"Nmap scan report for {address}")
+        lines.append("PORT STATE SERVICE VERSION")
+        for (port, proto), p in sorted(host["ports"].items(), key=lambda kv: (kv[0][1], kv[0][0])):
+            version = " ".join(x for x in (p["product"], p["version"], p["extrainfo"]) if x)
+            lines.append(f"{port}/{proto} {p['state']} {p['service']} {version}".rstrip())
+            for block in p["scripts"].values():
+                lines.extend(block)
+        lines.extend(host["trailer"].values())
+        if host["scripts"]:
+            lines.append("Host script results:")
+            for block in host["scripts"].values():
+                lines.extend(block)
+    return "\n".join(lines)
+
+
+def _nmap_timeout_text(timeout: int) -> str:
+    return f"Nmap 扫描在 {timeout} 秒内未完成，已被沙箱超时终止。请缩小扫描范围或调整参数后重试。"
+
+
+
+def _nmap_result_text(result: CommandResult) -> str:
+    if result.exit_code != 0:
+        error_text = result.stderr.strip() or result.stdout.strip()
+        return f"Nmap 扫描返回非零退出码 ({result.exit_code})：\n{error_text}"
+    return _filter_nmap_output(result.stdout)
+
+
+# ---------- 扫描检查点（超时 / 取消后续扫） ----------
+#
+# 本机沙箱中的 Nmap 额外写一份普通格式日志（-oN）到检查点目录。扫描超时或被取消时日志保留，
+# 再次发起相同的扫描（同一命令）时改为 nmap --resume 从最后一台完成的主机之后继续，
+# 结果与之前已完成主机的结果合并；大网段可以分几次有界的运行扫完。--resume 失败（日志损坏等）时
+# 按记录的已完成主机用 --exclude 排除后重新扫描其余主机。扫描正常结束即删除检查点。
+
+# 自带普通 / grepable 输出或无法续扫（随机目标）的参数不写检查点
+_CHECKPOINT_CONFLICTS = ("-oN", "-oG", "-oA", "-iR", "--resume")
+_checkpoints_in_use: set[str] = set()
+_checkpoints_lock = threading.Lock()
+
+
+@dataclass(eq=False)
+class _Checkpoint:
+    key: str
+    directory: Path
+    # 原始命令与本次实际执行的命令（首次带 -oN，续扫为 nmap --resume）
+    original: list[str]
+    cmd: list[str]
+    # 之前运行中已完成的主机及其结果（Nmap 普通输出）
+    done_hosts: list[str] = field(default_factory=list)
+    previous: str = ""
+    resumed: bool = False
+
+    @property
+    def log(self) -> Path:
+        return self.directory / "scan.nmap"
+
+    @property
+    def state_path(self) -> Path:
+        return self.directory / "state.json"
+
+
+def _checkpoint_root() -> Path:
+    raw = Path(settings.scan_checkpoint_dir)
+    return raw if raw.is_absolute() else BASE_DIR / raw
+
+
+def _read_state(path: Path) -> dict[str, Any]:
+    try:
+        return json.loads(path.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_state(ckpt: _Checkpoint, **changes: Any) -> None:
+    state = _read_state(ckpt.state_path)
+    state.update(changes, updated=time.time())
+    ckpt.state_path.write_text(json.dumps(state, ensure_ascii=False), encoding="utf-8")
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _purge_checkpoints(root: Path) -> None:
+    """删除过期的检查点。"""
+    if not root.is_dir():
+        return
+    cutoff = time.time() - settings.scan_checkpoint_ttl
+    for directory in root.iterdir():
+        state = _read_state(directory / "state.json")
+        if state.get("updated", 0) < cutoff and not (state.get("running") and _pid_alive(int(state.get("pid") or 0))):
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+def _open_checkpoint(cmd: list[str]) -> Optional[_Checkpoint]:
+    """为 Nmap 命令打开检查点：有可续扫的进度时改为 --resume，否则新建并加 -oN。
+
+    未开启、非本机沙箱（日志需写在本机）、参数冲突或同一命令正在别处运行时返回 None，按原命令执行。
+    """
+    if not settings.scan_checkpoint or get_effective_sandbox_mode() != "local":
+        return None
+    if any(tok.split("=", 1)[0] in _CHECKPOINT_CONFLICTS for tok in cmd[1:]):
+        return None
+    key = hashlib.sha1("\0".join(cmd).encode("utf-8")).hexdigest()[:16]
+    # 同步 nmap_scan（工具线程）与协程路径（to_thread）可能同时打开同一命令的检查点，占用登记需加锁
+    with _checkpoints_lock:
+        if key in _checkpoints_in_use:
+            return None
+        _checkpoints_in_use.add(key)
+    ckpt = _load_checkpoint(cmd, key)
+    if ckpt is None:
+        with _checkpoints_lock:
+            _checkpoints_in_use.discard(key)
+    return ckpt
+
+
+def _load_checkpoint(cmd: list[str], key: str) -> Optional[_Checkpoint]:
+    root = _checkpoint_root()
+    ckpt = _Checkpoint(key=key, directory=root / key, original=list(cmd), cmd=list(cmd))
+    state = _read_state(ckpt.state_path)
+    if state.get("running") and state.get("pid") != os.getpid() and _pid_alive(int(state.get("pid") or 0)):
+        return None
+    fresh = time.time() - state.get("updated", 0) < settings.scan_checkpoint_ttl
+    log_text = ""
+    if state.get("cmd") == cmd and fresh and ckpt.log.exists():
+        log_text = ckpt.log.read_text(encoding="utf-8", errors="replace")
+    try:
+        if log_text and "# Nmap done" not in log_text and parse_nmap_output(log_text):
+            ckpt.done_hosts = list(state.get("carried_hosts") or []) + [h["address"] for h in parse_nmap_output(log_text)]
+            ckpt.previous = merge_nmap_outputs([state.get("carried") or "", log_text])
+            ckpt.cmd = ["nmap", "--resume", str(ckpt.log)]
+            ckpt.resumed = True
+            _write_state(ckpt, running=True, pid=os.getpid())
+        elif state.get("cmd") == cmd and fresh and state.get("carried_hosts"):
+            # 上次 --resume 失败后改为排除已完成主机，但那次运行还没有完成任何主机
+            ckpt.done_hosts = list(state["carried_hosts"])
+            ckpt.previous = state.get("carried") or ""
+            if not _exclude_done(ckpt):
+                return None
+            _write_state(ckpt, running=True, pid=os.getpid())
+        else:
+            _purge_checkpoints(root)
+            shutil.rmtree(ckpt.directory, ignore_errors=True)
+            ckpt.directory.mkdir(parents=True, exist_ok=True)
+            ckpt.cmd = cmd[:-1] + ["-oN", str(ckpt.log), cmd[-1]]
+            _write_state(ckpt, cmd=cmd, created=time.time(), runs=0, running=True, pid=os.getpid())
+    except OSError as exc:
+        logger.warning("Scan checkpoint unavailable, running without it: %s", exc)
+        return None
+    return ckpt
+
+
+def _exclude_done(ckpt: _Checkpoint) -> bool:
+    """改为重新扫描未完成的主机（--exclude 已完成的主机）；目标自带选择参数时无法排除，返回 False。"""
+    if not ckpt.done_hosts or any(tok.split("=", 1)[0] in _TARGET_OPTIONS for tok in ckpt.original[1:]):
+        return False
+    ckpt.cmd = ckpt.original[:-1] + ["--exclude", ",".join(dict.fromkeys(ckpt.done_hosts)), "-oN", str(ckpt.log), ckpt.original[-1]]
+    ckpt.resumed = False
+    ckpt.log.unlink(missing_ok=True)
+    _write_state(ckpt, carried=ckpt.previous, carried_hosts=list(dict.fromkeys(ckpt.done_hosts)))
+    return True
+
+
+def _close_checkpoint(ckpt: _Checkpoint, finished: bool) -> None:
+    """扫描结束：完成（或出错）时删除检查点，超时 / 取消时保留以便续扫。"""
+    with _checkpoints_lock:
+        _checkpoints_in_use.discard(ckpt.key)
+    if finished:
+        shutil.rmtree(ckpt.directory, ignore_errors=True)
+        return
+    try:
+        state = _read_state(ckpt.state_path)
+        _write_state(ckpt, running=False, runs=int(state.get("runs") or 0) + 1)
+    except OSError as exc:
+        logger.warning("Failed to update scan checkpoint %s: %s", ckpt.directory, exc)
+
+
+def _checkpoint_info(ckpt: _Checkpoint, saved: bool) -> dict[str, Any]:
+    log_hosts: list[str] = []
+    if saved and ckpt.log.exists():
+        log_hosts = [h["address"] for h in parse_nmap_output(ckpt.log.read_text(encoding="utf-8", errors="replace"))]
+    return {"resumed": bool(ckpt.previous), "hosts_done": len(set(ckpt.done_hosts) | set(log_hosts)), "saved": saved}
+
+
+def _timeout_branch(stdout: str, timeout: int, ckpt: Optional[_Checkpoint]) -> dict[str, Any]:
+    """超时：有端口结果时为 partial（含检查点中之前已完成的主机），否则为 timeout。"""
+    if ckpt is None:
+        partial = _filter_nmap_output(stdout) if stdout else ""
+        if parse_nmap_output(partial):
+            return {"status": "partial", "text": partial}
+        return {"status": "timeout", "text": _nmap_timeout_text(timeout)}
+    log_text = ckpt.log.read_text(encoding="utf-8", errors="replace") if ckpt.log.exists() else ""
+    info = _checkpoint_info(ckpt, saved=True)
+    partial = merge_nmap_outputs([ckpt.previous, log_text, stdout])
+    if partial:
+        return {"status": "partial", "text": partial, "checkpoint": info}
+    return {
+        "status": "timeout",
+        "text": f"Nmap 扫描在 {timeout} 秒内未完成，进度已保存（已完成 {info['hosts_done']} 台主机）；再次发起相同的扫描将从中断处继续。",
+        "checkpoint": info,
+    }
+
+
+def _finished_branch(result: CommandResult, ckpt: Optional[_Checkpoint]) -> dict[str, Any]:
+    status = "ok" if result.exit_code == 0 else "error"
+    text = _nmap_result_text(result)
+    if ckpt is not None and ckpt.previous:
+        merged = merge_nmap_outputs([ckpt.previous] + ([result.stdout] if result.exit_code == 0 else []))
+        if merged:
+            text = merged
+            if status == "error":
+                # 续扫失败且无法排除重扫：至少保留之前已完成主机的结果
+                status = "partial"
+        return {"status": status, "text": text, "checkpoint": _checkpoint_info(ckpt, saved=False)}
+    return {"status": status, "text": text}
 
 
 @tool("nmap_scan", return_direct=False)
 def nmap_scan(target: str, arguments: str = "-sV -Pn") -> str:
-    """在沙箱中运行 Nmap（默认本机，可由 KALI_AGENT_SANDBOX_MODE 切换 Docker）。"""
+    """在沙箱中运行 Nmap（默认本机，可由 KALI_AGENT_SANDBOX_MODE 切换 Docker）。超时后再次调用从检查点继续。"""
     cmd = _build_nmap_command(target, arguments)
     sandbox = get_sandbox()
-    progress_queue = _get_progress_queue()
+    channel = current_channel()
     on_stdout_line: Optional[object] = None
-    if progress_queue:
+    if channel is not None:
 
         def _on_line(line: str) -> None:
             if line.strip():
-                try:
-                    progress_queue.put_nowait(("progress_line", "recon", line))
-                except Exception:
-                    pass
+                channel.put(("progress_line", "recon", line))
 
         on_stdout_line = _on_line
+    ckpt = _open_checkpoint(cmd)
+    branch: dict[str, Any] = {}
     try:
-        if on_stdout_line is not None:
-            result = sandbox.run(cmd, timeout=300, on_stdout_line=on_stdout_line)
-        else:
-            result = sandbox.run(cmd, timeout=300)
-    except CommandTimeoutError:
-        return "Nmap 扫描在 300 秒内未完成，已被沙箱超时终止。请缩小扫描范围或调整参数后重试。"
-    except Exception as exc:  # noqa: BLE001
-        return f"Nmap 扫描执行失败: {exc}"
-    if result.exit_code != 0:
-        error_text = result.stderr.strip() or result.stdout.strip()
-        return f"Nmap 扫描返回非零退出码 ({result.exit_code})：\n{error_text}"
-    return _filter_nmap_output(result.stdout)
+        while True:
+            run_cmd = ckpt.cmd if ckpt is not None else cmd
+            try:
+                if on_stdout_line is not None:
+                    result = sandbox.run(run_cmd, timeout=300, on_stdout_line=on_stdout_line)
+                else:
+                    result = sandbox.run(run_cmd, timeout=300)
+            except CommandTimeoutError as exc:
+                branch = _timeout_branch(exc.stdout, 300, ckpt)
+            except Exception as exc:  # noqa: BLE001
+                branch = {"status": "error", "text": f"Nmap 扫描执行失败: {exc}"}
+            else:
+                if ckpt is not None and ckpt.resumed and result.exit_code != 0 and _exclude_done(ckpt):
+                    continue
+                branch = _finished_branch(result, ckpt)
+            break
+    finally:
+        if ckpt is not None:
+            _close_checkpoint(ckpt, finished=branch.get("status") in ("ok", "error"))
+    if branch["status"] == "partial":
+        note = "；进度已保存，再次扫描将从中断处继续" if branch.get("checkpoint", {}).get("saved") else ""
+        return branch["text"] + "\n# 扫描在 300 秒内未完成，以上为部分结果" + note
+    return branch["text"]
+
+
+# ---------- 相同扫描合并（single-flight） ----------
+#
+# 参数相同、目标相同（或网段重叠）的 Nmap 同时只跑一份：后来者接入进行中的扫描，
+# 重放已输出的行并接收后续输出，结束时共享结果。网段部分重叠时，已在扫描中的主机
+# 用 --exclude 排除，只扫其余主机，结束后与进行中扫描的对应主机结果合并。
+
+_DISCOVERED_RE = re.compile(r"^Discovered open port \d+/\w+ on (\S+)$")
+# 自带目标选择的参数无法按主机计算重叠，只合并完全相同的请求
+_TARGET_OPTIONS = ("-iL", "-iR", "--exclude", "--excludefile")
+
+
+@dataclass(eq=False)
+class _InflightScan:
+    target: str
+    arguments: str
+    # 覆盖的 IP 集合；主机名等无法展开的目标为 None
+    hosts: Optional[frozenset[str]]
+    lines: list[str] = field(default_factory=list)
+    listeners: list[Callable[[str], Awaitable[None]]] = field(default_factory=list)
+    task: Optional[asyncio.Task] = None
+    waiters: int = 0
+    # 扫描任务在独立上下文中运行：调度器排队等事件经 events 转发给所有接入者的通道，进程结果记入 runs 后交给每个接入者
+    events: BroadcastChannel = field(default_factory=BroadcastChannel)
+    runs: list[ProcessResult] = field(default_factory=list)
+
+
+_inflight: set[_InflightScan] = set()
+
+
+def _normalize_arguments(arguments: str) -> str:
+    try:
+        return " ".join(shlex.split(arguments or ""))
+    except ValueError:
+        return (arguments or "").strip()
+
+
+def _normalize_target(target: str) -> tuple[str, Optional[frozenset[str]]]:
+    """返回 (规范化目标, 覆盖的 IP 集合)；IP / CIDR 之外的目标或超过 scan_coalesce_max_hosts 的网段集合为 None。"""
+    target = (target or "").strip()
+    try:
+        net = ipaddress.ip_network(target, strict=False)
+    except ValueError:
+        return target.lower(), None
+    if net.num_addresses > max(settings.scan_coalesce_max_hosts, 1):
+        return str(net), None
+    return str(net), frozenset(str(a) for a in net)
+
+
+def coalesce_key(target: str, arguments: str) -> tuple[str, str]:
+    """相同扫描的合并键：(规范化目标, 规范化参数)。Web 层据此合并相同的 Agent 任务。"""
+    return _normalize_target(target)[0], _normalize_arguments(arguments)
+
+
+def _close_abandoned(opening: asyncio.Future) -> None:
+    if not opening.cancelled() and opening.exception() is None and opening.result() is not None:
+        asyncio.ensure_future(asyncio.to_thread(_close_checkpoint, opening.result(), False))
+
+
+async def _execute_branch(cmd: list[str], timeout: int, on_stdout_line: Optional[Callable[[str], Awaitable[None]]]) -> dict[str, Any]:
+    """执行一次 Nmap（带检查点）；被取消时进程组被结束，检查点保留供下次续扫。
+
+    检查点的读写（读取 -oN 日志、清理过期目录等）是阻塞的文件操作，放到线程里执行，不占用事件循环。
+    """
+    branch: dict[str, Any] = {}
+    started = time.monotonic()
+    opening = asyncio.ensure_future(asyncio.to_thread(_open_checkpoint, cmd))
+    try:
+        ckpt = await asyncio.shield(opening)
+    except asyncio.CancelledError:
+        # 打开中被取消：等线程打开完成后按未完成关闭，不留下占用登记
+        opening.add_done_callback(_close_abandoned)
+        raise
+    try:
+        if ckpt is not None and ckpt.resumed and on_stdout_line is not None:
+            await on_stdout_line(f"从检查点继续：已完成 {len(set(ckpt.done_hosts))} 台主机，跳过这些主机")
+        while True:
+            run_cmd = ckpt.cmd if ckpt is not None else cmd
+            try:
+                result = await get_sandbox().arun(run_cmd, timeout=timeout, on_stdout_line=on_stdout_line)
+            except CommandTimeoutError as exc:
+                branch.update(await asyncio.to_thread(_timeout_branch, exc.stdout, timeout, ckpt))
+            except Exception as exc:  # noqa: BLE001
+                branch.update(status="error", text=f"Nmap 扫描执行失败: {exc}")
+            else:
+                if ckpt is not None and ckpt.resumed and result.exit_code != 0 and await asyncio.to_thread(_exclude_done, ckpt):
+                    logger.warning("nmap --resume failed for %s, rescanning the remaining hosts", ckpt.original[-1])
+                    continue
+                branch.update(await asyncio.to_thread(_finished_branch, result, ckpt))
+            break
+    finally:
+        if ckpt is not None:
+            # shield：关闭过程中再次被取消时，线程中的关闭仍会完成
+            close = asyncio.ensure_future(asyncio.to_thread(_close_checkpoint, ckpt, branch.get("status") in ("ok", "error")))
+            await asyncio.shield(close)
+    branch["elapsed"] = round(time.monotonic() - started, 2)
+    return branch
+
+
+def _start_scan(target: str, arguments: str, hosts: Optional[frozenset[str]], cmd: list[str], timeout: int) -> _InflightScan:
+    """在独立任务中启动扫描并登记为进行中；输出逐行分发给所有接入者。"""
+    entry = _InflightScan(target=target, arguments=arguments, hosts=hosts)
+
+    async def _on_line(line: str) -> None:
+        entry.lines.append(line)
+        for listener in list(entry.listeners):
+            try:
+                await listener(line)
+            except Exception:  # noqa: BLE001
+                pass
+
+    async def _run() -> dict[str, Any]:
+        bind_channel(entry.events)
+        with track_processes() as runs:
+            entry.runs = runs
+            return await _execute_branch(cmd, timeout, _on_line)
+
+    # 不继承发起者的上下文（事件通道、进程记录、剖析）：扫描属于所有接入者，不归第一个请求，
+    # 发起者离开时扫描继续为其余接入者运行
+    entry.task = asyncio.get_running_loop().create_task(_run(), context=contextvars.Context())
+    _inflight.add(entry)
+    entry.task.add_done_callback(lambda _t: _inflight.discard(entry))
+    return entry
+
+
+async def _attach(
+    entry: _InflightScan,
+    listener: Callable[[str], Awaitable[None]],
+    channel: Optional[EventChannel | BroadcastChannel] = None,
+) -> dict[str, Any]:
+    """接入进行中的扫描：先重放已有输出再接收后续行，等待结果。所有接入者都离开时取消扫描（终止进程）。
+
+    channel 非空时订阅扫描的其他事件（调度器排队等）；扫描结束后其进程记入接入者自己的 track_processes。
+    """
+    i = 0
+    while i < len(entry.lines):
+        await listener(entry.lines[i])
+        i += 1
+    # 重放到最新一行与登记监听之间没有 await，不会漏行
+    entry.listeners.append(listener)
+    if channel is not None:
+        entry.events.subscribe(channel)
+    entry.waiters += 1
+    try:
+        result = await asyncio.shield(entry.task)
+    finally:
+        entry.waiters -= 1
+        entry.listeners.remove(listener)
+        if channel is not None:
+            entry.events.unsubscribe(channel)
+        if entry.waiters == 0 and not entry.task.done():
+            # 立即注销：紧接着发起的相同扫描不能接入这个正在取消的任务
+            _inflight.discard(entry)
+            entry.task.cancel()
+    for run in entry.runs:
+        record_process(run)
+    return result
+
+
+def _only_discovered(hosts: frozenset[str], listener: Callable[[str], Awaitable[None]]) -> Callable[[str], Awaitable[None]]:
+    """部分重叠时只转发与本请求相关主机的 Discovered 行（供实时进度与推测式分析）。"""
+
+    async def _filtered(line: str) -> None:
+        m = _DISCOVERED_RE.match(line.strip())
+        if m and m.group(1) in hosts:
+            await listener(line)
+
+    return _filtered
+
+
+def _combine(parts: list[dict[str, Any]], hosts: Optional[frozenset[str]]) -> dict[str, Any]:
+    """合并本次扫描与借用的进行中扫描结果（只取本请求覆盖的主机）。"""
+    statuses = [p["status"] for p in parts]
+    text = merge_nmap_outputs([p["text"] for p in parts], only=hosts)
+    if all(st == "ok" for st in statuses):
+        status = "ok"
+    elif text:
+        status = "partial"
+    else:
+        status = next(st for st in statuses if st != "ok")
+    if not text:
+        text = next((p["text"] for p in parts if p["status"] != "ok"), parts[0]["text"])
+    return {"status": status, "text": text}
+
+
+async def anmap_branch(
+    target: str,
+    arguments: str,
+    timeout: int = 300,
+    label: str = "",
+    on_line: Optional[Callable[[str], None]] = None,
+) -> dict[str, Any]:
+    """异步执行一次 Nmap（Agent 的侦察分支），返回 {label, arguments, status, text, elapsed}。
+
+    status：ok / partial（超时但已有端口结果，text 为部分结果）/ timeout / error。
+    实时输出推送到当前上下文的事件通道，label 非空时加 [label] 前缀以区分并行分支；on_line 收到原始行。
+    相同参数的扫描在进行中时接入它而不重复启动（见上方 single-flight），结果中 shared 为借用的主机（目标）数。
+    """
+    cmd = _build_nmap_command(target, arguments)
+    channel = current_channel()
+    prefix = f"[{label}] " if label else ""
+
+    async def _deliver(line: str) -> None:
+        if on_line is not None:
+            on_line(line)
+        if channel is not None and line.strip():
+            await channel.aput(("progress_line", "recon", prefix + line))
+
+    branch: dict[str, Any] = {"label": label, "arguments": arguments}
+    if not settings.scan_coalesce:
+        branch.update(await _execute_branch(cmd, timeout, _deliver))
+        return branch
+
+    started = time.monotonic()
+    norm_target, hosts = _normalize_target(target)
+    norm_args = _normalize_arguments(arguments)
+    if any(t.split("=", 1)[0] in _TARGET_OPTIONS for t in norm_args.split()):
+        hosts = None
+    same_args = [e for e in _inflight if e.arguments == norm_args]
+    exact = next((e for e in same_args if e.target == norm_target and (e.hosts is None or e.hosts == hosts)), None)
+    donors: list[_InflightScan] = []
+    remaining = hosts
+    if exact is not None:
+        donors = [exact]
+        remaining = frozenset()
+    elif hosts is not None:
+        covered: set[str] = set()
+        for e in same_args:
+            if e.hosts is not None and e.hosts & hosts:
+                donors.append(e)
+                covered |= e.hosts & hosts
+        remaining = hosts - covered
+
+    if not donors:
+        branch.update(await _attach(_start_scan(norm_target, norm_args, hosts, cmd, timeout), _deliver, channel))
+        return branch
+
+    shared = len(hosts - remaining) if hosts is not None else 0
+    if channel is not None:
+        await channel.aput((
+            "progress_line", "recon",
+            prefix + (f"复用进行中的相同扫描（{shared} 台主机）" if shared else "复用进行中的相同扫描"),
+        ))
+    if exact is not None:
+        result = await _attach(exact, _deliver, channel)
+        branch.update(status=result["status"], text=result["text"])
+    else:
+        waits = [_attach(e, _only_discovered(hosts, _deliver), channel) for e in donors]
+        if remaining:
+            excluded = ",".join(str(n) for n in ipaddress.collapse_addresses(
+                ipaddress.ip_address(a) for a in hosts - remaining
+            ))
+            own_cmd = cmd[:-1] + ["--exclude", excluded, cmd[-1]]
+            waits.insert(0, _attach(_start_scan(norm_target, norm_args, remaining, own_cmd, timeout), _deliver, channel))
+        branch.update(_combine(list(await asyncio.gather(*waits)), hosts))
+    branch["elapsed"] = round(time.monotonic() - started, 2)
+    branch["shared"] = shared or 1
+    return branch
+
+
+async def anmap_scan(
+    target: str,
+    arguments: str = "-sV -Pn",
+    on_line: Optional[Callable[[str], None]] = None,
+) -> str:
+    """nmap_scan 的协程版本：子进程由进程监督器执行，实时输出推送到当前上下文的事件通道。
+
+    on_line 在事件循环上收到每一行原始输出（如推测式分析）。超时且已有端口结果时返回部分结果。
+    """
+    branch = await anmap_branch(target, arguments, on_line=on_line)
+    if branch["status"] == "partial":
+        note = "；进度已保存，再次扫描将从中断处继续" if branch.get("checkpoint", {}).get("saved") else ""
+        return branch["text"] + "\n# 扫描在 300 秒内未完成，以上为部分结果" + note
+    return branch["text"]
 
 
-__all__ = ["nmap_scan"]
+__all__ = ["anmap_branch", "anmap_scan", "coalesce_key", "merge_nmap_outputs", "nmap_scan", "parse_nmap_output"]
@@ -0,0 +1,298 @@
+"""字典分片并行执行：把大字典切成 N 份，同时跑 N 个工具进程，结果边到达边合并去重。
+
+- count_lines：按块统计字典行数，决定是否值得分片（不把字典读进内存）。
+- write_shards：mmap 流式读取字典，按词的哈希分到各分片临时文件（同一个词总落在同一分片，分片内保持原顺序），
+  再逐个分片去重。内存峰值约为最大一个分片的去重集合，不在进程中缓存词表。
+- run_sharded：并行启动各分片命令，逐行解析输出；同一结果只保留一次；
+  整体超时或任一 worker 命中停止条件（如 Hydra 找到口令）时终止全部进程，返回已得到的部分结果。
+"""
+
+from __future__ import annotations
+
+import logging
+import mmap
+import queue
+import shlex
+import tempfile
+import threading
+import time
+import zlib
+from collections import deque
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, Optional
+
+from core.events import current_channel
+from core.scheduler import QueueTimeoutError, get_scheduler
+from core.supervisor import ProcessHandle, get_supervisor
+
+logger = logging.getLogger(__name__)
+
+_CHUNK = 1 << 20
+
+
+def count_lines(path: str | Path) -> int:
+    """字典的行数（含空行、注释与重复），用于判断是否分片。"""
+    lines = 0
+    last = b"\n"
+    with Path(path).open("rb") as fh:
+        while chunk := fh.read(_CHUNK):
+            lines += chunk.count(b"\n")
+            last = chunk[-1:]
+    return lines + (last != b"\n")
+
+
+def write_shards(
+    path: str | Path,
+    shards: int,
+    directory: str | Path,
+    skip_comments: bool = True,
+    strip: bool = True,
+) -> tuple[list[Path], int]:
+    """把字典去掉空行、去重后写成 shard_<i>.txt，返回 (非空分片的路径列表, 去重后条数)。
+
+    按 crc32 分片使重复的词落在同一分片，去重只需逐个分片进行。
+    口令字典应传 skip_comments=False（# 开头也是合法口令）、strip=False（只去行尾换行，保留首尾空格）。
+    """
+    path = Path(path)
+    directory = Path(directory)
+    shards = max(shards, 1)
+    raw = [directory / f"raw_{i}.txt" for i in range(shards)]
+    if path.stat().st_size:
+        outs = [p.open("wb") for p in raw]
+        try:
+            with path.open("rb") as fh, mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                for line in iter(mm.readline, b""):
+                    word = line.strip() if strip else line.rstrip(b"\r\n")
+                    if not word or (skip_comments and word.startswith(b"#")):
+                        continue
+                    outs[zlib.crc32(word) % shards].write(word + b"\n")
+        finally:
+            for out in outs:
+                out.close()
+    paths: list[Path] = []
+    total = 0
+    for i, src in enumerate(raw):
+        if not src.exists():
+            continue
+        seen: set[bytes] = set()
+        dst = directory / f"shard_{i}.txt"
+        with src.open("rb") as fh, dst.open("wb") as out:
+            for line in fh:
+                if line not in seen:
+                    seen.add(line)
+                    out.write(line)
+        src.unlink()
+        if seen:
+            total += len(seen)
+            paths.append(dst)
+        else:
+            dst.unlink()
+    return paths, total
+
+
+@dataclass
+class ShardedResult:
+    """分片执行结果。lines 为合并去重后的结果行（按到达顺序）。"""
+
+    lines: list[str] = field(default_factory=list)
+    errors: list[str] = field(default_factory=list)
+    exit_codes: list[int] = field(default_factory=list)
+    words: int = 0
+    shards: int = 0
+    elapsed: float = 0.0
+    timed_out: bool = False
+    stopped_early: bool = False
+
+    def to_tuple(self, title: str) -> tuple[int, str, str]:
+        """转成 run_* 工具统一的 (returncode, stdout, stderr)。"""
+        summary = f"[{title}] 字典 {self.words} 条（去重后），{self.shards} 个分片并行，用时 {self.elapsed:.1f}s，结果 {len(self.lines)} 条"
+        if self.stopped_early:
+            summary += "，已命中结果，提前结束其余分片"
+        stdout = "\n".join([summary, *self.lines]) + "\n"
+        stderr = "\n".join(self.errors)
+        if self.timed_out:
+            stderr = (stderr + "\n" if stderr else "") + "执行超时，以上为已完成部分的结果"
+            return -1, stdout, stderr
+        ok = self.stopped_early or any(code == 0 for code in self.exit_codes)
+        return (0 if ok else (self.exit_codes[0] if self.exit_codes else -1)), stdout, stderr
+
+
+def run_sharded(
+    build_cmd: Callable[[Path], list[str]],
+    wordlist: str | Path,
+    shards: int,
+    parse_line: Callable[[str], Optional[str]],
+    timeout: float,
+    stop_when: Optional[Callable[[str], bool]] = None,
+    progress_channel: str = "recon",
+    target: str = "",
+    skip_comments: bool = True,
+    strip: bool = True,
+) -> ShardedResult:
+    """把 wordlist 去重后分成 shards 份（见 write_shards），并行执行 build_cmd(shard_path) 生成的命令。
+
+    parse_line 从输出行中提取去重键（如路径、子域名），返回 None 表示该行不是结果；
+    stop_when 对结果行返回 True 时终止所有分片。新结果会作为进度行推送到当前线程的事件通道。
+    每个分片进程以 batch 优先级经全局调度器排队，由进程监督器执行，进程退出即归还槽位。
+    """
+    result = ShardedResult()
+    channel = current_channel()
+    seen: set[str] = set()
+    lock = threading.Lock()
+    stop = threading.Event()
+    handles: list[ProcessHandle] = []
+    # 结果行在监督线程上解析去重，推送进度由调用线程完成（通道可能阻塞，不能占用监督线程）
+    progress: queue.SimpleQueue = queue.SimpleQueue()
+    started = time.monotonic()
+
+    scheduler = get_scheduler()
+    supervisor = get_supervisor()
+
+    def _on_line(raw: str) -> None:
+        line = raw.strip()
+        if not line:
+            return
+        key = parse_line(line)
+        if key is None:
+            return
+        with lock:
+            if key in seen:
+                return
+            seen.add(key)
+            result.lines.append(line)
+        progress.put(line)
+        if stop_when is not None and stop_when(line):
+            result.stopped_early = True
+            stop.set()
+            with lock:
+                running = list(handles)
+            for h in running:
+                h.kill()
+
+    def _forward(wait: float = 0.0) -> None:
+        try:
+            line = progress.get(timeout=wait) if wait else progress.get_nowait()
+            while True:
+                if channel is not None and line is not None:
+                    channel.put(("progress_line", progress_channel, line))
+                line = progress.get_nowait()
+        except queue.Empty:
+            pass
+
+    def _on_stderr(tail: deque) -> Callable[[str], None]:
+        # gobuster 等在 stderr 输出进度，只保留最后几行用于报错
+        def _append(raw: str) -> None:
+            if raw.strip():
+                tail.append(raw.strip())
+        return _append
+
+    with tempfile.TemporaryDirectory(prefix="youkai-shards-") as tmp:
+        try:
+            paths, result.words = write_shards(wordlist, shards, tmp, skip_comments=skip_comments, strip=strip)
+        except OSError as exc:
+            result.errors.append(f"读取字典失败: {exc}")
+            return result
+        if not paths:
+            result.errors.append("字典为空")
+            return result
+        result.shards = len(paths)
+        tails: list[deque] = []
+        deadline = started + timeout
+        for path in paths:
+            if stop.is_set():
+                break
+            cmd = build_cmd(path)
+            try:
+                ticket = scheduler.acquire(cmd[0], target, "batch", timeout=max(deadline - time.monotonic(), 0.0))
+            except QueueTimeoutError:
+                result.timed_out = True
+                break
+            if stop.is_set():
+                scheduler.release(ticket)
+                break
+            logger.info("Starting shard: %s", " ".join(shlex.quote(a) for a in cmd))
+            tail: deque = deque(maxlen=3)
+            try:
+                handle = supervisor.spawn(
+                    cmd,
+                    timeout=max(deadline - time.monotonic(), 0.1),
+                    on_stdout_line=_on_line,
+                    on_stderr_line=_on_stderr(tail),
+                )
+            except FileNotFoundError:
+                scheduler.release(ticket)
+                result.errors.append(f"未找到命令: {cmd[0]}，请确保已安装（Kali: apt install {cmd[0]}）")
+                break
+            # 进程退出即归还槽位，并唤醒下面的等待循环
+            handle.future.add_done_callback(lambda _f, t=ticket: (scheduler.release(t), progress.put(None)))
+            with lock:
+                handles.append(handle)
+            tails.append(tail)
+            _forward()
+
+        while not all(h.done() for h in handles):
+            if stop.is_set():
+                break
+            if time.monotonic() >= deadline:
+                result.timed_out = True
+                break
+            _forward(0.2)
+        for h in handles:
+            h.kill()
+        for h, tail in zip(handles, tails):
+            res = h.result()
+            if res.timed_out:
+                result.timed_out = True
+            if res.exit_code != 0 and tail and not (stop.is_set() or result.timed_out):
+                result.errors.append(tail[-1])
+            result.exit_codes.append(res.exit_code)
+        _forward()
+    result.elapsed = time.monotonic() - started
+    return result
+
+
+class TargetBudget:
+    """按目标分配并发连接数：同一目标上所有请求合计不超过 limit。"""
+
+    def __init__(self) -> None:
+        self._used: dict[str, int] = {}
+        self._cond = threading.Condition()
+
+    def acquire(self, target: str, want: int, limit: int, minimum: int = 1, timeout: Optional[float] = None) -> int:
+        """等待至少 minimum 个空闲连接后，尽量分配 want 个；超时返回 0。"""
+        want = max(min(want, limit), 1)
+        minimum = max(min(minimum, want), 1)
+        with self._cond:
+            ok = self._cond.wait_for(lambda: limit - self._used.get(target, 0) >= minimum, timeout=timeout)
+            if not ok:
+                return 0
+            granted = min(want, limit - self._used.get(target, 0))
+            self._used[target] = self._used.get(target, 0) + granted
+            return granted
+
+    def release(self, target: str, n: int) -> None:
+        with self._cond:
+            left = self._used.get(target, 0) - n
+            if left > 0:
+                self._used[target] = left
+            else:
+                self._used.pop(target, None)
+            self._cond.notify_all()
+
+
+def per_worker_delay(rate_limit: float, workers: int, threads_per_worker: int = 1) -> float:
+    """全局请求速率上限 rate_limit（次/秒）折算成每个线程两次请求之间的间隔（秒），0 表示不限速。"""
+    if rate_limit <= 0:
+        return 0.0
+    return max(workers, 1) * max(threads_per_worker, 1) / rate_limit
+
+
+__all__ = [
+    "ShardedResult",
+    "TargetBudget",
+    "count_lines",
+    "per_worker_delay",
+    "run_sharded",
+    "write_shards",
+]
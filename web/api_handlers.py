@@ -6,19 +6,17 @@ import json
 import re
 from typing import Any
 
-# 上一次扫描的上下文，供追问时 LLM 回复使用
-_last_context: dict[str, Any] = {}
+from core.state import get_state_backend
 
 
-def get_last_context() -> dict[str, Any]:
-    """获取上一次扫描的上下文（goal、target、report_summary 等）。"""
-    return dict(_last_context)
+def get_last_context(session: str = "") -> dict[str, Any]:
+    """获取会话上一次扫描的上下文（goal、target、report_summary 等）；存于共享状态后端，任意 worker 进程可读。"""
+    return dict(get_state_backend().get("context", session) or {})
 
 
-def set_last_context(ctx: dict[str, Any]) -> None:
-    """保存最近一次扫描的上下文，供追问回复使用。"""
-    global _last_context
-    _last_context = dict(ctx) if ctx else {}
+def set_last_context(ctx: dict[str, Any], session: str = "") -> None:
+    """保存会话最近一次扫描的上下文，供追问回复使用。"""
+    get_state_backend().set("context", session, dict(ctx) if ctx else {})
 
 
 def build_context_from_state(state: dict[str, Any]) -> dict[str, Any]:
@@ -35,22 +33,17 @@ def build_context_from_state(state: dict[str, Any]) -> dict[str, Any]:
     }
 
 
-def classify_intent_with_llm(message: str) -> str:
+async def classify_intent_with_llm(message: str) -> str:
     """用 LLM 判断用户意图：scan（新扫描/渗透任务）或 followup（追问/询问/闲聊）。"""
-    from langchain_core.messages import HumanMessage
-    from core.agent import create_llm
+    from core.agent import get_llm
+    from core.prompts import CLASSIFY_INSTRUCTIONS, ainvoke_llm, build_messages
     msg = (message or "").strip()
     if not msg:
         return "followup"
     try:
-        llm = create_llm()
-        prompt = (
-            "用户说：「" + msg + "」\n"
-            "请判断用户意图。若用户是在下达新的扫描/渗透任务（例如要扫描某个目标、对某 IP 做侦察），回复 scan。"
-            "若用户是在追问、询问、吐槽或闲聊（例如问结果在哪、目标文件呢、怎么回事、为什么），回复 followup。"
-            "仅回复一个英文词：scan 或 followup。"
-        )
-        resp = llm.invoke([HumanMessage(content=prompt)])
+        llm = get_llm()
+        messages = build_messages(CLASSIFY_INSTRUCTIONS, "用户说：「" + msg + "」", with_system_prompt=False)
+        resp, _ = await ainvoke_llm(llm, messages, "classify")
         raw = (resp.content or "").strip().lower()
         if "followup" in raw:
             return "followup"
@@ -59,22 +52,22 @@ def classify_intent_with_llm(message: str) -> str:
         return "scan"
 
 
-def reply_followup_with_llm(message: str, context: dict[str, Any]) -> str:
+async def reply_followup_with_llm(message: str, context: dict[str, Any]) -> str:
     """根据用户追问和上次扫描上下文，用 LLM 生成简短回复。"""
-    from langchain_core.messages import HumanMessage
-    from core.agent import create_llm
+    from core.agent import get_llm
+    from core.prompts import FOLLOWUP_INSTRUCTIONS, ainvoke_llm, build_messages
     try:
-        llm = create_llm()
+        llm = get_llm()
         goal = context.get("goal", "")
         target = context.get("target", "")
         report_summary = (context.get("report_summary") or "暂无")[:400]
-        prompt = (
-            "你是 Youkai 红队助手。用户之前可能运行过扫描。"
+        messages = build_messages(
+            FOLLOWUP_INSTRUCTIONS,
             f"上下文：目标={target}，目标描述={goal}。报告摘要：{report_summary}\n"
-            f"用户现在说：「{message}」\n"
-            "请用一两句话简短回复（中文），例如：报告在「Youkai 报告」窗口、执行结果在「终端 — 执行」、或请先下达扫描任务。"
+            f"用户现在说：「{message}」",
+            with_system_prompt=False,
         )
-        resp = llm.invoke([HumanMessage(content=prompt)])
+        resp, _ = await ainvoke_llm(llm, messages, "followup")
         return (resp.content or "请先在对话中下达扫描任务，例如：扫描 192.168.1.1").strip()
     except Exception:
         return "请先在对话中下达扫描任务，例如：扫描 192.168.1.1"
@@ -141,13 +134,59 @@ def build_terminal_lines(state: dict[str, Any]) -> list[dict[str, Any]]:
             else:
                 lines.append({"type": "info", "text": line, "channel": "recon"})
 
+    branches = state.get("recon_branches") or {}
+    if len(branches) > 1:
+        status_text = {"ok": "完成", "partial": "超时，保留部分结果", "timeout": "超时", "error": "失败", "skipped": "跳过"}
+        parts = [
+            f"{name} {status_text.get(branches[name].get('status'), '')}（{branches[name].get('elapsed', 0):.1f}s）"
+            for name in ("TCP", "UDP", "NSE")
+            if name in branches
+        ]
+        degraded = any(b.get("status") in ("partial", "timeout", "error") for b in branches.values())
+        lines.append({"type": "warn" if degraded else "info", "text": "[RECON] 并行分支：" + " | ".join(parts), "channel": "recon"})
+
+    for name, branch in branches.items():
+        if branch.get("shared"):
+            lines.append({"type": "info", "text": f"[RECON] {name} 分支复用了进行中的相同扫描（{branch['shared']} 台主机/目标），未重复探测", "channel": "recon"})
+        checkpoint = branch.get("checkpoint") or {}
+        if checkpoint.get("resumed"):
+            lines.append({"type": "info", "text": f"[RECON] {name} 分支从检查点继续，已合并之前完成的主机结果", "channel": "recon"})
+        if checkpoint.get("saved"):
+            lines.append({"type": "warn", "text": f"[RECON] {name} 分支进度已保存（已完成 {checkpoint.get('hosts_done', 0)} 台主机），再次发起相同扫描将从中断处继续", "channel": "recon"})
+
+    candidates = state.get("exploit_candidates") or []
+    if candidates:
+        lines.append({"type": "warn", "text": "--- Exploit-DB 候选 ---", "channel": "analysis"})
+        for c in candidates:
+            for e in c.get("exploits", [])[:5]:
+                lines.append({
+                    "type": "success" if e.get("match") == "exact" else "info",
+                    "text": f"{c['product']} {c['version']} → EDB-{e['id']} {e['title']}",
+                    "channel": "analysis",
+                })
+
     analysis = state.get("analysis") or ""
     if analysis:
-        lines.append({"type": "warn", "text": "--- LLM 分析 ---", "channel": "analysis"})
+        source = {
+            "speculative": "（采用扫描期间的推测分析，结果一致）",
+            "reconciled": "（已与扫描期间的初步分析对账）",
+        }.get(state.get("analysis_source") or "", "")
+        lines.append({"type": "warn", "text": f"--- LLM 分析{source} ---", "channel": "analysis"})
         for line in analysis.splitlines()[:15]:
             if line.strip():
                 lines.append({"type": "info", "text": line.strip(), "channel": "analysis"})
 
+    usage = state.get("llm_usage") or {}
+    if usage:
+        lines.append({
+            "type": "info",
+            "text": (
+                f"[LLM] {usage.get('calls', 0)} 次调用，输入 {usage.get('input_tokens', 0)} tokens"
+                f"（缓存命中 {usage.get('cache_read', 0)}），输出 {usage.get('output_tokens', 0)} tokens"
+            ),
+            "channel": "analysis",
+        })
+
     decision = state.get("decision") or ""
     if decision:
         lines.append({"type": "warn", "text": "--- 决策 ---", "channel": "exec"})
@@ -167,6 +206,66 @@ def build_terminal_lines(state: dict[str, Any]) -> list[dict[str, Any]]:
     return lines
 
 
+def _format_limits(limits: dict[str, Any]) -> str:
+    parts: list[str] = []
+    if "worker" in limits:
+        parts.append(f"worker={limits['worker']}")
+    if "nice" in limits:
+        parts.append(f"nice={limits['nice']}")
+    if "ionice" in limits:
+        parts.append(f"ionice={limits['ionice']}")
+    if "max_memory_mb" in limits:
+        parts.append(f"内存≤{limits['max_memory_mb']}MB")
+    if "container_memory_mb" in limits:
+        parts.append(f"容器内存≤{limits['container_memory_mb']}MB")
+    if "max_open_files" in limits:
+        parts.append(f"文件≤{limits['max_open_files']}")
+    if "cgroup" in limits:
+        parts.append(f"cgroup={limits['cgroup']}")
+    if limits.get("errors"):
+        parts.append("未生效: " + "; ".join(limits["errors"]))
+    return " ".join(parts) or "无资源限制"
+
+
+def _format_bytes(n: float) -> str:
+    for unit in ("B", "KB", "MB"):
+        if n < 1024:
+            return f"{n:.0f}{unit}"
+        n /= 1024
+    return f"{n:.1f}GB"
+
+
+def _format_usage(usage: dict[str, Any]) -> str:
+    parts: list[str] = []
+    if "user_s" in usage:
+        parts.append(f"CPU {usage['user_s'] + usage.get('sys_s', 0):.1f}s")
+    if usage.get("max_rss_kb"):
+        parts.append(f"峰值内存 {_format_bytes(usage['max_rss_kb'] * 1024)}")
+    if usage.get("read_bytes") or usage.get("write_bytes"):
+        parts.append(f"磁盘读/写 {_format_bytes(usage.get('read_bytes', 0))}/{_format_bytes(usage.get('write_bytes', 0))}")
+    if "stdout_bytes" in usage:
+        parts.append(f"输出 {_format_bytes(usage['stdout_bytes'] + usage.get('stderr_bytes', 0))}")
+    return " ".join(parts)
+
+
+def build_process_lines(processes: list[dict[str, Any]], channel: str = "general") -> list[dict[str, Any]]:
+    """外部进程摘要（ProcessResult.summary()）转成终端行：退出码、用时、资源消耗与实际生效的资源限制。"""
+    lines: list[dict[str, Any]] = []
+    for p in processes:
+        status = "超时" if p.get("timed_out") else f"退出码 {p.get('exit_code')}"
+        usage = _format_usage(p.get("usage") or {})
+        lines.append({
+            "type": "warn" if p.get("timed_out") or (p.get("limits") or {}).get("errors") else "info",
+            "text": (
+                f"[进程] {p.get('command')} {status}，用时 {p.get('elapsed', 0):.1f}s"
+                + (f" | {usage}" if usage else "")
+                + f" | {_format_limits(p.get('limits') or {})}"
+            ),
+            "channel": channel,
+        })
+    return lines
+
+
 def _parse_port_counts(recon: str) -> dict[str, int]:
     """从 recon 文本中解析 open/filtered/closed 数量，供前端饼图使用。"""
     open_count = filtered_count = closed_count = 0
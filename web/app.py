@@ -2,21 +2,35 @@ from __future__ import annotations
 
 import asyncio
 import json
+import logging
 import threading
+import time
+import uuid
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
 from pathlib import Path
 
 from fastapi import FastAPI, Form, Request
-from fastapi.responses import HTMLResponse, JSONResponse, RedirectResponse, StreamingResponse
+from fastapi.responses import FileResponse, HTMLResponse, JSONResponse, RedirectResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 
-from config.runtime import load_runtime_settings, save_runtime_settings
-from core.agent import create_kali_agent
-from tools.exploitation import run_dangerous_command
+from config.runtime import SANDBOX_MODES, load_runtime_settings, save_runtime_settings
+from config.settings import settings
+from core.cassette import get_cassette, is_replaying
+from core.engagement_db import get_engagement_db
+from core.events import BroadcastChannel, EventChannel, bind_channel
+from core.profiler import SamplingProfiler, profile_path
+from core.state import get_state_backend
+from core.scheduler import get_scheduler, set_priority
+from core.supervisor import total_usage, track_processes
+from tools.exploitation import normalize_url, parse_sqlmap_output, run_dangerous_command
 from tools.kali_tools import run_tool
+from tools.scanning import coalesce_key
 from web.api_handlers import (
     build_context_from_state,
     build_panels,
+    build_process_lines,
     build_terminal_lines,
     classify_intent_with_llm,
     get_last_context,
@@ -25,14 +39,16 @@ from web.api_handlers import (
     reply_followup_with_llm,
     set_last_context,
 )
+from web.panels import get_panel_store
+from web.streaming import append_progress, dumps_event, encode_frame, read_frame
+
+logger = logging.getLogger(__name__)
 
 BASE_DIR = Path(__file__).resolve().parents[1]
 templates = Jinja2Templates(directory=str(BASE_DIR / "web" / "templates"))
 
-app = FastAPI(title="YOUKAI / Kali Agent Web UI", version="0.1.0")
-app.mount("/static", StaticFiles(directory=str(BASE_DIR / "web" / "static")), name="static")
-
 _agent_cache = None
+_agent_lock = threading.Lock()
 
 
 def get_agent():
@@ -40,8 +56,19 @@ def get_agent():
     global _agent_cache
     if _agent_cache is not None:
         return _agent_cache
-    _agent_cache = create_kali_agent()
-    return _agent_cache
+    with _agent_lock:
+        if _agent_cache is None:
+            # core.agent 在首次使用时才导入，LLM 提供商模块再按配置按需导入
+            from core.agent import create_kali_agent
+            _agent_cache = create_kali_agent()
+        return _agent_cache
+
+
+async def aget_agent():
+    """get_agent 的协程版本：首次构建（导入提供商模块、编译图）放到线程里，避免阻塞事件循环。"""
+    if _agent_cache is not None:
+        return _agent_cache
+    return await asyncio.to_thread(get_agent)
 
 
 def clear_agent_cache():
@@ -49,10 +76,37 @@ def clear_agent_cache():
     _agent_cache = None
 
 
+def prewarm_agent() -> None:
+    """启动预热：导入提供商模块、编译 Agent 图，并发一次极短请求建立 LLM 连接。"""
+    if not has_llm_configured():
+        return
+    try:
+        get_agent()
+        if is_replaying():
+            return
+        from core.agent import get_llm
+        get_llm().invoke("ping")
+        logger.info("Agent prewarm finished")
+    except Exception as exc:  # noqa: BLE001
+        logger.warning("Agent prewarm failed: %s", exc)
+
+
+@asynccontextmanager
+async def _lifespan(_app: FastAPI):
+    if settings.prewarm:
+        threading.Thread(target=prewarm_agent, name="youkai-prewarm", daemon=True).start()
+    yield
+
+
+app = FastAPI(title="YOUKAI / Kali Agent Web UI", version="0.1.0", lifespan=_lifespan)
+app.mount("/static", StaticFiles(directory=str(BASE_DIR / "web" / "static")), name="static")
+
+
 def has_llm_configured() -> bool:
-    """是否已配置任一 LLM（Web 保存或环境变量）。"""
+    """是否已配置任一 LLM（Web 保存或环境变量）；回放录制带时不需要。"""
     from config.runtime import get_effective_llm_config
-    from config.settings import settings
+    if is_replaying():
+        return True
     provider, key = get_effective_llm_config()
     if provider and key:
         return True
@@ -90,170 +144,431 @@ async def api_command(request: Request) -> JSONResponse:
             content={"ok": False, "error": "未从指令中识别到目标 IP 或域名，请写明例如：扫描 192.168.1.1"},
         )
 
-    try:
-        agent = get_agent()
-        state = agent.invoke(
-            {"goal": goal, "target": target, "nmap_arguments": nmap_arguments}
-        )
-    except Exception as exc:  # noqa: BLE001
+    # 与流式接口共用任务表：相同的任务正在进行时等待它的结果（任务自己写入记录库）
+    job, created = await _start_agent_job(goal, target, nmap_arguments, engagement=(body.get("engagement") or "").strip())
+    await job.wait()
+    if job.error:
+        local_stats = await asyncio.to_thread(get_local_stats)
         return JSONResponse(
             status_code=500,
             content={
                 "ok": False,
-                "error": str(exc),
-                "panels": {"local_stats": get_local_stats(), "target_info": {}, "ports": "", "tracking": "", "report": ""},
-                "terminal": [{"type": "error", "text": str(exc)}],
+                "error": job.error,
+                "panels": {"local_stats": local_stats, "target_info": {}, "ports": "", "tracking": "", "report": ""},
+                "terminal": [{"type": "error", "text": job.error}],
             },
         )
 
-    set_last_context(build_context_from_state(state))
-    local_stats = get_local_stats()
+    state = job.final_state or {}
+    processes = job.processes
+    session = _session_id(body)
+    await asyncio.to_thread(set_last_context, build_context_from_state(state), session)
+    local_stats = await asyncio.to_thread(get_local_stats)
     panels = build_panels(state, local_stats)
-    terminal = build_terminal_lines(state)
+    terminal = build_terminal_lines(state) + build_process_lines(processes, channel="recon")
+    panel_fields = (
+        {"panel_delta": await asyncio.to_thread(get_panel_store().update, session, panels, _panel_version(body))}
+        if session else {"panels": panels}
+    )
     return JSONResponse(
         content={
             "ok": True,
-            "panels": panels,
+            **panel_fields,
             "terminal": terminal,
+            "processes": processes,
+            "resources": total_usage(processes),
+            "job_id": job.job_id,
+            "shared": not created,
         },
     )
 
 
+def _session_id(body: dict) -> str:
+    """前端标签页的会话 ID（请求体 session），用于数据窗口增量更新。"""
+    return str(body.get("session") or "").strip()[:64]
+
+
+def _panel_version(body: dict) -> int | None:
+    """客户端当前的数据窗口版本（请求体 panel_version），缺省或无效时返回 None（服务端回完整快照）。"""
+    try:
+        return int(body["panel_version"])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+@app.get("/api/panels")
+async def api_panels(request: Request) -> JSONResponse:
+    """会话当前的完整数据窗口与版本号，客户端增量对不上时用来重新同步。"""
+    session = (request.query_params.get("session") or "").strip()[:64]
+    if not session:
+        return JSONResponse(status_code=400, content={"ok": False, "error": "缺少 session 参数"})
+    return JSONResponse(content={"ok": True, **await asyncio.to_thread(get_panel_store().snapshot, session)})
+
+
+def _record_run(kind: str, *args, **kwargs) -> None:
+    """把运行结果写入渗透记录库（kind: agent / tool）；失败只记日志，不影响主流程。"""
+    try:
+        db = get_engagement_db()
+        if kind == "agent":
+            db.record_agent_run(*args, **kwargs)
+        else:
+            db.record_tool_run(*args, **kwargs)
+    except Exception as exc:  # noqa: BLE001
+        logger.warning("Failed to record %s run: %s", kind, exc)
+
+
+# 运行中的流式 Agent 任务
+_agent_tasks: set[asyncio.Task] = set()
+
 STEP_MESSAGES = {
     "START": "接收目标，准备侦察…",
-    "RECON": "执行 Nmap 扫描中…",
+    "RECON_TCP": "TCP 服务扫描分支完成",
+    "RECON_UDP": "UDP 常见端口扫描分支完成",
+    "RECON_NSE": "NSE 脚本扫描分支完成",
+    "RECON": "合并各分支侦察结果…",
     "ANALYSIS": "LLM 分析扫描结果中…",
     "DECISION": "生成下一步决策中…",
     "HUMAN_CHECK": "生成人工确认报告…",
 }
 
 
-async def _stream_command_events(goal: str, target: str, nmap_arguments: str):
-    """异步生成器：逐步推送 Thinking 与最终结果（NDJSON）。等待期间每 12 秒推送「进行中」避免长时间无反馈。"""
-    import time
-    queue: asyncio.Queue = asyncio.Queue()
+def _profiling_requested(request: Request) -> bool:
+    """请求头 X-Youkai-Profile: 1 或配置 profile_requests 开启单任务采样剖析。"""
+    header = (request.headers.get("x-youkai-profile") or "").strip().lower()
+    return header in ("1", "true", "yes", "on") or settings.profile_requests
+
+
+@dataclass(eq=False)
+class _AgentJob:
+    """本进程上运行的一次 Agent 任务。参数相同的并发请求（含重复提交）接入同一个任务，共享事件流与结果。"""
+
+    job_id: str
+    key: tuple
+    events: BroadcastChannel = field(default_factory=BroadcastChannel)
     final_state: dict | None = None
     error: str | None = None
+    processes: list[dict] = field(default_factory=list)
+    profiled: bool = False
+    task: asyncio.Task | None = None
+
+    def subscribe(self, channel: EventChannel) -> None:
+        self.events.subscribe(channel)
+
+    def unsubscribe(self, channel: EventChannel) -> None:
+        self.events.unsubscribe(channel)
+
+    async def wait(self) -> None:
+        await asyncio.shield(self.task)
+
+
+@dataclass(eq=False)
+class _RemoteJob:
+    """其他 worker 进程上运行的相同任务（共享状态后端中登记）：轮询后端获取它的事件与结果。"""
+
+    job_id: str
+    final_state: dict | None = None
+    error: str | None = None
+    processes: list[dict] = field(default_factory=list)
+    profiled: bool = False
+    _pumps: dict = field(default_factory=dict)
+
+    def subscribe(self, channel: EventChannel) -> None:
+        self._pumps[channel] = asyncio.create_task(self._pump(channel))
+
+    def unsubscribe(self, channel: EventChannel) -> None:
+        task = self._pumps.pop(channel, None)
+        if task is not None:
+            task.cancel()
+
+    async def _finished(self) -> bool:
+        """任务已结束（结果写入后端，或运行它的进程失联）时载入结果并返回 True。"""
+        backend = get_state_backend()
+        result = await asyncio.to_thread(backend.job_result, self.job_id)
+        if result is not None:
+            self.final_state = result.get("final_state")
+            self.error = result.get("error")
+            self.processes = result.get("processes") or []
+            return True
+        if not await asyncio.to_thread(backend.job_active, self.job_id):
+            self.error = "运行该任务的服务进程已失联，请重试"
+            return True
+        return False
+
+    async def _pump(self, channel: EventChannel) -> None:
+        backend = get_state_backend()
+        seq = 0
+        while True:
+            rows = await asyncio.to_thread(backend.read_events, self.job_id, seq)
+            for seq, event in rows:
+                if event[0] == "done":
+                    await self._finished()
+                await channel.aput(tuple(event))
+                if event[0] == "done":
+                    return
+            if rows:
+                continue
+            if await self._finished():
+                # 结果已写入但 done 可能还没发布：补读一次剩余事件
+                for seq, event in await asyncio.to_thread(backend.read_events, self.job_id, seq):
+                    if event[0] != "done":
+                        await channel.aput(tuple(event))
+                await channel.aput(("done",))
+                return
+            await asyncio.sleep(settings.state_poll_interval)
 
-    def run_stream():
-        nonlocal final_state, error
-        setattr(threading.current_thread(), "progress_queue", queue)
+    async def wait(self) -> None:
+        while not await self._finished():
+            await asyncio.sleep(settings.state_poll_interval)
+
+
+# 本进程上进行中的 Agent 任务，键见 _job_key；任务结束即移除
+_agent_jobs: dict[tuple, _AgentJob] = {}
+
+
+def _job_key(goal: str, target: str, nmap_arguments: str, engagement: str) -> tuple:
+    """规范化的目标与 Nmap 参数（同 Nmap 扫描合并），加上目标描述与项目名。"""
+    return (*coalesce_key(target, nmap_arguments), " ".join(goal.split()), engagement)
+
+
+async def _publish_job_events(job: _AgentJob, key: str, channel: EventChannel) -> None:
+    """把本进程任务的事件成批写入共享后端，供其他 worker 进程上接入的请求读取，并定期续期任务登记。"""
+    backend = get_state_backend()
+    ttl = settings.state_job_ttl
+    try:
+        while True:
+            try:
+                batch = await read_frame(channel, ttl / 3, 0.2, 500)
+            except asyncio.TimeoutError:
+                batch = []
+            await asyncio.to_thread(backend.publish, job.job_id, [list(e) for e in batch])
+            if batch and batch[-1][0] == "done":
+                return
+            await asyncio.to_thread(backend.refresh_job, key, job.job_id, ttl)
+    finally:
+        job.unsubscribe(channel)
+        channel.close()
+
+
+async def _start_agent_job(
+    goal: str,
+    target: str,
+    nmap_arguments: str,
+    profile: bool = False,
+    engagement: str = "",
+) -> tuple[_AgentJob | _RemoteJob, bool]:
+    """启动 Agent 任务，返回 (任务, 是否新建)。开启 scan_coalesce 且相同任务正在进行时直接返回该任务；
+    共享状态后端中登记的任务可能在其他 worker 进程上运行，此时返回 _RemoteJob。
+
+    Agent 以 asyncio 任务运行在事件循环上（agent.astream），事件推送到任务的 BroadcastChannel。
+    profile=True 时对事件循环线程做采样剖析，只统计本任务（及其派生的 asyncio 任务）运行的时刻，
+    任务结束后写入 profiles/<job_id>.folded。
+    """
+    key = _job_key(goal, target, nmap_arguments, engagement)
+    if settings.scan_coalesce and key in _agent_jobs:
+        return _agent_jobs[key], False
+    job = _AgentJob(job_id=uuid.uuid4().hex[:12], key=key, profiled=profile)
+    backend = get_state_backend()
+    shared_key = json.dumps(list(key), ensure_ascii=False)
+    # 只有登记到共享后端的任务会被其他 worker 进程接入（_RemoteJob）；不合并时没有远端读者，不必发布事件与结果
+    remote = settings.scan_coalesce and backend.shared
+    if remote:
+        owner = await asyncio.to_thread(backend.claim_job, shared_key, job.job_id, settings.state_job_ttl)
+        if owner != job.job_id:
+            return _RemoteJob(job_id=owner), False
+    profiler: SamplingProfiler | None = None
+    if profile:
+        profiler = SamplingProfiler(interval=max(settings.profile_interval_ms, 0.5) / 1000.0)
+        profiler.start()
+
+    async def run_job():
+        # 任务创建时复制了上下文，这里绑定的通道只对本任务（及其派生的线程）可见
+        bind_channel(job.events)
+        if profiler is not None:
+            # 事件循环由所有请求共享：只采样本任务及其派生任务运行的时刻
+            profiler.track_tasks(name="event-loop")
         try:
-            agent = get_agent()
+            agent = await aget_agent()
             initial = {"goal": goal, "target": target, "nmap_arguments": nmap_arguments}
             state = dict(initial)
-            try:
-                for chunk in agent.stream(initial, stream_mode="updates"):
-                    for node_name, update in chunk.items():
-                        state = {**state, **update}
-                        loop.call_soon_threadsafe(
-                            queue.put_nowait,
-                            ("step", node_name, STEP_MESSAGES.get(node_name, node_name)),
-                        )
-            except Exception as e:  # noqa: BLE001
-                error = str(e)
-            final_state = state
+            with track_processes() as runs:
+                try:
+                    # updates 用于推送步骤；values 为应用 reducer 后的完整状态（并行分支的结果已合并）
+                    async for mode, chunk in agent.astream(initial, stream_mode=["updates", "values"]):
+                        if mode == "values":
+                            state = chunk
+                            continue
+                        for node_name in chunk:
+                            # 并行侦察分支（RECON_TCP 等）在前端归入 RECON 步骤
+                            step = "RECON" if node_name.startswith("RECON_") else node_name
+                            job.events.put(("step", step, STEP_MESSAGES.get(node_name, node_name)))
+                except Exception as e:  # noqa: BLE001
+                    job.error = str(e)
+            job.processes.extend(r.summary() for r in runs)
+            job.final_state = state
+            if not job.error:
+                await asyncio.to_thread(_record_run, "agent", state, engagement=engagement, processes=job.processes)
         except Exception as e:  # noqa: BLE001
-            error = str(e)
-        loop.call_soon_threadsafe(queue.put_nowait, ("done",))
-
-    loop = asyncio.get_event_loop()
-    thread = threading.Thread(target=run_stream, daemon=True)
-    thread.start()
-
-    # 1. 对话窗口简短回复
-    yield json.dumps(
-        {"type": "reply", "message": "收到，开始侦察目标…"},
-        ensure_ascii=False,
-    ) + "\n"
-    # 2. 立即显示「正在做什么」，避免长时间空白
-    yield json.dumps(
-        {"type": "thinking", "step": "START", "message": "正在启动侦察（即将执行 Nmap）…"},
-        ensure_ascii=False,
-    ) + "\n"
-
-    last_step, last_message = "RECON", "执行 Nmap 扫描中…"
-    idle_since = time.monotonic()
-    wait_interval = 12.0
-    total_timeout = 300.0
-
-    while True:
-        try:
-            msg = await asyncio.wait_for(queue.get(), timeout=wait_interval)
-        except asyncio.TimeoutError:
-            # 等待期间定期推送「进行中」，让用户看到 Youkai 在这段时间在干什么
-            elapsed = time.monotonic() - idle_since
-            if elapsed >= total_timeout:
-                yield json.dumps(
-                    {"type": "error", "message": "执行超时（侦察/扫描耗时较长可稍候重试）"},
-                    ensure_ascii=False,
-                ) + "\n"
-                break
-            yield json.dumps(
-                {
+            job.error = str(e)
+        finally:
+            if _agent_jobs.get(key) is job:
+                del _agent_jobs[key]
+            if profiler is not None:
+                profiler.stop()
+                profiler.save(job.job_id)
+        if remote:
+            # 结果先写入后端，再发布 done，其他进程读到 done 时结果已可用
+            result = {"final_state": job.final_state, "error": job.error, "processes": job.processes}
+            try:
+                await asyncio.to_thread(backend.finish_job, shared_key, job.job_id, result)
+            except Exception as exc:  # noqa: BLE001
+                logger.warning("Failed to store job %s result: %s", job.job_id, exc)
+        job.events.put(("done",))
+
+    if remote:
+        publisher = EventChannel(capacity=settings.event_channel_capacity, policy="coalesce")
+        job.subscribe(publisher)
+        task = asyncio.create_task(_publish_job_events(job, shared_key, publisher))
+        _agent_tasks.add(task)
+        task.add_done_callback(_agent_tasks.discard)
+    # 客户端断开后任务继续跑完并记录结果，持有引用防止被回收
+    job.task = asyncio.create_task(run_job())
+    _agent_tasks.add(job.task)
+    job.task.add_done_callback(_agent_tasks.discard)
+    if settings.scan_coalesce:
+        _agent_jobs[key] = job
+    return job, True
+
+
+async def _stream_command_events(
+    goal: str,
+    target: str,
+    nmap_arguments: str,
+    profile: bool = False,
+    engagement: str = "",
+    session: str = "",
+    panel_version: int | None = None,
+):
+    """异步生成器：逐步推送 Thinking 与最终结果（NDJSON）。等待期间每 12 秒推送「进行中」避免长时间无反馈。
+
+    相同的任务正在进行时接入它：先收到已经过的步骤，再与发起者同步接收后续事件与结果。
+    带 session 时 done 事件携带相对 panel_version 的数据窗口增量（panel_delta，见 web/panels.py），否则为完整 panels。
+    """
+    job, created = await _start_agent_job(goal, target, nmap_arguments, profile=profile, engagement=engagement)
+    job_id = job.job_id
+    queue = EventChannel(
+        capacity=settings.event_channel_capacity,
+        policy=settings.event_channel_policy,
+        block_timeout=settings.event_channel_block_timeout,
+    )
+    job.subscribe(queue)
+
+    try:
+        # 1. 对话窗口简短回复；2. 立即显示「正在做什么」，避免长时间空白
+        if created:
+            yield encode_frame([
+                {"type": "reply", "message": "收到，开始侦察目标…"},
+                {"type": "thinking", "step": "START", "message": "正在启动侦察（即将执行 Nmap）…"},
+            ])
+        else:
+            yield encode_frame([
+                {"type": "reply", "message": f"相同的任务正在进行（{job_id}），已接入其进度，不重复扫描。"},
+                {"type": "thinking", "step": "START", "message": "接入进行中的任务…"},
+            ])
+
+        last_step, last_message = "RECON", "执行 Nmap 扫描中…"
+        idle_since = time.monotonic()
+        wait_interval = 12.0
+        total_timeout = 300.0
+        frame_interval = max(settings.stream_frame_ms, 0.0) / 1000.0
+        frame_max_events = max(settings.stream_frame_max_events, 1)
+
+        while True:
+            try:
+                # 按时间窗口合帧：一帧内的多条消息合并为一次写入
+                batch = await read_frame(queue, wait_interval, frame_interval, frame_max_events)
+            except asyncio.TimeoutError:
+                # 等待期间定期推送「进行中」，让用户看到 Youkai 在这段时间在干什么
+                elapsed = time.monotonic() - idle_since
+                if elapsed >= total_timeout:
+                    yield dumps_event({"type": "error", "message": "执行超时（侦察/扫描耗时较长可稍候重试）"})
+                    break
+                yield dumps_event({
                     "type": "thinking",
                     "step": last_step,
                     "message": last_message + "（进行中，请稍候…）",
-                },
-                ensure_ascii=False,
-            ) + "\n"
-            continue
-        idle_since = time.monotonic()
-        try:
-            if msg[0] == "progress_line":
-                _, channel, line = msg
-                yield json.dumps(
-                    {"type": "progress", "channel": channel, "line": line},
-                    ensure_ascii=False,
-                ) + "\n"
-            elif msg[0] == "step":
-                _, node_name, message = msg
-                last_step, last_message = node_name, message
-                yield json.dumps(
-                    {"type": "thinking", "step": node_name, "message": message},
-                    ensure_ascii=False,
-                ) + "\n"
-            elif msg[0] == "done":
-                if error:
-                    yield json.dumps({"type": "error", "message": error}, ensure_ascii=False) + "\n"
-                    break
-                local_stats = get_local_stats()
-                panels = build_panels(final_state or {}, local_stats)
-                terminal = build_terminal_lines(final_state or {})
-                # 终端流式输出：逐行推送，前端可实时跟踪
-                for line in terminal:
-                    yield json.dumps(
-                        {"type": "terminal_line", "line": line},
-                        ensure_ascii=False,
-                    ) + "\n"
-                if final_state:
-                    set_last_context(build_context_from_state(final_state))
-                yield json.dumps(
-                    {"type": "done", "ok": True, "panels": panels},
-                    ensure_ascii=False,
-                ) + "\n"
+                })
+                continue
+            idle_since = time.monotonic()
+            events: list[dict] = []
+            finished = False
+            try:
+                for msg in batch:
+                    if msg[0] == "progress_line":
+                        _, channel, line = msg
+                        append_progress(events, channel, line)
+                    elif msg[0] == "progress_dropped":
+                        _, channel, count = msg
+                        events.append({"type": "progress_dropped", "channel": channel, "count": count})
+                    elif msg[0] == "queue":
+                        events.append({"type": "queue", **msg[1]})
+                    elif msg[0] == "analysis_preview":
+                        events.append({"type": "analysis_preview", **msg[1]})
+                    elif msg[0] == "step":
+                        _, node_name, message = msg
+                        last_step, last_message = node_name, message
+                        events.append({"type": "thinking", "step": node_name, "message": message})
+                    elif msg[0] == "done":
+                        finished = True
+                        final_state, error, processes = job.final_state, job.error, job.processes
+                        if error:
+                            events.append({"type": "error", "message": error})
+                            break
+                        local_stats = await asyncio.to_thread(get_local_stats)
+                        panels = build_panels(final_state or {}, local_stats)
+                        # 终端行一次性批量推送，前端按通道合并渲染
+                        events.append({
+                            "type": "terminal_lines",
+                            "lines": build_terminal_lines(final_state or {}) + build_process_lines(processes, channel="recon"),
+                        })
+                        if final_state:
+                            await asyncio.to_thread(set_last_context, build_context_from_state(final_state), session)
+                        done: dict = {"type": "done", "ok": True, "job_id": job_id}
+                        if session:
+                            done["panel_delta"] = await asyncio.to_thread(get_panel_store().update, session, panels, panel_version)
+                        else:
+                            done["panels"] = panels
+                        if not created:
+                            done["shared"] = True
+                        if final_state and final_state.get("llm_usage"):
+                            done["usage"] = final_state["llm_usage"]
+                        if processes:
+                            done["processes"] = processes
+                            done["resources"] = total_usage(processes)
+                        if job.profiled:
+                            done["profile"] = f"/api/profiles/{job_id}"
+                        events.append(done)
+                        break
+            except Exception as e:  # noqa: BLE001
+                events.append({"type": "error", "message": f"流式输出异常: {e!s}"})
+                finished = True
+            if events:
+                yield encode_frame(events)
+            if finished:
                 break
-        except Exception as e:  # noqa: BLE001
-            yield json.dumps({"type": "error", "message": f"流式输出异常: {e!s}"}, ensure_ascii=False) + "\n"
-            break
-
-
-async def _stream_followup_reply(message: str):
-    """追问分支：仅用 LLM 根据上下文生成简短回复，不跑扫描。"""
-    yield json.dumps(
-        {"type": "thinking", "step": "FOLLOWUP", "message": "理解你的问题…"},
-        ensure_ascii=False,
-    ) + "\n"
-    ctx = get_last_context()
-    reply_text = await asyncio.to_thread(reply_followup_with_llm, message, ctx)
-    yield json.dumps(
+    finally:
+        job.unsubscribe(queue)
+        queue.close()
+
+
+async def _stream_followup_reply(message: str, session: str = ""):
+    """追问分支：仅用 LLM 根据会话上下文生成简短回复，不跑扫描。"""
+    yield dumps_event({"type": "thinking", "step": "FOLLOWUP", "message": "理解你的问题…"})
+    ctx = await asyncio.to_thread(get_last_context, session)
+    reply_text = await reply_followup_with_llm(message, ctx)
+    yield encode_frame([
         {"type": "reply", "message": reply_text},
-        ensure_ascii=False,
-    ) + "\n"
-    yield json.dumps(
         {"type": "done", "ok": True, "followup": True, "panels": None},
-        ensure_ascii=False,
-    ) + "\n"
+    ])
 
 
 @app.post("/api/command_stream")
@@ -269,10 +584,10 @@ async def api_command_stream(request: Request):
     if not has_llm_configured():
         return JSONResponse(status_code=400, content={"error": "请先在「设置」中配置 LLM API Key"})
 
-    intent = await asyncio.to_thread(classify_intent_with_llm, message)
+    intent = await classify_intent_with_llm(message)
     if intent == "followup":
         return StreamingResponse(
-            _stream_followup_reply(message),
+            _stream_followup_reply(message, _session_id(body)),
             media_type="application/x-ndjson",
             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
         )
@@ -285,47 +600,367 @@ async def api_command_stream(request: Request):
         )
 
     return StreamingResponse(
-        _stream_command_events(goal, target, nmap_arguments),
+        _stream_command_events(
+            goal,
+            target,
+            nmap_arguments,
+            profile=_profiling_requested(request),
+            engagement=(body.get("engagement") or "").strip(),
+            session=_session_id(body),
+            panel_version=_panel_version(body),
+        ),
         media_type="application/x-ndjson",
         headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
     )
 
 
+@app.get("/api/profiles/{job_id}")
+def api_profile(job_id: str):
+    """下载某次任务的采样剖析结果（folded stacks，可用 flamegraph.pl / speedscope 打开）。"""
+    path = profile_path(job_id)
+    if path is None:
+        return JSONResponse(status_code=404, content={"ok": False, "error": "未找到该任务的剖析结果"})
+    return FileResponse(path, media_type="text/plain; charset=utf-8", filename=path.name)
+
+
+def _run_interactive(fn, *args):
+    """在线程池中以 interactive 优先级执行外部命令：排队时不阻塞事件循环，且优先于 Agent 与批量任务。
+
+    返回 (fn 的结果, 期间启动的外部进程摘要)。
+    """
+    set_priority("interactive")
+    try:
+        with track_processes() as runs:
+            result = fn(*args)
+        return result, [r.summary() for r in runs]
+    finally:
+        set_priority(None)
+
+
+@app.get("/api/scheduler")
+def api_scheduler() -> JSONResponse:
+    """查看全局进程调度器：正在运行与排队中的外部命令。"""
+    return JSONResponse(content={"ok": True, **get_scheduler().snapshot()})
+
+
+@app.post("/api/workers/heartbeat")
+async def api_workers_heartbeat(request: Request) -> JSONResponse:
+    """分布式 worker 登记与心跳（core/worker.py 定时调用），需 Authorization: Bearer <worker_token>。"""
+    from core.coordinator import get_worker_registry
+    from core.worker import check_token
+
+    if not check_token(request.headers.get("Authorization"), settings.worker_token):
+        return JSONResponse(status_code=401, content={"ok": False, "error": "unauthorized"})
+    try:
+        body = await request.json()
+    except Exception:
+        return JSONResponse(status_code=400, content={"ok": False, "error": "无效 JSON"})
+    url = (body.get("url") or "").strip()
+    if not url:
+        return JSONResponse(status_code=400, content={"ok": False, "error": "缺少 url"})
+    info = get_worker_registry().heartbeat(url, body.get("name") or "", body.get("capacity") or 1, body.get("running") or 0)
+    backend = get_state_backend()
+    if backend.shared:
+        # 多进程部署：心跳写入共享后端，其他进程的登记表据此合并
+        entry = {"name": info.name, "capacity": info.capacity, "running": info.running, "seen": time.time()}
+        await asyncio.to_thread(backend.set, "workers", info.url, entry)
+    return JSONResponse(content={"ok": True})
+
+
+@app.get("/api/llm/stats")
+def api_llm_stats() -> JSONResponse:
+    """多提供商路由的延迟 / 错误率统计（只配置了一个提供商时 router 为 null），以及各类调用的 token 与缓存命中累计。
+
+    开启录制 / 回放时 cassette 给出录制带路径与记录、命中数。
+    """
+    from core.agent import get_llm
+    from core.llm_router import LLMRouter
+    from core.prompts import usage_totals
+
+    try:
+        llm = get_llm()
+    except RuntimeError as e:
+        return JSONResponse(status_code=400, content={"ok": False, "error": str(e)})
+    cassette = get_cassette()
+    return JSONResponse(content={
+        "ok": True,
+        "router": llm.snapshot() if isinstance(llm, LLMRouter) else None,
+        "usage": usage_totals(),
+        "cassette": cassette.snapshot() if cassette is not None else None,
+    })
+
+
+@app.get("/api/workers")
+def api_workers() -> JSONResponse:
+    """列出已登记的分布式 worker 及其在线状态与负载。"""
+    from core.coordinator import get_worker_registry
+
+    return JSONResponse(content={"ok": True, "workers": get_worker_registry().snapshot()})
+
+
+@dataclass(eq=False)
+class _ExploitJob:
+    """后台运行的一次利用（如 sqlmap）。参数相同的利用正在进行时接入同一个任务；结束后保留结果供查询。"""
+
+    job_id: str
+    key: tuple
+    action: str
+    target: str
+    events: BroadcastChannel = field(default_factory=BroadcastChannel)
+    exit_code: int | None = None
+    stdout: str = ""
+    stderr: str = ""
+    processes: list[dict] = field(default_factory=list)
+    started_at: float = field(default_factory=time.time)
+    finished_at: float | None = None
+    task: asyncio.Task | None = None
+
+    @property
+    def done(self) -> bool:
+        return self.finished_at is not None
+
+    def status(self) -> dict:
+        end = self.finished_at or time.time()
+        return {
+            "job_id": self.job_id,
+            "action": self.action,
+            "target": self.target,
+            "state": "done" if self.done else "running",
+            "exit_code": self.exit_code,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "elapsed": round(end - self.started_at, 3),
+        }
+
+    def terminal(self, output: bool = True) -> list[dict]:
+        """结果终端行；output=False 时不含工具输出（流式接口已逐行推送）。"""
+        code = self.exit_code
+        lines = [
+            {"type": "cmd", "text": f"[EXPLOIT] {self.action} 已执行"},
+            {"type": "error" if code != 0 else "success", "text": self.stderr or (self.stdout if output else "") or f"退出码 {code}"},
+        ]
+        if output:
+            for line in self.stdout.splitlines()[:50]:
+                if line.strip():
+                    lines.append({"type": "info", "text": line.strip()})
+        lines.extend(build_process_lines(self.processes, channel="exec"))
+        return lines
+
+    def result(self, output: bool = True) -> dict:
+        injections = []
+        if self.action == "sqlmap":
+            injections = [r for r in parse_sqlmap_output(self.stdout)["results"] if r["injectable"]]
+        return {
+            "ok": self.exit_code == 0,
+            "job_id": self.job_id,
+            "exit_code": self.exit_code,
+            "terminal": self.terminal(output),
+            "injections": injections,
+            "processes": self.processes,
+            "resources": total_usage(self.processes),
+        }
+
+    async def wait(self) -> None:
+        await asyncio.shield(self.task)
+
+
+# 本进程的利用任务：按 job_id 索引，已结束的保留最近 exploit_job_history 个；
+# _exploit_running 按参数索引进行中的任务，相同的利用接入而不重复执行
+_exploit_jobs: dict[str, _ExploitJob] = {}
+_exploit_running: dict[tuple, _ExploitJob] = {}
+
+
+def _exploit_request(body: dict) -> tuple[str, dict]:
+    """请求体 → (action, 规范化的 payload)。payload 可放在 body.payload 中，也可直接写在 body 里。"""
+    action = (body.get("action") or "").strip().lower()
+    payload = body.get("payload") or body
+    return action, {
+        "url": str(payload.get("url") or "").strip(),
+        "extra_args": " ".join(str(payload.get("extra_args") or "").split()),
+        "engagement": str(payload.get("engagement") or body.get("engagement") or "").strip(),
+        "force": bool(payload.get("force")),
+    }
+
+
+def _prune_exploit_jobs() -> None:
+    finished = [job_id for job_id, job in _exploit_jobs.items() if job.done]
+    for job_id in finished[: max(len(finished) - max(settings.exploit_job_history, 0), 0)]:
+        del _exploit_jobs[job_id]
+
+
+def _start_exploit_job(action: str, payload: dict) -> tuple[_ExploitJob, bool]:
+    """启动后台利用任务，返回 (任务, 是否新建)。利用在线程池中以 interactive 优先级执行，
+    输出行推送到任务的 BroadcastChannel；客户端断开后任务继续执行，结果可经 /api/exploit_jobs 查询。
+    """
+    key = (action, json.dumps(payload, ensure_ascii=False, sort_keys=True))
+    running = _exploit_running.get(key)
+    if running is not None:
+        return running, False
+    job = _ExploitJob(job_id=uuid.uuid4().hex[:12], key=key, action=action, target=payload.get("url") or "")
+
+    async def run_job():
+        bind_channel(job.events)
+        try:
+            (code, out, err), processes = await asyncio.to_thread(_run_interactive, run_dangerous_command, action, payload)
+            job.exit_code, job.stdout, job.stderr, job.processes = code, out or "", err or "", processes
+        except Exception as e:  # noqa: BLE001
+            job.exit_code, job.stderr = -1, str(e)
+        finally:
+            job.finished_at = time.time()
+            if _exploit_running.get(key) is job:
+                del _exploit_running[key]
+            _prune_exploit_jobs()
+        job.events.put(("done",))
+
+    job.task = asyncio.create_task(run_job())
+    _agent_tasks.add(job.task)
+    job.task.add_done_callback(_agent_tasks.discard)
+    _exploit_jobs[job.job_id] = job
+    _exploit_running[key] = job
+    return job, True
+
+
+async def _stream_exploit_events(job: _ExploitJob, created: bool):
+    """异步生成器：推送利用任务的实时输出（「终端 — 执行」）与最终结果（NDJSON），每 12 秒无输出时推送「执行中」。
+
+    接入进行中的任务时只收到之后的输出；任务在接入前已结束时 done 之前补发完整输出。
+    """
+    queue = EventChannel(
+        capacity=settings.event_channel_capacity,
+        policy=settings.event_channel_policy,
+        block_timeout=settings.event_channel_block_timeout,
+    )
+    finished_before = job.done
+    job.events.subscribe(queue)
+    try:
+        if created:
+            message = f"已在后台开始执行 {job.action}（任务 {job.job_id}），输出实时显示在「终端 — 执行」。"
+        elif finished_before:
+            message = f"任务 {job.job_id} 已结束，以下为其结果。"
+        else:
+            message = f"相同的利用正在进行（{job.job_id}），已接入其输出，不重复执行。"
+        yield dumps_event({"type": "reply", "message": message, "job_id": job.job_id})
+        frame_interval = max(settings.stream_frame_ms, 0.0) / 1000.0
+        frame_max_events = max(settings.stream_frame_max_events, 1)
+        while True:
+            try:
+                batch = await read_frame(queue, 12.0, frame_interval, frame_max_events)
+            except asyncio.TimeoutError:
+                yield dumps_event({
+                    "type": "thinking",
+                    "step": "EXEC",
+                    "message": f"{job.action} 执行中（已用 {int(time.time() - job.started_at)}s，请稍候…）",
+                })
+                continue
+            events: list[dict] = []
+            finished = False
+            for msg in batch:
+                if msg[0] == "progress_line":
+                    append_progress(events, msg[1], msg[2])
+                elif msg[0] == "progress_dropped":
+                    events.append({"type": "progress_dropped", "channel": msg[1], "count": msg[2]})
+                elif msg[0] == "queue":
+                    events.append({"type": "queue", **msg[1]})
+                elif msg[0] == "done":
+                    finished = True
+                    result = job.result(output=finished_before)
+                    events.append({"type": "terminal_lines", "lines": result.pop("terminal")})
+                    events.append({"type": "done", **result})
+                    break
+            if events:
+                yield encode_frame(events)
+            if finished:
+                break
+    finally:
+        job.events.unsubscribe(queue)
+        queue.close()
+
+
 @app.post("/api/execute_exploit")
 async def api_execute_exploit(request: Request) -> JSONResponse:
-    """人工确认后执行利用（如 sqlmap）。请求体: {"action": "sqlmap", "url": "http://..."}。"""
+    """人工确认后执行利用（如 sqlmap）。请求体: {"action": "sqlmap", "url": "http://...", "extra_args": "...", "force": false}。
+
+    默认等待执行结束后返回结果；"background": true 时立即返回 job_id，之后经 /api/exploit_jobs/{job_id}（/stream）获取。
+    """
     try:
         body = await request.json()
     except Exception:
         return JSONResponse(status_code=400, content={"ok": False, "error": "无效 JSON"})
-    action = (body.get("action") or "").strip().lower()
+    action, payload = _exploit_request(body)
     if action not in ("sqlmap",):
         return JSONResponse(status_code=400, content={"ok": False, "error": "仅支持 action: sqlmap"})
-    payload = body.get("payload") or body
-    code, out, err = run_dangerous_command(action, payload)
-    terminal = [
-        {"type": "cmd", "text": f"[EXPLOIT] {action} 已执行"},
-        {"type": "error" if code != 0 else "success", "text": err or out or f"退出码 {code}"},
-    ]
-    for line in (out or "").splitlines()[:50]:
-        if line.strip():
-            terminal.append({"type": "info", "text": line.strip()})
-    return JSONResponse(content={"ok": code == 0, "terminal": terminal, "exit_code": code})
+    job, created = _start_exploit_job(action, payload)
+    if body.get("background"):
+        return JSONResponse(content={
+            "ok": True, **job.status(), "shared": not created, "stream": f"/api/exploit_jobs/{job.job_id}/stream",
+        })
+    await job.wait()
+    return JSONResponse(content={**job.result(), "shared": not created})
+
+
+@app.post("/api/execute_exploit_stream")
+async def api_execute_exploit_stream(request: Request):
+    """人工确认后执行利用（流式）：后台启动任务，实时推送输出，结束时推送结果；客户端断开不影响任务。"""
+    try:
+        body = await request.json()
+    except Exception:
+        return JSONResponse(status_code=400, content={"error": "无效 JSON"})
+    action, payload = _exploit_request(body)
+    if action not in ("sqlmap",):
+        return JSONResponse(status_code=400, content={"error": "仅支持 action: sqlmap"})
+    job, created = _start_exploit_job(action, payload)
+    return StreamingResponse(
+        _stream_exploit_events(job, created),
+        media_type="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.get("/api/exploit_jobs")
+def api_exploit_jobs() -> JSONResponse:
+    """列出本进程进行中与最近结束的利用任务（新的在前）。"""
+    jobs = [job.status() for job in reversed(list(_exploit_jobs.values()))]
+    return JSONResponse(content={"ok": True, "jobs": jobs})
+
+
+@app.get("/api/exploit_jobs/{job_id}")
+def api_exploit_job(job_id: str) -> JSONResponse:
+    """利用任务的状态；已结束时附带结果（终端行、确认的注入点、进程资源消耗）。"""
+    job = _exploit_jobs.get(job_id)
+    if job is None:
+        return JSONResponse(status_code=404, content={"ok": False, "error": "未找到该利用任务"})
+    content = {"ok": True, **job.status()}
+    if job.done:
+        content["result"] = job.result()
+    return JSONResponse(content=content)
+
+
+@app.get("/api/exploit_jobs/{job_id}/stream")
+async def api_exploit_job_stream(job_id: str):
+    """重新接入利用任务的输出流（如刷新页面后）。"""
+    job = _exploit_jobs.get(job_id)
+    if job is None:
+        return JSONResponse(status_code=404, content={"error": "未找到该利用任务"})
+    return StreamingResponse(
+        _stream_exploit_events(job, created=False),
+        media_type="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 
 # Kali 工具列表（供前端展示与调用）
 KALI_TOOLS = [
     {"id": "nmap", "name": "Nmap", "desc": "端口/服务扫描", "params": [{"key": "target", "label": "目标", "placeholder": "192.168.1.1"}, {"key": "args", "label": "参数", "placeholder": "-sV -Pn"}]},
     {"id": "nikto", "name": "Nikto", "desc": "Web 服务器扫描", "params": [{"key": "url", "label": "URL", "placeholder": "http://target/"}]},
-    {"id": "dirb", "name": "Dirb", "desc": "目录枚举", "params": [{"key": "url", "label": "URL", "placeholder": "http://target/"}]},
-    {"id": "gobuster_dir", "name": "Gobuster Dir", "desc": "目录枚举", "params": [{"key": "url", "label": "URL", "placeholder": "http://target/"}]},
-    {"id": "gobuster_dns", "name": "Gobuster DNS", "desc": "子域名枚举", "params": [{"key": "domain", "label": "域名", "placeholder": "example.com"}]},
+    {"id": "dirb", "name": "Dirb", "desc": "目录枚举", "params": [{"key": "url", "label": "URL", "placeholder": "http://target/"}, {"key": "wordlist", "label": "字典", "placeholder": "/usr/share/wordlists/dirb/common.txt"}, {"key": "shards", "label": "分片数", "placeholder": "4"}, {"key": "rate_limit", "label": "限速(次/秒)", "placeholder": "0 不限速"}]},
+    {"id": "gobuster_dir", "name": "Gobuster Dir", "desc": "目录枚举", "params": [{"key": "url", "label": "URL", "placeholder": "http://target/"}, {"key": "wordlist", "label": "字典", "placeholder": "/usr/share/wordlists/dirb/common.txt"}, {"key": "shards", "label": "分片数", "placeholder": "4"}, {"key": "rate_limit", "label": "限速(次/秒)", "placeholder": "0 不限速"}]},
+    {"id": "gobuster_dns", "name": "Gobuster DNS", "desc": "子域名枚举", "params": [{"key": "domain", "label": "域名", "placeholder": "example.com"}, {"key": "wordlist", "label": "字典", "placeholder": "/usr/share/wordlists/dirb/common.txt"}, {"key": "shards", "label": "分片数", "placeholder": "4"}, {"key": "rate_limit", "label": "限速(次/秒)", "placeholder": "0 不限速"}]},
     {"id": "whatweb", "name": "Whatweb", "desc": "Web 技术指纹", "params": [{"key": "url", "label": "URL", "placeholder": "http://target/"}]},
     {"id": "whois", "name": "Whois", "desc": "域名信息", "params": [{"key": "domain", "label": "域名", "placeholder": "example.com"}]},
     {"id": "ping", "name": "Ping", "desc": "连通性测试", "params": [{"key": "host", "label": "主机", "placeholder": "192.168.1.1"}]},
     {"id": "curl", "name": "Curl", "desc": "HTTP 请求", "params": [{"key": "url", "label": "URL", "placeholder": "http://target/"}, {"key": "method", "label": "方法", "placeholder": "GET"}]},
     {"id": "searchsploit", "name": "Searchsploit", "desc": "漏洞库搜索", "params": [{"key": "keyword", "label": "关键词", "placeholder": "apache 2.4"}]},
-    {"id": "hydra", "name": "Hydra", "desc": "暴力破解", "params": [{"key": "target", "label": "目标", "placeholder": "192.168.1.1"}, {"key": "service", "label": "服务", "placeholder": "ssh"}, {"key": "user", "label": "用户", "placeholder": "root"}, {"key": "passlist", "label": "密码字典", "placeholder": "/usr/share/wordlists/rockyou.txt"}]},
+    {"id": "hydra", "name": "Hydra", "desc": "暴力破解", "params": [{"key": "target", "label": "目标", "placeholder": "192.168.1.1"}, {"key": "service", "label": "服务", "placeholder": "ssh"}, {"key": "user", "label": "用户", "placeholder": "root"}, {"key": "passlist", "label": "密码字典", "placeholder": "/usr/share/wordlists/rockyou.txt"}, {"key": "workers", "label": "分区数", "placeholder": "4"}, {"key": "tasks", "label": "每进程任务数", "placeholder": "4"}]},
 ]
 
 
@@ -346,7 +981,11 @@ async def api_tool_run(request: Request) -> JSONResponse:
     params = body.get("params") or {}
     if not tool_id:
         return JSONResponse(status_code=400, content={"ok": False, "error": "缺少 tool"})
-    code, out, err = run_tool(tool_id, params)
+    (code, out, err), processes = await asyncio.to_thread(_run_interactive, run_tool, tool_id, params)
+    await asyncio.to_thread(
+        _record_run, "tool", tool_id, params, code, out, err,
+        engagement=(body.get("engagement") or "").strip(), processes=processes,
+    )
     terminal = [
         {"type": "cmd", "text": f"[Kali] {tool_id} 执行"},
         {"type": "error" if code != 0 else "success", "text": (err or out or f"退出码 {code}")[:500]},
@@ -354,7 +993,129 @@ async def api_tool_run(request: Request) -> JSONResponse:
     for line in (out or "").splitlines()[:80]:
         if line.strip():
             terminal.append({"type": "info", "text": line.strip()})
-    return JSONResponse(content={"ok": code == 0, "terminal": terminal, "exit_code": code})
+    terminal.extend(build_process_lines(processes, channel="exec"))
+    return JSONResponse(content={
+        "ok": code == 0, "terminal": terminal, "exit_code": code,
+        "processes": processes, "resources": total_usage(processes),
+    })
+
+
+def _int_param(request: Request, name: str) -> int | None:
+    raw = (request.query_params.get(name) or "").strip()
+    return int(raw) if raw.isdigit() else None
+
+
+@app.get("/api/db/engagements")
+def api_db_engagements() -> JSONResponse:
+    """列出渗透记录库中的项目及其主机数、运行次数。"""
+    return JSONResponse(content={"ok": True, "engagements": get_engagement_db().list_engagements()})
+
+
+@app.get("/api/db/hosts")
+def api_db_hosts(request: Request) -> JSONResponse:
+    """按端口/服务查主机，例：/api/db/hosts?port=445 或 ?service=ssh&engagement=lab。"""
+    q = request.query_params
+    hosts = get_engagement_db().query_hosts(
+        port=_int_param(request, "port"),
+        state=q.get("state", "open"),
+        service=q.get("service", ""),
+        engagement=q.get("engagement", ""),
+        limit=_int_param(request, "limit") or 1000,
+    )
+    return JSONResponse(content={"ok": True, "count": len(hosts), "hosts": hosts})
+
+
+@app.get("/api/db/services")
+def api_db_services(request: Request) -> JSONResponse:
+    """按产品/版本/端口查服务，例：/api/db/services?product=Apache&version=2.4.x。"""
+    q = request.query_params
+    rows = get_engagement_db().query_services(
+        port=_int_param(request, "port"),
+        protocol=q.get("protocol", ""),
+        state=q.get("state", "open"),
+        service=q.get("service", ""),
+        product=q.get("product", ""),
+        version=q.get("version", ""),
+        address=q.get("address", ""),
+        engagement=q.get("engagement", ""),
+        limit=_int_param(request, "limit") or 1000,
+    )
+    return JSONResponse(content={"ok": True, "count": len(rows), "services": rows})
+
+
+@app.get("/api/db/findings")
+def api_db_findings(request: Request) -> JSONResponse:
+    """查询发现（LLM 分析、决策、工具输出等），可按 source / address / engagement 过滤。"""
+    q = request.query_params
+    rows = get_engagement_db().query_findings(
+        source=q.get("source", ""),
+        address=q.get("address", ""),
+        engagement=q.get("engagement", ""),
+        limit=_int_param(request, "limit") or 200,
+    )
+    return JSONResponse(content={"ok": True, "count": len(rows), "findings": rows})
+
+
+@app.get("/api/db/tool_costs")
+def api_db_tool_costs(request: Request) -> JSONResponse:
+    """按外部命令汇总资源消耗（次数、用时、CPU、峰值内存、I/O），例：/api/db/tool_costs?command=nmap&engagement=lab。"""
+    q = request.query_params
+    try:
+        since = float(q.get("since") or 0)
+    except ValueError:
+        since = 0.0
+    rows = get_engagement_db().tool_costs(
+        engagement=q.get("engagement", ""),
+        command=q.get("command", ""),
+        since=since,
+    )
+    return JSONResponse(content={"ok": True, "count": len(rows), "tools": rows})
+
+
+@app.get("/api/db/sqlmap")
+def api_db_sqlmap(request: Request) -> JSONResponse:
+    """按 URL / 参数查 sqlmap 测试结果，例：/api/db/sqlmap?url=http://t/item.php&injectable=1。"""
+    q = request.query_params
+    injectable = q.get("injectable", "")
+    rows = get_engagement_db().query_sqlmap_results(
+        url=normalize_url(q["url"]) if q.get("url") else "",
+        parameter=q.get("parameter", ""),
+        engagement=q.get("engagement", ""),
+        injectable=None if injectable == "" else injectable.lower() in ("1", "true", "yes"),
+        limit=_int_param(request, "limit") or 1000,
+    )
+    return JSONResponse(content={"ok": True, "count": len(rows), "results": rows})
+
+
+@app.post("/api/exploits/match")
+async def api_exploits_match(request: Request) -> JSONResponse:
+    """批量匹配服务版本与 Exploit-DB。请求体: {"services": [{"product": "OpenSSH", "version": "7.4"}]}
+    或 {"recon": "<nmap 输出>"}（从扫描结果中提取开放服务）。"""
+    try:
+        body = await request.json()
+    except Exception:
+        return JSONResponse(status_code=400, content={"ok": False, "error": "无效 JSON"})
+    from tools.exploitdb import get_exploit_index, services_from_hosts
+    from tools.scanning import parse_nmap_output
+
+    index = get_exploit_index()
+    if not index.available:
+        return JSONResponse(
+            status_code=503,
+            content={"ok": False, "error": f"未找到 Exploit-DB 数据：{index.csv_path}"},
+        )
+    services = [
+        (str(s.get("product") or ""), str(s.get("version") or ""))
+        for s in (body.get("services") or [])
+        if isinstance(s, dict)
+    ]
+    if body.get("recon"):
+        services.extend(services_from_hosts(parse_nmap_output(str(body["recon"]))))
+    if not services:
+        return JSONResponse(status_code=400, content={"ok": False, "error": "缺少 services 或 recon"})
+    limit = _int_param(request, "limit") or 20
+    matches = index.match_services(services, limit=limit)
+    return JSONResponse(content={"ok": True, "count": len(matches), "matches": matches})
 
 
 @app.get("/", response_class=HTMLResponse)
@@ -374,7 +1135,7 @@ def index(request: Request) -> HTMLResponse:
 
 
 @app.post("/", response_class=HTMLResponse)
-def run_scan(
+async def run_scan(
     request: Request,
     goal: str = Form(..., description="渗透目标描述"),
     target: str = Form(..., description="扫描目标 IP/网段"),
@@ -393,10 +1154,12 @@ def run_scan(
         error = "Target 不能为空，请提供要扫描的 IP 或网段。"
     else:
         try:
-            agent = get_agent()
-            final_state = agent.invoke(
-                {"goal": goal, "target": target, "nmap_arguments": nmap_arguments}
-            )
+            agent = await aget_agent()
+            with track_processes() as runs:
+                final_state = await agent.ainvoke(
+                    {"goal": goal, "target": target, "nmap_arguments": nmap_arguments}
+                )
+            await asyncio.to_thread(_record_run, "agent", final_state, processes=[r.summary() for r in runs])
         except Exception as exc:  # noqa: BLE001
             error = f"执行 Agent 时发生错误：{exc}"
     return templates.TemplateResponse(
@@ -441,7 +1204,7 @@ def settings_save(
         llm_provider = "deepseek"
     api_key = api_key.strip()
     sandbox_mode = (sandbox_mode or "local").strip().lower()
-    if sandbox_mode not in ("local", "docker"):
+    if sandbox_mode not in SANDBOX_MODES:
         sandbox_mode = "local"
 
     runtime = load_runtime_settings()
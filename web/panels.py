@@ -0,0 +1,102 @@
+"""按会话维护的版本化数据窗口状态：每次只推送变化的字段。
+
+build_panels 每次生成完整的数据窗口（报告全文、端口、跟踪等），其中大部分与上次相同。
+这里为每个会话（前端标签页）保存上次推送的内容与版本号，新内容与之比较后只返回增量：
+
+    {"version": 新版本, "base": 基准版本, "set": {变化的字段}, "patch": {长文本字段的片段替换}, "remove": [删除的字段]}
+
+patch 为 {"p": 公共前缀长度, "s": 公共后缀长度, "t": 中间的新文本}，前端用
+old[:p] + t + old[len(old) - s:] 还原。客户端的版本与服务端不一致（新标签页、服务重启、
+并发任务乱序）时返回 "full": true 的完整快照，客户端也可用 GET /api/panels 主动取快照。
+状态存于共享状态后端（core/state.py 的 "panels" 命名空间），多 worker 进程部署时版本号全局一致。
+"""
+
+from __future__ import annotations
+
+import os
+from typing import Any, Optional
+
+from core.state import StateBackend, get_state_backend
+
+# 短文本直接整段替换，片段替换只用于更长的字段
+_PATCH_MIN_CHARS = 256
+
+
+def _text_patch(old: str, new: str) -> Optional[dict[str, Any]]:
+    """长文本的片段替换；比整段发送省不了多少时返回 None。"""
+    if len(new) < _PATCH_MIN_CHARS:
+        return None
+    # 前端按 UTF-16 下标切片，含 BMP 以外字符（如 emoji）时下标对不上，整段发送
+    if any(ord(c) > 0xFFFF for c in old) or any(ord(c) > 0xFFFF for c in new):
+        return None
+    p = len(os.path.commonprefix([old, new]))
+    limit = min(len(old), len(new)) - p
+    s = 0
+    while s < limit and old[-1 - s] == new[-1 - s]:
+        s += 1
+    middle = new[p:len(new) - s]
+    if len(middle) * 2 > len(new):
+        return None
+    return {"p": p, "s": s, "t": middle}
+
+
+class PanelStore:
+    """会话 → {"version": 版本号, "panels": 上次推送的数据窗口}，读-改-写由后端保证原子性。"""
+
+    NAMESPACE = "panels"
+
+    def __init__(self, backend: Optional[StateBackend] = None) -> None:
+        self.backend = backend or get_state_backend()
+
+    def snapshot(self, session: str) -> dict[str, Any]:
+        """会话当前的完整数据窗口与版本号（未知会话为版本 0 的空快照）。"""
+        entry = self.backend.get(self.NAMESPACE, session)
+        if entry is None:
+            return {"version": 0, "panels": {}}
+        return {"version": entry["version"], "panels": dict(entry["panels"])}
+
+    def update(self, session: str, panels: dict[str, Any], base_version: Optional[int] = None) -> dict[str, Any]:
+        """记录会话的新数据窗口，返回相对 base_version 的增量；base_version 与服务端不一致时返回完整快照。"""
+        out: dict[str, Any] = {}
+
+        def _apply(entry: Optional[dict[str, Any]]) -> dict[str, Any]:
+            entry = entry or {"version": 0, "panels": {}}
+            old = entry["panels"]
+            full = base_version is None or base_version != entry["version"]
+            changed: dict[str, Any] = {}
+            patch: dict[str, Any] = {}
+            for key, value in panels.items():
+                if key in old and old[key] == value:
+                    continue
+                text_patch = None
+                if not full and isinstance(value, str) and isinstance(old.get(key), str):
+                    text_patch = _text_patch(old[key], value)
+                if text_patch is not None:
+                    patch[key] = text_patch
+                else:
+                    changed[key] = value
+            removed = [key for key in old if key not in panels]
+            base = entry["version"]
+            version = base + 1 if changed or patch or removed else base
+            if full:
+                out.update(version=version, full=True, set=dict(panels))
+            else:
+                out.update(version=version, base=base)
+                if changed:
+                    out["set"] = changed
+                if patch:
+                    out["patch"] = patch
+                if removed:
+                    out["remove"] = removed
+            return {"version": version, "panels": dict(panels)}
+
+        self.backend.update(self.NAMESPACE, session, _apply)
+        return out
+
+
+def get_panel_store() -> PanelStore:
+    """基于当前状态后端的数据窗口状态。"""
+    return PanelStore(get_state_backend())
+
+
+__all__ = ["PanelStore", "get_panel_store"]
@@ -0,0 +1,64 @@
+"""NDJSON 流式事件编码：按时间窗口合帧，减少小块写入与前端重绘。"""
+
+from __future__ import annotations
+
+import asyncio
+import json
+from typing import Any, Iterable
+
+try:  # 可选依赖：orjson 更快，且默认输出 UTF-8（等价于 ensure_ascii=False）
+    import orjson
+except ImportError:  # pragma: no cover - 未安装时回退到标准库
+    orjson = None  # type: ignore[assignment]
+
+
+def dumps_event(event: dict[str, Any]) -> str:
+    """把单个事件编码为一行 NDJSON（含结尾换行）。"""
+    if orjson is not None:
+        return orjson.dumps(event).decode("utf-8") + "\n"
+    return json.dumps(event, ensure_ascii=False) + "\n"
+
+
+def encode_frame(events: Iterable[dict[str, Any]]) -> str:
+    """把一帧内的多个事件编码为一个写入块。"""
+    return "".join(dumps_event(e) for e in events)
+
+
+async def read_frame(
+    queue: asyncio.Queue,
+    timeout: float,
+    interval: float = 0.05,
+    max_events: int = 200,
+) -> list[tuple]:
+    """等待第一条消息（最多 timeout 秒，超时抛 asyncio.TimeoutError），
+    之后在 interval 秒窗口内继续收集，最多 max_events 条；遇到 ("done",) 立即结束本帧。"""
+    first = await asyncio.wait_for(queue.get(), timeout=timeout)
+    batch = [first]
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + interval
+    while len(batch) < max_events and batch[-1][0] != "done":
+        try:
+            batch.append(queue.get_nowait())
+            continue
+        except asyncio.QueueEmpty:
+            pass
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            break
+        try:
+            batch.append(await asyncio.wait_for(queue.get(), timeout=remaining))
+        except asyncio.TimeoutError:
+            break
+    return batch
+
+
+def append_progress(events: list[dict[str, Any]], channel: str, line: str) -> None:
+    """把一行进度并入事件列表：与上一条同通道的 progress 事件合并为 lines 数组。"""
+    last = events[-1] if events else None
+    if last is not None and last.get("type") == "progress" and last.get("channel") == channel:
+        last["lines"].append(line)
+        return
+    events.append({"type": "progress", "channel": channel, "lines": [line]})
+
+
+__all__ = ["append_progress", "dumps_event", "encode_frame", "read_frame"]